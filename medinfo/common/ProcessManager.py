@@ -21,44 +21,60 @@ class ProcessManager:
         self.processCount = 0
         self.completedProcessCount = 0
         self.completed = False
+        self.pendingArgvList = list();  # Commands not yet started
+        self.runningProcesses = list(); # (index, Popen) for commands currently running
+        self.returnCodes = list();      # Exit status for each command, in order of the original argv list
 
     def parseArgList(self, argvList):
-        # initiate self.processCount
-        pass
-
-    def update(self, argvList):
-        # poll
-        # update globals
-        pass
-
-
-    def batchProcess(self, argvList, numParallel=1):
+        """Reset tracking state for a new list of argv command lists to run"""
+        self.pendingArgvList = [(index, list(argv)) for index, argv in enumerate(argvList)];
+        self.runningProcesses = list();
+        self.returnCodes = [None] * len(argvList);
+        self.processCount = len(argvList);
+        self.completedProcessCount = 0;
+        self.availableThreads = self.parallelProcessCount;
+        self.completed = (self.processCount == 0);
+        return self.pendingArgvList;
+
+    def update(self):
+        """Poll running processes and update tracking for any that have completed"""
+        stillRunning = list();
+        for (index, process) in self.runningProcesses:
+            returnCode = process.poll();
+            if returnCode is None:
+                stillRunning.append( (index, process) );
+            else:
+                self.returnCodes[index] = returnCode;
+                self.completedProcessCount += 1;
+                log.info("Completed process %d (%d of %d) with exit status %s" % (process.pid, self.completedProcessCount, self.processCount, returnCode) );
+        self.runningProcesses = stillRunning;
+        self.availableThreads = self.parallelProcessCount - len(self.runningProcesses);
+        self.completed = (self.completedProcessCount >= self.processCount);
+
+    def batchProcess(self, argvList, numParallel=1, interval=1):
         """Given a list of argv command string lists, spawn
         subprocesses to run each argv as if run from the command-line.
         Option to specify running multiple processes in parallel, and
         only continuing to spawn more as previous processes complete.
-        """
-        commandStringList = self.parseArgList(argvList);
-
-        #############???????????????##############
-        """See scripts/CDSS/assocAnalysis.py for example.
-        Top part is just nested loops to generate lists of argv parameters.
-        Bottom section is part to reproduce/generalize so will run all given argv,
-        but should create subprocess.Popen objects instead so can print out Popen.pid as
-        part of progress log, and allow for multiple processes running in parallel.
-        I believe you can do something like Popen.poll() to check if a current subprocess
-        is still running or if it's completed.
-        """
-
-        while(processesRemain):
-            self.update()
-            if self.completed:
-                print "All processes have completed.\n"
-                break
-            if availableThreads > 0:
-                # run an unprocessed command string
-                pass
+        Polls for completed processes every interval seconds.
 
+        Returns list of exit status codes in the same order as the argvList.
+        """
+        self.parallelProcessCount = numParallel;
+        self.parseArgList(argvList);
+
+        while not self.completed:
+            # Start as many pending commands as there are available slots for
+            while self.availableThreads > 0 and self.pendingArgvList:
+                (index, argv) = self.pendingArgvList.pop(0);
+                process = subprocess.Popen(argv);
+                log.info("Started process %d: %s" % (process.pid, str.join(" ", argv)) );
+                self.runningProcesses.append( (index, process) );
+                self.availableThreads -= 1;
+            time.sleep(interval);
+            self.update();
+        log.info("All %d processes have completed" % self.processCount );
+        return self.returnCodes;
 
     def main(self, argv):
         """Main method, callable from command line"""
@@ -2,8 +2,11 @@
 import sys;
 from math import log;
 from math import sqrt, exp, log as ln;
+import numpy as np;
 from scipy.stats import chi2_contingency;
 from scipy.stats import fisher_exact;
+from scipy.stats import chi2 as chi2_distribution;
+from scipy.stats import hypergeom;
 
 """Count values less than this in the contingency stats table will be considered degenerate and needing normalization.
 Will correct such values by the given adjustment value.
@@ -306,6 +309,358 @@ class ContingencyStats:
         """Short-hand for access calc function"""
         return self.calc(key);
 
+class ContingencyStatsArray:
+    """Array counterpart of ContingencyStats.
+    Given NumPy vectors (or scalars to broadcast) of nAB, nA, nB, N for many candidates at once
+    (e.g., every item a recommender is scoring), calculate each of the same statistics
+    for all of them in whole array operations instead of one ContingencyStats object per candidate.
+
+    calc(statId) accepts the same statIds and returns an array of the values
+    ContingencyStats.calc would return for each element, including the default values
+    when a p-value cannot be calculated (e.g., negative table values).
+    Where the scalar calculation would raise an error instead (e.g., divide by zero), the element is inf or nan.
+    """
+    def __init__(self, nAB, nA, nB, N):
+        """Setup 2x2 tables based on occurrence totals, as in ContingencyStats"""
+        (nAB, nA, nB, N) = np.broadcast_arrays( *[np.atleast_1d(np.asarray(value, dtype=np.float64)) for value in (nAB, nA, nB, N)] );
+        self.nAB = nAB;
+        self.nA = nA;
+        self.nB = nB;
+        self.N = N;
+
+        self.ct = [ [None,None], [None,None] ];
+        self.ct[0][0] = nAB.copy();
+        self.ct[0][1] = nA-nAB;
+        self.ct[1][0] = nB-nAB;
+        self.ct[1][1] = N-nA-nB+nAB;
+
+    def __len__(self):
+        return self.nAB.size;
+
+    def normalize(self,truncateNegativeValues=False):
+        """Same adjustments as ContingencyStats.normalize, applied to each table"""
+        ct = self.ct;
+        if truncateNegativeValues:
+            for i in (0,1):
+                for j in (0,1):
+                    ct[i][j][ct[i][j] < 0.0] = 0.0;
+
+        # Tables with any zero values get a small delta value added to ALL of their fields
+        hasDegenerateValues = np.zeros(ct[0][0].shape, dtype=bool);
+        for i in (0,1):
+            for j in (0,1):
+                hasDegenerateValues |= (np.abs(ct[i][j]) <= DEGENERATE_VALUE_THRESHOLD);
+        for i in (0,1):
+            for j in (0,1):
+                isDegenerateValue = (np.abs(ct[i][j]) <= DEGENERATE_VALUE_THRESHOLD);
+                ct[i][j] = np.where( isDegenerateValue, DEGENERATE_VALUE_ADJUSTMENT, np.where(hasDegenerateValues, ct[i][j]+DEGENERATE_VALUE_ADJUSTMENT, ct[i][j]) );
+
+    def calc(self, statId):
+        """Return an array of the calculated statistic by an identifying name"""
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            return self._calc(statId);
+
+    def _calc(self, statId):
+        # Same order of checks as ContingencyStats.calc, so statIds resolve identically
+        ct = self.ct;   # Short-hand convenience
+        nAB = self.nAB;
+        nA = self.nA;
+        nB = self.nB;
+        N = self.N;
+
+        if statId in ("total","N"):
+            return N;
+
+        elif statId in ("nA",):
+            return nA;
+
+        elif statId in ("nB",):
+            return nB;
+
+        elif statId in ("nAB","support",):
+            return ct[0][0];
+
+        elif statId in ("P(A)",):
+            return self["nA"] / self["total"];
+
+        elif statId in ("P(!A)",):
+            return 1-self["P(A)"];
+
+        elif statId in ("P(B)","prevalence","preTestProbability","baselineFreq"):
+            return self["nB"] / self["total"];
+
+        elif statId in ("SE(prevalence)"):
+            return np.sqrt( (self["prevalence"]*(1-self["prevalence"]))/self["total"] );
+
+        elif statId in ("prevalence95CILow"):
+            return self["prevalence"] - 1.96*self["SE(prevalence)"]
+
+        elif statId in ("prevalence95CIHigh"):
+            return self["prevalence"] + 1.96*self["SE(prevalence)"]
+
+        elif statId in ("P(!B)",):
+            return 1-self["P(B)"];
+
+        elif statId in ("P(AB)",):
+            return self["nAB"] / self["total"];
+
+        elif statId in ("P(B|A)","positivePredictiveValue","PPV","precision","postTestProbability","confidence","conditionalFreq","truePositiveAccuracy"):
+            # Fall back to original values that may have been very small and suppressed to 0 by loss of numerical precision
+            return np.where( ct[0][0]+ct[0][1] == 0.0, nAB / nA, ct[0][0] / (ct[0][0]+ct[0][1]) );
+
+        elif statId in ("SE(PPV)"):
+            return np.sqrt( (self["PPV"]*(1-self["PPV"]))/(ct[0][0]+ct[0][1]) );
+
+        elif statId in ("PPV95CILow"):
+            return self["PPV"] - 1.96*self["SE(PPV)"]
+
+        elif statId in ("PPV95CIHigh"):
+            return self["PPV"] + 1.96*self["SE(PPV)"]
+
+        elif statId in ("P(!B|A)",):
+            return 1-self["P(B|A)"];
+
+        elif statId in ("P(B|!A)",):
+            return ct[1][0] / (ct[1][0]+ct[1][1]);
+
+        elif statId in ("P(!B|!A)","negativePredictiveValue","NPV","inversePrecision","trueNegativeAccuracy"):
+            return 1-self["P(B|!A)"];
+
+        elif statId in ("P(A|B)","truePositiveRate","TPR","sensitivity","sens","recall"):
+            return ct[0][0] / (ct[0][0]+ct[1][0]);
+
+        elif statId in ("P(!A|B)","falseNegativeRate","FNR","missRate"):
+            return 1-self["P(A|B)"];
+
+        elif statId in ("P(A|!B)","falsePositiveRate","FPR","fallout"):
+            return ct[0][1] / (ct[0][1]+ct[1][1]);
+
+        elif statId in ("P(!A|!B)","trueNegativeRate","TNR","specificity","spec","inverseRecall"):
+            return 1-self["P(A|!B)"];
+
+        elif statId in ("F1","F1-score"):
+            precision = self["precision"];
+            recall = self["recall"];
+            return np.where( precision+recall == 0.0, 0.0, 2*precision*recall / (precision+recall) );
+
+        elif statId in ("positiveLikelihoodRatio","+LR","LR+","LR"):
+            return self["P(A|B)"] / self["P(A|!B)"];
+
+        elif statId in ("negativeLikelihoodRatio","-LR","LR-"):
+            return self["P(!A|B)"] / self["P(!A|!B)"];
+
+        elif statId in ("oddsRatio","OR"):
+            return (ct[0][0]/ct[0][1]) / (ct[1][0]/ct[1][1]);
+
+        elif statId in ("SE(ln(OR))"):
+            return np.sqrt(1/ct[0][0] + 1/ct[0][1] + 1/ct[1][0] + 1/ct[1][1]);
+
+        elif statId in ("oddsRatio95CILow","OR95CILow"):
+            return np.exp( np.log(self["OR"]) - 1.96*self["SE(ln(OR))"] );
+
+        elif statId in ("oddsRatio95CIHigh","OR95CIHigh"):
+            return np.exp( np.log(self["OR"]) + 1.96*self["SE(ln(OR))"] );
+
+        elif statId in ("relativeRisk","RR"):
+            return self["P(B|A)"] / self["P(B|!A)"];
+
+        elif statId in ("SE(ln(RR))"):
+            return np.sqrt(1/ct[0][0] + 1/ct[1][0] + 1/(ct[0][0]+ct[0][1]) + 1/(ct[1][0]+ct[1][1]) );
+
+        elif statId in ("relativeRisk95CILow","RR95CILow"):
+            return np.exp( np.log(self["RR"]) - 1.96*self["SE(ln(RR))"] );
+
+        elif statId in ("relativeRisk95CIHigh","RR95CIHigh"):
+            return np.exp( np.log(self["RR"]) + 1.96*self["SE(ln(RR))"] );
+
+        elif statId in ("interest","freqRatio","TF*IDF","tfidf","lift","P(B|A)/P(B)"):
+            return self["P(B|A)"] / self["P(B)"];
+
+        elif statId in ("YatesChi2",):
+            (chi2, chi2P, isValid) = self.chi2Contingency(True);
+            return np.where(isValid, chi2, 0.0);
+
+        elif statId in ("P-YatesChi2",):
+            (chi2, chi2P, isValid) = self.chi2Contingency(True);
+            return np.where(isValid, chi2P, 1.0);
+
+        elif statId in ("P-YatesChi2-NegLog",):
+            (chi2, chi2P, isValid) = self.chi2Contingency(True);
+            return np.where(isValid, self.signedNegLog(chi2P, self["OR"]), 0.0);
+
+        elif statId in ("P-Chi2",):
+            (chi2, chi2P, isValid) = self.chi2Contingency(False);
+            return np.where(isValid, chi2P, 1.0);
+
+        elif statId in ("P-Chi2-NegLog",):
+            (chi2, chi2P, isValid) = self.chi2Contingency(False);
+            return np.where(isValid, self.signedNegLog(chi2P, self["OR"]), 0.0);
+
+        elif statId in ("P-Fisher",):
+            (oddsRatio, fisherP, isValid) = self.fisherExact();
+            return np.where(isValid, fisherP, 1.0);
+
+        elif statId in ("P-Fisher-Complement",):
+            (oddsRatio, fisherP, isValid) = self.fisherExact();
+            return np.where(isValid, np.where(oddsRatio > 1.0, 1-fisherP, fisherP-1), 0.0);
+
+        elif statId in ("P-Fisher-NegLog",):
+            (oddsRatio, fisherP, isValid) = self.fisherExact();
+            return np.where(isValid, self.signedNegLog(fisherP, oddsRatio), 0.0);
+        else:
+            raise UnrecognizedStatException("Unrecognized statistic ID: [%s]" % statId );
+
+    def __getitem__(self, key):
+        """Short-hand for access calc function"""
+        return self.calc(key);
+
+    def signedNegLog(self, pValues, oddsRatios):
+        """log10 of the p-values, negated for positive associations (oddsRatio > 1),
+        so sorting in descending order brings the most significant positive associations to the top
+        """
+        logP = np.empty(pValues.shape);
+        logP.fill(-sys.float_info.max);
+        isPositive = (pValues > 0.0);
+        logP[isPositive] = np.log(pValues[isPositive]) / ln(10);    # Same as math.log(p,10)
+        return np.where(oddsRatios > 1.0, -logP, logP);
+
+    def chi2Contingency(self, correction):
+        """Chi-square test of independence for each table, as scipy.stats.chi2_contingency does for one.
+        Return (chi2, p, isValid) arrays, where isValid is False for tables chi2_contingency would reject
+        (negative values or a zero expected frequency), with meaningless chi2 and p values for those.
+        """
+        ct = self.ct;
+        observed = [ct[0][0], ct[0][1], ct[1][0], ct[1][1]];
+        rowSums = [ct[0][0]+ct[0][1], ct[1][0]+ct[1][1]];
+        colSums = [ct[0][0]+ct[1][0], ct[0][1]+ct[1][1]];
+        total = ct[0][0]+ct[0][1]+ct[1][0]+ct[1][1];
+        expected = [rowSums[0]*colSums[0]/total, rowSums[0]*colSums[1]/total, rowSums[1]*colSums[0]/total, rowSums[1]*colSums[1]/total];
+
+        isValid = np.ones(total.shape, dtype=bool);
+        for iCell in xrange(4):
+            isValid &= (observed[iCell] >= 0) & (expected[iCell] != 0);
+
+        chi2 = np.zeros(total.shape);
+        for iCell in xrange(4):
+            cellObserved = observed[iCell];
+            if correction:  # Yates' correction for continuity
+                cellObserved = cellObserved + 0.5*np.sign(expected[iCell] - cellObserved);
+            chi2 += (cellObserved - expected[iCell])**2 / expected[iCell];
+        chi2P = chi2_distribution.sf(chi2, 1);
+        return (chi2, chi2P, isValid);
+
+    def fisherExact(self):
+        """Two-sided Fisher exact test for each table, as scipy.stats.fisher_exact does for one
+        (including its truncation of table values to integers).
+        Return (oddsRatio, p, isValid) arrays, where isValid is False for tables with negative values.
+
+        The p-value sums the hypergeometric probabilities of the observed table and all tables
+        no more probable than it.  The cut-off on the other side of the distribution mode
+        is located by a bisection over all of the tables at once.
+        """
+        ct = self.ct;
+        c = [ [ np.trunc(ct[i][j]).astype(np.int64) for j in (0,1) ] for i in (0,1) ];
+        shape = c[0][0].shape;
+
+        isValid = (c[0][0] >= 0) & (c[0][1] >= 0) & (c[1][0] >= 0) & (c[1][1] >= 0);
+        hasEmptyMargin = (c[0][0]+c[0][1] == 0) | (c[1][0]+c[1][1] == 0) | (c[0][0]+c[1][0] == 0) | (c[0][1]+c[1][1] == 0);
+
+        oddsRatio = np.where( (c[1][0] > 0) & (c[0][1] > 0), (c[0][0]*c[1][1]).astype(np.float64) / (c[1][0]*c[0][1]), np.inf );
+        oddsRatio[hasEmptyMargin] = np.nan;
+
+        pValue = np.ones(shape);
+        isTested = isValid & ~hasEmptyMargin;
+        if not np.any(isTested):
+            return (oddsRatio, pValue, isValid);
+
+        x = c[0][0][isTested];
+        n1 = (c[0][0]+c[0][1])[isTested];
+        n2 = (c[1][0]+c[1][1])[isTested];
+        n = (c[0][0]+c[1][0])[isTested];
+        M = n1+n2;
+        pmf = lambda k: hypergeom.pmf(k, M, n1, n);
+
+        mode = ((n+1)*(n1+1)) // (n1+n2+2);
+        pexact = pmf(x);
+        pmode = pmf(mode);
+        epsilon = 1 - 1e-4;
+
+        testedP = np.ones(len(x));
+        isModal = ( np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= 1 - epsilon );
+
+        # Observed table below the mode, add the upper tail starting where probabilities drop back down to the observed one
+        isLower = ~isModal & (x < mode);
+        testedP[isLower] = self.fisherTwoSidedP( x[isLower], mode[isLower], pexact[isLower], M[isLower], n1[isLower], n[isLower], "upper" );
+
+        # Observed table above the mode, add the lower tail
+        isUpper = ~isModal & (x >= mode);
+        testedP[isUpper] = self.fisherTwoSidedP( x[isUpper], mode[isUpper], pexact[isUpper], M[isUpper], n1[isUpper], n[isUpper], "lower" );
+
+        pValue[isTested] = np.minimum(testedP, 1.0);
+        return (oddsRatio, pValue, isValid);
+
+    def fisherTwoSidedP(self, x, mode, pexact, M, n1, n, otherSide):
+        """Fisher p-values for tables observed on one side of the mode,
+        adding the tail of tables on the otherSide ("upper" or "lower") of the mode
+        that are no more probable than the observed ones.
+        """
+        epsilon = 1 - 1e-4;
+        zeros = np.zeros(len(x), dtype=np.int64);
+        if otherSide == "upper":
+            pValue = self.hypergeomTail(hypergeom.cdf, x, M, n1, n);
+            isTwoSided = ~(hypergeom.pmf(n, M, n1, n) > pexact / epsilon);
+            (low, high) = (mode, n);
+        else:
+            pValue = self.hypergeomTail(hypergeom.sf, x-1, M, n1, n);
+            isTwoSided = ~(hypergeom.pmf(zeros, M, n1, n) > pexact / epsilon);
+            (low, high) = (zeros, mode);
+        if not np.any(isTwoSided):
+            return pValue;
+
+        (low, high, pexact, M, n1, n) = [ values[isTwoSided] for values in (low, high, pexact, M, n1, n) ];
+        pmf = lambda k: hypergeom.pmf(k, M, n1, n);
+
+        # Bisection for every table at once to find where the probabilities on the other side drop to the observed one
+        while np.any(high - low > 1):
+            mid = (low + high) // 2;
+            isNotMoreProbable = (pmf(mid) <= pexact);
+            if otherSide == "upper":
+                (low, high) = ( np.where(isNotMoreProbable, low, mid), np.where(isNotMoreProbable, mid, high) );
+            else:
+                (low, high) = ( np.where(isNotMoreProbable, mid, low), np.where(isNotMoreProbable, high, mid) );
+
+        # Same floating point tolerance adjustments fisher_exact makes to its search result
+        if otherSide == "upper":
+            guess = high;
+            step = (guess > 0) & (pmf(guess) < pexact * epsilon);
+            while np.any(step):
+                guess = guess - step;
+                step = (guess > 0) & (pmf(guess) < pexact * epsilon);
+            step = (pmf(guess) > pexact / epsilon);
+            while np.any(step):
+                guess = guess + step;
+                step = (pmf(guess) > pexact / epsilon);
+            pValue[isTwoSided] += self.hypergeomTail(hypergeom.sf, guess-1, M, n1, n);
+        else:
+            guess = low;
+            step = (pmf(guess) < pexact * epsilon);
+            while np.any(step):
+                guess = guess + step;
+                step = (pmf(guess) < pexact * epsilon);
+            step = (guess > 0) & (pmf(guess) > pexact / epsilon);
+            while np.any(step):
+                guess = guess - step;
+                step = (guess > 0) & (pmf(guess) > pexact / epsilon);
+            pValue[isTwoSided] += self.hypergeomTail(hypergeom.cdf, guess, M, n1, n);
+        return pValue;
+
+    def hypergeomTail(self, tailFunction, k, M, n, N):
+        """Evaluate a hypergeom cdf or sf function table by table.
+        Older scipy versions cannot broadcast these over arrays of distribution parameters,
+        and sum up the probability masses one table at a time internally regardless.
+        """
+        return np.array( [tailFunction(*args) for args in zip(k, M, n, N)], dtype=np.float64 );
+
 class UnrecognizedStatException(Exception):
     def __init__( self, initStr ):
         Exception.__init__(self, initStr);
@@ -5,11 +5,14 @@ import sys, os
 import cStringIO
 import logging
 import unittest
-from math import sqrt, exp, log as ln;
+import random;
+from math import sqrt, exp, log as ln, isinf, isnan;
+
+import numpy as np;
 
 import Const, Util
 
-from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, UnrecognizedStatException;
+from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, ContingencyStatsArray, UnrecognizedStatException;
 from medinfo.common.test.Util import MedInfoTestCase
 
 class TestAggregateStats(MedInfoTestCase):
@@ -263,6 +266,98 @@ class TestContingencyStats(MedInfoTestCase):
             testValue = contStats.calc(statId);
             self.assertAlmostEquals( expectedValue, testValue, 3 );
 
+class TestContingencyStatsArray(MedInfoTestCase):
+    def setUp(self):
+        MedInfoTestCase.setUp(self);
+
+        # Every supported stat, including synonyms, should agree with the scalar calculation
+        self.STAT_IDS = \
+            [   "total","N","nA","nB","nAB","support",
+                "P(A)","P(!A)","P(B)","prevalence","preTestProbability","baselineFreq",
+                "SE(prevalence)","prevalence95CILow","prevalence95CIHigh",
+                "P(!B)","P(AB)",
+                "P(B|A)","positivePredictiveValue","PPV","precision","postTestProbability","confidence","conditionalFreq","truePositiveAccuracy",
+                "SE(PPV)","PPV95CILow","PPV95CIHigh",
+                "P(!B|A)","P(B|!A)",
+                "P(!B|!A)","negativePredictiveValue","NPV","inversePrecision","trueNegativeAccuracy",
+                "P(A|B)","truePositiveRate","TPR","sensitivity","sens","recall",
+                "P(!A|B)","falseNegativeRate","FNR","missRate",
+                "P(A|!B)","falsePositiveRate","FPR","fallout",
+                "P(!A|!B)","trueNegativeRate","TNR","specificity","spec","inverseRecall",
+                "F1","F1-score",
+                "positiveLikelihoodRatio","+LR","LR+","LR",
+                "negativeLikelihoodRatio","-LR","LR-",
+                "oddsRatio","OR","SE(ln(OR))","oddsRatio95CILow","OR95CILow","oddsRatio95CIHigh","OR95CIHigh",
+                "relativeRisk","RR","SE(ln(RR))","relativeRisk95CILow","RR95CILow","relativeRisk95CIHigh","RR95CIHigh",
+                "interest","freqRatio","TF*IDF","tfidf","lift","P(B|A)/P(B)",
+                "YatesChi2","P-YatesChi2","P-YatesChi2-NegLog","P-Chi2","P-Chi2-NegLog",
+                "P-Fisher","P-Fisher-Complement","P-Fisher-NegLog",
+            ];
+
+        # Tables of (nAB, nA, nB, N), including degenerate zero and negative cells
+        self.TABLES = \
+            [   (20, 30, 40, 100),
+                (10, 15, 25, 20),   # Negative cell
+                (0, 15, 25, 100),   # Zero cell
+                (5, 5, 5, 5),       # Mostly zero cells
+                (0, 0, 0, 100),
+                (3, 3, 50, 1000),
+                (50, 60, 55, 70),
+                (1, 200, 300, 100000),
+                (2.5, 7.25, 11.75, 40.5),   # Fractional counts, as from decayed association values
+                (1.5e-160, 3.0e-180, 1000.0, 15000.0),
+            ];
+        randomizer = random.Random(12345);
+        for iTable in xrange(200):
+            N = randomizer.randint(1,500);
+            nA = randomizer.randint(0,N);
+            nB = randomizer.randint(0,N);
+            nAB = randomizer.randint(max(0,nA+nB-N), min(nA,nB));
+            self.TABLES.append( (nAB, nA, nB, N) );
+
+    def tearDown(self):
+        MedInfoTestCase.tearDown(self);
+
+    def assertArrayAgreesWithScalar(self, tables, normalize=False, truncateNegativeValues=False):
+        (nAB, nA, nB, N) = zip(*tables);
+        arrayStats = ContingencyStatsArray( np.array(nAB), np.array(nA), np.array(nB), np.array(N) );
+        scalarStatsList = [ContingencyStats(*table) for table in tables];
+        if normalize:
+            arrayStats.normalize(truncateNegativeValues);
+            for scalarStats in scalarStatsList:
+                scalarStats.normalize(truncateNegativeValues);
+
+        for statId in self.STAT_IDS:
+            arrayValues = arrayStats[statId];
+            self.assertEqual( len(tables), len(arrayValues) );
+            for (table, scalarStats, arrayValue) in zip(tables, scalarStatsList, arrayValues):
+                try:
+                    expectedValue = scalarStats[statId];
+                except (ZeroDivisionError, ValueError):
+                    continue;   # Scalar version cannot calculate, array version will just have inf or nan
+                msg = "%s %s: %s != %s" % (statId, table, expectedValue, arrayValue);
+                if isnan(expectedValue) or isinf(expectedValue):
+                    self.assertTrue( isnan(arrayValue) if isnan(expectedValue) else expectedValue == arrayValue, msg );
+                else:
+                    self.assertTrue( abs(expectedValue-arrayValue) <= 1e-9*max(1.0,abs(expectedValue)), msg );
+
+    def test_contingencyStatsArray(self):
+        self.assertArrayAgreesWithScalar(self.TABLES);
+
+    def test_contingencyStatsArray_normalize(self):
+        self.assertArrayAgreesWithScalar(self.TABLES, normalize=True);
+        self.assertArrayAgreesWithScalar(self.TABLES, normalize=True, truncateNegativeValues=True);
+
+    def test_broadcastScalars(self):
+        # Common values like the total patient count can be given as a single value
+        arrayStats = ContingencyStatsArray( np.array([20,10]), np.array([30,15]), np.array([40,40]), 100 );
+        self.assertEqual( [100.0,100.0], arrayStats["N"].tolist() );
+        self.assertAlmostEquals( (20/10.0) / (20/50.0), arrayStats["OR"][0], 3 );
+
+    def test_unrecognizedStat(self):
+        arrayStats = ContingencyStatsArray( np.array([20]), np.array([30]), np.array([40]), np.array([100]) );
+        self.assertRaises( UnrecognizedStatException, arrayStats.calc, "notAStat" );
+
 class TestUnitTestTools(MedInfoTestCase):
     def test_assertEqualsGeneral(self):
         # Should allow option of verifying equal values by number of significant digits, not just decimal places
@@ -335,6 +430,7 @@ def suite():
     suite = unittest.TestSuite();
     suite.addTest(unittest.makeSuite(TestAggregateStats));
     suite.addTest(unittest.makeSuite(TestContingencyStats));
+    suite.addTest(unittest.makeSuite(TestContingencyStatsArray));
     suite.addTest(unittest.makeSuite(TestUnitTestTools));
     return suite;
 
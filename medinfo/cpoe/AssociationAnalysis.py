@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 import sys, os
+import glob;
 import json
 import time;
 import math;
+import hashlib;
+import heapq;
+import multiprocessing;
+from collections import namedtuple;
 from datetime import datetime;
 from optparse import OptionParser
+import numpy as np;
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
@@ -16,6 +22,9 @@ from Env import DATE_FORMAT;
 from DataManager import DataManager;
 
 from Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
+from Const import COUNT_ENGINE_OPTIONS, SHARD_METHOD_OPTIONS;
+from RecommendationCache import invalidateAll as invalidateRecommendationCaches;
+from AssociationBuffer import AssociationBuffer, COLUMN_NAMES, COLUMN_INDEX_BY_NAME, NPZ_FILE_SIGNATURE, packItemIdPair, packItemIdPairArrays;
 
 from Util import log;
 
@@ -28,6 +37,23 @@ class AnalysisOptions:
         self.endDate = None;
         self.bufferFile = None;
         self.deltaSecondsOptions = None;    # Seconds values / suffixes to look for count fields to update
+        self.countEngine = None;    # One of COUNT_ENGINE_OPTIONS to select how item pairs are counted. Default (None) to the plain "python" nested loop
+        self.skipCountQuery = False;    # If True, don't run an extra count query on the patient items just to estimate progress
+        self.fetchSize = 10000; # Number of patient item rows to fetch from the database at a time
+
+"""Columns of patient item data for association analysis"""
+PATIENT_ITEM_HEADERS = ("patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date");
+
+class PatientItemRow(namedtuple("PatientItemRow", PATIENT_ITEM_HEADERS)):
+    """Lightweight (tuple) record of patient item data for association analysis,
+    instead of a (dictionary) RowItemModel per row.
+    Still supports the same dictionary style lookups (e.g., patientItem["clinical_item_id"]).
+    """
+    __slots__ = ();
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key);
+        return tuple.__getitem__(self, key);
 
 class AssociationAnalysis:
     """Pre-Computation module to sort through data on patient clinical items
@@ -54,6 +80,8 @@ class AssociationAnalysis:
 
     Running batches of 3,000-5,000 patients with ~3,000 possible clinical items yields ~6M associations,
      requiring ~25GB memory for learning then ~45GB memory to reload and commit as a buffer file.
+    (Those numbers were for a dictionary of str(itemIdPair) keyed dictionaries. Increments are now kept
+    in an AssociationBuffer of packed integer pair keys and fixed width float rows, ~0.5KB per association.)
 
     Suggestion: Break up input patientID list into discrete subsets and run AssociationAnalysis on each with -b
     option to do parallel association counting (on a server with enough RAM to do all in memory),
@@ -61,11 +89,13 @@ class AssociationAnalysis:
     Run a single AssociationAnalysis with -b option on the buffer file name prefix
     (and -u to limit number of patient item updates per query), to sequentially load and merge all buffer files
     into one aggregate buffer file to commit to database in one pass.
+    The -w (workers) option does this all in one command (see analyzePatientItemsParallel).
     """
     connFactory = None; # Allow specification of alternative DB connection source
     patientsPerCommit = None; # Commit any bufferred analysis results to the database after analyzing this many patients.  If None, will wait until the end before committing, so less DB hits, but will lose  progress if script cancelled midway
     associationsPerCommit = None;   # Commit buffered analysis results if accrue this many association results to avoid risk of running over runtime memory limitations
     itemsPerUpdate = None;  # When updating analyze_dates for patient_items, do so for this many blocks at a time to avoid avoid loading MySQL query time
+    bulkCommit = None;  # If True, commit update buffers by bulk loading them into temporary staging tables and applying set-based upserts, rather than one update query per item pair
 
     def __init__(self):
         """Default constructor"""
@@ -74,6 +104,7 @@ class AssociationAnalysis:
         self.patientsPerCommit = None;
         self.associationsPerCommit = None;
         self.itemsPerUpdate = None;
+        self.bulkCommit = False;
 
     def makeUpdateBuffer(self, existingBuffer=None):
         """Factory method to prepare a blank "updateBuffer" to store association increment data.
@@ -88,9 +119,30 @@ class AssociationAnalysis:
         updateBuffer.clear();
         updateBuffer["nAssociations"] = 0;
         updateBuffer["analyzedPatientItemIds"] = set();
-        updateBuffer["incrementDataByItemIdPair"] = dict();
+        updateBuffer["incrementDataByItemIdPair"] = AssociationBuffer();
         return updateBuffer;
 
+    def associationBufferFrom(self, updateBuffer):
+        """Return the AssociationBuffer of increment data in the updateBuffer, creating one if needed.
+        If the updateBuffer instead holds a legacy dictionary of increment data keyed by str(itemIdPair)
+        (e.g., loaded from an old JSON buffer file), convert it in place.
+        """
+        if "incrementDataByItemIdPair" not in updateBuffer:
+            updateBuffer["incrementDataByItemIdPair"] = AssociationBuffer();
+            updateBuffer["nAssociations"] = 0;
+        elif not isinstance(updateBuffer["incrementDataByItemIdPair"], AssociationBuffer):
+            updateBuffer["incrementDataByItemIdPair"] = AssociationBuffer.fromIncrementDataByItemIdPair(updateBuffer["incrementDataByItemIdPair"]);
+            updateBuffer["nAssociations"] = len(updateBuffer["incrementDataByItemIdPair"]);
+        return updateBuffer["incrementDataByItemIdPair"];
+
+    def flushAssociationBuffer(self, updateBuffer):
+        """Add the increments staged by updateClinicalItemAssociationBuffer calls (e.g., for one patient)
+        into the updateBuffer's AssociationBuffer in one step, and update the count of associations in the buffer.
+        """
+        associationBuffer = self.associationBufferFrom(updateBuffer);
+        associationBuffer.flush();
+        updateBuffer["nAssociations"] = len(associationBuffer);
+
     def analyzePatientItems(self, analysisOptions):
         """Primary run function to analyze patient clinical item data and
         record updated stats to the respective database tables.
@@ -111,34 +163,226 @@ class AssociationAnalysis:
             # Keep an in memory buffer of the updates to be done so can stall and submit them
             #   to the database in batch to minimize inefficient DB hits
             updateBuffer = self.makeUpdateBuffer();
+            lastActiveTime = time.time();
             log.info("Main patient item query...")
             for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
                 log.debug("Calculate associations for Patient %d's %d patient items. %d associations in buffer." % (iPatient, len(patientItemList), updateBuffer["nAssociations"]) );
-                self.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+                self.countPatientItemAssociations(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
                 if self.readyForIntervalCommit(iPatient, updateBuffer, analysisOptions):
                     log.info("Commit after %s patients" % (iPatient+1) );
                     self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);  # Periodically commit update buffer
-                else:   # If not committing, still send a quick arbitrary query to DB,
+                else:   # If not committing, still periodically send a quick health check query to DB,
                         # otherwise connection may get recycled because DB thinks timeout with no interaction
-                    DBUtil.execute("select 1+1", conn=conn);
+                    lastActiveTime = DBUtil.keepAlive(conn, lastActiveTime);
             log.info("Final commit / persist");
             self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);  # Final update buffer commit. Don't use iPatient here, as may collide if interval commit happened to land on last patient
         finally:
             conn.close();
         # progress.PrintStatus();
 
+    def analyzePatientItemsParallel(self, analysisOptions, numWorkers, shardMethod=None):
+        """Parallel version of analyzePatientItems.
+        Partition the analysisOptions.patientIds into numWorkers shards (see partitionPatientIds),
+        count item associations for each shard in a separate worker process,
+        saving each shard's update buffer to a file, then reduce the shard buffers
+        with a pairwise (tree) merge and persist (commit, or save if analysisOptions.bufferFile) once.
+
+        If a previous run crashed or was cancelled, shard buffer files for the same
+        patients and options will still exist, and those shards will not be recounted.
+        Shard files are deleted after the merged result has been persisted.
+
+        If associationsPerCommit is set, workers spill their buffer to a shard part file whenever it
+        accrues that many associations, and the shard files are merged and persisted in intervals of
+        that many associations, rather than all at once, to keep memory use within the same limit.
+        """
+        timer = time.time();
+        # Don't hold a connection open while forking the worker processes, which would otherwise share its socket
+        conn = self.connFactory.connection();
+        try:
+            patientIds = analysisOptions.patientIds;
+            if not patientIds:
+                patientIds = self.queryPatientIds(analysisOptions, conn=conn);
+            patientIdsByShard = self.partitionPatientIds(patientIds, numWorkers, analysisOptions, shardMethod, conn=conn);
+        finally:
+            conn.close();
+
+        # Prepare tasks for any shards that don't already have results from a previous run
+        shardFilenames = list();
+        shardTasks = list();
+        for shardPatientIds in patientIdsByShard:
+            shardOptions = AnalysisOptions();
+            shardOptions.__dict__.update(analysisOptions.__dict__);
+            shardOptions.patientIds = shardPatientIds;
+            shardFilename = self.shardFilename(shardOptions);
+            shardFilenames.append(shardFilename);
+            if os.path.exists(shardFilename):
+                log.info("Resume with existing shard buffer for %d patients: %s" % (len(shardPatientIds), shardFilename) );
+            elif shardPatientIds:
+                shardTasks.append( (self.connFactory, shardOptions, shardFilename, self.associationsPerCommit) );
+
+        # Count associations for each shard in parallel
+        if shardTasks:
+            pool = multiprocessing.Pool(min(numWorkers, len(shardTasks)));
+            try:
+                for (pid, nPatients, nItems, nAssociations, shardSeconds) in pool.imap_unordered(analyzePatientShard, shardTasks):
+                    log.info("Worker %d: %d patients, %d items, %d associations in %.1f seconds (%.1f patients/sec, %.1f items/sec)" % \
+                        (pid, nPatients, nItems, nAssociations, shardSeconds, nPatients/max(shardSeconds,1e-6), nItems/max(shardSeconds,1e-6)) );
+                pool.close();
+            finally:
+                pool.terminate();
+                pool.join();
+
+        # Reduce shard results and persist them
+        bufferFilenames = list();
+        for shardFilename in shardFilenames:
+            if os.path.exists(shardFilename):
+                bufferFilenames.extend( self.shardPartFilenames(shardFilename) );
+                bufferFilenames.append( shardFilename );
+
+        conn = self.connFactory.connection();
+        try:
+            linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+            if self.associationsPerCommit is None:
+                # All at once
+                updateBuffer = self.treeMergeBuffers([self.loadUpdateBufferFromFile(bufferFilename) for bufferFilename in bufferFilenames]);
+                if updateBuffer is None:
+                    updateBuffer = self.makeUpdateBuffer();
+            else:
+                # One file at a time, persisting (and then deleting the files) whenever accrue associationsPerCommit
+                updateBuffer = self.makeUpdateBuffer();
+                mergedFilenames = list();
+                for iBuffer, bufferFilename in enumerate(bufferFilenames):
+                    self.mergeBuffers(updateBuffer, self.loadUpdateBufferFromFile(bufferFilename));
+                    mergedFilenames.append(bufferFilename);
+                    if updateBuffer["nAssociations"] > self.associationsPerCommit:
+                        log.info("Commit after %d of %d shard buffers" % (iBuffer+1, len(bufferFilenames)) );
+                        self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iBuffer, conn=conn);
+                        for mergedFilename in mergedFilenames:
+                            os.remove(mergedFilename);
+                        mergedFilenames = list();
+            log.info("Final commit / persist of %d associations" % updateBuffer["nAssociations"] );
+            self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);
+        finally:
+            conn.close();
+
+        for bufferFilename in bufferFilenames:
+            if os.path.exists(bufferFilename):
+                os.remove(bufferFilename);
+
+        timer = time.time() - timer;
+        log.info("%d patients analyzed by %d workers in %.1f seconds (%.1f patients/sec)" % (len(patientIds), numWorkers, timer, len(patientIds)/max(timer,1e-6)) );
+
+    def queryPatientIds(self, analysisOptions, conn=None):
+        """Find the distinct patient IDs with items in the analysisOptions date range"""
+        query = SQLQuery();
+        query.addSelect("distinct pi.patient_id");
+        query.addFrom("patient_item as pi");
+        if analysisOptions.startDate is not None:
+            query.addWhereOp("pi.item_date",">=", analysisOptions.startDate);
+        if analysisOptions.endDate is not None:
+            query.addWhereOp("pi.item_date","<", analysisOptions.endDate);
+        query.addOrderBy("pi.patient_id");
+        return [row[0] for row in DBUtil.execute(query, conn=conn)];
+
+    def partitionPatientIds(self, patientIds, nShards, analysisOptions=None, shardMethod=None, conn=None):
+        """Split the patientIds into a list of nShards lists of patient IDs.
+        shardMethod is one of SHARD_METHOD_OPTIONS:
+            "hash" (default): by patient ID modulo nShards
+            "itemCount": Balance the work across shards by (greedily) assigning patients with the most items first
+                to whichever shard has the least work so far. Work for each patient is estimated as
+                the square of their item count (the number of item pairs to count).
+        Partitioning is deterministic, so a rerun will yield the same shards (see resuming in analyzePatientItemsParallel).
+        """
+        patientIdsByShard = [list() for iShard in xrange(nShards)];
+        if shardMethod == "itemCount":
+            itemCountByPatientId = dict( (patientId, 0) for patientId in patientIds );
+            if patientIds:
+                query = SQLQuery();
+                query.addSelect("pi.patient_id");
+                query.addSelect("count(*)");
+                query.addFrom("patient_item as pi");
+                query.addFrom("clinical_item as ci");
+                query.addWhere("pi.clinical_item_id = ci.clinical_item_id");
+                query.addWhere("ci.analysis_status <> 0");
+                query.addWhereIn("pi.patient_id", patientIds );
+                if analysisOptions is not None and analysisOptions.startDate is not None:
+                    query.addWhereOp("pi.item_date",">=", analysisOptions.startDate);
+                if analysisOptions is not None and analysisOptions.endDate is not None:
+                    query.addWhereOp("pi.item_date","<", analysisOptions.endDate);
+                query.addGroupBy("pi.patient_id");
+                itemCountById = dict( (str(patientId), itemCount) for (patientId, itemCount) in DBUtil.execute(query, conn=conn) );
+                for patientId in patientIds:
+                    itemCountByPatientId[patientId] = itemCountById.get(str(patientId), 0);
+
+            shardHeap = [(0, iShard) for iShard in xrange(nShards)];  # (Work so far, shard index)
+            for patientId in sorted(patientIds, key=lambda patientId: (-itemCountByPatientId[patientId], str(patientId))):
+                (shardWork, iShard) = heapq.heappop(shardHeap);
+                patientIdsByShard[iShard].append(patientId);
+                heapq.heappush(shardHeap, (shardWork + itemCountByPatientId[patientId]**2, iShard) );
+        else:
+            for patientId in patientIds:
+                patientIdsByShard[int(patientId) % nShards].append(patientId);
+        return patientIdsByShard;
+
+    def shardFilename(self, shardOptions):
+        """Buffer filename for a shard of a parallel analysis.
+        Named by a digest of the shard's patient IDs and analysis options, so results can be reused
+        only by a run with the same parameters. Deliberately does not start with the bufferFile prefix,
+        so shard files are not picked up by loadUpdateBufferFromFile(bufferFile).
+        """
+        bufferFile = shardOptions.bufferFile;
+        if bufferFile is None:
+            bufferFile = "associationAnalysis";
+        signature = repr( (sorted(str(patientId) for patientId in shardOptions.patientIds), shardOptions.startDate, shardOptions.endDate, shardOptions.deltaSecondsOptions, shardOptions.countEngine) );
+        digest = hashlib.md5(signature).hexdigest()[:16];
+        return os.path.join(os.path.dirname(bufferFile), "shard.%s.%s.npz" % (os.path.basename(bufferFile), digest) );
+
+    def shardPartFilename(self, shardFilename, iPart):
+        """Buffer filename for one part of a shard's results, spilled by a worker to stay within associationsPerCommit"""
+        return "%s.part%d.npz" % (os.path.splitext(shardFilename)[0], iPart);
+
+    def shardPartFilenames(self, shardFilename):
+        """Existing part buffer filenames for the shard (see shardPartFilename)"""
+        return sorted( glob.glob("%s.part*.npz" % os.path.splitext(shardFilename)[0]) );
+
+    def treeMergeBuffers(self, updateBuffers):
+        """Reduce a list of update buffers into one by merging pairs of buffers at a time,
+        so each level merges buffers of similar size rather than repeatedly merging into one large buffer.
+        """
+        if not updateBuffers:
+            return None;
+        while len(updateBuffers) > 1:
+            mergedBuffers = list();
+            for iBuffer in xrange(0, len(updateBuffers)-1, 2):
+                mergedBuffers.append( self.mergeBuffers(updateBuffers[iBuffer], updateBuffers[iBuffer+1]) );
+            if len(updateBuffers) % 2 == 1:
+                mergedBuffers.append( updateBuffers[-1] );
+            updateBuffers = mergedBuffers;
+        return updateBuffers[0];
+
+    def countPatientItemAssociations(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None, progress=None):
+        """Update the buffer for one patient's items, with whichever analysisOptions.countEngine selected"""
+        if analysisOptions.countEngine == "numpy":
+            self.updateItemAssociationsBufferVectorized(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+        else:
+            self.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+
     def queryPatientItemsPerPatient(self, analysisOptions, progress=None, conn=None):
         """Query the database for an ordered list of patient clinical items,
         in the order in which they occurred.
         This could be a large amount of data, so option to provide
         list of specific patientIds or date ranges to query for.  In either case,
         results will be returned as an iterator over individual lists
-        for each patient.  Lists will contain RowItemModels, each with data:
+        for each patient.  Lists will contain PatientItemRows, each with data:
+            * patient_item_id
             * patient_id
             * encounter_id
             * clinical_item_id
             * item_date
             * analyze_date
+
+        Rows are streamed from the database analysisOptions.fetchSize at a time (see DBUtil.executeStream),
+        so memory use stays flat no matter how much data the query covers.
         """
         extConn = conn is not None;
         if not extConn:
@@ -167,48 +411,43 @@ class AssociationAnalysis:
         query.addOrderBy("pi.clinical_item_id");
 
         # Query to get an estimate of how long the process will be
-        if progress is not None:
+        if progress is not None and not analysisOptions.skipCountQuery:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
+        fetchSize = analysisOptions.fetchSize;
+        if fetchSize is None:
+            fetchSize = AnalysisOptions().fetchSize;
 
         # Do one massive query, but yield data for one patient at a time.
         # This should minimize the number of DB queries and the amount of
         #   data that must be kept in memory at any one time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        currentPatientId = None;
-        currentPatientData = list();
-
-        headers = ["patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date"];
-
-        row = cursor.fetchone();
-        while row is not None:
-            (patient_item_id, patientId, encounter_id, clinicalItemId, itemDate, analyzeDate) = row;
-            if currentPatientId is None:
-                currentPatientId = patientId;
-
-            if patientId != currentPatientId:
-                # Changed user, yield the existing data for the previous user
-                yield currentPatientData;
-                # Update our data tracking for the current user
-                currentPatientId = patientId;
-                currentPatientData = list();
-
-            rowModel = RowItemModel( row, headers );
-            currentPatientData.append( rowModel );
-
-            row = cursor.fetchone();
-
-        # Yield the final user's data
-        yield currentPatientData;
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
-
-        if not extConn:
-            conn.close();
+        #   The conn is external to the stream, so the caller may commit (intervals of) results while still iterating.
+        batches = DBUtil.executeStream(query, fetchSize=fetchSize, conn=conn);
+        try:
+            currentPatientId = None;
+            currentPatientData = list();
+
+            for rows in batches:
+                for row in rows:
+                    patientId = row[1];
+                    if currentPatientId is None:
+                        currentPatientId = patientId;
+
+                    if patientId != currentPatientId:
+                        # Changed user, yield the existing data for the previous user
+                        yield currentPatientData;
+                        # Update our data tracking for the current user
+                        currentPatientId = patientId;
+                        currentPatientData = list();
+
+                    currentPatientData.append( PatientItemRow(*row) );
+
+            # Yield the final user's data
+            yield currentPatientData;
+        finally:
+            batches.close();    # Release the server-side cursor before the connection
+            if not extConn:
+                conn.close();
 
     def updateItemAssociationsBuffer(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None,  progress=None):
         """Given a list of data on patient clinical items,
@@ -266,6 +505,8 @@ class AssociationAnalysis:
             if progress is not None:
                 progress.Update();
 
+        self.flushAssociationBuffer(updateBuffer);
+
         # Record this analysis date to any unmarked records
         if "analyzedPatientItemIds" not in updateBuffer:
             updateBuffer["analyzedPatientItemIds"] = set();
@@ -278,6 +519,7 @@ class AssociationAnalysis:
 
         Default to recording increments for pair (patientItem1["clinical_item_id"],patientItem2["clinical_item_id"]).
         If itemIdPair explicitly specified, then use that instead.
+        Increments are staged until the next flushAssociationBuffer call.
         """
         # Determine which time threshold count windows to update
         deltaSecondsOptions = None;
@@ -306,37 +548,167 @@ class AssociationAnalysis:
         if isNewPairWithinEncounter:
             countPrefixes.append("encounter_");
 
-        if "incrementDataByItemIdPair" not in updateBuffer:
-            updateBuffer["incrementDataByItemIdPair"] = dict();
-            updateBuffer["nAssociations"] = 0;
-        if str(itemIdPair) not in updateBuffer["incrementDataByItemIdPair"]:
-            updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)] = dict();
-            updateBuffer["nAssociations"] += 1;
-        incrementData = updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)];
-
-        # Decide on columns to increment pair association with time dependency
+        # Decide on columns to increment pair association with time dependency, as a full row of increments in COLUMN_NAMES order
+        rowIncrements = [0] * len(COLUMN_NAMES);
         for countPrefix in countPrefixes:
-            countField = countPrefix+"count_any";
-            if countField not in incrementData:
-                incrementData[countField] = 0;
-            incrementData[countField] += 1;
-
+            rowIncrements[COLUMN_INDEX_BY_NAME[countPrefix+"count_any"]] = 1;
             for secondsOption in deltaSecondsOptions:
                 if secondsDelta <= secondsOption:
-                    countField = countPrefix+"count_%d" % secondsOption;
-                    if countField not in incrementData:
-                        incrementData[countField] = 0;
-                    incrementData[countField] += 1;
+                    rowIncrements[COLUMN_INDEX_BY_NAME[countPrefix+"count_%d" % secondsOption]] = 1;
+            rowIncrements[COLUMN_INDEX_BY_NAME[countPrefix+"time_diff_sum"]] = secondsDelta;
+            rowIncrements[COLUMN_INDEX_BY_NAME[countPrefix+"time_diff_sum_squares"]] = secondsDelta**2;
+
+        associationBuffer = self.associationBufferFrom(updateBuffer);
+        associationBuffer.addRow(itemIdPair[0], itemIdPair[1], rowIncrements);
+
+    def updateItemAssociationsBufferVectorized(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None, progress=None):
+        """Alternative counting engine to updateItemAssociationsBuffer with the same semantics
+        (and identical resulting updateBuffer contents), but avoiding the pure Python
+        nested loop over item models.
+
+        Converts the patient's items into arrays (item index, encounter index, item time, analyzed flag)
+        and uses the date ordering of the items to generate all forward / non-negative item pairs at once
+        (searchsorted for the first item that does not precede each one).
+        Pairs are then visited in the same order as the nested loop would, so that the first
+        occurrence of each item pair (patient_ counts) and each item pair within a common
+        encounter (encounter_ counts) can be found with unique first index lookups.
+        Count increments per item pair are then summed by grouping on sorted pair keys.
+        """
+        if "analyzedPatientItemIds" not in updateBuffer:
+            updateBuffer["analyzedPatientItemIds"] = set();
 
-            sumField = countPrefix+"time_diff_sum";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta;
+        nItems = len(patientItemList);
+        if nItems < 1:
+            return;
 
-            sumField = countPrefix+"time_diff_sum_squares";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta**2;
+        # Determine which time threshold count windows to update
+        deltaSecondsOptions = None;
+        if analysisOptions is not None and analysisOptions.deltaSecondsOptions is not None:
+            deltaSecondsOptions = analysisOptions.deltaSecondsOptions;
+        else:
+            deltaSecondsOptions = DELTA_NAME_BY_SECONDS.keys();
+
+        # Factorize item and encounter IDs into contiguous indexes.
+        #   Retain the original ID objects so buffer keys are identical to the nested loop's str(itemIdPair)
+        itemIds = list();
+        itemIndexById = dict();
+        encounterIndexById = dict();
+        itemIndexes = np.empty(nItems, dtype=np.int64);
+        encounterIndexes = np.empty(nItems, dtype=np.int64);
+        for iItem, patientItem in enumerate(patientItemList):
+            itemId = patientItem["clinical_item_id"];
+            if itemId not in itemIndexById:
+                itemIndexById[itemId] = len(itemIds);
+                itemIds.append(itemId);
+            itemIndexes[iItem] = itemIndexById[itemId];
+
+            encounterId = patientItem["encounter_id"];
+            if encounterId not in encounterIndexById:
+                encounterIndexById[encounterId] = len(encounterIndexById);
+            encounterIndexes[iItem] = encounterIndexById[encounterId];
+        nUniqueItems = len(itemIds);
+        nEncounters = len(encounterIndexById);
+
+        # Microsecond resolution so floor division reproduces timedelta (days*SECONDS_PER_DAY + seconds) exactly
+        itemTimes = np.array([patientItem["item_date"] for patientItem in patientItemList], dtype="datetime64[us]").astype(np.int64);
+        isAnalyzed = np.array([patientItem["analyze_date"] is not None for patientItem in patientItemList], dtype=bool);
+
+        # For each item1, the acceptable item2s are all those at the same time or later.
+        timeOrder = np.argsort(itemTimes, kind="mergesort");
+        sortedTimes = itemTimes[timeOrder];
+        firstLaterPositions = np.searchsorted(sortedTimes, itemTimes, side="left");
+        pairsPerItem = nItems - firstLaterPositions;
+        nPairs = int(pairsPerItem.sum());
+
+        item1Rows = np.repeat(np.arange(nItems, dtype=np.int64), pairsPerItem);
+        groupOffsets = np.arange(nPairs, dtype=np.int64) - np.repeat(np.cumsum(pairsPerItem) - pairsPerItem, pairsPerItem);
+        item2Rows = timeOrder[np.repeat(firstLaterPositions, pairsPerItem) + groupOffsets];
+        if not np.all(timeOrder[:-1] < timeOrder[1:]):
+            # Input was not already in time order. Restore the nested loop (item1, item2) list order
+            pairOrder = np.lexsort((item2Rows, item1Rows));
+            item1Rows = item1Rows[pairOrder];
+            item2Rows = item2Rows[pairOrder];
+
+        pairKeys = itemIndexes[item1Rows] * nUniqueItems + itemIndexes[item2Rows];
+
+        # Drop previously composite linked item pairs
+        if linkedItemIdsByBaseId:
+            excludedKeys = list();
+            for itemId1 in itemIds:
+                if itemId1 in linkedItemIdsByBaseId:
+                    for itemId2 in linkedItemIdsByBaseId[itemId1]:
+                        if itemId2 in itemIndexById:
+                            excludedKeys.append( itemIndexById[itemId1] * nUniqueItems + itemIndexById[itemId2] );
+                            excludedKeys.append( itemIndexById[itemId2] * nUniqueItems + itemIndexById[itemId1] );
+            if excludedKeys:
+                isPairToAnalyze = ~np.in1d(pairKeys, np.array(excludedKeys, dtype=np.int64));
+                item1Rows = item1Rows[isPairToAnalyze];
+                item2Rows = item2Rows[isPairToAnalyze];
+                pairKeys = pairKeys[isPairToAnalyze];
+
+        secondsDeltas = (itemTimes[item2Rows] - itemTimes[item1Rows]) // 1000000;
+
+        # First occurrence of each item pair (and item pair within a common encounter) in nested loop order.
+        #   Evaluated over all acceptable pairs, including already analyzed ones, just as the nested loop tracks them.
+        isNewPair = np.zeros(len(pairKeys), dtype=bool);
+        uniqueKeys, firstRows = np.unique(pairKeys, return_index=True);
+        isNewPair[firstRows] = True;
+
+        isNewPairWithinEncounter = np.zeros(len(pairKeys), dtype=bool);
+        commonEncounterRows = np.flatnonzero(encounterIndexes[item1Rows] == encounterIndexes[item2Rows]);
+        encounterPairKeys = pairKeys[commonEncounterRows] * nEncounters + encounterIndexes[item1Rows[commonEncounterRows]];
+        uniqueKeys, firstRows = np.unique(encounterPairKeys, return_index=True);
+        isNewPairWithinEncounter[commonEncounterRows[firstRows]] = True;
+
+        # Only record stat updates if this pair has not already been analyzed/recorded before
+        isPairToCount = ~(isAnalyzed[item1Rows] & isAnalyzed[item2Rows]);
+
+        # Every counted pair gets a base ("" prefix) increment, so its blocks define the rows of increments to add
+        pairRowKeys = None;
+        rowValues = None;
+        for countPrefix, isPrefixCounted in (("", isPairToCount), ("patient_", isPairToCount & isNewPair), ("encounter_", isPairToCount & isNewPairWithinEncounter)):
+            prefixKeys = pairKeys[isPrefixCounted];
+            if len(prefixKeys) < 1:
+                continue;
+            prefixDeltas = secondsDeltas[isPrefixCounted];
+
+            # Group by sorted pair key so each key's increments are a contiguous block to sum
+            keyOrder = np.argsort(prefixKeys, kind="mergesort");
+            prefixKeys = prefixKeys[keyOrder];
+            prefixDeltas = prefixDeltas[keyOrder];
+            blockStarts = np.flatnonzero(np.concatenate(([True], prefixKeys[1:] != prefixKeys[:-1])));
+            blockKeys = prefixKeys[blockStarts];
+            blockIndexes = np.cumsum(np.concatenate(([False], prefixKeys[1:] != prefixKeys[:-1])));
+
+            if rowValues is None:
+                pairRowKeys = blockKeys;
+                rowValues = np.zeros((len(pairRowKeys), len(COLUMN_NAMES)), dtype=np.float64);
+            blockRows = np.searchsorted(pairRowKeys, blockKeys);
+
+            rowValues[blockRows, COLUMN_INDEX_BY_NAME[countPrefix+"count_any"]] = np.bincount(blockIndexes, minlength=len(blockKeys));
+            for secondsOption in deltaSecondsOptions:
+                rowValues[blockRows, COLUMN_INDEX_BY_NAME[countPrefix+"count_%d" % secondsOption]] = np.bincount(blockIndexes[prefixDeltas <= secondsOption], minlength=len(blockKeys));
+            prefixDeltas = prefixDeltas.astype(np.float64);
+            rowValues[blockRows, COLUMN_INDEX_BY_NAME[countPrefix+"time_diff_sum"]] = np.add.reduceat(prefixDeltas, blockStarts);
+            rowValues[blockRows, COLUMN_INDEX_BY_NAME[countPrefix+"time_diff_sum_squares"]] = np.add.reduceat(prefixDeltas * prefixDeltas, blockStarts);
+
+        # Convert from patient local item indexes to packed item ID pair keys for the update buffer
+        if rowValues is not None:
+            itemIdArray = np.array(itemIds, dtype=np.int64);
+            associationBuffer = self.associationBufferFrom(updateBuffer);
+            associationBuffer.addRows( packItemIdPairArrays(itemIdArray[pairRowKeys // nUniqueItems], itemIdArray[pairRowKeys % nUniqueItems]), rowValues );
+            updateBuffer["nAssociations"] = len(associationBuffer);
+
+        # Record this analysis date to any unmarked records
+        countedRows = np.union1d(item1Rows[isPairToCount], item2Rows[isPairToCount]);
+        for iItem in countedRows[~isAnalyzed[countedRows]]:
+            updateBuffer["analyzedPatientItemIds"].add(patientItemList[iItem]["patient_item_id"]);
+
+        # Update progress meter if available, once per item as for updateItemAssociationsBuffer,
+        #   since the meter only prints dots / status lines when its count lands exactly on their intervals
+        if progress is not None:
+            for iItem in xrange(nItems):
+                progress.Update();
 
     def readyForIntervalCommit(self, iPatient, updateBuffer, analysisOptions):
         isReady = False;
@@ -346,39 +718,23 @@ class AssociationAnalysis:
 
 
     def mergeBuffers(self, bufferOne, bufferTwo):
+        """Add the increment data and analyzed patient items of bufferTwo into bufferOne.
+        Either may be in the legacy dictionary format, but the result will use an AssociationBuffer.
+        """
         if "analyzedPatientItemIds" not in bufferOne:
             bufferOne["analyzedPatientItemIds"] = set();
-        else:
+        if "analyzedPatientItemIds" in bufferTwo:
             bufferOne["analyzedPatientItemIds"].update(bufferTwo["analyzedPatientItemIds"]);
 
-        if "nAssociations" not in bufferOne:
-            bufferOne["nAssociations"] = 0
-        else:
-             bufferOne["nAssociations"] = bufferOne["nAssociations"] + bufferTwo["nAssociations"]
-
-        if "incrementDataByItemIdPair" not in bufferOne:
-            bufferOne["incrementDataByItemIdPair"] = dict()
-        if "incrementDataByItemIdPair" not in bufferTwo:
-            bufferTwo["incrementDataByItemIdPair"] = dict()
-
-        # then fill up any remaining id pairs from buffer two. if you have some in buffer two that are also in buffer one, then add those specific ones together
-        for key, value in bufferTwo["incrementDataByItemIdPair"].iteritems():
-            if key not in bufferOne["incrementDataByItemIdPair"]:
-                bufferOne["incrementDataByItemIdPair"][key] = bufferTwo["incrementDataByItemIdPair"][key]
-            else:
-                for key2, value2 in bufferTwo["incrementDataByItemIdPair"][key].iteritems():
-                    if key2 not in bufferOne["incrementDataByItemIdPair"][key]:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]=bufferTwo["incrementDataByItemIdPair"][key][key2]
-                    else:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]+=bufferTwo["incrementDataByItemIdPair"][key][key2]
+        associationBuffer = self.associationBufferFrom(bufferOne);
+        associationBuffer.merge( self.associationBufferFrom(bufferTwo) );
+        bufferOne["nAssociations"] = len(associationBuffer);
 
         return bufferOne
 
     def bufferDecay (self, bufferDecay, decayValue):
         if "incrementDataByItemIdPair" in bufferDecay:
-            for key, value in bufferDecay["incrementDataByItemIdPair"].iteritems():
-                for key2, value2 in bufferDecay["incrementDataByItemIdPair"][key].iteritems():
-                    bufferDecay["incrementDataByItemIdPair"][key][key2] *= decayValue
+            self.associationBufferFrom(bufferDecay).decay(decayValue);
         return bufferDecay
 
 
@@ -387,27 +743,49 @@ class AssociationAnalysis:
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
             self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn)
         else:
-            bufferFilename = "%s.%s.json.gz" % (analysisOptions.bufferFile, iPatient);    # Modify filename with which patient done so far, in case saving several sequential results
+            bufferFilename = "%s.%s.npz" % (analysisOptions.bufferFile, iPatient);    # Modify filename with which patient done so far, in case saving several sequential results
             self.saveBufferToFile(bufferFilename, updateBuffer);
 
     def saveBufferToFile (self, filename, updateBuffer):
-        ofs = stdOpen (filename, "w");
-        updateBuffer["analyzedPatientItemIds"] = list(updateBuffer["analyzedPatientItemIds"]);
-        json.dump(updateBuffer, ofs);
+        """Save the updateBuffer contents as a compressed NumPy (.npz) archive of the AssociationBuffer arrays
+        and analyzed patient item IDs.
+        """
+        associationBuffer = self.associationBufferFrom(updateBuffer);
+        analyzedPatientItemIds = np.array(sorted(updateBuffer.get("analyzedPatientItemIds",[])), dtype=np.int64);
+        ofs = open(filename, "wb");
+        associationBuffer.save(ofs, analyzedPatientItemIds=analyzedPatientItemIds);
         ofs.close();
 
         # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
         updateBuffer = self.makeUpdateBuffer(updateBuffer);
 
     def loadUpdateBufferFromFile(self, filename):
+        """Load an updateBuffer previously saved by saveBufferToFile.
+        Also accepts the legacy (optionally gzipped) JSON format.
+        If filename is not an existing file, treat it as a prefix and merge all files that start with it.
+        """
         updateBuffer = None;
         try:
             #print >> sys.stderr, filename
             log.info("Loading: %s" % filename);
-            ifs = stdOpen(filename, "r")
-            updateBuffer = json.load(ifs)
-            updateBuffer["analyzedPatientItemIds"] = set(updateBuffer["analyzedPatientItemIds"])
-            ifs.close()
+            ifs = open(filename, "rb");
+            isNumpyArchive = (ifs.read(4) == NPZ_FILE_SIGNATURE);
+            ifs.close();
+            if isNumpyArchive:
+                ifs = open(filename, "rb");
+                (associationBuffer, archive) = AssociationBuffer.load(ifs);
+                updateBuffer = self.makeUpdateBuffer();
+                updateBuffer["incrementDataByItemIdPair"] = associationBuffer;
+                updateBuffer["nAssociations"] = len(associationBuffer);
+                updateBuffer["analyzedPatientItemIds"] = set( int(itemId) for itemId in archive["analyzedPatientItemIds"] );
+                archive.close();
+                ifs.close();
+            else:
+                ifs = stdOpen(filename, "r")
+                updateBuffer = json.load(ifs)
+                updateBuffer["analyzedPatientItemIds"] = set(updateBuffer["analyzedPatientItemIds"])
+                ifs.close()
+                self.associationBufferFrom(updateBuffer);   # Convert legacy dictionary of increment data
         except IOError, exc:
             # Apparently could not find the named filename. See if instead it's a prefix
             #    for a series of enumerated files and then merge them into one mass buffer
@@ -437,14 +815,26 @@ class AssociationAnalysis:
         """Take data accumulated in updateBuffer from prior update methods and
         commit them as incremental changes to the database.
         Clear buffer thereafter.
+
+        If the stored association counts are pending a lazy decay (see DataManager.decayAssociationModel),
+        the increments are divided by the pending decay scale (in place), so they are not decayed along with the prior counts.
         """
         extConn = conn is not None;
         if not extConn:
             conn = self.connFactory.connection();
         try:
             if "incrementDataByItemIdPair" in updateBuffer:
+                decayScale = self.dataManager.loadDecayScale(acceptCache=False, conn=conn);
+                if decayScale != 1.0:
+                    self.associationBufferFrom(updateBuffer).decay(1.0/decayScale);
+
+            if "incrementDataByItemIdPair" in updateBuffer and self.bulkCommit:
+                self.bulkCommitItemAssociations(self.associationBufferFrom(updateBuffer), linkedItemIdsByBaseId, conn);
+            elif "incrementDataByItemIdPair" in updateBuffer:
+                associationBuffer = self.associationBufferFrom(updateBuffer);
+
                 # Ensure baseline records exist to facilitate subsequent incremental update queries
-                itemIdPairs = updateBuffer["incrementDataByItemIdPair"].keys();
+                itemIdPairs = associationBuffer.itemIdPairs();
                 self.prepareItemAssociations(itemIdPairs, linkedItemIdsByBaseId, conn);
 
                 # Construct incremental update queries based on each item pair's incremental counts/sums
@@ -454,22 +844,28 @@ class AssociationAnalysis:
                 incrementProg.total = nItemPairs;
                 cursor = conn.cursor();
                 try:
-                    for (itemIdPair, incrementData) in updateBuffer["incrementDataByItemIdPair"].iteritems():
+                    for (itemIdPair, incrementData) in associationBuffer.iteritems():
+                        if not incrementData:
+                            continue;   # Nothing left to increment (e.g., decayed to 0)
                         query = ["UPDATE clinical_item_association SET"];
+                        params = list();
                         for col, increment in incrementData.iteritems():
-                            query.append("%(col)s=%(col)s+%(increment)s" % {"col":col,"increment":increment});
+                            query.append("%(col)s=%(col)s+%(p)s" % {"col":col,"p":DBUtil.SQL_PLACEHOLDER});
                             query.append(",");
+                            params.append(increment);
                         query.pop();    # Drop extra comma at end of list
                         query.append("WHERE clinical_item_id=%(p)s AND subsequent_item_id=%(p)s" % {"p":DBUtil.SQL_PLACEHOLDER} );
                         query = str.join(" ", query);
-                        itemIdPair = eval(itemIdPair)
-                        cursor.execute(query, itemIdPair);
+                        params.extend(itemIdPair);
+                        cursor.execute(query, tuple(params));
                         incrementProg.update();
                     # incrementProg.printStatus();
                 finally:
                     cursor.close();
 
-            if "analyzedPatientItemIds" in updateBuffer:
+            if "analyzedPatientItemIds" in updateBuffer and self.bulkCommit:
+                self.bulkCommitAnalyzeDates(updateBuffer["analyzedPatientItemIds"], conn);
+            elif "analyzedPatientItemIds" in updateBuffer:
                 # Record analysis date for the given patient items
                 patientItemIdSet = updateBuffer["analyzedPatientItemIds"];
                 nItems = len(patientItemIdSet);
@@ -513,6 +909,9 @@ class AssociationAnalysis:
             # Database commit
             conn.commit();
 
+            # Don't keep serving recommendations from this process based on the old statistics
+            invalidateRecommendationCaches();
+
             # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
             updateBuffer.clear();
             updateBuffer["nAssociations"] = 0;
@@ -520,16 +919,105 @@ class AssociationAnalysis:
             if not extConn:
                 conn.close();
 
+    def bulkCommitItemAssociations(self, associationBuffer, linkedItemIdsByBaseId, conn):
+        """Set-based alternative to prepareItemAssociations + one update query per item pair.
+        Bulk load (COPY / executemany) the buffer increments into a temporary staging table
+        and apply them all with a single upsert (insert, or add to the existing counts on conflict).
+        Baseline (zero) records for all other pairwise combinations of the items involved are staged
+        and inserted the same way, so the end result matches the per item pair commit.
+        Previously composite linked item pairs are skipped in either case.
+        Does not commit, so all of the changes are applied in the caller's (commitUpdateBuffer) transaction.
+        """
+        (itemIds1, itemIds2) = associationBuffer.itemIdArrays();
+        pairKeys = associationBuffer.pairKeys;
+        clinicalItemIds = np.union1d(itemIds1, itemIds2);
+
+        # Packed keys of item pairs to skip, sorted for rapid lookup
+        excludedKeys = list();
+        clinicalItemIdSet = set(clinicalItemIds.tolist());
+        for itemId1 in clinicalItemIdSet:
+            if itemId1 in linkedItemIdsByBaseId:
+                for itemId2 in linkedItemIdsByBaseId[itemId1]:
+                    if itemId2 in clinicalItemIdSet:
+                        excludedKeys.append( packItemIdPair(itemId1, itemId2) );
+                        excludedKeys.append( packItemIdPair(itemId2, itemId1) );
+        excludedKeys = np.unique(np.array(excludedKeys, dtype=np.int64));
+
+        def incrementRows():
+            for iPair in np.flatnonzero(~np.in1d(pairKeys, excludedKeys)):
+                yield (int(itemIds1[iPair]), int(itemIds2[iPair])) + tuple(associationBuffer.values[iPair].tolist());
+
+        def baselineRows():
+            for itemId1 in clinicalItemIds:
+                combinationKeys = packItemIdPairArrays(np.repeat(itemId1, len(clinicalItemIds)), clinicalItemIds);
+                isBaseline = ~np.in1d(combinationKeys, pairKeys) & ~np.in1d(combinationKeys, excludedKeys);
+                for itemId2 in clinicalItemIds[isBaseline]:
+                    yield (int(itemId1), int(itemId2));
+
+        isMySQL = DBUtil.DATABASE_CONNECTOR_NAME in ("MySQLdb","mysql.connector");
+        idColumns = ["clinical_item_id","subsequent_item_id"];
+
+        DBUtil.execute("DROP TABLE IF EXISTS temp_association_increment", conn=conn, autoCommit=False);
+        DBUtil.execute("DROP TABLE IF EXISTS temp_association_baseline", conn=conn, autoCommit=False);
+        DBUtil.execute \
+        (   "CREATE TEMPORARY TABLE temp_association_increment (clinical_item_id BIGINT, subsequent_item_id BIGINT, %s)" % \
+                str.join(", ", ["%s DOUBLE PRECISION" % col for col in COLUMN_NAMES]),
+            conn=conn, autoCommit=False
+        );
+        DBUtil.execute("CREATE TEMPORARY TABLE temp_association_baseline (clinical_item_id BIGINT, subsequent_item_id BIGINT)", conn=conn, autoCommit=False);
+
+        nIncrements = DBUtil.insertRows("temp_association_increment", idColumns+list(COLUMN_NAMES), incrementRows(), conn=conn);
+        nBaseline = DBUtil.insertRows("temp_association_baseline", idColumns, baselineRows(), conn=conn);
+        log.debug("Staged %d item pair increments and %d baseline records" % (nIncrements, nBaseline) );
+
+        # Baseline records only need to exist
+        if isMySQL:
+            upsertQuery = "INSERT IGNORE INTO clinical_item_association (clinical_item_id, subsequent_item_id) SELECT clinical_item_id, subsequent_item_id FROM temp_association_baseline";
+        else:   # "WHERE true" needed to disambiguate the SELECT from the ON CONFLICT clause for SQLite
+            upsertQuery = "INSERT INTO clinical_item_association (clinical_item_id, subsequent_item_id) SELECT clinical_item_id, subsequent_item_id FROM temp_association_baseline WHERE true ON CONFLICT (clinical_item_id, subsequent_item_id) DO NOTHING";
+        DBUtil.execute(upsertQuery, conn=conn, autoCommit=False);
+
+        # Increment records in one upsert
+        query = ["INSERT INTO clinical_item_association (%s)" % str.join(", ", idColumns+list(COLUMN_NAMES))];
+        query.append("SELECT %s FROM temp_association_increment" % str.join(", ", idColumns+list(COLUMN_NAMES)) );
+        if isMySQL:
+            query.append("ON DUPLICATE KEY UPDATE");
+            query.append( str.join(", ", ["%(col)s = clinical_item_association.%(col)s + VALUES(%(col)s)" % {"col": col} for col in COLUMN_NAMES]) );
+        else:
+            query.append("WHERE true ON CONFLICT (clinical_item_id, subsequent_item_id) DO UPDATE SET");
+            query.append( str.join(", ", ["%(col)s = clinical_item_association.%(col)s + excluded.%(col)s" % {"col": col} for col in COLUMN_NAMES]) );
+        DBUtil.execute(str.join(" ", query), conn=conn, autoCommit=False);
+
+        DBUtil.execute("DROP TABLE temp_association_increment", conn=conn, autoCommit=False);
+        DBUtil.execute("DROP TABLE temp_association_baseline", conn=conn, autoCommit=False);
+
+    def bulkCommitAnalyzeDates(self, patientItemIds, conn):
+        """Set-based alternative to recording analyze_date with chunked IN (...) lists.
+        Bulk load the patient item IDs into a temporary staging table and update them all with a single query.
+        """
+        log.debug("Record %d analyzed items" % len(patientItemIds) );
+        if len(patientItemIds) < 1:
+            return;
+        DBUtil.execute("DROP TABLE IF EXISTS temp_analyzed_patient_item", conn=conn, autoCommit=False);
+        DBUtil.execute("CREATE TEMPORARY TABLE temp_analyzed_patient_item (patient_item_id BIGINT)", conn=conn, autoCommit=False);
+        DBUtil.insertRows("temp_analyzed_patient_item", ["patient_item_id"], ((itemId,) for itemId in patientItemIds), conn=conn);
+        DBUtil.execute \
+        (   """update patient_item
+            set analyze_date = %(p)s
+            where patient_item_id in (select patient_item_id from temp_analyzed_patient_item)
+            and analyze_date is null
+            """ % {"p": DBUtil.SQL_PLACEHOLDER},
+            (datetime.now(),),
+            conn=conn, autoCommit=False
+        );
+        DBUtil.execute("DROP TABLE temp_analyzed_patient_item", conn=conn, autoCommit=False);
+
     def prepareItemAssociations(self, itemIdPairs, linkedItemIdsByBaseId, conn):
         """Make sure all pair-wise item association records are ready / initialized
         so that subsequent queries don't have to pause to check for their existence.
         Should help greatly to reduce number of queries and execution time.
         """
         clinicalItemIdSet = set();
-        #Do the below to convert the list of strings into a list of pairs, which is needed for the rest of this function
-        for index, pair in enumerate(itemIdPairs):
-            itemIdPairs[index]=eval(pair)
-
         for (itemId1, itemId2) in itemIdPairs:
             clinicalItemIdSet.add(itemId1);
             clinicalItemIdSet.add(itemId2);
@@ -595,6 +1083,11 @@ class AssociationAnalysis:
         parser.add_option("-a", "--associationsPerCommit", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit. 1M seems to just fit within 7.5GB memory (assuming 64-bit Python). Running batches of 3000 patients with ~3000 possible clinical items yields ~5M associations requiring ~25GB memory for learning then ~45GB memory to reload and commit a buffer file.")
         parser.add_option("-u", "--itemsPerUpdate", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query. (e.g., 10,000)")
         parser.add_option("-b", "--bufferFile", dest="bufferFile", help="If provided, send buffer to output file rather than commiting to database. If patientIds arguments and idFile parameter are blank, then instead read in bufferFile from this filename (prefix) and commit to database.")
+        parser.add_option("-c", "--countEngine", dest="countEngine", type="choice", choices=COUNT_ENGINE_OPTIONS, help="Engine used to count item pair associations per patient. Options: %s. Default \"python\" nested loop, or \"numpy\" to count with vectorized array operations (same results, much faster for patients with many items)." % str.join(", ", COUNT_ENGINE_OPTIONS) )
+        parser.add_option("-m", "--bulkCommit", dest="bulkCommit", action="store_true", help="If set, commit results to the database by bulk loading them into temporary staging tables (COPY with PostgreSQL) and applying them with set-based upsert queries, instead of one update query per item pair.")
+        parser.add_option("-q", "--skipCountQuery", dest="skipCountQuery", action="store_true", help="If set, skip the extra count query over all patient items that is otherwise used to estimate progress.")
+        parser.add_option("-w", "--workers", dest="workers", type="int", help="If provided (and > 1), partition the patients into this many shards and count associations for each in a separate (parallel) worker process, then merge the results to commit (or save to bufferFile) once. Shard results are kept in files until done, so rerunning the same command after a crash will resume with them.")
+        parser.add_option("-x", "--shardMethod", dest="shardMethod", type="choice", choices=SHARD_METHOD_OPTIONS, help="How to partition patients into shards when using multiple workers. Options: %s. Default \"hash\" by patient ID, or \"itemCount\" to balance workload by patient item counts." % str.join(", ", SHARD_METHOD_OPTIONS) )
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -613,8 +1106,15 @@ class AssociationAnalysis:
         if options.bufferFile is not None:
             analysisOptions.bufferFile = options.bufferFile
 
+        if options.countEngine is not None:
+            analysisOptions.countEngine = options.countEngine;
+        if options.skipCountQuery:
+            analysisOptions.skipCountQuery = True;
+
         if options.itemsPerUpdate is not None:
             self.itemsPerUpdate = int(options.itemsPerUpdate);
+        if options.bulkCommit:
+            self.bulkCommit = True;
 
         if analysisOptions.bufferFile is not None and not analysisOptions.patientIds:
             # Have a previously generated result buffer file and not trying to train on any patientID subset.
@@ -643,11 +1143,53 @@ class AssociationAnalysis:
             if options.associationsPerCommit is not None:
                 self.associationsPerCommit = int(options.associationsPerCommit);
 
-            self.analyzePatientItems(analysisOptions);
+            if options.workers is not None and options.workers > 1:
+                self.analyzePatientItemsParallel(analysisOptions, options.workers, options.shardMethod);
+            else:
+                self.analyzePatientItems(analysisOptions);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
 
+def analyzePatientShard(shardTask):
+    """Worker process function for AssociationAnalysis.analyzePatientItemsParallel.
+    Count item associations for one shard of patients and save the update buffer to the shard file.
+    If associationsPerCommit is set, spill the buffer to a shard part file whenever it accrues that many associations.
+    Write to temporary names first, renaming the shard file last, so only complete results will be found if resuming after a crash.
+    Returns (process ID, patients, items, associations, seconds) to report throughput.
+    """
+    (connFactory, shardOptions, shardFilename, associationsPerCommit) = shardTask;
+    timer = time.time();
+    analyzer = AssociationAnalysis();
+    analyzer.connFactory = connFactory;
+    analyzer.dataManager.connFactory = connFactory;
+    analyzer.associationsPerCommit = associationsPerCommit;
+    for partFilename in analyzer.shardPartFilenames(shardFilename):
+        os.remove(partFilename);    # Leftover from an incomplete prior run, which this one will recount
+    partFilenames = list();
+    nAssociations = 0;
+    conn = connFactory.connection();
+    try:
+        linkedItemIdsByBaseId = analyzer.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+        updateBuffer = analyzer.makeUpdateBuffer();
+        nItems = 0;
+        for iPatient, patientItemList in enumerate(analyzer.queryPatientItemsPerPatient(shardOptions, conn=conn)):
+            analyzer.countPatientItemAssociations(patientItemList, updateBuffer, shardOptions, linkedItemIdsByBaseId);
+            nItems += len(patientItemList);
+            if analyzer.readyForIntervalCommit(iPatient, updateBuffer, shardOptions):
+                nAssociations += updateBuffer["nAssociations"];
+                partFilename = analyzer.shardPartFilename(shardFilename, len(partFilenames));
+                analyzer.saveBufferToFile(partFilename+".partial", updateBuffer);   # Also clears the buffer
+                partFilenames.append(partFilename);
+    finally:
+        conn.close();
+    nAssociations += updateBuffer["nAssociations"];
+    analyzer.saveBufferToFile(shardFilename+".partial", updateBuffer);
+    for partFilename in partFilenames:
+        os.rename(partFilename+".partial", partFilename);
+    os.rename(shardFilename+".partial", shardFilename);
+    return (os.getpid(), len(shardOptions.patientIds), nItems, nAssociations, time.time()-timer);
+
 if __name__ == "__main__":
     instance = AssociationAnalysis();
     instance.main(sys.argv);
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""Compact in-memory store of clinical_item_association increments accumulated by AssociationAnalysis
+before they are committed to the database.
+"""
+import numpy as np;
+
+from Const import DELTA_NAME_BY_SECONDS, COUNT_PREFIX_OPTIONS;
+
+"""Fixed column layout of the buffer, matching the clinical_item_association count/sum columns.
+For each count prefix: count_<seconds> for each time window, count_any, time_diff_sum, time_diff_sum_squares
+"""
+COLUMN_NAMES = list();
+for countPrefix in COUNT_PREFIX_OPTIONS:
+    for secondsOption in sorted(DELTA_NAME_BY_SECONDS.keys()):
+        COLUMN_NAMES.append(countPrefix+"count_%d" % secondsOption);
+    COLUMN_NAMES.append(countPrefix+"count_any");
+    COLUMN_NAMES.append(countPrefix+"time_diff_sum");
+    COLUMN_NAMES.append(countPrefix+"time_diff_sum_squares");
+COLUMN_NAMES = tuple(COLUMN_NAMES);
+COLUMN_INDEX_BY_NAME = dict( (col, iCol) for iCol, col in enumerate(COLUMN_NAMES) );
+
+"""Leading bytes of a (zip based) NumPy .npz archive, to distinguish saved buffers from legacy JSON ones"""
+NPZ_FILE_SIGNATURE = "PK\x03\x04";
+
+LOW_ID_MASK = 0xFFFFFFFF;
+LOW_ID_SIGN = 0x80000000;
+
+def packItemIdPair(itemId1, itemId2):
+    """Pack a (clinical_item_id, subsequent_item_id) pair into a single 64-bit integer key.
+    Item IDs must fit in signed 32-bit integers (the clinical_item serial range, including negative test IDs).
+    """
+    return (int(itemId1) << 32) | (int(itemId2) & LOW_ID_MASK);
+
+def packItemIdPairArrays(itemIds1, itemIds2):
+    """Vectorized version of packItemIdPair for arrays of item IDs"""
+    itemIds1 = np.asarray(itemIds1, dtype=np.int64);
+    itemIds2 = np.asarray(itemIds2, dtype=np.int64);
+    return (itemIds1 << 32) | (itemIds2 & LOW_ID_MASK);
+
+def unpackItemIdPair(pairKey):
+    """Inverse of packItemIdPair"""
+    pairKey = int(pairKey);
+    itemId1 = pairKey >> 32;
+    itemId2 = ((pairKey & LOW_ID_MASK) ^ LOW_ID_SIGN) - LOW_ID_SIGN;
+    return (itemId1, itemId2);
+
+def parseItemIdPairKey(pairKeyStr):
+    """Parse the str(itemIdPair) keys of the legacy dictionary / JSON buffer format
+    (e.g., "(-2, -4)" or "(2L, 4L)") without having to eval them.
+    """
+    (itemId1, itemId2) = pairKeyStr.strip().strip("()").split(",");
+    return ( int(itemId1.strip().rstrip("Ll")), int(itemId2.strip().rstrip("Ll")) );
+
+class AssociationBuffer:
+    """Increment data for clinical_item_association records, keyed by item pair.
+
+    Instead of a dictionary of str(itemIdPair) -> dictionary of column increments,
+    item pairs are packed into 64-bit integer keys, kept sorted in a NumPy array,
+    with the increments for all of the COLUMN_NAMES in a parallel 2D float array
+    (the database columns are all DOUBLE PRECISION anyway). An absent column is simply a 0 increment.
+
+    Individual add / addRow calls only append to plain Python lists (pair keys and flattened rows of increments),
+    as NumPy call overhead would dominate for single values. Callers flush the staged increments
+    (e.g., once per patient), which sums and adds them to the arrays in one vectorized step:
+    increments to pairs that are already stored are added in place, while
+    new pairs are accrued in a pending block (with a dictionary lookup of rows)
+    and only merged into the sorted arrays once enough accumulate,
+    so insertion costs are amortized rather than paid for every new pair.
+    """
+    def __init__(self, pairKeys=None, values=None):
+        """Optionally start with an existing set of sorted unique pairKeys and corresponding values rows"""
+        if pairKeys is None:
+            pairKeys = np.zeros(0, dtype=np.int64);
+            values = np.zeros((0, len(COLUMN_NAMES)), dtype=np.float64);
+        self.pairKeys = np.asarray(pairKeys, dtype=np.int64);
+        self.values = np.asarray(values, dtype=np.float64);
+        self.minPendingPairs = 65536;   # Let at least this many new pairs accrue before merging them into the main sorted arrays (or staged pairs before flushing)
+        self._clearStaged();
+        self._clearPending();
+
+    def _clearStaged(self):
+        self._stagedKeys = list();
+        self._stagedValues = list();    # Flattened rows of increments, parallel to the staged keys
+
+    def _clearPending(self):
+        self._pendingRowByKey = dict();
+        self._pendingValues = np.zeros((16, len(COLUMN_NAMES)), dtype=np.float64);
+
+    def _pendingRows(self, pairKeys):
+        """Find (or create) the pending block rows for the given new pair keys"""
+        pendingRows = list();
+        for pairKey in pairKeys:
+            iRow = self._pendingRowByKey.get(pairKey);
+            if iRow is None:
+                iRow = self._pendingRowByKey[pairKey] = len(self._pendingRowByKey);
+            pendingRows.append(iRow);
+        pendingRows = np.array(pendingRows, dtype=np.int64);
+
+        nPending = len(self._pendingRowByKey);
+        if nPending > len(self._pendingValues):
+            # Grow pending block geometrically
+            newPendingValues = np.zeros((max(nPending, 2*len(self._pendingValues)), len(COLUMN_NAMES)), dtype=np.float64);
+            newPendingValues[:len(self._pendingValues)] = self._pendingValues;
+            self._pendingValues = newPendingValues;
+        return pendingRows;
+
+    def _consolidateIfLarge(self):
+        if len(self._pendingRowByKey) >= max(self.minPendingPairs, len(self.pairKeys) // 4):
+            self.consolidate();
+
+    def flush(self):
+        """Add any staged increments from individual add calls into the arrays"""
+        nStaged = len(self._stagedKeys);
+        if nStaged < 1:
+            return;
+        stagedKeys = np.fromiter(self._stagedKeys, dtype=np.int64, count=nStaged);
+        stagedValues = np.fromiter(self._stagedValues, dtype=np.float64, count=nStaged*len(COLUMN_NAMES)).reshape(nStaged, len(COLUMN_NAMES));
+        self._clearStaged();
+
+        # Sum the rows staged for the same pair
+        keyOrder = np.argsort(stagedKeys, kind="mergesort");
+        stagedKeys = stagedKeys[keyOrder];
+        isFirstOfKey = np.ones(nStaged, dtype=bool);
+        isFirstOfKey[1:] = (stagedKeys[1:] != stagedKeys[:-1]);
+        keyStarts = np.flatnonzero(isFirstOfKey);
+        self.addRows(stagedKeys[keyStarts], np.add.reduceat(stagedValues[keyOrder], keyStarts, axis=0));
+
+    def consolidate(self):
+        """Flush any staged increments and merge any pending new pairs into the main sorted arrays"""
+        self.flush();
+        nPending = len(self._pendingRowByKey);
+        if nPending < 1:
+            return;
+        pendingKeys = np.fromiter(self._pendingRowByKey.iterkeys(), dtype=np.int64, count=nPending);
+        pendingRows = np.fromiter(self._pendingRowByKey.itervalues(), dtype=np.int64, count=nPending);
+        self._mergeSorted(pendingKeys, self._pendingValues[pendingRows]);
+        self._clearPending();
+
+    def _mergeSorted(self, newKeys, newValues):
+        """Add rows for the given (unique) keys into the main sorted arrays"""
+        mergedKeys = np.union1d(self.pairKeys, newKeys);
+        mergedValues = np.zeros((len(mergedKeys), len(COLUMN_NAMES)), dtype=np.float64);
+        mergedValues[np.searchsorted(mergedKeys, self.pairKeys)] = self.values;
+        mergedValues[np.searchsorted(mergedKeys, newKeys)] += newValues;
+        self.pairKeys = mergedKeys;
+        self.values = mergedValues;
+
+    def add(self, itemId1, itemId2, columns, increments):
+        """Add increments to the named columns for an item pair.
+        columns may be a single column name or a list of (distinct) names with corresponding increments.
+        Increments are only staged until the next flush (or any other method that reads the buffer contents).
+        """
+        rowIncrements = [0] * len(COLUMN_NAMES);
+        if isinstance(columns, basestring):
+            rowIncrements[COLUMN_INDEX_BY_NAME[columns]] = increments;
+        else:
+            for col, increment in zip(columns, increments):
+                rowIncrements[COLUMN_INDEX_BY_NAME[col]] = increment;
+        self.addRow(itemId1, itemId2, rowIncrements);
+
+    def addRow(self, itemId1, itemId2, rowIncrements):
+        """Add a full row of increments (list of values for the columns in COLUMN_NAMES order) for an item pair.
+        Increments are only staged until the next flush (or any other method that reads the buffer contents).
+        """
+        self._stagedKeys.append( (int(itemId1) << 32) | (int(itemId2) & LOW_ID_MASK) );  # packItemIdPair, inline as called for every item pair
+        self._stagedValues.extend(rowIncrements);
+        if len(self._stagedKeys) >= self.minPendingPairs:
+            self.flush();
+
+    def addRows(self, pairKeys, rowValues):
+        """Add full rows of increments (columns in COLUMN_NAMES order) for an array of distinct packed pair keys"""
+        if len(pairKeys) < 1:
+            return;
+        pairKeys = np.asarray(pairKeys, dtype=np.int64);
+        rowValues = np.asarray(rowValues, dtype=np.float64);
+
+        # Pairs already in the main sorted arrays
+        iRows = np.searchsorted(self.pairKeys, pairKeys);
+        isStored = (iRows < len(self.pairKeys));
+        isStored[isStored] = (self.pairKeys[iRows[isStored]] == pairKeys[isStored]);
+        self.values[iRows[isStored]] += rowValues[isStored];
+
+        # New pairs go to the pending block
+        isNew = ~isStored;
+        if isNew.any():
+            pendingRows = self._pendingRows(pairKeys[isNew].tolist());  # May grow the pending block
+            self._pendingValues[pendingRows] += rowValues[isNew];
+            self._consolidateIfLarge();
+
+    def merge(self, other):
+        """Add all of the increments from another AssociationBuffer into this one"""
+        self.consolidate();
+        other.consolidate();
+        self._mergeSorted(other.pairKeys, other.values);
+        return self;
+
+    def decay(self, decayValue):
+        """Scale all increments by the decay factor"""
+        self.flush();
+        self.values *= decayValue;
+        self._pendingValues *= decayValue;
+        return self;
+
+    def __len__(self):
+        """Number of distinct item pairs (associations) with increments"""
+        self.flush();
+        return len(self.pairKeys) + len(self._pendingRowByKey);
+
+    def __eq__(self, other):
+        if not isinstance(other, AssociationBuffer):
+            return False;
+        self.consolidate();
+        other.consolidate();
+        return np.array_equal(self.pairKeys, other.pairKeys) and np.array_equal(self.values, other.values);
+
+    def __ne__(self, other):
+        return not self.__eq__(other);
+
+    def __repr__(self):
+        return "AssociationBuffer(%d pairs)" % len(self);
+
+    def itemIdPairs(self):
+        """List of (clinical_item_id, subsequent_item_id) tuples for all pairs with increments"""
+        (itemIds1, itemIds2) = self.itemIdArrays();
+        return zip(itemIds1.tolist(), itemIds2.tolist());
+
+    def itemIdArrays(self):
+        """Arrays of clinical_item_id and subsequent_item_id values, parallel to the (consolidated) pairKeys and values"""
+        self.consolidate();
+        itemIds1 = self.pairKeys >> 32;
+        itemIds2 = ((self.pairKeys & LOW_ID_MASK) ^ LOW_ID_SIGN) - LOW_ID_SIGN;
+        return (itemIds1, itemIds2);
+
+    def iteritems(self):
+        """Iterate over ((clinical_item_id, subsequent_item_id), incrementData) for all pairs,
+        where incrementData is a dictionary of only the non-zero column increments
+        (same form as the legacy incrementDataByItemIdPair values).
+        """
+        self.consolidate();
+        for pairKey, rowValues in zip(self.pairKeys, self.values):
+            nonzeroColumns = np.flatnonzero(rowValues);
+            incrementData = dict( (COLUMN_NAMES[iCol], float(rowValues[iCol])) for iCol in nonzeroColumns );
+            yield (unpackItemIdPair(pairKey), incrementData);
+
+    def toIncrementDataByItemIdPair(self):
+        """Convert to the legacy dictionary format, keyed by str((clinical_item_id, subsequent_item_id))"""
+        return dict( (str(itemIdPair), incrementData) for itemIdPair, incrementData in self.iteritems() );
+
+    @staticmethod
+    def fromIncrementDataByItemIdPair(incrementDataByItemIdPair):
+        """Convert from the legacy dictionary format (e.g., from an old JSON buffer file),
+        keyed by str((clinical_item_id, subsequent_item_id)) strings (or already parsed tuples).
+        """
+        associationBuffer = AssociationBuffer();
+        nPairs = len(incrementDataByItemIdPair);
+        pairKeys = np.zeros(nPairs, dtype=np.int64);
+        values = np.zeros((nPairs, len(COLUMN_NAMES)), dtype=np.float64);
+        for iPair, (itemIdPair, incrementData) in enumerate(incrementDataByItemIdPair.iteritems()):
+            if isinstance(itemIdPair, basestring):
+                itemIdPair = parseItemIdPairKey(itemIdPair);
+            pairKeys[iPair] = packItemIdPair(*itemIdPair);
+            for col, increment in incrementData.iteritems():
+                values[iPair, COLUMN_INDEX_BY_NAME[col]] = increment;
+        keyOrder = np.argsort(pairKeys, kind="mergesort");
+        associationBuffer.pairKeys = pairKeys[keyOrder];
+        associationBuffer.values = values[keyOrder];
+        return associationBuffer;
+
+    def save(self, ofs, **extraArrays):
+        """Write buffer contents as a (compressed) NumPy .npz archive to the given file object.
+        Column names are recorded with the data, so files remain loadable if the column layout changes.
+        Any extraArrays are stored alongside by name.
+        """
+        self.consolidate();
+        np.savez_compressed(ofs, pairKeys=self.pairKeys, values=self.values, columnNames=np.array(COLUMN_NAMES), **extraArrays);
+
+    @staticmethod
+    def load(ifs):
+        """Read an .npz archive written by save.
+        Return (associationBuffer, archive) so caller can retrieve any extra arrays from the archive.
+        """
+        archive = np.load(ifs);
+        values = np.zeros((len(archive["pairKeys"]), len(COLUMN_NAMES)), dtype=np.float64);
+        for iCol, col in enumerate(archive["columnNames"]):
+            values[:, COLUMN_INDEX_BY_NAME[str(col)]] = archive["values"][:, iCol];
+        return (AssociationBuffer(archive["pairKeys"], values), archive);
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Build the clinical_item_association model directly from flat file extracts, without a database connection,
+so models can be built reproducibly offline (e.g., on compute nodes) and the results compared for regression testing.
+
+Streams through a patient_item extract, grouped (sorted) by patient_id, with columns
+patient_id, encounter_id, clinical_item_id, item_date, and optionally patient_item_id.
+Either tab-delimited text (as from DBUtil or psql COPY) or Parquet (if the pyarrow package is available, by file extension).
+Counts item associations for each patient with the same semantics as AssociationAnalysis.updateItemAssociationsBuffer,
+and writes them to an association file: a compressed NumPy .npz archive of the AssociationBuffer arrays
+(see AssociationBuffer.save, one row of count columns per item pair) plus:
+- analyzedPatientItemIds: patient_item_ids counted (empty if the extract has no patient_item_id column)
+- totalPatients: Number of patients with items counted
+- itemIds, categoryIds, analysisStatus: clinical_item data, if a clinical_item extract was provided
+
+The same file can be loaded into a recommender snapshot (AssociationMatrix -f option)
+or committed to the database like any other AssociationAnalysis buffer file
+(AssociationAnalysis -b option, with -m to bulk load with COPY for PostgreSQL).
+"""
+
+import sys, os
+import time;
+import itertools;
+from optparse import OptionParser
+import numpy as np;
+
+from medinfo.common.Const import NULL_STRING;
+from medinfo.common.Util import stdOpen, ProgressDots, parseDateValue;
+from medinfo.db.ResultsFormatter import TabDictReader;
+
+from AssociationAnalysis import AssociationAnalysis, AnalysisOptions, PatientItemRow;
+from DataManager import DataManager;
+from Util import log;
+from Const import COUNT_ENGINE_OPTIONS;
+
+"""File extension of patient_item extracts to read as Parquet instead of tab-delimited text"""
+PARQUET_FILE_EXT = ".parquet";
+
+class AssociationFileBuilder:
+    """Count item associations from flat files into an association file.
+    Reuses the AssociationAnalysis counting, but never connects to the database.
+    """
+    def __init__(self):
+        """Default constructor"""
+        self.analyzer = AssociationAnalysis();
+        self.dataManager = DataManager();
+        self.analysisOptions = AnalysisOptions();
+
+        self.analysisStatusByItemId = None; # If loaded, skip items with analysis_status 0, as AssociationAnalysis does
+        self.categoryIdByItemId = None;
+        self.linkedItemIdsByBaseId = dict();
+
+    def loadClinicalItems(self, ifs):
+        """Read a clinical_item extract (tab-delimited, with clinical_item_id, clinical_item_category_id, and analysis_status columns)
+        to filter out items not fit for analysis and record item categories.
+        """
+        self.analysisStatusByItemId = dict();
+        self.categoryIdByItemId = dict();
+        for row in TabDictReader(ifs):
+            itemId = int(row["clinical_item_id"]);
+            self.analysisStatusByItemId[itemId] = parseIntValue(row.get("analysis_status"));
+            self.categoryIdByItemId[itemId] = parseIntValue(row.get("clinical_item_category_id"));
+
+    def loadLinkedItems(self, ifs):
+        """Read a clinical_item_link extract (tab-delimited, with clinical_item_id and linked_item_id columns)
+        of previously composite item pairs not to count associations for
+        """
+        linkRows = [(int(row["clinical_item_id"]), int(row["linked_item_id"])) for row in TabDictReader(ifs)];
+        self.linkedItemIdsByBaseId = self.dataManager.linkedItemIdsByBaseIdFromRows(linkRows);
+
+    def readPatientItemRows(self, filename):
+        """Reader to iterate through a dictionary of (text or already parsed) values for each row of the patient_item extract,
+        with the column names available as fieldnames (once iteration has started).
+        """
+        if filename.endswith(PARQUET_FILE_EXT):
+            return ParquetRowReader(filename);
+        return TabDictReader(stdOpen(filename));
+
+    def iterPatientItemLists(self, patientItemRows):
+        """Group a stream of patient_item rows into lists of PatientItemRows for each patient,
+        in item date order, as AssociationAnalysis.queryPatientItemsPerPatient would yield them.
+        Rows must already be grouped by patient, but need not be sorted within each patient.
+        Items not fit for analysis (analysis_status 0) are skipped, if the clinical items were loaded.
+        Without a patient_item_id column, rows are numbered in file order instead.
+        """
+        rowNumbers = itertools.count(1);
+        finishedPatientIds = set();
+        currentPatientId = None;
+        currentPatientData = list();
+        for row in patientItemRows:
+            clinicalItemId = int(row["clinical_item_id"]);
+            if self.analysisStatusByItemId is not None and self.analysisStatusByItemId.get(clinicalItemId) == 0:
+                continue;
+            patientId = int(row["patient_id"]);
+            if patientId != currentPatientId:
+                if currentPatientData:
+                    yield sortedPatientItems(currentPatientData);
+                    finishedPatientIds.add(currentPatientId);
+                if patientId in finishedPatientIds:
+                    raise ValueError("Patient items not grouped by patient_id, found more for patient %s after other patients" % patientId);
+                currentPatientId = patientId;
+                currentPatientData = list();
+
+            patientItemId = row.get("patient_item_id");
+            if patientItemId is None:
+                patientItemId = rowNumbers.next();
+            patientItem = PatientItemRow(int(patientItemId), patientId, parseIntValue(row["encounter_id"]), clinicalItemId, parseDateValue(row["item_date"]), None);
+            currentPatientData.append(patientItem);
+
+        if currentPatientData:
+            yield sortedPatientItems(currentPatientData);
+
+    def buildAssociationFile(self, patientItemFilename, ofs):
+        """Count the item associations for all patients in the patient_item extract file
+        and save them to the association file object ofs.
+        Return the number of patients counted.
+        """
+        patientItemRows = self.readPatientItemRows(patientItemFilename);
+        updateBuffer = self.analyzer.makeUpdateBuffer();
+        totalPatients = 0;
+        progress = ProgressDots(name="Patients");
+        for patientItemList in self.iterPatientItemLists(patientItemRows):
+            nAnalyzedItems = len(updateBuffer["analyzedPatientItemIds"]);
+            self.analyzer.countPatientItemAssociations(patientItemList, updateBuffer, self.analysisOptions, self.linkedItemIdsByBaseId);
+            if len(updateBuffer["analyzedPatientItemIds"]) > nAnalyzedItems:
+                totalPatients += 1;
+            progress.update();
+
+        analyzedPatientItemIds = list();
+        if "patient_item_id" in (patientItemRows.fieldnames or []):   # Otherwise just row numbers
+            analyzedPatientItemIds = sorted(updateBuffer["analyzedPatientItemIds"]);
+
+        extraArrays = dict();
+        extraArrays["analyzedPatientItemIds"] = np.array(analyzedPatientItemIds, dtype=np.int64);
+        extraArrays["totalPatients"] = np.array(totalPatients, dtype=np.float64);
+        if self.analysisStatusByItemId is not None:
+            itemIds = sorted(self.analysisStatusByItemId.iterkeys());
+            extraArrays["itemIds"] = np.array(itemIds, dtype=np.int64);
+            extraArrays["categoryIds"] = np.array([nullToValue(self.categoryIdByItemId[itemId]) for itemId in itemIds], dtype=np.int64);
+            extraArrays["analysisStatus"] = np.array([nullToValue(self.analysisStatusByItemId[itemId], 1) for itemId in itemIds], dtype=np.int64);
+
+        associationBuffer = self.analyzer.associationBufferFrom(updateBuffer);
+        log.info("Saving %d associations for %d patients" % (len(associationBuffer), totalPatients) );
+        associationBuffer.save(ofs, **extraArrays);
+        return totalPatients;
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] <patientItemFile> <outputFile>\n"+\
+                    "   <patientItemFile>   Tab-delimited (or %s) patient_item extract, grouped by patient_id,\n" % PARQUET_FILE_EXT +\
+                    "                           with patient_id, encounter_id, clinical_item_id, item_date, and optionally patient_item_id columns.\n"+\
+                    "   <outputFile>        Association file (NumPy .npz) to write.\n"+\
+                    "                           Load into a recommender snapshot with AssociationMatrix -f,\n"+\
+                    "                           or commit to the database with AssociationAnalysis -b (and -m to bulk load).\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-i", "--clinicalItemFile", dest="clinicalItemFile", help="If provided, tab-delimited clinical_item extract with clinical_item_id, clinical_item_category_id, and analysis_status columns. Items with analysis_status 0 will be skipped.");
+        parser.add_option("-l", "--linkFile", dest="linkFile", help="If provided, tab-delimited clinical_item_link extract with clinical_item_id and linked_item_id columns, of item pairs not to count associations for.");
+        parser.add_option("-c", "--countEngine", dest="countEngine", type="choice", choices=COUNT_ENGINE_OPTIONS, help="Engine used to count item pair associations per patient. Options: %s." % str.join(", ", COUNT_ENGINE_OPTIONS) );
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+        if len(args) > 1:
+            if options.clinicalItemFile is not None:
+                ifs = stdOpen(options.clinicalItemFile);
+                self.loadClinicalItems(ifs);
+                ifs.close();
+            if options.linkFile is not None:
+                ifs = stdOpen(options.linkFile);
+                self.loadLinkedItems(ifs);
+                ifs.close();
+            self.analysisOptions.countEngine = options.countEngine;
+
+            ofs = open(args[1], "wb");
+            self.buildAssociationFile(args[0], ofs);
+            ofs.close();
+        else:
+            parser.print_help()
+            sys.exit(-1)
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+def parseIntValue(value):
+    """Integer value of a text (or already parsed) field, None for blank or null fields"""
+    if value is None or value == NULL_STRING or value == "":
+        return None;
+    return int(value);
+
+def nullToValue(value, nullValue=0):
+    if value is None:
+        return nullValue;
+    return value;
+
+def sortedPatientItems(patientItemList):
+    """Same order as AssociationAnalysis.queryPatientItemsPerPatient"""
+    patientItemList.sort(key=lambda patientItem: (patientItem.item_date, patientItem.clinical_item_id));
+    return patientItemList;
+
+class ParquetRowReader:
+    """Iterate through the rows of a Parquet file as dictionaries, one row group at a time,
+    so the whole file need not be in memory at once.
+    """
+    def __init__(self, filename):
+        try:
+            import pyarrow.parquet;
+        except ImportError:
+            raise ImportError("Reading Parquet files requires the pyarrow package: %s" % filename);
+        self.parquetFile = pyarrow.parquet.ParquetFile(filename);
+        self.fieldnames = list(self.parquetFile.schema.names);
+
+    def __iter__(self):
+        for iRowGroup in xrange(self.parquetFile.num_row_groups):
+            valuesByColumn = self.parquetFile.read_row_group(iRowGroup).to_pydict();
+            columns = valuesByColumn.keys();
+            columnValues = [valuesByColumn[column] for column in columns];
+            for rowValues in itertools.izip(*columnValues):
+                yield dict(itertools.izip(columns, rowValues));
+
+if __name__ == "__main__":
+    instance = AssociationFileBuilder();
+    instance.main(sys.argv);
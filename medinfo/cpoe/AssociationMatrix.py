@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+"""
+Read-only, in-memory snapshot of the clinical_item_association counts
+(plus the per item base counts and total patient count needed to score associations),
+so recommenders can score all candidate items with vectorized sparse matrix row slices,
+instead of repeated database queries or per row dictionary caches.
+"""
+import sys, os
+import time;
+from optparse import OptionParser;
+import numpy as np;
+from scipy.sparse import csr_matrix;
+
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from DataManager import DataManager;
+from AssociationBuffer import AssociationBuffer, COLUMN_NAMES, COLUMN_INDEX_BY_NAME;
+from Util import log;
+from Const import COUNT_PREFIX_OPTIONS;
+
+"""Association count columns that can be loaded into a snapshot (all but the time_diff sums)"""
+COUNT_COLUMN_NAMES = tuple( col for col in COLUMN_NAMES if "count_" in col );
+
+"""clinical_item base count columns, matching each of the association count prefixes"""
+BASE_COUNT_COLUMN_NAMES = tuple( (countPrefix or "item_")+"count" for countPrefix in COUNT_PREFIX_OPTIONS );
+
+"""Placeholder category ID for items not found in the clinical_item table"""
+MISSING_CATEGORY_ID = np.iinfo(np.int64).min;
+
+class AssociationMatrix:
+    """Snapshot of clinical_item_association as CSR sparse matrices, one per count column,
+    with rows indexed by clinical_item_id and columns by subsequent_item_id (both via the sorted itemIds array).
+
+    All count matrices share the same sparsity structure, the association records with count_any > 0,
+    keeping explicit zero entries, so row slices return the same candidate items as the respective database query.
+
+    Dense vectors parallel to itemIds hold the clinical_item base counts (for the analyzable items)
+    and category IDs, for vectorized lookup of nA / nB and category filters.
+
+    Counts are held already multiplied by any pending lazy decay scale of the stored database counts
+    (see DataManager.decayAssociationModel), recorded as decayScale.
+    """
+    def __init__(self):
+        self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+        self.dataManager = DataManager();
+        self.fetchSize = 100000;    # Number of association rows to fetch from the database at a time when loading
+
+        self.itemIds = np.zeros(0, dtype=np.int64);
+        self.countMatrixByColumn = dict();
+        self.baseCountsByColumn = dict();
+        self.categoryIds = np.zeros(0, dtype=np.int64);
+        self.totalPatients = None;
+        self.decayScale = 1.0;  # Pending (lazy) decay scale of the database counts, already applied to the snapshot counts
+
+        self._invertedMatrixByColumn = dict();   # Lazily built transposes, for queries by subsequent_item_id
+        self._diagonalPositions = None;
+
+    def __len__(self):
+        """Number of stored associations (item pairs)"""
+        for countMatrix in self.countMatrixByColumn.itervalues():
+            return countMatrix.nnz;
+        return 0;
+
+    def __repr__(self):
+        return "AssociationMatrix(%d items, %d associations)" % (len(self.itemIds), len(self));
+
+    def loadFromDatabase(self, countColumns=None, acceptCache=True, conn=None):
+        """Load the snapshot from the database.
+        countColumns can limit which of the COUNT_COLUMN_NAMES are loaded (to save memory), defaults to all of them.
+        """
+        if countColumns is None:
+            countColumns = COUNT_COLUMN_NAMES;
+        countColumns = list(countColumns);
+
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            # Ensure the denormalized clinical_item counts are up-to-date before copying them
+            self.dataManager.updateClinicalItemCounts(acceptCache=acceptCache, conn=conn);
+
+            baseCountQuery = SQLQuery();
+            baseCountQuery.addSelect("clinical_item_id");
+            baseCountQuery.addSelect("clinical_item_category_id");
+            baseCountQuery.addSelect("analysis_status");
+            for baseCountColumn in BASE_COUNT_COLUMN_NAMES:
+                baseCountQuery.addSelect(baseCountColumn);
+            baseCountQuery.addFrom("clinical_item");
+            baseCountTable = DBUtil.execute(baseCountQuery, conn=conn);
+            self.dataManager.queryCount += 1;
+
+            associationQuery = SQLQuery();
+            associationQuery.addSelect("clinical_item_id");
+            associationQuery.addSelect("subsequent_item_id");
+            for countColumn in countColumns:
+                associationQuery.addSelect(countColumn);
+            associationQuery.addFrom("clinical_item_association");
+            associationQuery.addWhere("count_any > 0"); # Same candidates the recommender queries for
+            (itemIdPairs, counts) = self.fetchAssociationArrays(associationQuery, len(countColumns), conn);
+            self.dataManager.queryCount += 1;
+
+            self.totalPatients = self.queryTotalPatients(conn);
+            self.decayScale = self.dataManager.loadDecayScale(acceptCache=acceptCache, conn=conn);
+        finally:
+            if not extConn:
+                conn.close();
+
+        if baseCountTable:
+            baseCountArray = np.array(baseCountTable, dtype=np.float64);
+        else:
+            baseCountArray = np.zeros((0, 3+len(BASE_COUNT_COLUMN_NAMES)), dtype=np.float64);
+        clinicalItemIds = baseCountArray[:,0].astype(np.int64);
+        self.itemIds = np.union1d( clinicalItemIds, itemIdPairs.ravel() );
+        iClinicalItems = np.searchsorted(self.itemIds, clinicalItemIds);
+
+        self.categoryIds = np.empty(len(self.itemIds), dtype=np.int64);
+        self.categoryIds.fill(MISSING_CATEGORY_ID);
+        self.categoryIds[iClinicalItems] = baseCountArray[:,1].astype(np.int64);
+
+        # Only items fit for analysis have base counts for scaling, like the recommender's database query
+        isAnalyzable = (baseCountArray[:,2] != 0) & ~np.isnan(baseCountArray[:,2]);
+        self.baseCountsByColumn = dict();
+        for iBaseCount, baseCountColumn in enumerate(BASE_COUNT_COLUMN_NAMES):
+            baseCounts = np.zeros(len(self.itemIds), dtype=np.float64);
+            baseCounts[iClinicalItems[isAnalyzable]] = np.nan_to_num(baseCountArray[isAnalyzable, 3+iBaseCount]) * self.decayScale;
+            self.baseCountsByColumn[baseCountColumn] = baseCounts;
+
+        if self.decayScale != 1.0:
+            counts = counts * self.decayScale;
+        self.setAssociationCounts(itemIdPairs, counts, countColumns);
+
+        log.info("Loaded %r", self);
+
+    def loadFromAssociationFile(self, ifs, countColumns=None):
+        """Load the snapshot from an association file built offline from flat files (see AssociationFileBuilder),
+        rather than from the database, with the same results as loading after committing that file to an empty database.
+        Base counts are the diagonal (item with itself) count_0 values, the same way DataManager.updateClinicalItemCounts derives them,
+        for items fit for analysis if the file includes the clinical_item data.
+        """
+        if countColumns is None:
+            countColumns = COUNT_COLUMN_NAMES;
+        countColumns = list(countColumns);
+
+        (associationBuffer, archive) = AssociationBuffer.load(ifs);
+        clinicalItemIds = np.zeros(0, dtype=np.int64);
+        clinicalItemCategoryIds = np.zeros(0, dtype=np.int64);
+        isAnalyzable = None;
+        if "itemIds" in archive.files:
+            clinicalItemIds = archive["itemIds"];
+            clinicalItemCategoryIds = archive["categoryIds"];
+            isAnalyzable = (archive["analysisStatus"] != 0);
+        self.totalPatients = float(archive["totalPatients"]);
+        self.decayScale = 1.0;
+        archive.close();
+
+        (itemIds1, itemIds2) = associationBuffer.itemIdArrays();
+        values = associationBuffer.values;
+        self.itemIds = np.union1d( clinicalItemIds, np.union1d(itemIds1, itemIds2) );
+
+        self.categoryIds = np.empty(len(self.itemIds), dtype=np.int64);
+        self.categoryIds.fill(MISSING_CATEGORY_ID);
+        self.categoryIds[np.searchsorted(self.itemIds, clinicalItemIds)] = clinicalItemCategoryIds;
+
+        isDiagonal = (itemIds1 == itemIds2);
+        if isAnalyzable is not None:    # Only items fit for analysis have base counts, like loadFromDatabase
+            isDiagonal &= ~np.in1d(itemIds1, clinicalItemIds[~isAnalyzable]);
+        iDiagonalItems = np.searchsorted(self.itemIds, itemIds1[isDiagonal]);
+        self.baseCountsByColumn = dict();
+        for countPrefix in COUNT_PREFIX_OPTIONS:
+            baseCounts = np.zeros(len(self.itemIds), dtype=np.float64);
+            baseCounts[iDiagonalItems] = values[isDiagonal, COLUMN_INDEX_BY_NAME[countPrefix+"count_0"]];
+            self.baseCountsByColumn[(countPrefix or "item_")+"count"] = baseCounts;
+
+        isCounted = (values[:,COLUMN_INDEX_BY_NAME["count_any"]] > 0);   # Same candidates as loadFromDatabase
+        itemIdPairs = np.column_stack( (itemIds1[isCounted], itemIds2[isCounted]) );
+        counts = values[isCounted][:, [COLUMN_INDEX_BY_NAME[countColumn] for countColumn in countColumns]];
+        self.setAssociationCounts(itemIdPairs, counts, countColumns);
+
+        log.info("Loaded %r", self);
+
+    def setAssociationCounts(self, itemIdPairs, counts, countColumns):
+        """Sort association records (item ID pairs, all found in itemIds, and a column of counts for each of the countColumns)
+        into CSR order to build the count matrices.
+        """
+        rows = np.searchsorted(self.itemIds, itemIdPairs[:,0]);
+        cols = np.searchsorted(self.itemIds, itemIdPairs[:,1]);
+        order = np.lexsort((cols, rows));
+        indptr = np.zeros(len(self.itemIds)+1, dtype=np.int64);
+        np.cumsum(np.bincount(rows, minlength=len(self.itemIds)), out=indptr[1:]);
+        self.setCountMatrices( indptr, cols[order], dict( (countColumn, counts[order,iCol]) for iCol, countColumn in enumerate(countColumns) ) );
+
+    def fetchAssociationArrays(self, associationQuery, nCountColumns, conn):
+        """Run the association query, fetching rows in blocks of fetchSize into NumPy arrays,
+        rather than holding the whole result set as Python lists.
+        Return (itemIdPairs, counts) arrays.
+        """
+        itemIdPairBlocks = [np.zeros((0,2), dtype=np.int64)];
+        countBlocks = [np.zeros((0,nCountColumns), dtype=np.float64)];
+
+        cursor = conn.cursor();
+        try:
+            cursor.execute( str(associationQuery), tuple(associationQuery.params) );
+            rows = cursor.fetchmany(self.fetchSize);
+            while rows:
+                itemIdPairBlocks.append( np.array([row[:2] for row in rows], dtype=np.int64) );
+                countBlocks.append( np.nan_to_num(np.array([row[2:] for row in rows], dtype=np.float64)) );
+                rows = cursor.fetchmany(self.fetchSize);
+        finally:
+            cursor.close();
+        return ( np.concatenate(itemIdPairBlocks), np.concatenate(countBlocks) );
+
+    def queryTotalPatients(self, conn):
+        """Total number of analyzed patients to scale counts against.
+        Same as ItemAssociationRecommender.totalPatientCount, preferring the value saved in the data_cache table.
+        """
+        dataStr = self.dataManager.getCacheData("analyzedPatientCount", conn=conn);
+        if dataStr is not None:
+            return float(dataStr);
+
+        totalPatientQuery = SQLQuery();
+        totalPatientQuery.addSelect("count(distinct patient_id)")
+        totalPatientQuery.addFrom("patient_item");
+        totalPatientQuery.addWhere("analyze_date is not null");
+        totalPatients = float(DBUtil.execute(totalPatientQuery, conn=conn)[0][0]);
+        self.dataManager.queryCount += 1;
+
+        self.dataManager.setCacheData("analyzedPatientCount", str(totalPatients), conn=conn);
+        return totalPatients;
+
+    def setCountMatrices(self, indptr, indices, countsByColumn):
+        """Build the per column CSR matrices from a common (row sorted) structure,
+        so they all share the same indptr and indices arrays.
+        """
+        self.countMatrixByColumn = dict();
+        self._invertedMatrixByColumn = dict();
+        self._diagonalPositions = None;
+        shape = (len(self.itemIds), len(self.itemIds));
+        for countColumn, counts in countsByColumn.iteritems():
+            countMatrix = csr_matrix( (counts, indices, indptr), shape=shape );
+            (indices, indptr) = (countMatrix.indices, countMatrix.indptr);  # Reuse any index dtype conversion
+            self.countMatrixByColumn[countColumn] = countMatrix;
+
+    def applyIncrements(self, associationBuffer, newPatientCount=0, conn=None):
+        """Add the association increments accumulated in an AssociationBuffer (e.g., by an incremental update,
+        see AssociationUpdater) to the snapshot, so it stays consistent with the updated clinical_item_association table
+        without reloading the whole snapshot.
+
+        Pairs counted for the first time (count_any increment > 0) are merged into the sparsity structure,
+        and items not yet in the snapshot are looked up in the clinical_item table for their category.
+        Base counts are incremented by the diagonal (item with itself) count_0 increments,
+        the same way DataManager.updateClinicalItemCounts derives them,
+        and totalPatients by the newPatientCount (patients with analyzed items for the first time).
+        Increments are expected in stored database units (as committed by AssociationAnalysis.commitUpdateBuffer),
+        so are multiplied by the decayScale like the rest of the snapshot counts.
+        """
+        if self.totalPatients is not None:
+            self.totalPatients += newPatientCount;
+
+        (itemIds1, itemIds2) = associationBuffer.itemIdArrays();
+        isCounted = (associationBuffer.values[:,COLUMN_INDEX_BY_NAME["count_any"]] > 0);   # Same candidates as loadFromDatabase
+        (itemIds1, itemIds2, values) = (itemIds1[isCounted], itemIds2[isCounted], associationBuffer.values[isCounted] * self.decayScale);
+        if len(values) < 1:
+            return;
+
+        self.addItems( np.union1d(itemIds1, itemIds2), conn=conn );
+        rows = np.searchsorted(self.itemIds, itemIds1);
+        cols = np.searchsorted(self.itemIds, itemIds2);
+
+        isDiagonal = (rows == cols);
+        for countPrefix in COUNT_PREFIX_OPTIONS:
+            self.baseCountsByColumn[(countPrefix or "item_")+"count"][rows[isDiagonal]] += values[isDiagonal, COLUMN_INDEX_BY_NAME[countPrefix+"count_0"]];
+
+        countColumns = self.countMatrixByColumn.keys();
+        if not countColumns:
+            return;
+        # Merge increment entries into existing entries by their linear (row, column) positions
+        nItems = len(self.itemIds);
+        countMatrix = self.countMatrixByColumn[countColumns[0]];
+        entryRows = np.repeat(np.arange(nItems, dtype=np.int64), np.diff(countMatrix.indptr));
+        entryKeys = entryRows*nItems + countMatrix.indices;
+        incrementKeys = rows*nItems + cols;
+        mergedKeys = np.union1d(entryKeys, incrementKeys);
+        iEntries = np.searchsorted(mergedKeys, entryKeys);
+        iIncrements = np.searchsorted(mergedKeys, incrementKeys);
+
+        countsByColumn = dict();
+        for countColumn in countColumns:
+            counts = np.zeros(len(mergedKeys), dtype=np.float64);
+            counts[iEntries] = self.countMatrixByColumn[countColumn].data;
+            counts[iIncrements] += values[:,COLUMN_INDEX_BY_NAME[countColumn]];
+            countsByColumn[countColumn] = counts;
+
+        indptr = np.zeros(nItems+1, dtype=np.int64);
+        np.cumsum(np.bincount(mergedKeys // nItems, minlength=nItems), out=indptr[1:]);
+        self.setCountMatrices( indptr, mergedKeys % nItems, countsByColumn );
+
+    def addItems(self, itemIds, conn=None):
+        """Expand the snapshot to include any of the given items that it does not have yet
+        (with zero counts, and categories from the clinical_item table),
+        re-indexing the existing count matrices to the expanded itemIds.
+        """
+        newItemIds = np.setdiff1d(np.asarray(itemIds, dtype=np.int64), self.itemIds);
+        if len(newItemIds) < 1:
+            return;
+
+        categoryQuery = SQLQuery();
+        categoryQuery.addSelect("clinical_item_id");
+        categoryQuery.addSelect("clinical_item_category_id");
+        categoryQuery.addFrom("clinical_item");
+        categoryQuery.addWhereIn("clinical_item_id", newItemIds.tolist() );
+        categoryTable = DBUtil.execute(categoryQuery, conn=conn, connFactory=self.connFactory);
+        self.dataManager.queryCount += 1;
+
+        mergedItemIds = np.union1d(self.itemIds, newItemIds);
+        iOldItems = np.searchsorted(mergedItemIds, self.itemIds);
+        nItems = len(mergedItemIds);
+
+        categoryIds = np.empty(nItems, dtype=np.int64);
+        categoryIds.fill(MISSING_CATEGORY_ID);
+        categoryIds[iOldItems] = self.categoryIds;
+        for (clinicalItemId, categoryId) in categoryTable:
+            categoryIds[np.searchsorted(mergedItemIds, clinicalItemId)] = categoryId;
+
+        for baseCountColumn in BASE_COUNT_COLUMN_NAMES:
+            baseCounts = np.zeros(nItems, dtype=np.float64);
+            if baseCountColumn in self.baseCountsByColumn:
+                baseCounts[iOldItems] = self.baseCountsByColumn[baseCountColumn];
+            self.baseCountsByColumn[baseCountColumn] = baseCounts;
+
+        if self.countMatrixByColumn:
+            # Same entries, just at the new row and column indexes
+            countMatrix = self.countMatrixByColumn.values()[0];
+            rowLengths = np.zeros(nItems, dtype=np.int64);
+            rowLengths[iOldItems] = np.diff(countMatrix.indptr);
+            indptr = np.zeros(nItems+1, dtype=np.int64);
+            np.cumsum(rowLengths, out=indptr[1:]);
+            indices = iOldItems[countMatrix.indices];
+            self.itemIds = mergedItemIds;
+            self.setCountMatrices( indptr, indices, dict( (countColumn, matrix.data) for countColumn, matrix in self.countMatrixByColumn.iteritems() ) );
+        self.itemIds = mergedItemIds;
+        self.categoryIds = categoryIds;
+
+    def countMatrix(self, countColumn, invert=False):
+        """CSR matrix for the given count column.
+        If invert, then the transpose, with rows by subsequent_item_id and columns by clinical_item_id.
+        """
+        if countColumn not in self.countMatrixByColumn:
+            raise KeyError("Association count column not loaded in snapshot: %s" % countColumn);
+        if not invert:
+            return self.countMatrixByColumn[countColumn];
+        if countColumn not in self._invertedMatrixByColumn:
+            self._invertedMatrixByColumn[countColumn] = self.countMatrixByColumn[countColumn].T.tocsr();   # Conversion keeps explicit zero entries
+        return self._invertedMatrixByColumn[countColumn];
+
+    def itemIndexes(self, itemIds):
+        """Return (indexes, isFound) arrays, locating each of the itemIds in the snapshot"""
+        itemIds = np.asarray(itemIds, dtype=np.int64);
+        if len(self.itemIds) < 1:
+            return (np.zeros(len(itemIds), dtype=np.int64), np.zeros(len(itemIds), dtype=bool));
+        indexes = np.minimum(np.searchsorted(self.itemIds, itemIds), len(self.itemIds)-1);
+        isFound = (self.itemIds[indexes] == itemIds);
+        return (indexes, isFound);
+
+    def associationRows(self, sourceItemIds, countColumns, invert=False):
+        """Slice out the association rows for each of the source items (clinical_item_id, or subsequent_item_id if invert).
+        Return (sourceItemIds, targetItemIds, countsByColumn) as parallel arrays, one element per stored association,
+        grouped by source item in the order given.
+        """
+        (rowIndexes, isFound) = self.itemIndexes( list(sourceItemIds) );
+        rowIndexes = rowIndexes[isFound];
+
+        countMatrices = [self.countMatrix(countColumn, invert) for countColumn in countColumns];
+        if not countMatrices:
+            countMatrices = [self.countMatrix(self.countMatrixByColumn.keys()[0], invert)];
+        (indptr, indices) = (countMatrices[0].indptr, countMatrices[0].indices);
+
+        starts = indptr[rowIndexes];
+        lengths = indptr[rowIndexes+1] - starts;
+        # Positions of every entry in the selected rows, without a Python loop over rows
+        positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths);
+
+        sourceIds = np.repeat(self.itemIds[rowIndexes], lengths);
+        targetIds = self.itemIds[indices[positions]];
+        countsByColumn = dict( (countColumn, countMatrix.data[positions]) for countColumn, countMatrix in zip(countColumns, countMatrices) );
+        return (sourceIds, targetIds, countsByColumn);
+
+    def diagonal(self, countColumns):
+        """Items with a stored association to themselves (i.e., their overall counts).
+        Return (itemIds, countsByColumn) as parallel arrays.
+        """
+        countMatrices = [self.countMatrix(countColumn) for countColumn in countColumns];
+        countMatrix = self.countMatrixByColumn.values()[0];
+        if self._diagonalPositions is None:
+            entryRows = np.repeat(np.arange(len(self.itemIds)), np.diff(countMatrix.indptr));
+            self._diagonalPositions = np.flatnonzero(entryRows == countMatrix.indices);
+        diagonalItemIds = self.itemIds[countMatrix.indices[self._diagonalPositions]];
+        countsByColumn = dict( (countColumn, countMatrix.data[self._diagonalPositions]) for countColumn, countMatrix in zip(countColumns, countMatrices) );
+        return (diagonalItemIds, countsByColumn);
+
+    def baseCounts(self, itemIds, countPrefix=""):
+        """Base (clinical_item) counts for the given items, matching the association countPrefix. 0 for unknown or unanalyzed items."""
+        (indexes, isFound) = self.itemIndexes(itemIds);
+        return np.where(isFound, self.baseCountsByColumn[(countPrefix or "item_")+"count"][indexes], 0.0);
+
+    def itemCategoryIds(self, itemIds):
+        """clinical_item_category_id of the given items, MISSING_CATEGORY_ID for unknown items"""
+        (indexes, isFound) = self.itemIndexes(itemIds);
+        return np.where(isFound, self.categoryIds[indexes], MISSING_CATEGORY_ID);
+
+    def save(self, ofs):
+        """Write snapshot contents as a (compressed) NumPy .npz archive to the given file object"""
+        countColumns = sorted(self.countMatrixByColumn.keys());
+        arrays = dict();
+        arrays["itemIds"] = self.itemIds;
+        arrays["categoryIds"] = self.categoryIds;
+        arrays["baseCountColumns"] = np.array(BASE_COUNT_COLUMN_NAMES);
+        arrays["baseCounts"] = np.column_stack([self.baseCountsByColumn[col] for col in BASE_COUNT_COLUMN_NAMES]) if len(self.itemIds) > 0 else np.zeros((0,len(BASE_COUNT_COLUMN_NAMES)));
+        arrays["totalPatients"] = np.array(self.totalPatients, dtype=np.float64);
+        arrays["decayScale"] = np.array(self.decayScale, dtype=np.float64);
+        arrays["countColumns"] = np.array(countColumns);
+        if countColumns:
+            countMatrix = self.countMatrixByColumn[countColumns[0]];
+            arrays["indptr"] = countMatrix.indptr;
+            arrays["indices"] = countMatrix.indices;
+            for countColumn in countColumns:
+                arrays["counts:"+countColumn] = self.countMatrixByColumn[countColumn].data;
+        np.savez_compressed(ofs, **arrays);
+
+    @staticmethod
+    def load(ifs):
+        """Read a snapshot .npz archive written by save"""
+        archive = np.load(ifs);
+        associationMatrix = AssociationMatrix();
+        associationMatrix.itemIds = archive["itemIds"];
+        associationMatrix.categoryIds = archive["categoryIds"];
+        baseCounts = archive["baseCounts"];
+        for iCol, baseCountColumn in enumerate(archive["baseCountColumns"]):
+            associationMatrix.baseCountsByColumn[str(baseCountColumn)] = baseCounts[:,iCol];
+        associationMatrix.totalPatients = float(archive["totalPatients"]);
+        if "decayScale" in archive.files:   # Older snapshots predate lazy decay
+            associationMatrix.decayScale = float(archive["decayScale"]);
+        countColumns = [str(countColumn) for countColumn in archive["countColumns"]];
+        if countColumns:
+            countsByColumn = dict( (countColumn, archive["counts:"+countColumn]) for countColumn in countColumns );
+            associationMatrix.setCountMatrices( archive["indptr"], archive["indices"], countsByColumn );
+        return associationMatrix;
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] <outputFile>\n"+\
+                    "   <outputFile>    NumPy .npz file to save the association matrix snapshot to,\n"+\
+                    "                       for ItemAssociationRecommender to load from (-a option) instead of querying the database.\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-c", "--countColumns", dest="countColumns", help="Comma-separated list of clinical_item_association count columns to include in the snapshot (e.g., patient_count_0,patient_count_any).  Defaults to all count columns.");
+        parser.add_option("-f", "--associationFile", dest="associationFile", help="If provided, load the snapshot from this association file built from flat files (see AssociationFileBuilder), instead of from the database.");
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+        if len(args) > 0:
+            countColumns = None;
+            if options.countColumns is not None:
+                countColumns = options.countColumns.split(",");
+            if options.associationFile is not None:
+                ifs = open(options.associationFile, "rb");
+                self.loadFromAssociationFile(ifs, countColumns);
+                ifs.close();
+            else:
+                self.loadFromDatabase(countColumns);
+
+            ofs = open(args[0],"wb");
+            self.save(ofs);
+            ofs.close();
+        else:
+            parser.print_help()
+            sys.exit(-1)
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+if __name__ == "__main__":
+    instance = AssociationMatrix();
+    instance.main(sys.argv);
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Incremental (online) updates of the clinical_item_association model,
+so it stays fresh as new patient_item data is loaded, without rerunning a full AssociationAnalysis batch job.
+
+Watches for patient_item records not yet analyzed (analyze_date is null),
+and re-runs the association counting for just the affected patients.
+Each patient's full item history is queried, but (as in AssociationAnalysis) only item pairs
+involving at least one newly loaded item are counted, so the increments are the same
+as if those items had been included in the original batch analysis.
+(Exactly the same when new items are dated after the patient's already analyzed items, as for newly loaded data.
+Back-dated items may change which earlier pairs count as the first per patient or encounter,
+which is not revised, just as with any repeat AssociationAnalysis run.)
+
+The increments are committed to the clinical_item_association table and also applied to
+any in-memory AssociationMatrix snapshots in the same process, so they don't have to reload.
+Recommenders in other processes see the ASSOCIATION_UPDATE_KEY data_cache item change
+and reload their snapshots (see ItemAssociationRecommender.refreshAssociationMatrix).
+"""
+
+import sys, os
+import time;
+from optparse import OptionParser
+from medinfo.common.Util import ProgressDots;
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from AssociationMatrix import AssociationMatrix;
+from DataManager import DataManager;
+from Util import log;
+from Const import COUNT_ENGINE_OPTIONS, ASSOCIATION_UPDATE_KEY;
+
+DEFAULT_POLL_SECONDS = 60;  # Default time to wait between checks for new patient items when watching
+
+class AssociationUpdater:
+    """Incrementally count and commit item associations for newly loaded patient items.
+    Any AssociationMatrix snapshots added to associationMatrices will have the same increments applied.
+    Recommenders that cache results (e.g., in a RecommendationCache) will see the association statistics updated
+    by the data_cache flags that AssociationAnalysis.commitUpdateBuffer clears,
+    and any RecommendationCache in the same process is invalidated by the commit.
+    """
+    connFactory = None; # Allow specification of alternative DB connection source
+    maxPatientsPerUpdate = None;    # If set, only update this many patients at a time, leaving the rest for the next update
+    countEngine = None; # One of COUNT_ENGINE_OPTIONS to select how item pairs are counted
+
+    def __init__(self):
+        """Default constructor"""
+        self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+        self.dataManager = DataManager();
+        self.analyzer = AssociationAnalysis();
+        self.maxPatientsPerUpdate = None;
+        self.countEngine = None;
+        self.associationMatrices = list();  # In-memory snapshots to keep up to date
+
+    def queryPendingPatientIds(self, conn=None):
+        """Find the patients that have analyzable patient items not yet analyzed, up to maxPatientsPerUpdate"""
+        query = SQLQuery();
+        query.addSelect("distinct pi.patient_id");
+        query.addFrom("patient_item as pi");
+        query.addFrom("clinical_item as ci");
+        query.addWhere("pi.clinical_item_id = ci.clinical_item_id");
+        query.addWhere("ci.analysis_status <> 0");  # Same items AssociationAnalysis would count
+        query.addWhere("pi.analyze_date is null");
+        query.addOrderBy("pi.patient_id");
+        if self.maxPatientsPerUpdate is not None:
+            query.setLimit(self.maxPatientsPerUpdate);
+        resultTable = DBUtil.execute(query, conn=conn, connFactory=self.connFactory);
+        return [row[0] for row in resultTable];
+
+    def updateAssociations(self, conn=None, snapshotFilename=None):
+        """Count the associations for any newly loaded patient items and commit them to the database
+        and to the associationMatrices.
+        If snapshotFilename is specified, save the (first) updated associationMatrix to it,
+        before flagging the update for recommender processes to reload it.
+        Return the number of patients updated.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            patientIds = self.queryPendingPatientIds(conn=conn);
+            if not patientIds:
+                return 0;
+
+            analysisOptions = AnalysisOptions();
+            analysisOptions.patientIds = patientIds;
+            analysisOptions.countEngine = self.countEngine;
+            analysisOptions.skipCountQuery = True;
+
+            linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+            updateBuffer = self.analyzer.makeUpdateBuffer();
+            newPatientCount = 0;    # Patients with analyzed items for the first time, to add to the total patient count
+            progress = ProgressDots(name="Patients");
+            for patientItemList in self.analyzer.queryPatientItemsPerPatient(analysisOptions, conn=conn):
+                isNewPatient = all(patientItem["analyze_date"] is None for patientItem in patientItemList);
+                nAnalyzedItems = len(updateBuffer["analyzedPatientItemIds"]);
+                self.analyzer.countPatientItemAssociations(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId);
+                if isNewPatient and len(updateBuffer["analyzedPatientItemIds"]) > nAnalyzedItems:
+                    newPatientCount += 1;
+                progress.update();
+
+            # Keep the increments for the snapshots, as committing will clear them out of the updateBuffer
+            associationBuffer = self.analyzer.associationBufferFrom(updateBuffer);
+            nAssociations = len(associationBuffer);
+            self.analyzer.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn);
+
+            for associationMatrix in self.associationMatrices:
+                associationMatrix.applyIncrements(associationBuffer, newPatientCount, conn=conn);
+            if snapshotFilename is not None:
+                self.saveSnapshot(snapshotFilename);
+            self.dataManager.setCacheData(ASSOCIATION_UPDATE_KEY, time.time(), conn=conn);
+
+            log.info("Updated %d associations for %d patients (%d new)" % (nAssociations, len(patientIds), newPatientCount) );
+            return len(patientIds);
+        finally:
+            if not extConn:
+                conn.close();
+
+    def watch(self, pollSeconds=DEFAULT_POLL_SECONDS, maxUpdates=None, snapshotFilename=None):
+        """Repeatedly check for and update associations for newly loaded patient items,
+        waiting pollSeconds between checks when there is nothing left to update.
+        Stop after maxUpdates updates, if specified.
+        If snapshotFilename is specified, save the (first) updated associationMatrix to it after each update,
+        so recommender processes can reload it.
+        """
+        nUpdates = 0;
+        while maxUpdates is None or nUpdates < maxUpdates:
+            nPatients = self.updateAssociations(snapshotFilename=snapshotFilename);
+            nUpdates += 1;
+            if nPatients < 1 or (self.maxPatientsPerUpdate is not None and nPatients < self.maxPatientsPerUpdate):
+                # Caught up with any new data, wait a bit before checking again
+                if maxUpdates is None or nUpdates < maxUpdates:
+                    time.sleep(pollSeconds);
+
+    def saveSnapshot(self, filename):
+        """Save the (first) associationMatrix snapshot.
+        Write to a temporary name first, so readers never find a partially written file.
+        """
+        tempFilename = "%s.tmp" % filename;
+        ofs = open(tempFilename, "wb");
+        try:
+            self.associationMatrices[0].save(ofs);
+        finally:
+            ofs.close();
+        os.rename(tempFilename, filename);
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options]\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-p", "--pollSeconds", dest="pollSeconds", type="float", default=DEFAULT_POLL_SECONDS, help="Seconds to wait between checks for newly loaded patient items. Default %s." % DEFAULT_POLL_SECONDS);
+        parser.add_option("-n", "--maxUpdates", dest="maxUpdates", type="int", help="If provided, stop after this many updates, rather than watching indefinitely.  Use 1 to just update once.");
+        parser.add_option("-m", "--maxPatientsPerUpdate", dest="maxPatientsPerUpdate", type="int", help="If provided, only update associations for this many patients at a time.");
+        parser.add_option("-c", "--countEngine", dest="countEngine", type="choice", choices=COUNT_ENGINE_OPTIONS, help="Engine used to count item pair associations per patient. Options: %s." % str.join(", ", COUNT_ENGINE_OPTIONS) );
+        parser.add_option("-b", "--bulkCommit", dest="bulkCommit", action="store_true", help="If set, commit results to the database with staging tables and set-based upserts (see AssociationAnalysis).");
+        parser.add_option("-a", "--associationMatrix", dest="associationMatrix", help="If provided, load this AssociationMatrix snapshot file (see AssociationMatrix), apply each update to it, and save it back, so recommenders can reload it without a database rebuild.");
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+
+        self.maxPatientsPerUpdate = options.maxPatientsPerUpdate;
+        self.countEngine = options.countEngine;
+        if options.bulkCommit:
+            self.analyzer.bulkCommit = True;
+        if options.associationMatrix is not None:
+            ifs = open(options.associationMatrix, "rb");
+            associationMatrix = AssociationMatrix.load(ifs);
+            ifs.close();
+            associationMatrix.connFactory = self.connFactory;
+            self.associationMatrices.append(associationMatrix);
+
+        self.watch(options.pollSeconds, options.maxUpdates, options.associationMatrix);
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+if __name__ == "__main__":
+    instance = AssociationUpdater();
+    instance.main(sys.argv);
@@ -49,6 +49,46 @@ AGGREGATOR_OPTIONS = ("weighted","unweighted","SerialBayes","NaiveBayes");
 """Option key prefixes for selecting a counting method for item associations"""
 COUNT_PREFIX_OPTIONS = ("","patient_","encounter_");
 
+"""Option keys for selecting the engine that counts item pair associations for each patient.
+"python" is the original nested loop over item models, "numpy" works on sorted arrays of the same data.
+"""
+COUNT_ENGINE_OPTIONS = ("python","numpy");
+
+"""Option keys for partitioning patients into shards for parallel association analysis.
+"hash" by patient ID, "itemCount" to balance the (item pair) work across shards by patient item counts.
+"""
+SHARD_METHOD_OPTIONS = ("hash","itemCount");
+
+"""Default limits for in-memory data caches (DataCache).
+Estimated memory cap in bytes (None for unlimited),
+and seconds before entries expire by cache namespace (entries don't expire for namespaces not listed).
+"""
+DATA_CACHE_MAX_BYTES = None;
+DATA_CACHE_MAX_AGE_BY_NAMESPACE = \
+    {   "totalPatientCount": 60,    # Recheck the database data_cache, in case associations were updated
+        "decayScale": 60,   # Recheck the database data_cache, in case associations were (lazily) decayed
+    }
+
+"""data_cache key for the pending (lazy) decay scale factor of the clinical_item_association counts.
+Stored counts times this factor yield the current (decayed) counts.  Absent means 1.0 (no pending decay).
+"""
+DECAY_SCALE_KEY = "associationDecayScale";
+
+"""data_cache key that AssociationUpdater resets whenever it commits association updates, so its last_update time
+serves as a version for recommenders with their own in-memory AssociationMatrix snapshots to know when to reload them.
+"""
+ASSOCIATION_UPDATE_KEY = "associationUpdate";
+
+"""Seconds between checks of the ASSOCIATION_UPDATE_KEY by recommenders using an in-memory AssociationMatrix snapshot"""
+ASSOCIATION_MATRIX_CHECK_SECONDS = 60;
+
+"""Default limits for caching recommender results (RecommendationCache).
+Estimated memory cap in bytes, and seconds before cached results expire,
+which bounds how long recommendations may lag updates to the association statistics committed by other processes.
+"""
+RESULT_CACHE_MAX_BYTES = 64*1024*1024;
+RESULT_CACHE_MAX_AGE = 5*60;
+
 
 """Core fields to always show with results"""
 #CORE_FIELDS = ["nAB","nA","nB","nA!B","nB!A","n!A!B","N"];
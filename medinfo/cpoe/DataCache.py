@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Bounded, instrumented in-memory cache for query results and other data (e.g., DataManager.dataCache),
+usable in place of a plain dict() that otherwise never releases anything in long-lived processes.
+
+Entries are kept in least recently used order, and evicted as needed to stay within a memory cap
+(estimated bytes) and/or entry count.  Entries can expire after a time to live, set per entry,
+or by default per named namespace (e.g., association rows vs. base counts vs. total patient counts).
+Hit, miss, eviction, rejection (too large to store), and resident byte counts are tracked per namespace for logging.
+Entry sizes are only estimated when there is a memory cap, so resident bytes are not tracked without one.
+"""
+import sys;
+import time;
+from collections import OrderedDict;
+
+from Util import log;
+from Const import DATA_CACHE_MAX_BYTES, DATA_CACHE_MAX_AGE_BY_NAMESPACE;
+
+"""Namespace for entries stored through the plain dict interface"""
+DEFAULT_NAMESPACE = "default";
+
+"""Namespace for general query results (DataManager.executeCacheOption)"""
+QUERY_RESULT_NAMESPACE = "queryResults";
+
+class DataCache:
+    def __init__(self, maxBytes=DATA_CACHE_MAX_BYTES, maxEntries=None, maxAge=None, maxAgeByNamespace=None):
+        self.maxBytes = maxBytes;   # Memory cap (estimated) for all entries.  None for unlimited
+        self.maxEntries = maxEntries;   # Maximum number of entries.  None for unlimited
+        self.maxAge = maxAge;   # Default seconds entries are good for.  None for no expiration
+        self.maxAgeByNamespace = dict(DATA_CACHE_MAX_AGE_BY_NAMESPACE); # Namespace specific defaults for maxAge
+        if maxAgeByNamespace is not None:
+            self.maxAgeByNamespace.update(maxAgeByNamespace);
+
+        self.entryByKey = OrderedDict();   # [expireTime, nBytes, value] by (namespace, key), in least to most recently used order
+        self.residentBytes = 0;
+
+        self.hits = 0;
+        self.misses = 0;
+        self.evictions = 0;
+        self.expirations = 0;
+        self.rejections = 0;
+        self.statsByNamespace = dict();
+
+    def namespaceStats(self, namespace):
+        if namespace not in self.statsByNamespace:
+            self.statsByNamespace[namespace] = {"entries": 0, "residentBytes": 0, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "rejections": 0};
+        return self.statsByNamespace[namespace];
+
+    def get(self, key, default=None, namespace=DEFAULT_NAMESPACE):
+        """Return the value stored for the key, or the default if there is none (or it has expired)"""
+        entry = self.lookup(namespace, key);
+        namespaceStats = self.namespaceStats(namespace);
+        if entry is None:
+            self.misses += 1;
+            namespaceStats["misses"] += 1;
+            return default;
+        self.hits += 1;
+        namespaceStats["hits"] += 1;
+        return entry[2];
+
+    def set(self, key, value, namespace=DEFAULT_NAMESPACE, maxAge=None, nBytes=None):
+        """Store the value for the key, evicting least recently used entries as needed to stay within the cache limits.
+        Entry will expire after maxAge seconds, or per the namespace (or cache) default if not specified.
+        Size will be estimated if nBytes is not given and there is a memory cap.  Values too large for the whole cache are not stored.
+        Returns whether the value was stored.
+        """
+        self.remove(namespace, key);
+
+        if maxAge is None:
+            maxAge = self.maxAgeByNamespace.get(namespace, self.maxAge);
+        expireTime = None;
+        if maxAge is not None:
+            expireTime = time.time() + maxAge;
+        if nBytes is None:
+            if self.maxBytes is None:
+                nBytes = 0; # No cap to enforce, so don't bother walking the value to estimate its size
+            else:
+                nBytes = estimateSize(value);
+        namespaceStats = self.namespaceStats(namespace);
+        if self.maxBytes is not None and nBytes > self.maxBytes:
+            if namespaceStats["rejections"] == 0:
+                log.warning("Data too large to cache in %s (%d bytes > %d maxBytes), will not be cached" % (namespace, nBytes, self.maxBytes) );
+            else:
+                log.debug("Data too large to cache in %s (%d bytes)" % (namespace, nBytes) );
+            self.rejections += 1;
+            namespaceStats["rejections"] += 1;
+            return False;
+
+        self.entryByKey[(namespace, key)] = [expireTime, nBytes, value];
+        self.residentBytes += nBytes;
+        namespaceStats["entries"] += 1;
+        namespaceStats["residentBytes"] += nBytes;
+
+        while (self.maxBytes is not None and self.residentBytes > self.maxBytes) or (self.maxEntries is not None and len(self.entryByKey) > self.maxEntries):
+            ((evictNamespace, evictKey), evictEntry) = self.entryByKey.popitem(last=False);
+            self.discardEntry(evictNamespace, evictEntry);
+            self.evictions += 1;
+            self.namespaceStats(evictNamespace)["evictions"] += 1;
+        return True;
+
+    def lookup(self, namespace, key):
+        """Return the entry for the key (marking it most recently used), or None if there is none or it has expired"""
+        entry = self.entryByKey.pop((namespace, key), None);
+        if entry is not None:
+            if entry[0] is not None and time.time() > entry[0]:
+                self.discardEntry(namespace, entry);
+                self.expirations += 1;
+                self.namespaceStats(namespace)["expirations"] += 1;
+                return None;
+            self.entryByKey[(namespace, key)] = entry;   # Re-insert as the most recently used
+        return entry;
+
+    def remove(self, namespace, key):
+        entry = self.entryByKey.pop((namespace, key), None);
+        if entry is not None:
+            self.discardEntry(namespace, entry);
+        return entry;
+
+    def discardEntry(self, namespace, entry):
+        """Update size accounting for an entry removed from entryByKey"""
+        self.residentBytes -= entry[1];
+        namespaceStats = self.namespaceStats(namespace);
+        namespaceStats["entries"] -= 1;
+        namespaceStats["residentBytes"] -= entry[1];
+
+    def pop(self, key, default=None, namespace=DEFAULT_NAMESPACE):
+        entry = self.remove(namespace, key);
+        if entry is None:
+            return default;
+        return entry[2];
+
+    def clear(self, namespace=None):
+        """Remove all entries, or just those in the given namespace"""
+        if namespace is None:
+            self.entryByKey.clear();
+            self.residentBytes = 0;
+            for namespaceStats in self.statsByNamespace.itervalues():
+                namespaceStats["entries"] = 0;
+                namespaceStats["residentBytes"] = 0;
+        else:
+            for (entryNamespace, key) in self.entryByKey.keys():
+                if entryNamespace == namespace:
+                    self.remove(entryNamespace, key);
+
+    def namespace(self, namespace):
+        """Dictionary style view of just the entries in the given namespace"""
+        return DataCacheNamespace(self, namespace);
+
+    # Plain dict interface, on the default namespace
+    def __contains__(self, key):
+        return self.lookup(DEFAULT_NAMESPACE, key) is not None;
+
+    def __getitem__(self, key):
+        missing = [];
+        value = self.get(key, missing);
+        if value is missing:
+            raise KeyError(key);
+        return value;
+
+    def __setitem__(self, key, value):
+        self.set(key, value);
+
+    def __delitem__(self, key):
+        if self.remove(DEFAULT_NAMESPACE, key) is None:
+            raise KeyError(key);
+
+    def __len__(self):
+        return len(self.entryByKey);
+
+    def stats(self):
+        """Dictionary of usage counters, overall and by namespace, for logging"""
+        return \
+            {   "entries": len(self.entryByKey),
+                "residentBytes": self.residentBytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejections": self.rejections,
+                "namespaces": dict( (namespace, dict(namespaceStats)) for (namespace, namespaceStats) in self.statsByNamespace.iteritems() ),
+            };
+
+    def logStats(self):
+        """Log one line summary of usage per namespace"""
+        for namespace, namespaceStats in sorted(self.statsByNamespace.iteritems()):
+            log.info("DataCache %(namespace)s: %(entries)d entries, %(residentBytes)d bytes, %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(expirations)d expirations, %(rejections)d rejections" % dict(namespaceStats, namespace=namespace) );
+
+class DataCacheNamespace:
+    """Dictionary style access to one namespace of a DataCache"""
+    def __init__(self, dataCache, namespace):
+        self.dataCache = dataCache;
+        self.namespace = namespace;
+
+    def get(self, key, default=None):
+        return self.dataCache.get(key, default, namespace=self.namespace);
+
+    def set(self, key, value, maxAge=None, nBytes=None):
+        return self.dataCache.set(key, value, namespace=self.namespace, maxAge=maxAge, nBytes=nBytes);
+
+    def pop(self, key, default=None):
+        return self.dataCache.pop(key, default, namespace=self.namespace);
+
+    def clear(self):
+        self.dataCache.clear(self.namespace);
+
+    def __contains__(self, key):
+        return self.dataCache.lookup(self.namespace, key) is not None;
+
+    def __getitem__(self, key):
+        missing = [];
+        value = self.get(key, missing);
+        if value is missing:
+            raise KeyError(key);
+        return value;
+
+    def __setitem__(self, key, value):
+        self.set(key, value);
+
+    def __delitem__(self, key):
+        if self.dataCache.remove(self.namespace, key) is None:
+            raise KeyError(key);
+
+    def __len__(self):
+        return self.dataCache.namespaceStats(self.namespace)["entries"];
+
+def estimateSize(value):
+    """Rough estimate of the memory used by a value and the (built-in type) containers and items within it"""
+    nBytes = sys.getsizeof(value);
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            nBytes += estimateSize(key) + estimateSize(item);
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            nBytes += estimateSize(item);
+    return nBytes;
@@ -15,6 +15,9 @@ IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery, RowItemModel, generatePlaceholders;
 from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from Util import log;
+from DataCache import DataCache, QUERY_RESULT_NAMESPACE;
+from AssociationBuffer import COLUMN_NAMES;
+from Const import DECAY_SCALE_KEY;
 
 IntegrityError = DBUtil.DB_CONNECTOR_MODULE.IntegrityError;
 
@@ -25,7 +28,7 @@ class DataManager:
     def __init__(self):
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.maxClinicalItemId = None;  # Can set to a value to limit what items will be processed.  Particularly for setting to 0, so will only work on negative values, generally only test cases, while leaving "real" data alone
-        self.dataCache = dict();  # If set, use as in memory data cache.  Set to None to avoid usage if having memory leak problems with persistent processes
+        self.dataCache = DataCache();  # If set, use as in memory data cache.  Set to None to avoid usage, or to a DataCache with limits for long-lived processes.  A plain dict() also works, without limits or namespaces
         self.queryCount = 0;
 
     def resetAssociationModel(self, conn=None):
@@ -147,12 +150,17 @@ class DataManager:
             baseCountQuery.addSelect("%scount" % countPrefix);
             baseCountQuery.addFrom("clinical_item");
             if acceptCache:
-                baseCountResultTable = self.executeCacheOption( baseCountQuery, conn=conn );
+                baseCountResultTable = self.executeCacheOption( baseCountQuery, conn=conn, namespace="baseCounts" );
             else:
                 baseCountResultTable = DBUtil.execute( baseCountQuery, conn=conn );
 
+            # Stored counts may be pending a (lazy) decay
+            decayScale = self.loadDecayScale(acceptCache=acceptCache, conn=conn);
+
             baseCountByItemId = dict();
             for (itemId, baseCount) in baseCountResultTable:
+                if decayScale != 1.0 and baseCount is not None:
+                    baseCount *= decayScale;
                 baseCountByItemId[itemId] = baseCount;
             return baseCountByItemId;
 
@@ -161,6 +169,72 @@ class DataManager:
                 conn.close();
 
 
+    def loadDecayScale(self, acceptCache=True, conn=None):
+        """Pending (lazy) decay scale factor to multiply the stored clinical_item_association counts
+        (and the clinical_item counts derived from them) by, to yield the current decayed counts.
+        See decayAssociationModel.  If acceptCache, checks the in-memory data cache first (which expires after a while
+        to recheck the database, see DATA_CACHE_MAX_AGE_BY_NAMESPACE), before the data_cache table.
+        """
+        dataCache = self.cacheNamespace("decayScale");
+        if dataCache is None: dataCache = dict();
+        decayScale = None;
+        if acceptCache:
+            decayScale = dataCache.get(DECAY_SCALE_KEY);
+        if decayScale is None:
+            decayScale = 1.0;
+            dataStr = self.getCacheData(DECAY_SCALE_KEY, conn=conn);
+            if dataStr is not None:
+                decayScale = float(dataStr);
+            dataCache[DECAY_SCALE_KEY] = decayScale;
+        return decayScale;
+
+    def decayAssociationModel(self, decay, lazy=False, conn=None):
+        """Decay (multiply) all of the clinical_item_association counts and time sums by the decay factor.
+
+        Unless lazy, do so with a single set based update of all of the columns at once,
+        folding in any pending lazy decay scale as well.
+
+        If lazy, don't touch the association rows at all, just multiply the pending decay scale
+        recorded in the data_cache table, so each decay step costs the same regardless of the model size.
+        Readers apply the scale to the stored counts (see loadDecayScale),
+        and AssociationAnalysis.commitUpdateBuffer divides new increments by it, so they are not decayed by prior steps.
+        Use a (non-lazy) decay of 1.0 to apply the pending scale to the stored counts and reset it,
+        e.g., before the stored counts grow large relative to the decayed values.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            # Check the database directly, as other processes may have decayed the model too
+            decayScale = self.loadDecayScale(acceptCache=False, conn=conn) * decay;
+
+            if lazy:
+                self.setCacheData(DECAY_SCALE_KEY, repr(decayScale), conn=conn);
+            else:
+                query = ["UPDATE clinical_item_association SET"];
+                for col in COLUMN_NAMES:
+                    query.append("%(col)s=%(col)s*%(p)s" % {"col":col,"p":DBUtil.SQL_PLACEHOLDER});
+                    query.append(",");
+                query.pop();    # Drop extra comma at end of list
+                query = str.join(" ", query);
+                log.debug("Decay association model by %s" % decayScale );
+                DBUtil.execute(query, (decayScale,)*len(COLUMN_NAMES), conn=conn);
+
+                self.clearCacheData(DECAY_SCALE_KEY, conn=conn);
+                self.clearCacheData("clinicalItemCountsUpdated", conn=conn);   # Denormalized counts will need to be decayed too
+
+            # Flag that any cached association metrics will be out of date
+            self.clearCacheData("analyzedPatientCount", conn=conn);
+            dataCache = self.cacheNamespace("decayScale");
+            if dataCache is not None:
+                dataCache.pop(DECAY_SCALE_KEY, None);
+
+            conn.commit();
+        finally:
+            if not extConn:
+                conn.close();
+
     def deactivateAnalysis(self, clinicalItemIds, conn=None):
         """The specified clinical_items will be removed from association analysis.
         This includes
@@ -481,45 +555,52 @@ class DataManager:
 
         linkedItemIdsByBaseId = None;
         try:
-            linkedItemIdsByBaseId = dict();
             query = "select clinical_item_id, linked_item_id from clinical_item_link";
             params = list();
             if maxItemId is not None:
                 query += " where clinical_item_id < %s" % DBUtil.SQL_PLACEHOLDER;
                 params.append(maxItemId);
             clinicalItemLinkTable = DBUtil.execute( query, params, conn=conn);
-            for (clinicalItemId, linkedItemId) in clinicalItemLinkTable:
-                if clinicalItemId not in linkedItemIdsByBaseId:
-                    linkedItemIdsByBaseId[clinicalItemId] = set();
-                linkedItemIdsByBaseId[clinicalItemId].add(linkedItemId);
-
-            # Additional passes to capture inherited relationships (beware this could be infinite loop if cyclic inheritance pattern)
-            lookForNewLinks = True;
-            inheritanceDepth = 0;
-            while lookForNewLinks:
-                lookForNewLinks = False;
-                inheritanceDepth += 1;
-
-                for (clinicalItemId, linkedItemIdSet) in linkedItemIdsByBaseId.iteritems():
-                    linkedItemIdSetCopy = set(linkedItemIdSet); # Make copy as could be modifying set as iterate through it
-                    for linkedItemId in linkedItemIdSetCopy:
-                        if linkedItemId in linkedItemIdsByBaseId:
-                            subLinkedItemIds = linkedItemIdsByBaseId[linkedItemId];
-                            preSize = len(linkedItemIdSet);
-                            linkedItemIdSet.update(subLinkedItemIds);
-                            postSize = len(linkedItemIdSet);
-                            if postSize > preSize:
-                                # New inherited links were recorded, so will need to do at least one more pass to keep look for further inheritance depth
-                                lookForNewLinks = True;
-
-                if inheritanceDepth > 8 and (math.log(inheritanceDepth,2) % 1) < 0.001:
-                    # Very high inheritance depth, caution that may be infinite loop that should be aborted
-                    log.warning("Clinical Item Link Inheritance Resolution down to depth %s.  Potential for infinite loop." % inheritanceDepth );
+            linkedItemIdsByBaseId = self.linkedItemIdsByBaseIdFromRows(clinicalItemLinkTable);
         finally:
             if not extConn:
                 conn.close();
         return linkedItemIdsByBaseId;
 
+    def linkedItemIdsByBaseIdFromRows(self, clinicalItemLinkRows):
+        """Build the linked item lookup dictionary (see loadLinkedItemIdsByBaseId)
+        from (clinical_item_id, linked_item_id) rows, whether queried from the database or read from a file.
+        """
+        linkedItemIdsByBaseId = dict();
+        for (clinicalItemId, linkedItemId) in clinicalItemLinkRows:
+            if clinicalItemId not in linkedItemIdsByBaseId:
+                linkedItemIdsByBaseId[clinicalItemId] = set();
+            linkedItemIdsByBaseId[clinicalItemId].add(linkedItemId);
+
+        # Additional passes to capture inherited relationships (beware this could be infinite loop if cyclic inheritance pattern)
+        lookForNewLinks = True;
+        inheritanceDepth = 0;
+        while lookForNewLinks:
+            lookForNewLinks = False;
+            inheritanceDepth += 1;
+
+            for (clinicalItemId, linkedItemIdSet) in linkedItemIdsByBaseId.iteritems():
+                linkedItemIdSetCopy = set(linkedItemIdSet); # Make copy as could be modifying set as iterate through it
+                for linkedItemId in linkedItemIdSetCopy:
+                    if linkedItemId in linkedItemIdsByBaseId:
+                        subLinkedItemIds = linkedItemIdsByBaseId[linkedItemId];
+                        preSize = len(linkedItemIdSet);
+                        linkedItemIdSet.update(subLinkedItemIds);
+                        postSize = len(linkedItemIdSet);
+                        if postSize > preSize:
+                            # New inherited links were recorded, so will need to do at least one more pass to keep look for further inheritance depth
+                            lookForNewLinks = True;
+
+            if inheritanceDepth > 8 and (math.log(inheritanceDepth,2) % 1) < 0.001:
+                # Very high inheritance depth, caution that may be infinite loop that should be aborted
+                log.warning("Clinical Item Link Inheritance Resolution down to depth %s.  Potential for infinite loop." % inheritanceDepth );
+        return linkedItemIdsByBaseId;
+
     def getCacheData(self,key,conn=None):
         """Utility function to retrieve cached data item from data_cache table.  Returns None if not found"""
         extConn = conn is not None;
@@ -536,6 +617,24 @@ class DataManager:
         if not extConn:
             conn.close();
 
+    def getCacheDataUpdateTime(self,key,conn=None):
+        """Utility function to retrieve when a cached data item in the data_cache table was last updated.  Returns None if not found.
+        Useful as a version token for anything derived from the cached item, since clearing and resetting the item will change it.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            cacheQuery = "select last_update from data_cache where data_key = %s" % DBUtil.SQL_PLACEHOLDER;
+            cacheResult = DBUtil.execute(cacheQuery, (key,), conn=conn);
+            if len(cacheResult) > 0:
+                return cacheResult[0][0];
+            else:
+                return None;
+        finally:
+            if not extConn:
+                conn.close();
+
     def setCacheData(self,key,value,conn=None):
         """Utility function to set cached data item in data_cache table"""
         extConn = conn is not None;
@@ -564,25 +663,39 @@ class DataManager:
         if not extConn:
             conn.close();
 
-    def executeCacheOption(self, query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, conn=None, connFactory=None, autoCommit=True):
+    def cacheNamespace(self, namespace):
+        """Return a dictionary style view of the named namespace of the instance's dataCache (if it's a DataCache),
+        or the dataCache itself (e.g., plain dict), or None if no dataCache is set.
+        """
+        if self.dataCache is None:
+            return None;
+        elif isinstance(self.dataCache, DataCache):
+            return self.dataCache.namespace(namespace);
+        else:
+            return self.dataCache;
+
+    def executeCacheOption(self, query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, conn=None, connFactory=None, autoCommit=True, namespace=QUERY_RESULT_NAMESPACE):
         """Wrap DBUtil.execute.  If instance's dataCache is present, will check and store any results in there
-        to help reduce time for repeat queries.
+        (under the given namespace) to help reduce time for repeat queries.
 
-        Beware, bad idea to store lots of varied, huge results in this cache, otherwise memory leak explosion.
+        Beware, bad idea to store lots of varied, huge results in this cache, unless it's a DataCache with limits,
+        otherwise memory leak explosion.
         """
         if connFactory is None:
             connFactory = self.connFactory;
 
-        dataCache = self.dataCache;
+        dataCache = self.cacheNamespace(namespace);
         if dataCache is None:
             dataCache = dict(); # Create a temporary holder
 
         queryStr = DBUtil.parameterizeQueryString(query);
-        if queryStr not in dataCache:
-            dataCache[queryStr] = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
+        resultTable = dataCache.get(queryStr);
+        if resultTable is None:
+            resultTable = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
+            dataCache[queryStr] = resultTable;
             self.queryCount += 1;
 
-        dataCopy = list(dataCache[queryStr]);
+        dataCopy = list(resultTable);
 
         return dataCopy;
 
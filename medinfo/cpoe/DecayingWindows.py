@@ -43,6 +43,7 @@ from medinfo.db.DBUtil import DB_CONNECTOR_MODULE
 IntegrityError = DB_CONNECTOR_MODULE.IntegrityError
 from medinfo.cpoe.test import TestAssociationAnalysis
 from medinfo.cpoe import AssociationAnalysis
+from medinfo.cpoe.DataManager import DataManager
 from medinfo.cpoe.test.Const import RUNNER_VERBOSITY
 from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
 from Util import log;
@@ -59,6 +60,7 @@ class DecayAnalysisOptions:
 		self.associationsPerCommit = None
 		self.itemsPerUpdate = None
 		self.outputFile = None
+		self.lazyDecay = False;	# If set, then decay the database stats lazily, by a global decay scale factor applied when the counts are read, rather than updating every association row each delta
 		self.skipLargerCountWindows = True;	# If set, then won't try to update association count fields longer than the given delta time, since will never be a different number than the next largest interval count and just consumes extra memory
 
 
@@ -68,63 +70,20 @@ class DecayingWindows:
 	def __init__(self):
 		"Default constructor"
 		self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+		self.dataManager = DataManager()
+		self.dataManager.connFactory = self.connFactory
 		self.decayCount = 0
 
 	def standardDecay (self, decayAnalysisOptions):
+		"""Decay all of the association stats in the database, with a single update of every count and time sum column,
+		or, if lazyDecay, just by recording the decay in the model's pending decay scale (see DataManager.decayAssociationModel)
+		"""
 		conn = self.connFactory.connection()
-		prefixes = ['', 'patient_', 'encounter_']
-		times = ['0', '3600', '7200', '21600', '43200', '86400', '172800', '345600', '604800', '1209600', '2592000', '7776000', '15552000', '31536000', '63072000', '126144000', 'any']
 		try:
-			log.debug("Connected to datbase");
-			curs = conn.cursor()
-
-			fields = list()
-			for prefix in prefixes:
-				for time in times:
-					fieldName = prefix + "count_" + str(time)
-					fields.append(fieldName + '=' + fieldName + "*" + str(decayAnalysisOptions.decay))
-
-			"""log.debug("starting to drop indices");
-			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_pkey;"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_clinical_item_fkey;"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_subsequent_item_fkey;"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_composite_key;"
-			curs.execute(sqlQuery)
-			sqlQuery = "DROP INDEX clinical_item_association_clinical_item_id;"
-			curs.execute(sqlQuery)
-			sqlQuery = "DROP INDEX clinical_item_association_subsequent_item_id;"
-			curs.execute(sqlQuery)
-			log.debug( "finished dropping indices" );
-			"""
-
 			log.debug("starting decay");
-			sqlQuery = "UPDATE clinical_item_association SET " + str.join(',', fields) + ";"
-			curs.execute(sqlQuery)
+			self.dataManager.decayAssociationModel(decayAnalysisOptions.decay, lazy=decayAnalysisOptions.lazyDecay, conn=conn)
 			log.debug("finished decay");
-
-			"""log.debug("starting to add indices");
-			sqlQuery = "ALTER TABLE clinical_item_association ADD CONSTRAINT clinical_item_association_pkey PRIMARY KEY (clinical_item_association_id);"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association ADD CONSTRAINT clinical_item_association_clinical_item_fkey FOREIGN KEY (clinical_item_id) REFERENCES clinical_item(clinical_item_id);"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association ADD CONSTRAINT clinical_item_association_subsequent_item_fkey FOREIGN KEY (subsequent_item_id) REFERENCES clinical_item(clinical_item_id);"
-			curs.execute(sqlQuery)
-			sqlQuery = "ALTER TABLE clinical_item_association ADD CONSTRAINT clinical_item_association_composite_key UNIQUE (clinical_item_id, subsequent_item_id);"
-			curs.execute(sqlQuery)
-			sqlQuery = "CREATE INDEX clinical_item_association_clinical_item_id ON clinical_item_association(clinical_item_id, subsequent_item_id);"
-			curs.execute(sqlQuery)
-			sqlQuery = "CREATE INDEX clinical_item_association_subsequent_item_id ON clinical_item_association(subsequent_item_id, clinical_item_id);"
-			curs.execute(sqlQuery)
-			log.debug("finished adding indices");
-			"""
-
-			conn.commit()
-			log.debug("finished commit");
 		finally:
-			curs.close()
 			conn.close()
 
 	def decayAnalyzePatientItems(self, decayAnalysisOptions):
@@ -238,6 +197,7 @@ class DecayingWindows:
 		parser.add_option("-a", "--associationsPerCommit", type="int", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit.")
 		parser.add_option("-u", "--itemsPerUpdate", type="int", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query.")
 		parser.add_option("-o", "--outputFile", dest="outputFile", help="If provided, send buffer to output file rather than commiting to database")
+		parser.add_option("-l", "--lazyDecay", dest="lazyDecay", action="store_true", help="If set, decay the database stats lazily by recording a global decay scale factor, applied when the counts are read, rather than updating every association row after each delta.")
 		(options, args) = parser.parse_args(argv[1:])
 
 		decayAnalysisOptions = DecayAnalysisOptions()
@@ -259,6 +219,8 @@ class DecayingWindows:
 
 		if options.outputFile is not None:
 			decayAnalysisOptions.outputFile = options.outputFile
+		if options.lazyDecay:
+			decayAnalysisOptions.lazyDecay = True
 
 		#set patientIds based on either a file input or args
 		decayAnalysisOptions.patientIds = list()
@@ -13,9 +13,10 @@ import json;
 import urlparse;
 import math;
 from datetime import datetime, timedelta;
+import numpy as np;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
-from medinfo.common.StatsUtil import ContingencyStats, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
+from medinfo.common.StatsUtil import ContingencyStats, ContingencyStatsArray, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.Model import RowItemFieldComparator;
@@ -23,11 +24,13 @@ from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.db.ResultsFormatter import TextResultsFormatter;
 
 from DataManager import DataManager;
+from AssociationMatrix import AssociationMatrix, MISSING_CATEGORY_ID;
 
 from Util import log;
 from Const import AGGREGATOR_OPTIONS;
 from Const import SECONDS_PER_DAY;
 from Const import CORE_FIELDS;
+from Const import ASSOCIATION_UPDATE_KEY, ASSOCIATION_MATRIX_CHECK_SECONDS;
 
 # List of fields that may be aggregated across results by a (weighted) average
 WEIGHTED_AVERAGE_FIELDS = ["nAB","nA"];
@@ -146,6 +149,32 @@ class RecommenderQuery:
             i += 1;
             fieldKey = "filterField%s" % i;
 
+    def cacheKey(self):
+        """Canonical, hashable representation of the query parameters that determine recommendation results,
+        (independent of item set ordering), suitable as a key to cache results by (see RecommendationCache).
+        """
+        timeDeltaSeconds = None;
+        if self.timeDeltaMax is not None:
+            timeDeltaSeconds = self.timeDeltaMax.days*SECONDS_PER_DAY + self.timeDeltaMax.seconds;
+        return \
+            (   tuple(sorted(self.queryItemIds)),
+                tuple(sorted(self.targetItemIds)),
+                tuple(sorted(self.excludeItemIds)),
+                tuple(sorted(self.excludeCategoryIds)),
+                timeDeltaSeconds,
+                self.countPrefix,
+                self.aggregationMethod,
+                self.sortField,
+                self.sortReverse,
+                tuple(sorted(self.fieldFilters.iteritems())),
+                self.limit,
+                self.maxRecommendedId,
+                self.acceptCache,
+                self.invertQuery,
+                self.itemsPerCluster,
+                self.minClusterWeight,
+            );
+
     def getDisplayFields(self):
         """Infer display fields based on sort and field options.  Check for duplicates."""
         displayFields = [self.sortField];
@@ -166,8 +195,9 @@ class BaseItemRecommender:
     def __init__(self):
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.dataManager = DataManager();
+        self.resultCache = None;    # If set to a RecommendationCache, reuse results for repeat queries
 
-    def __call__(self, query):
+    def __call__(self, query, conn=None):
         """Primary function.  Given a query object representing
         key clinical items (orders, etc.), return a set of
         clinical items, rank ordered and scored, based on
@@ -179,6 +209,14 @@ class BaseItemRecommender:
         """
         raise NotImplementedError("Abstract base class method.  Sub-class should override.");
 
+    def recommendBatch(self, queries, conn=None):
+        """Recommendations for each of a list of query objects (e.g., one per test patient),
+        returned as a list of the respective result lists, the same as calling this recommender on each query.
+        Sub-classes may override to share candidate preparation and score all of the queries
+        at once with matrix operations.  By default, just run each query in turn.
+        """
+        return [self(query, conn=conn) for query in queries];
+
     def defaultExcludedClinicalItemCategoryIds(self, conn=None):
         """Return the default list of clinical item categories that
         should be excluded from a recommendation list.
@@ -190,7 +228,7 @@ class BaseItemRecommender:
             extConn = False;
         try:
             query = """select clinical_item_category_id from clinical_item_category where default_recommend = 0""";
-            resultTable = self.dataManager.executeCacheOption(query, conn=conn);
+            resultTable = self.dataManager.executeCacheOption(query, conn=conn, namespace="itemLookups");
             self.dataManager.queryCount += 1;
             excludeIds = set();
             for row in resultTable:
@@ -211,7 +249,7 @@ class BaseItemRecommender:
             extConn = False;
         try:
             query = """select clinical_item_id from clinical_item where default_recommend = 0""";
-            resultTable = self.dataManager.executeCacheOption(query, conn=conn);
+            resultTable = self.dataManager.executeCacheOption(query, conn=conn, namespace="itemLookups");
             self.dataManager.queryCount += 1;
             excludeIds = set();
             for row in resultTable:
@@ -319,6 +357,37 @@ class BaseItemRecommender:
 
     populateDerivedStats = staticmethod(populateDerivedStats);
 
+    def populateDerivedStatsList(resultModels, statIds):
+        """Same as populateDerivedStats, but for a whole list of resultModels at once,
+        calculating each stat for all of them with array operations (StatsUtil.ContingencyStatsArray).
+        Where the per item calculation would fail with a divide by zero, will instead yield inf or nan values.
+        """
+        for resultModel in resultModels:
+            if "nAB" not in resultModel:    # Baseline query, so just populate with full correlations
+                resultModel["nAB"] = resultModel["nB"];
+                resultModel["nA"] = resultModel["N"];
+
+        if not resultModels:
+            return;
+
+        nAB = np.array([resultModel["nAB"] for resultModel in resultModels], dtype=np.float64);
+        nA = np.array([resultModel["nA"] for resultModel in resultModels], dtype=np.float64);
+        nB = np.array([resultModel["nB"] for resultModel in resultModels], dtype=np.float64);
+        N = np.array([resultModel["N"] for resultModel in resultModels], dtype=np.float64);
+
+        contStats = ContingencyStatsArray( nAB, nA, nB, N );
+        contStats.normalize(truncateNegativeValues=False);
+
+        for statId in statIds:
+            statValues = None;  # Only calculate if some result still needs it
+            for i, resultModel in enumerate(resultModels):
+                if statId not in resultModel:   # Skip stats that have already been populated
+                    if statValues is None:
+                        statValues = contStats[statId].tolist();    # Plain Python floats, same as the per item calculation
+                    resultModel[statId] = statValues[i];
+
+    populateDerivedStatsList = staticmethod(populateDerivedStatsList);
+
     def populateAggregateStats(aggregateResult, query, statIds=None):
         """Calculate and populate the aggregate result item with stats based
         on its component items (expected in item keyed by "componentResults"
@@ -406,6 +475,15 @@ class BaseItemRecommender:
             (nA'-nAB') = Product((nAi-nAiB)/(N-nB)) * (N-nB)
             nA' = Product((nAi-nAiB)/(N-nB)) * (N-nB) + nAB'
         """
+        BaseItemRecommender.populateAggregateStatsList([aggregateResult], query, statIds);
+
+    populateAggregateStats = staticmethod(populateAggregateStats);
+
+    def populateAggregateStatsList(aggregateResults, query, statIds=None):
+        """Same as populateAggregateStats, but for a whole list of aggregateResults at once,
+        so the derived stats can be calculated with array operations over all of them
+        (see populateDerivedStatsList).
+        """
         if statIds is None:
             statIds = set([query.sortField]);
             for (fieldOp, value) in query.fieldFilters.iteritems():
@@ -413,6 +491,21 @@ class BaseItemRecommender:
                     field = fieldOp[:-1];
                     statIds.add(field);
 
+        for aggregateResult in aggregateResults:
+            BaseItemRecommender.aggregateComponentCounts(aggregateResult, query);
+
+        # Populate derived statistics that may be used as scoring measures
+        BaseItemRecommender.populateDerivedStatsList(aggregateResults, statIds);
+        for aggregateResult in aggregateResults:
+            aggregateResult["score"] = aggregateResult[query.sortField];
+
+    populateAggregateStatsList = staticmethod(populateAggregateStatsList);
+
+    def aggregateComponentCounts(aggregateResult, query):
+        """Populate the aggregate result item's nAB, nA, nB, N counts
+        based on its component items (if any), per query.aggregationMethod.
+        See populateAggregateStats for notes on the aggregation methods.
+        """
         if "componentResultsById" in aggregateResult:
             componentResultsById = aggregateResult["componentResultsById"];
 
@@ -487,11 +580,7 @@ class BaseItemRecommender:
                 aggregateResult["nAB"] = aggregateResult["Product(nAB/nB)"] * aggregateResult["nB"];
                 aggregateResult["nA"] = aggregateResult["Product((nA-nAB)/(N-nB))"] * (aggregateResult["N"]-aggregateResult["nB"]) + aggregateResult["nAB"];
 
-        # Populate derived statistics that may be used as scoring measures
-        BaseItemRecommender.populateDerivedStats(aggregateResult, statIds);
-        aggregateResult["score"] = aggregateResult[query.sortField];
-
-    populateAggregateStats = staticmethod(populateAggregateStats);
+    aggregateComponentCounts = staticmethod(aggregateComponentCounts);
 
 
     def filterAggregateResultsByQuery( self, aggregateResultsByItemId, query ):
@@ -499,27 +588,59 @@ class BaseItemRecommender:
         and ordered list of aggregateResults based on the query sort and filter options.
         Should require calculation of summary statistics for each aggregate result based on component results.
         """
-        # Now collect and sort the aggregated results to return only the top relevant results
-        aggregateResultsWithScore = list();
-        for aggregateResult in aggregateResultsByItemId.itervalues():
-            itemId = aggregateResult["clinical_item_id"];
-
-            # Calculate and populate the aggregate result item with stats based on its component items
-            #   to enable subsequent sorting and filtering
-            self.populateAggregateStats(aggregateResult, query);
-
-            # Look for value filters
-            excludeResult = False;
+        aggregateResults = aggregateResultsByItemId.values();
+        for aggregateResult in aggregateResults:
+            self.aggregateComponentCounts(aggregateResult, query);
+
+        # Look for value filters first, only calculating the stats needed to evaluate them
+        #   so that filtered out results never need their other stats calculated
+        filterStatIds = set();
+        for (fieldOp, value) in query.fieldFilters.iteritems():
+            if value is not None:
+                filterStatIds.add(fieldOp[:-1]);
+        if filterStatIds:
+            self.populateDerivedStatsList(aggregateResults, filterStatIds);
+
+            includeResult = np.ones(len(aggregateResults), dtype=bool);
             for (fieldOp, value) in query.fieldFilters.iteritems():
                 if value is not None:
                     field = fieldOp[:-1];
                     op = fieldOp[-1];
-                    if (aggregateResult[field] < value and op == "<") or (aggregateResult[field] > value and op == ">"):
-                        excludeResult = True;
-                        break;  # Don't need to look anymore
+                    fieldValues = np.array([aggregateResult[field] for aggregateResult in aggregateResults], dtype=np.float64);
+                    if op == "<":
+                        includeResult &= ~(fieldValues < value);
+                    elif op == ">":
+                        includeResult &= ~(fieldValues > value);
+            aggregateResults = [aggregateResult for (aggregateResult, include) in zip(aggregateResults, includeResult) if include];
+
+        # Score the remaining results
+        self.populateDerivedStatsList(aggregateResults, [query.sortField]);
+        for aggregateResult in aggregateResults:
+            aggregateResult["score"] = aggregateResult[query.sortField];
+
+        return self.selectTopResults(aggregateResults, query);
+
+    def selectTopResults(aggregateResults, query):
+        """Return the aggregateResults ordered by the query sortField (and sortReverse),
+        keeping only the top query.limit (if specified).
+
+        Rather than sorting all of the results, first partition out just the candidates
+        scoring at least as well as the limit-th best (including any ties with it),
+        and only sort those.  Yields the same results (and tie-breaking) as fully sorting.
+        """
+        candidateResults = aggregateResults;
+        if query.limit is not None and 0 < query.limit < len(aggregateResults):
+            scores = np.array([aggregateResult[query.sortField] for aggregateResult in aggregateResults], dtype=np.float64);
+            if not np.any(np.isnan(scores)):   # Can't rank these consistently, so leave them to the full sort
+                if query.sortReverse:
+                    scores = -scores;   # Partition puts the smallest first
+                limitScore = np.partition(scores, query.limit-1)[query.limit-1];
+                candidateResults = [aggregateResults[i] for i in np.flatnonzero(scores <= limitScore)];
 
-            if not excludeResult:
-                aggregateResultsWithScore.append( (aggregateResult[query.sortField], aggregateResult) );
+        # Now collect and sort the aggregated results to return only the top relevant results
+        aggregateResultsWithScore = list();
+        for aggregateResult in candidateResults:
+            aggregateResultsWithScore.append( (aggregateResult[query.sortField], aggregateResult) );
 
         aggregateResultsWithScore.sort();
         if query.sortReverse:
@@ -534,6 +655,7 @@ class BaseItemRecommender:
 
         return topAggregateResults;
 
+    selectTopResults = staticmethod(selectTopResults);
 
 
 class ItemAssociationRecommender(BaseItemRecommender):
@@ -553,9 +675,39 @@ class ItemAssociationRecommender(BaseItemRecommender):
     If default is set, will just return whatever are the most common
     clinical items overall as recommendations.  Useful for "cold starts"
     when don't have much initial information to key recommendations from.
+
+    If associationMatrix is set (see loadAssociationMatrix), association and base counts
+    are all read from that in-memory snapshot instead of querying the database,
+    yielding the same rankings.  The snapshot is reloaded when AssociationUpdater commits updates (see refreshAssociationMatrix).
     """
 
+    def __init__(self):
+        BaseItemRecommender.__init__(self);
+        self.associationMatrix = None;  # If set to an AssociationMatrix snapshot, use it instead of querying clinical_item_association
+        self.associationMatrixFilename = None;  # File the snapshot was loaded from, to reload it from when updated
+        self.associationMatrixVersion = None;   # ASSOCIATION_UPDATE_KEY data_cache time when the snapshot was loaded
+        self.associationMatrixCheckTime = None; # When last checked whether the snapshot is still up to date
+        self.associationMatrixCheckSeconds = ASSOCIATION_MATRIX_CHECK_SECONDS;  # Set None to never check (e.g., if updated in process)
+
     def __call__(self, query, default=False, conn=None):
+        """Calculate recommendations for the query (see calculateRecommendations),
+        reusing any results for the same query from the resultCache, if one is set.
+        """
+        if self.associationMatrix is not None:
+            self.refreshAssociationMatrix(conn=conn);
+
+        if self.resultCache is None:
+            return self.calculateRecommendations(query, default, conn);
+
+        # Cached results may lag association statistics updates until they expire (RESULT_CACHE_MAX_AGE)
+        cacheKey = (self.__class__.__name__, default) + query.cacheKey();
+        resultModels = self.resultCache.getResults(cacheKey);
+        if resultModels is None:
+            resultModels = self.calculateRecommendations(query, default, conn);
+            self.resultCache.putResults(cacheKey, resultModels);
+        return resultModels;
+
+    def calculateRecommendations(self, query, default=False, conn=None):
         extConn = True;
         if conn is None:
             conn = self.connFactory.connection();
@@ -589,23 +741,29 @@ class ItemAssociationRecommender(BaseItemRecommender):
 
             if default:
                 # Just query for most common items overall, no particular associations / key item priming
-                sqlQuery.addWhere("cia."+query.sourceCol()+" = cia."+query.targetCol()+"");
-                sqlQuery.addOrderBy("cia."+query.countPrefix+"count_0 desc");
-                sqlQuery.addOrderBy("cia."+query.sourceCol()+"");    # Ensure a stable ordering in case of equal scores
-                sqlQuery.limit = query.limit;
+                if self.associationMatrix is not None:
+                    resultModels = self.loadMatrixDefaultResultModels(query, countField);
+                else:
+                    sqlQuery.addWhere("cia."+query.sourceCol()+" = cia."+query.targetCol()+"");
+                    sqlQuery.addOrderBy("cia."+query.countPrefix+"count_0 desc");
+                    sqlQuery.addOrderBy("cia."+query.sourceCol()+"");    # Ensure a stable ordering in case of equal scores
+                    sqlQuery.limit = query.limit;
 
-                #print >> sys.stderr, "DEFAULT Query:", sqlQuery, sqlQuery.params
-                resultTable = self.dataManager.executeCacheOption( sqlQuery, includeColumnNames=True, conn=conn );
-                resultModels = modelListFromTable( resultTable );
-                resultModels = self.filterResultItems(resultModels, query);
+                    #print >> sys.stderr, "DEFAULT Query:", sqlQuery, sqlQuery.params
+                    resultTable = self.dataManager.executeCacheOption( sqlQuery, includeColumnNames=True, conn=conn, namespace="associationRows" );
+                    resultModels = modelListFromTable( resultTable );
+                    resultModels = self.filterResultItems(resultModels, query);
 
                 # Direct DB query results will basically work, just add a score column
                 #   Use total number of patient records as a denominator as theoretical number of distinct times an order could be made
                 #   Technically not perfectly accurate, since a single patient can have the same order entered in multiple times.
                 totalPatients = self.totalPatientCount(query, conn);
+                decayScale = self.countDecayScale(conn);
 
                 for result in resultModels:
                     nB = result["nB"] = result[query.countPrefix+"count_0"];
+                    if decayScale != 1.0:
+                        nB = result["nB"] = nB * decayScale;
                     N = result["N"] = totalPatients;
 
                     self.populateDerivedStats(result, [query.sortField]);
@@ -633,7 +791,10 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 #   # Above will not work however, since single query is pulling data for all query items,
                 #   # and really should be applying cut-off limit to each "sub-query"
                 #print >> sys.stderr, "AssocQuery:", sqlQuery, sqlQuery.params;
-                resultModels = self.loadResultModels( query, sqlQuery, conn=conn );
+                if self.associationMatrix is not None:
+                    resultModels = self.loadMatrixResultModels( query, countField, conn=conn );
+                else:
+                    resultModels = self.loadResultModels( query, sqlQuery, conn=conn );
 
                 if len(resultModels) < 1:
                     # Not able to find any recommendations based on this query data.  Just return default recommendations then.
@@ -645,6 +806,86 @@ class ItemAssociationRecommender(BaseItemRecommender):
             if not extConn:
                 conn.close();
 
+    def recommendBatch(self, queries, conn=None):
+        """Recommendations for each of the queries, as a list of the respective result lists.
+
+        If associationMatrix is set, queries that share the same options (other than their queryItemIds)
+        share one preparation of their association rows (see calculateRecommendationsBatch).
+        Otherwise, just calculate each in turn with one shared database connection.
+        Any resultCache is checked and populated the same as for individual queries.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+
+        try:
+            if self.associationMatrix is not None:
+                self.refreshAssociationMatrix(conn=conn);
+
+            resultsList = [None] * len(queries);
+            if self.associationMatrix is None:
+                for iQuery, query in enumerate(queries):
+                    resultsList[iQuery] = self(query, conn=conn);
+                return resultsList;
+
+            cacheKeys = None;
+            if self.resultCache is not None:
+                cacheKeys = [(self.__class__.__name__, False) + query.cacheKey() for query in queries];
+                for iQuery, cacheKey in enumerate(cacheKeys):
+                    resultsList[iQuery] = self.resultCache.getResults(cacheKey);
+
+            # Group the remaining queries by their options other than the query items
+            iQueriesByOptions = dict();
+            for iQuery, query in enumerate(queries):
+                if resultsList[iQuery] is None:
+                    optionsKey = query.cacheKey()[1:];
+                    if optionsKey not in iQueriesByOptions:
+                        iQueriesByOptions[optionsKey] = list();
+                    iQueriesByOptions[optionsKey].append(iQuery);
+
+            for iQueries in iQueriesByOptions.itervalues():
+                batchResultsList = self.calculateRecommendationsBatch( [queries[iQuery] for iQuery in iQueries], conn=conn );
+                for iQuery, resultModels in zip(iQueries, batchResultsList):
+                    resultsList[iQuery] = resultModels;
+                    if cacheKeys is not None:
+                        self.resultCache.putResults(cacheKeys[iQuery], resultModels);
+            return resultsList;
+        finally:
+            if not extConn:
+                conn.close();
+
+    def calculateRecommendationsBatch(self, queries, conn=None):
+        """Equivalent of calculateRecommendations for each of the queries, which must all share the same options
+        other than their queryItemIds, using the associationMatrix.
+
+        Slices out the association rows for all of the queries' items at once, applying the common candidate filters
+        and looking up their base counts as whole arrays, then aggregates each query's share of those rows
+        the same as an individual query would (aggregateRecommendations), yielding identical result models.
+        """
+        query = queries[0]; # Common options for all of the queries
+        countField = "count_any";
+        if query.timeDeltaMax is not None:
+            timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
+            countField = "count_%d" % timeDeltaSeconds;
+        countField = query.countPrefix+countField;
+
+        batchItemIds = set();
+        for batchQuery in queries:
+            batchItemIds.update(batchQuery.queryItemIds);
+        (headers, columns) = self.matrixComponentColumns( query, batchItemIds, countField );
+        N = float(self.totalPatientCount(query, conn));
+
+        resultsList = list();
+        for batchQuery in queries:
+            if len(batchQuery.queryItemIds) < 1:
+                # Special case of an empty query set, just look for the most commonly used items in general
+                resultsList.append( self(batchQuery, default=True, conn=conn) );
+            else:
+                resultModels = self.matrixResultModels( batchQuery, headers, columns, N );
+                resultsList.append( self.aggregateRecommendations( resultModels, batchQuery, countField, conn=conn ) );
+        return resultsList;
+
     def loadResultModels( self, query, sqlQuery, conn ):
         """Query for the results from the SQL query, but if the dataCache is set on this instance,
         see if this can be retrieved/stored from there as well, to minimize repetitive database hits.
@@ -654,10 +895,11 @@ class ItemAssociationRecommender(BaseItemRecommender):
         simpleSQLQuery = str(sqlQuery).replace(",%s" % DBUtil.SQL_PLACEHOLDER,"");   # Strip down multiple consecutive placeholders
 
         # Populate a cache if it has not already been so
-        dataCache = self.dataManager.dataCache;
+        dataCache = self.dataManager.cacheNamespace("associationRows");
         if dataCache is None: dataCache = dict();
-        if simpleSQLQuery not in dataCache:
-            dataCache[simpleSQLQuery] = dict();
+        resultsBySourceItemId = dataCache.get(simpleSQLQuery);
+        if resultsBySourceItemId is None:
+            resultsBySourceItemId = dict();
 
             #print >> sys.stderr, sqlQuery;
 
@@ -668,17 +910,18 @@ class ItemAssociationRecommender(BaseItemRecommender):
             for result in newResultModels:
                 #print >> sys.stderr, "CACHE IT:", (result);
                 sourceItemId = result[query.sourceCol()];
-                if sourceItemId not in dataCache[simpleSQLQuery]:
-                    dataCache[simpleSQLQuery][sourceItemId] = list();
+                if sourceItemId not in resultsBySourceItemId:
+                    resultsBySourceItemId[sourceItemId] = list();
                 resultCopy = dict(result);
-                dataCache[simpleSQLQuery][sourceItemId].append(resultCopy);
+                resultsBySourceItemId[sourceItemId].append(resultCopy);
+            dataCache[simpleSQLQuery] = resultsBySourceItemId;    # Store once complete, so a DataCache can account for its size
 
         # Pull out the relevant results of interest
         resultModels = list();
         # See if can find what we want from the previously cached results
         for queryItemId in query.queryItemIds:
-            if queryItemId in dataCache[simpleSQLQuery]:
-                for result in dataCache[simpleSQLQuery][queryItemId]:
+            if queryItemId in resultsBySourceItemId:
+                for result in resultsBySourceItemId[queryItemId]:
                     resultCopy = dict(result);
                     resultModels.append( resultCopy );
                     #print >> sys.stderr, "PULL IT", resultCopy;
@@ -687,6 +930,137 @@ class ItemAssociationRecommender(BaseItemRecommender):
         return resultModels;
 
 
+    def loadMatrixResultModels( self, query, countField, conn ):
+        """Equivalent of loadResultModels followed by populateResultCounts,
+        but taking the association rows for all of the query items as slices of the in-memory associationMatrix,
+        then filtering candidates and looking up nAB / nA / nB for all of them as whole arrays.
+        """
+        (headers, columns) = self.matrixComponentColumns( query, query.queryItemIds, countField );
+        N = float(self.totalPatientCount(query, conn));
+        return self.matrixResultModels( query, headers, columns, N );
+
+    def matrixComponentColumns( self, query, sourceItemIds, countField ):
+        """Association rows from the associationMatrix for each of the sourceItemIds,
+        filtered by the query's candidate options (other than its own queryItemIds, see matrixResultModels),
+        with their nAB / nA / nB counts.  Return (headers, columns) as parallel arrays, ordered by source item,
+        starting with the query.sourceCol() and query.targetCol() item IDs.
+        """
+        associationMatrix = self.associationMatrix;
+        baseCountField = query.countPrefix+"count_0";
+        (sourceItemIds, targetItemIds, countsByColumn) = associationMatrix.associationRows( sourceItemIds, [baseCountField, countField], invert=query.invertQuery );
+
+        # Same filters as the database query and filterResultItems
+        isCandidate = self.matrixCandidateMask( targetItemIds, query );
+        if query.targetItemIds:
+            isCandidate &= np.in1d( targetItemIds, list(query.targetItemIds) );
+        if query.excludeItemIds:
+            isCandidate &= ~np.in1d( targetItemIds, list(query.excludeItemIds) );
+
+        positions = np.flatnonzero(isCandidate);
+        positions = positions[np.argsort(sourceItemIds[positions], kind="mergesort")];
+        sourceItemIds = sourceItemIds[positions];
+        targetItemIds = targetItemIds[positions];
+        nABs = countsByColumn[countField][positions];
+        nAs = associationMatrix.baseCounts( sourceItemIds, query.countPrefix );
+        nBs = associationMatrix.baseCounts( targetItemIds, query.countPrefix );
+
+        headers = [query.sourceCol(), query.targetCol(), baseCountField, countField, "nAB", "nA", "nB"];
+        columns = [sourceItemIds, targetItemIds, countsByColumn[baseCountField][positions], nABs, nABs, nAs, nBs];
+        return (headers, columns);
+
+    def matrixResultModels( self, query, headers, columns, N ):
+        """Result models for the rows of the matrixComponentColumns that come from the query's items,
+        leaving out recommendations of the query items themselves (unless the query specifies targetItemIds).
+        Results are grouped by query item in the order of query.queryItemIds, same as loading them separately.
+        """
+        (sourceItemIds, targetItemIds) = columns[:2];
+        queryItemIds = list(query.queryItemIds);
+        starts = np.searchsorted( sourceItemIds, queryItemIds, side="left" );
+        ends = np.searchsorted( sourceItemIds, queryItemIds, side="right" );
+        positions = np.concatenate( [np.arange(start, end) for (start, end) in zip(starts, ends)] + [np.zeros(0, dtype=np.int64)] );
+        if not query.targetItemIds:
+            positions = positions[~np.in1d( targetItemIds[positions], queryItemIds )];
+
+        resultModels = list();
+        for row in zip(*[column[positions].tolist() for column in columns]):
+            result = dict(zip(headers, row));
+            result["N"] = N;
+            resultModels.append(result);
+        return resultModels;
+
+    def loadMatrixDefaultResultModels( self, query, countField ):
+        """Equivalent of the default (most common items overall) database query, but from the associationMatrix diagonal"""
+        baseCountField = query.countPrefix+"count_0";
+        (itemIds, countsByColumn) = self.associationMatrix.diagonal( [baseCountField, countField] );
+
+        isCandidate = self.matrixCandidateMask( itemIds, query );
+        itemIds = itemIds[isCandidate];
+        baseCounts = countsByColumn[baseCountField][isCandidate];
+        counts = countsByColumn[countField][isCandidate];
+
+        order = np.lexsort( (itemIds, -baseCounts) );    # Descending count, then item ID to ensure a stable ordering in case of equal scores
+        if query.limit is not None:
+            order = order[:query.limit];
+
+        headers = [query.sourceCol(), query.targetCol(), baseCountField, countField];
+        columns = [itemIds[order], itemIds[order], baseCounts[order], counts[order]];
+        resultModels = [RowItemModel(list(row), headers) for row in zip(*[column.tolist() for column in columns])];
+        return self.filterResultItems(resultModels, query);
+
+    def matrixCandidateMask( self, itemIds, query ):
+        """Boolean array of which recommendation candidate itemIds pass the query's
+        maxRecommendedId and excludeCategoryIds filters (that the database queries apply)
+        """
+        isCandidate = np.ones(len(itemIds), dtype=bool);
+        if query.maxRecommendedId is not None:
+            isCandidate &= (itemIds <= query.maxRecommendedId);
+        if query.excludeCategoryIds:
+            categoryIds = self.associationMatrix.itemCategoryIds(itemIds);
+            isCandidate &= (categoryIds != MISSING_CATEGORY_ID) & ~np.in1d( categoryIds, list(query.excludeCategoryIds) );
+        return isCandidate;
+
+    def loadAssociationMatrix(self, filename=None, conn=None):
+        """Set up an in-memory AssociationMatrix snapshot to use for subsequent queries.
+        If filename is given and exists, load the snapshot from there (fast startup for repeat / worker processes),
+        otherwise build it from the database, then save it to filename if given.
+        """
+        # Note the version before loading, so any update committed meanwhile will trigger another reload
+        self.associationMatrixVersion = self.dataManager.getCacheDataUpdateTime(ASSOCIATION_UPDATE_KEY, conn=conn);
+        self.associationMatrixCheckTime = time.time();
+        self.associationMatrixFilename = filename;
+
+        if filename is not None and os.path.exists(filename):
+            ifs = open(filename,"rb");
+            self.associationMatrix = AssociationMatrix.load(ifs);
+            ifs.close();
+        else:
+            associationMatrix = AssociationMatrix();
+            associationMatrix.connFactory = self.connFactory;
+            associationMatrix.dataManager = self.dataManager;
+            associationMatrix.loadFromDatabase(conn=conn);
+            if filename is not None:
+                ofs = open(filename,"wb");
+                associationMatrix.save(ofs);
+                ofs.close();
+            self.associationMatrix = associationMatrix;
+        if self.resultCache is not None:
+            self.resultCache.clear();   # Don't mix in results calculated from other association counts
+        return self.associationMatrix;
+
+    def refreshAssociationMatrix(self, conn=None):
+        """Reload the associationMatrix (from the same file, or the database) if AssociationUpdater
+        has committed updates since it was loaded (per the ASSOCIATION_UPDATE_KEY data_cache item).
+        Only checks once every associationMatrixCheckSeconds, rather than querying the database for every recommendation.
+        """
+        if self.associationMatrixCheckTime is None or self.associationMatrixCheckSeconds is None:
+            return; # Snapshot not loaded by loadAssociationMatrix, or not to be checked
+        if time.time() - self.associationMatrixCheckTime < self.associationMatrixCheckSeconds:
+            return;
+        self.associationMatrixCheckTime = time.time();
+        if self.dataManager.getCacheDataUpdateTime(ASSOCIATION_UPDATE_KEY, conn=conn) != self.associationMatrixVersion:
+            log.info("Reloading association matrix after association updates");
+            self.loadAssociationMatrix(self.associationMatrixFilename, conn=conn);
+
     def filterResultItems(self,resultModels,query):
         """Application level item filtering so get more DB results that can be cached in local memory
         for rapid retrieval again, but retaining filtering options.
@@ -718,7 +1092,8 @@ class ItemAssociationRecommender(BaseItemRecommender):
             return self( query, default=True, conn=conn );
 
         # Ensure core association count statistics are available for each result
-        self.populateResultCounts( resultModels, query, countField, conn=conn );
+        if self.associationMatrix is None:  # Results from the snapshot come with their counts already
+            self.populateResultCounts( resultModels, query, countField, conn=conn );
 
         # Organize all possible results by target item ID, with component results as sub items
         aggregateResultsByItemId = self.collateAggregateResuls( resultModels, query );
@@ -760,11 +1135,12 @@ class ItemAssociationRecommender(BaseItemRecommender):
             baseCountQuery.addSelect(countPrefix+"count");
             baseCountQuery.addFrom("clinical_item as ci");
             baseCountQuery.addWhere("analysis_status <> 0");    # Will need all records fit for analysis to scale any suggested item
-            baseCountResultTable = self.dataManager.executeCacheOption( baseCountQuery, includeColumnNames=True, conn=conn );
+            baseCountResultTable = self.dataManager.executeCacheOption( baseCountQuery, includeColumnNames=True, conn=conn, namespace="baseCounts" );
 
             baseCountResultsByItemId = modelDictFromList( modelListFromTable(baseCountResultTable), "clinical_item_id");
             # Count up total number of patients to turn counts into per patient frequency
             totalPatients = self.totalPatientCount(query, conn);
+            decayScale = self.countDecayScale(conn);
 
             for result in resultModels:
                 queryItemId = result[""+query.sourceCol()+""];
@@ -772,9 +1148,9 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 baseCountResultsByItemId[queryItemId][countPrefix+"count"]
 
                 # Ensure component items have core association counts.  Convert to floats to facilitate calculations
-                nAB = result["nAB"] = float(result[countField]);
-                nA = result["nA"] = float(baseCountResultsByItemId[queryItemId][countPrefix+"count"]);
-                nB = result["nB"] = float(baseCountResultsByItemId[targetItemId][countPrefix+"count"]);
+                nAB = result["nAB"] = float(result[countField]) * decayScale;
+                nA = result["nA"] = float(baseCountResultsByItemId[queryItemId][countPrefix+"count"]) * decayScale;
+                nB = result["nB"] = float(baseCountResultsByItemId[targetItemId][countPrefix+"count"]) * decayScale;
                 N = result["N"] = float(totalPatients);
 
         finally:
@@ -821,6 +1197,14 @@ class ItemAssociationRecommender(BaseItemRecommender):
         return resultModels;
 
 
+    def countDecayScale(self, conn):
+        """Pending (lazy) decay scale to apply to the association and base counts queried from the database
+        (see DataManager.decayAssociationModel).  Snapshot counts already have it applied.
+        """
+        if self.associationMatrix is not None:
+            return 1.0;
+        return self.dataManager.loadDecayScale(conn=conn);
+
     def totalPatientCount(self, query, conn):
         """DB Query for total patient count to use to scale data.
         Option to filter essentially to only test data
@@ -838,10 +1222,22 @@ class ItemAssociationRecommender(BaseItemRecommender):
         if isSpecializedQuery:
             return SIMULATED_PATIENT_COUNT;
 
-        # First do optimistic check that results will already be in database result cache
+        # Snapshot already has the count from when it was loaded
+        if self.associationMatrix is not None:
+            return self.associationMatrix.totalPatients;
+
+        # First do optimistic check that results will already be in local memory or database result cache
+        #   (local memory copy expires after a while to recheck the database, see DATA_CACHE_MAX_AGE_BY_NAMESPACE)
+        dataCache = self.dataManager.cacheNamespace("totalPatientCount");
+        if dataCache is None: dataCache = dict();
+        totalPatients = dataCache.get("analyzedPatientCount");
+        if totalPatients is not None:
+            return totalPatients;
+
         dataStr = self.dataManager.getCacheData("analyzedPatientCount", conn=conn);
         if dataStr is not None:
             totalPatients = float(dataStr);
+            dataCache["analyzedPatientCount"] = totalPatients;
             return totalPatients;
 
         # No result returned from cache, so do raw query
@@ -851,10 +1247,11 @@ class ItemAssociationRecommender(BaseItemRecommender):
         totalPatientQuery.addWhere("analyze_date is not null");
         if query.maxRecommendedId is not None:  # Artificial filter to facilitate calculating only on test data
             totalPatientQuery.addWhere(""+query.sourceCol()+" <= %s" % query.maxRecommendedId );
-        totalPatients = float(self.dataManager.executeCacheOption(totalPatientQuery, conn=conn)[0][0]);
+        totalPatients = float(self.dataManager.executeCacheOption(totalPatientQuery, conn=conn, namespace="totalPatientCount")[0][0]);
 
         # Store the results in the data cache to expedite future repeat queries
         self.dataManager.setCacheData("analyzedPatientCount", str(totalPatients), conn=conn);
+        dataCache["analyzedPatientCount"] = totalPatients;
 
         return totalPatients;
 
@@ -868,12 +1265,16 @@ class ItemAssociationRecommender(BaseItemRecommender):
                     "   <outputFile>    Tab-delimited table of recommender results..\n"+\
                     "                       Leave blank or specify \"-\" to send to stdout.\n"
         parser = OptionParser(usage=usageStr)
+        parser.add_option("-a", "--associationMatrix", dest="associationMatrix", metavar="<snapshotFile>", help="Score recommendations from an in-memory snapshot of the association counts instead of querying clinical_item_association for them.  Loads the snapshot from the named .npz file, or builds it from the database and saves it there if the file does not exist yet.");
 
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
         timer = time.time();
         if len(args) > 0:
+            if options.associationMatrix is not None:
+                self.loadAssociationMatrix(options.associationMatrix);
+
             queryStr = args[0];
             # Format the results for output
             outputFilename = None;
@@ -897,8 +1298,7 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 # Denormalize results with links to clinical item descriptions
                 self.formatRecommenderResults(recommendedData);
                 # Ensure derived fields are populated if selected for display
-                for resultModel in recommendedData:
-                    self.populateDerivedStats(resultModel, displayFields);
+                self.populateDerivedStatsList(recommendedData, displayFields);
 
             colNames = ["rank","clinical_item_id","name","description","category_description"];
             colNames.extend(displayFields);
@@ -922,6 +1322,10 @@ class BaselineFrequencyRecommender(ItemAssociationRecommender):
     def __call__(self, query, conn=None):
         return ItemAssociationRecommender.__call__(self,query,default=True,conn=conn);
 
+    def recommendBatch(self, queries, conn=None):
+        """Nothing to share across queries, so just run each in turn"""
+        return [self(query, conn=conn) for query in queries];
+
 class RandomItemRecommender(BaseItemRecommender):
     """Absolute baseline for comparison.
     Recommender that just randomly scores and recommends items regardless of input.
@@ -973,6 +1377,10 @@ class RandomItemRecommender(BaseItemRecommender):
             if not extConn:
                 conn.close();
 
+    def recommendBatch(self, queries, conn=None):
+        """Nothing to share across queries, so just run each in turn"""
+        return [self(query, conn=conn) for query in queries];
+
 if __name__ == "__main__":
     instance = ItemAssociationRecommender();
     instance.main(sys.argv);
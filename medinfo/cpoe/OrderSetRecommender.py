@@ -11,6 +11,8 @@ import json;
 import urlparse;
 import math;
 from datetime import datetime, timedelta;
+import numpy as np;
+from scipy.sparse import csr_matrix, diags;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.common.StatsUtil import ContingencyStats, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
@@ -45,6 +47,9 @@ class OrderSetRecommender(BaseItemRecommender):
     Estimate P(item) = |OrderSets containing item| / |Items in Any Order Set|
         Can derive this by summing over all order sets for P(item|OrderSet_j)*P(OrderSet_j);
     Use above to generate TF*IDF, lift estimates with P(item|query) / P(item)
+
+    All of the above are calculated as sparse matrix products against the item x order set incidence matrix
+    built once in initItemLookups, for one or a batch of queries at a time (calculateScoreMatrix).
     """
     def __init__(self):
         """Initialize module with prior generated model and word document counts from TopicModel module.
@@ -60,6 +65,15 @@ class OrderSetRecommender(BaseItemRecommender):
         self.itemIdsByOrderSetId = None;
         self.orderSetIdsByItemId = None;
 
+        # Sparse incidence matrix of order set contents, rows by orderSetItemIds, columns by orderSetIds
+        self.orderSetIds = None;
+        self.orderSetItemIds = None;
+        self.itemIndexById = None;
+        self.incidenceMatrix = None;
+        self.itemGivenOrderSetMatrix = None;    # Incidence matrix, column normalized to P(item|OrderSet)
+        self.orderSetSizes = None;  # Number of items in each order set
+        self.orderSetCounts = None; # Number of order sets each item is in
+
     def initItemLookups(self, query):
         """Load lookup info and save into local member variables for reuse later
         so don't have to do wasteful repeat DB lookups for serial queries
@@ -85,6 +99,20 @@ class OrderSetRecommender(BaseItemRecommender):
                 self.orderSetIdsByItemId[itemId] = set();
             self.orderSetIdsByItemId[itemId].add(orderSetId);
 
+        self.orderSetIds = sorted(self.itemIdsByOrderSetId.keys());
+        self.orderSetItemIds = sorted(self.orderSetIdsByItemId.keys());
+        self.itemIndexById = dict( (itemId, iItem) for (iItem, itemId) in enumerate(self.orderSetItemIds) );
+        rowIndexes = list();
+        colIndexes = list();
+        for iOrderSet, orderSetId in enumerate(self.orderSetIds):
+            for itemId in self.itemIdsByOrderSetId[orderSetId]:
+                rowIndexes.append(self.itemIndexById[itemId]);
+                colIndexes.append(iOrderSet);
+        self.incidenceMatrix = csr_matrix( (np.ones(len(rowIndexes)), (rowIndexes, colIndexes)), shape=(len(self.orderSetItemIds), len(self.orderSetIds)) );
+        self.orderSetSizes = np.asarray(self.incidenceMatrix.sum(axis=0), dtype=float).ravel();
+        self.orderSetCounts = np.asarray(self.incidenceMatrix.sum(axis=1), dtype=float).ravel();
+        self.itemGivenOrderSetMatrix = (self.incidenceMatrix * diags(1.0/self.orderSetSizes)).tocsr();
+
         self.itemsById = DBUtil.loadTableAsDict("clinical_item");
         self.categoryIdByItemId = dict();
         self.patientCountByItemId = dict();
@@ -105,79 +133,107 @@ class OrderSetRecommender(BaseItemRecommender):
             self.initItemLookups(query);
 
         # Adapt query into dictionary format
+        queryItemCountById = self.queryItemCountById(query);
+
+        # Primary execution.  Apply query to generate scored relationship to each order set and then each item.
+        (weightMatrix, scoreMatrix, tfidfMatrix) = self.calculateScoreMatrix([queryItemCountById]);
+        return self.recommendedDataFromScores(query, queryItemCountById, weightMatrix[0], scoreMatrix[0], tfidfMatrix[0]);
+
+    def recommendBatch(self, queries, conn=None):
+        """Score all of the queries against the order sets at once (calculateScoreMatrix),
+        then build the recommended item list for each query.
+        """
+        if not queries:
+            return list();
+        if self.itemsById is None:
+            self.initItemLookups(queries[0]);
+
+        queryItemCountByIdList = [self.queryItemCountById(query) for query in queries];
+        (weightMatrix, scoreMatrix, tfidfMatrix) = self.calculateScoreMatrix(queryItemCountByIdList);
+
+        resultsList = list();
+        for iQuery, (query, queryItemCountById) in enumerate(zip(queries, queryItemCountByIdList)):
+            resultsList.append( self.recommendedDataFromScores(query, queryItemCountById, weightMatrix[iQuery], scoreMatrix[iQuery], tfidfMatrix[iQuery]) );
+        return resultsList;
+
+    def queryItemCountById(self, query):
+        """Adapt the query items into dictionary format"""
         queryItemCountById = query.queryItemIds;
         if not isinstance(queryItemCountById, dict):    # Not a dictionary, probably a one dimensional list/set, then just add counts of 1
             itemIds = queryItemCountById;
             queryItemCountById = dict();
             for itemId in itemIds:
                 queryItemCountById[itemId] = 1;
+        return queryItemCountById;
+
+    def calculateScoreMatrix(self, queryItemIdsList):
+        """Score a batch of queries (each a collection of query item IDs) at once.
+        Returns (weightMatrix, scoreMatrix, tfidfMatrix) as dense arrays with one row per query.
+        weightMatrix columns correspond to orderSetIds, estimating P(OrderSet|queryItems) (see estimateOrderSetWeights).
+        scoreMatrix columns correspond to orderSetItemIds, estimating P(item|queryItems) = Sum_j[ P(item|OrderSet_j)*P(OrderSet_j|queryItems) ]
+        tfidfMatrix scales the scores by the baseline order set counts, P(item|queryItems) / P(item)
+        """
+        weightMatrix = self.estimateOrderSetWeightMatrix(queryItemIdsList);
+        scoreMatrix = self.itemGivenOrderSetMatrix.dot(weightMatrix.T).T;
+        tfidfMatrix = scoreMatrix * (len(self.orderSetItemIds) / self.orderSetCounts); # Scale TF*IDF score based on baseline order set counts to prioritize disproportionately common items
+        return (weightMatrix, scoreMatrix, tfidfMatrix);
 
-        # Primary execution.  Apply query to generate scored relationship to each order set.
-        weightByOrderSetId = self.estimateOrderSetWeights(queryItemCountById, self.itemIdsByOrderSetId, self.orderSetIdsByItemId);
+    def recommendedDataFromScores(self, query, queryItemCountById, weights, scores, tfidfs):
+        """Build the sorted list of recommended item models for one query,
+        given its respective rows from calculateScoreMatrix.
+        """
+        weightByOrderSetId = dict( zip(self.orderSetIds, weights.tolist()) );
 
-        # Composite scores for (recommendable) items by taking weighted average across the top items for each topic
-        recScoreByItemId = dict();
+        # Composite scores for (recommendable) items
+        recommendedData = list();
         for itemId in self.candidateItemIds:
             if self.isItemRecommendable(itemId, queryItemCountById, query, self.categoryIdByItemId):
-                recScoreByItemId[itemId] = 0.0;
-        for orderSetId, orderSetWeight in weightByOrderSetId.iteritems():
-            for itemId in recScoreByItemId.keys():
-                itemWeight = self.itemOrderSetWeight(itemId, orderSetId, self.itemIdsByOrderSetId);
-                recScoreByItemId[itemId] += orderSetWeight*itemWeight;
-
-        # Build 2-pls with lists to sort by score
-        recommendedData = list();
-        numItemsInAnyOrderSet = len(self.orderSetIdsByItemId);
-        for itemId, totalItemWeight in recScoreByItemId.iteritems():
-            tfidf = 0.0;
-
-            if itemId in self.orderSetIdsByItemId:
-                numOrderSetsWithItem = len(self.orderSetIdsByItemId[itemId]);
-                tfidf = totalItemWeight * numItemsInAnyOrderSet / numOrderSetsWithItem;    # Scale TF*IDF score based on baseline order set counts to prioritize disproportionately common items
-            itemModel = \
-                {   "totalItemWeight": totalItemWeight, "tf": totalItemWeight, "PPV": totalItemWeight, "P(item|query)": totalItemWeight, "P(B|A)": totalItemWeight,
-                    "tfidf": tfidf, "lift": tfidf, "interest": tfidf, "P(item|query)/P(item)": tfidf, "P(B|A)/P(B)": tfidf,
-                    "clinical_item_id": itemId,
-                    "weightByOrderSetId": weightByOrderSetId, "numSelectedOrderSets": len(weightByOrderSetId),  # Duplicate for each item, but persist here to enable retrieve by caller
-                };
-            itemModel["score"] = itemModel[query.sortField];
-            recommendedData.append(itemModel);
+                iItem = self.itemIndexById[itemId];
+                totalItemWeight = float(scores[iItem]);
+                tfidf = float(tfidfs[iItem]);
+                itemModel = \
+                    {   "totalItemWeight": totalItemWeight, "tf": totalItemWeight, "PPV": totalItemWeight, "P(item|query)": totalItemWeight, "P(B|A)": totalItemWeight,
+                        "tfidf": tfidf, "lift": tfidf, "interest": tfidf, "P(item|query)/P(item)": tfidf, "P(B|A)/P(B)": tfidf,
+                        "clinical_item_id": itemId,
+                        "weightByOrderSetId": weightByOrderSetId, "numSelectedOrderSets": len(weightByOrderSetId),  # Duplicate for each item, but persist here to enable retrieve by caller
+                    };
+                itemModel["score"] = itemModel[query.sortField];
+                recommendedData.append(itemModel);
         recommendedData.sort( RowItemFieldComparator(["score","clinical_item_id"]), reverse=True);
         return recommendedData;
 
-    def estimateOrderSetWeights(self, queryItemIds, itemIdsByOrderSetId, orderSetIdsByItemId):
+    def estimateOrderSetWeights(self, queryItemIds):
+        """Dictionary of P(OrderSet|queryItems) by order set ID, for a single query.  See estimateOrderSetWeightMatrix"""
+        weightMatrix = self.estimateOrderSetWeightMatrix([queryItemIds]);
+        return dict( zip(self.orderSetIds, weightMatrix[0].tolist()) );
+
+    def estimateOrderSetWeightMatrix(self, queryItemIdsList):
         """
         Estimate each P(OrderSet|queryItems) = |Intersect(OrderSet,queryItems)| / |queryItems in Any OrderSets|
+        for a batch of queries, returning a dense array with one row per query and one column per orderSetIds.
 
         If blank query or no order set matches found, then use alternative estimate for
             P(OrderSet|queryItems) -> P(OrderSet), based on the size of the OrderSet relative to the size of all OrderSets combined
         """
-        numItemsInAnyOrderSet = float(len(orderSetIdsByItemId));
-
-        queryItemsInAnyOrderSet = set();
-        for orderSetId, itemIds in itemIdsByOrderSetId.iteritems():
-            queryItemsInAnyOrderSet.update( itemIds.intersection(queryItemIds) );
-        numQueryItemsInAnyOrderSet = float(len(queryItemsInAnyOrderSet));
-        if numQueryItemsInAnyOrderSet < 1:  # Blank query or otherwise searching for things we have no data.
-            # Treat as if effectively querying for all possible query items equally
-            queryItemIds = queryItemsInAnyOrderSet = set(orderSetIdsByItemId.keys());
-            numQueryItemsInAnyOrderSet = float(len(queryItemsInAnyOrderSet));
-
-        weightByOrderSetId = dict();
-        for orderSetId, itemIds in itemIdsByOrderSetId.iteritems():
-            numQueryItemsInOrderSet = len(itemIds.intersection(queryItemIds));
-            weightByOrderSetId[orderSetId] = numQueryItemsInOrderSet / numQueryItemsInAnyOrderSet;
-        return weightByOrderSetId;
-
-    def itemOrderSetWeight(self, itemId, orderSetId, itemIdsByOrderSetId):
-        """Estimate P(item|OrderSet) = |Insersect(item,OrderSet)| / |OrderSet|
-        Above intersection is simply 1 or 0 depending on if item is present in the given OrderSet
-        """
-        orderSetItemIds = itemIdsByOrderSetId[orderSetId];
-        queryIntersectionSize = len(orderSetItemIds.intersection([itemId]));
-        orderSetSize = float(len(orderSetItemIds));
-        itemWeight = queryIntersectionSize / orderSetSize;
-        return itemWeight;
+        # Sparse query x item indicator matrix.  Items not in any order set have no column and are effectively ignored
+        rowIndexes = list();
+        colIndexes = list();
+        for iQuery, queryItemIds in enumerate(queryItemIdsList):
+            for itemId in set(queryItemIds):
+                if itemId in self.itemIndexById:
+                    rowIndexes.append(iQuery);
+                    colIndexes.append(self.itemIndexById[itemId]);
+        queryMatrix = csr_matrix( (np.ones(len(rowIndexes)), (rowIndexes, colIndexes)), shape=(len(queryItemIdsList), len(self.orderSetItemIds)) );
+
+        numQueryItemsInAnyOrderSet = np.asarray(queryMatrix.sum(axis=1), dtype=float).ravel();
+        weightMatrix = queryMatrix.dot(self.incidenceMatrix).toarray();    # Counts of query items in each order set
+
+        blankQueries = (numQueryItemsInAnyOrderSet < 1);  # Blank query or otherwise searching for things we have no data.
+        numQueryItemsInAnyOrderSet[blankQueries] = len(self.orderSetItemIds);
+        weightMatrix[blankQueries,:] = self.orderSetSizes;  # Treat as if effectively querying for all possible query items equally
+
+        weightMatrix /= numQueryItemsInAnyOrderSet[:,np.newaxis];
+        return weightMatrix;
 
     def main(self, argv):
         """Main method, callable from command line"""
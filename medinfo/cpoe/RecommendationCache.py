@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+In-memory cache of recommender results, keyed by the normalized RecommenderQuery (see RecommenderQuery.cacheKey),
+so repeat requests for the same query items (e.g., from the web interface or evaluation runs)
+don't have to recalculate the recommendations from scratch.
+
+Least recently used results are evicted to stay within a memory cap, and results expire after a time to live
+(see DataCache).  Rather than querying the database on every lookup to check whether the association statistics
+have changed, results are simply allowed to lag updates until they expire.  Callers that know they just changed
+the statistics can invalidate the cache to see the updates immediately.  Committing association updates
+(AssociationAnalysis.commitUpdateBuffer) invalidates all of the caches in the same process (see invalidateAll),
+so only other processes have to wait for the expiration.
+"""
+import copy;
+import weakref;
+
+from DataCache import DataCache, estimateSize;
+from Util import log;
+from Const import RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_AGE;
+
+"""DataCache namespace to store recommender results in"""
+RESULT_NAMESPACE = "recommendations";
+
+"""All live RecommendationCache instances in this process, to invalidate together when the association statistics change"""
+_instances = weakref.WeakSet();
+
+def invalidateAll():
+    """Invalidate all of the RecommendationCache instances in this process"""
+    for cache in list(_instances):
+        cache.invalidate();
+
+class RecommendationCache(DataCache):
+    def __init__(self, maxBytes=RESULT_CACHE_MAX_BYTES, maxAge=RESULT_CACHE_MAX_AGE):
+        DataCache.__init__(self, maxBytes=maxBytes, maxAge=maxAge);
+        self.invalidations = 0;
+        _instances.add(self);
+
+    def getResults(self, key):
+        """Return a copy of the results cached for the key, or None if there are none (or they have expired)"""
+        results = self.get(key, namespace=RESULT_NAMESPACE);
+        if results is None:
+            return None;
+        return self.copyResults(results);
+
+    def putResults(self, key, results):
+        """Store a copy of the results for the key"""
+        self.set(key, self.copyResults(results), namespace=RESULT_NAMESPACE);
+
+    def invalidate(self):
+        """Clear out all cached results, such as after updating the underlying association statistics"""
+        if len(self) > 0:
+            log.debug("Association statistics updated, clearing %d cached recommendation results" % len(self) );
+            self.invalidations += 1;
+        self.clear();
+
+    def copyResults(self, results):
+        """Callers often add fields to the result models (e.g., formatRecommenderResults),
+        so work with copies of them rather than the cached ones.
+        """
+        return [copy.copy(result) for result in results];
+
+    def stats(self):
+        """Dictionary of usage counters, for logging"""
+        stats = DataCache.stats(self);
+        stats["invalidations"] = self.invalidations;
+        return stats;
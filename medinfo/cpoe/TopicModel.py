@@ -11,6 +11,7 @@ from optparse import OptionParser
 from cStringIO import StringIO;
 from datetime import timedelta;
 from pprint import pprint;
+import numpy as np;
 
 from medinfo.common.Const import COMMENT_TAG, NULL_STRING;
 from medinfo.common.Util import stdOpen, ProgressDots, loadJSONDict;
@@ -141,6 +142,60 @@ class TopicModel:
                 weightByItemIdByTopicId[topicId][itemId] = weight;
         return weightByItemIdByTopicId;
 
+    def generateTopicItemMatrix(self, model, itemsPerCluster, itemIds):
+        """Alternative to generateWeightByItemIdByTopicId, storing the topic item weights from enumerateTopics
+        into a dense (topics x items) array, with one column for each of the given itemIds.
+        Items outside of the top itemsPerCluster for a topic (or not in itemIds) are left with zero weight.
+        Return 2-ple (topicIds, weightMatrix), with topicIds listing the topic for each row.
+        """
+        itemIndexById = dict( (itemId, iItem) for (iItem, itemId) in enumerate(itemIds) );
+        topicItemsList = list(self.enumerateTopics(model, itemsPerCluster));
+        topicIds = np.array([topicId for (topicId, topicItems) in topicItemsList], dtype=np.int64);
+        weightMatrix = np.zeros((len(topicIds), len(itemIds)));
+        for iTopic, (topicId, topicItems) in enumerate(topicItemsList):
+            for (itemId, weight) in topicItems:
+                if itemId in itemIndexById:
+                    weightMatrix[iTopic, itemIndexById[itemId]] = weight;
+        return (topicIds, weightMatrix);
+
+    def generateTFIDFScales(self, docCountByWordId, itemIds):
+        """Array of TF*IDF scaling factors for the given itemIds, based on the document counts for each.
+        That is, the count of all documents / count of documents with the item, or zero if no documents with the item.
+        """
+        docCounts = np.array([docCountByWordId.get(itemId, 0) for itemId in itemIds], dtype=float);
+        tfidfScales = np.zeros(len(itemIds));
+        hasDocs = (docCounts > 0);
+        tfidfScales[hasDocs] = docCountByWordId[None] / docCounts[hasDocs];
+        return tfidfScales;
+
+    def topicItemMatrixFilename(self, baseName, itemsPerCluster):
+        """Generate a name for a topic item weight matrix file, given a base model filename and number of top items per topic stored"""
+        return baseName+".topicItems.%s.npz" % itemsPerCluster;
+
+    def saveTopicItemMatrix(self, filename, topicIds, itemIds, weightMatrix, tfidfScales, modelFilename=None):
+        """Save the results of generateTopicItemMatrix and generateTFIDFScales to a (numpy .npz) file.
+        If modelFilename is given, record its modification time, so loadTopicItemMatrix can recognize if the model is later replaced.
+        """
+        modelMTime = np.nan;
+        if modelFilename is not None:
+            modelMTime = os.path.getmtime(modelFilename);
+        np.savez(filename, topicIds=topicIds, itemIds=np.asarray(itemIds, dtype=np.int64), weightMatrix=weightMatrix, tfidfScales=tfidfScales, modelMTime=modelMTime);
+
+    def loadTopicItemMatrix(self, filename, modelFilename=None):
+        """Load back the contents of saveTopicItemMatrix.
+        Return 4-ple (topicIds, itemIds, weightMatrix, tfidfScales)
+        If modelFilename is given, only accept contents saved for the current version of that model file
+        (by its modification time), otherwise return None.
+        """
+        contents = np.load(filename);
+        try:
+            if modelFilename is not None:
+                if "modelMTime" not in contents.files or contents["modelMTime"] != os.path.getmtime(modelFilename):
+                    return None;
+            return (contents["topicIds"], contents["itemIds"], contents["weightMatrix"], contents["tfidfScales"]);
+        finally:
+            contents.close();
+
     def printTopicsToFile(self, model, docCountByWordId, topicFile, itemsPerCluster):
         """Print out the topic model contents to file in tab-delimited format for easy review"""
 
@@ -257,6 +312,12 @@ class TopicModel:
             print >> topicFile, COMMENT_TAG, json.dumps({"argv":argv});    # Print comment line with analysis arguments to allow for deconstruction later
             self.printTopicsToFile(model, docCountByWordId, topicFile, itemsPerCluster);
 
+            # Save topic item weights as a dense matrix, so recommenders don't have to re-extract them from the model
+            itemIds = sorted( itemId for itemId in docCountByWordId.iterkeys() if itemId is not None );
+            (topicIds, weightMatrix) = self.generateTopicItemMatrix(model, itemsPerCluster, itemIds);
+            tfidfScales = self.generateTFIDFScales(docCountByWordId, itemIds);
+            self.saveTopicItemMatrix(self.topicItemMatrixFilename(outputFilename, itemsPerCluster), topicIds, itemIds, weightMatrix, tfidfScales, outputFilename);
+
         else:
             parser.print_help()
             sys.exit(-1)
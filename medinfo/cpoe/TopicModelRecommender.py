@@ -11,6 +11,7 @@ import json;
 import urlparse;
 import math;
 from datetime import datetime, timedelta;
+import numpy as np;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.common.StatsUtil import ContingencyStats, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
@@ -21,11 +22,20 @@ from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.db.ResultsFormatter import TextResultsFormatter;
 from medinfo.cpoe.ItemRecommender import BaseItemRecommender;
 from medinfo.cpoe.TopicModel import TopicModel;
+from medinfo.cpoe.AssociationMatrix import MISSING_CATEGORY_ID;
 from Util import log;
 
+"""Result score fields based on the TF*IDF scaled item weights, rather than the raw item weights"""
+TFIDF_SCORE_FIELDS = ("tfidf","lift","interest","P(item|query)/P(item)","P(B|A)/P(B)");
+
 class TopicModelRecommender(BaseItemRecommender):
     """Implementation class for item (e.g., order) recommendation based on topic models 
     (LDA Latent Dirichlet Allocation or HDP Hierarchical Dirichlet Process).
+
+    Topic item weights are held in a dense (topics x items) matrix, with columns for each item in docCountByWordId,
+    so item scores for one or a batch of queries are just products with the query topic weights (calculateScoreMatrix).
+    If the model was loaded from a file, the matrix is loaded from the accompanying file saved with it in training
+    (see TopicModel.main), as long as that still matches the model.  Otherwise, it is generated from the model in memory.
     """
     def __init__(self, model, docCountByWordId=None):
         """Initialize module with prior generated model and word document counts from TopicModel module.
@@ -33,18 +43,28 @@ class TopicModelRecommender(BaseItemRecommender):
         BaseItemRecommender.__init__(self);
         self.modeler = TopicModel();    # Utility instance to run off of
 
+        self.modelFilename = None;
         if docCountByWordId:    # Specified both options
             self.model = model;
             self.docCountByWordId = docCountByWordId;
         else:   # If only the first one specified, interpret it as a base filename to load the objects from
-            filename = model;
-            (self.model, self.docCountByWordId) = self.modeler.loadModelAndDocCounts(filename);
+            self.modelFilename = model;
+            (self.model, self.docCountByWordId) = self.modeler.loadModelAndDocCounts(self.modelFilename);
 
         # Cached lookup data.  Don't repeat work for serial queries
         self.itemsById = None;
         self.categoryIdByItemId = None;
         self.candidateItemIds = None;
-        self.weightByItemIdByTopicId = None;
+
+        # Dense topic item weight matrix, rows by topicIds, columns by itemIds
+        self.itemsPerCluster = None;    # Number of top items per topic the matrix was generated for
+        self.topicIds = None;
+        self.topicIndexById = None;
+        self.itemIds = None;
+        self.topicItemMatrix = None;
+        self.tfidfScales = None;    # TF*IDF scaling factor for each item, based on baseline document counts
+        self.itemCategoryIds = None;    # Category ID for each item (or MISSING_CATEGORY_ID)
+        self.candidateMask = None;  # Whether each item is one of the candidateItemIds
     
     def initItemLookups(self, query):
         self.itemsById = DBUtil.loadTableAsDict("clinical_item");
@@ -56,54 +76,147 @@ class TopicModelRecommender(BaseItemRecommender):
         for itemId in self.docCountByWordId.keys():
             if self.isItemRecommendable(itemId, emptyQuerySet, query, self.categoryIdByItemId):
                 self.candidateItemIds.add(itemId);
+        self.candidateMask = None;  # Rebuild against the topic item matrix columns
+
+    def initTopicItemMatrix(self, itemsPerCluster):
+        """Load the dense topic item weight matrix and TF*IDF scaling factors for the given number of top items per topic.
+        Look for a copy saved alongside the model file for the same version of the model and items,
+        otherwise generate it from the model.
+        """
+        itemIds = np.array(sorted( itemId for itemId in self.docCountByWordId.iterkeys() if itemId is not None ), dtype=np.int64);
+
+        topicItemMatrixData = None;
+        if self.modelFilename is not None:
+            filename = self.modeler.topicItemMatrixFilename(self.modelFilename, itemsPerCluster);
+            if os.path.exists(filename):
+                topicItemMatrixData = self.modeler.loadTopicItemMatrix(filename, self.modelFilename);
+                if topicItemMatrixData is not None and not np.array_equal(topicItemMatrixData[1], itemIds):
+                    topicItemMatrixData = None; # Saved for a different set of items
+                if topicItemMatrixData is None:
+                    log.warning("Ignoring topic item matrix file that does not match the current model: %s" % filename);
+
+        if topicItemMatrixData is not None:
+            (self.topicIds, self.itemIds, self.topicItemMatrix, self.tfidfScales) = topicItemMatrixData;
+        else:
+            self.itemIds = itemIds;
+            (self.topicIds, self.topicItemMatrix) = self.modeler.generateTopicItemMatrix(self.model, itemsPerCluster, self.itemIds);
+            self.tfidfScales = self.modeler.generateTFIDFScales(self.docCountByWordId, self.itemIds);
+        self.topicIndexById = dict( (topicId, iTopic) for (iTopic, topicId) in enumerate(self.topicIds.tolist()) );
+        self.itemsPerCluster = itemsPerCluster;
+        self.candidateMask = None;
+
+    def initCandidateMask(self):
+        """Arrays parallel to the topic item matrix columns for vectorized isItemRecommendable checks"""
+        itemIds = self.itemIds.tolist();
+        self.itemCategoryIds = np.array([self.categoryIdByItemId.get(itemId, MISSING_CATEGORY_ID) for itemId in itemIds], dtype=np.int64);
+        self.candidateMask = np.array([itemId in self.candidateItemIds for itemId in itemIds], dtype=bool);
+
+    def recommendableMask(self, queryItemIds, query):
+        """Vectorized version of isItemRecommendable for each of the topic item matrix columns"""
+        mask = self.candidateMask.copy();
+        if queryItemIds:
+            mask &= ~np.in1d(self.itemIds, list(queryItemIds));
+        if query.excludeItemIds:
+            mask &= ~np.in1d(self.itemIds, list(query.excludeItemIds));
+        if query.excludeCategoryIds:
+            mask &= ~np.in1d(self.itemCategoryIds, list(query.excludeCategoryIds));
+        return mask;
     
     def __call__(self, query):
         # Given query items, use model to find related topics with relationship scores
 
-        # Load item category lookup information
-        if self.itemsById is None:
-            self.initItemLookups(query);
+        # Adapt query into dictionary format
+        queryItemCountById = self.queryItemCountById(query);
 
-        # Load model weight parameters once to save time on serial queries
-        if self.weightByItemIdByTopicId is None:
-            self.weightByItemIdByTopicId = self.modeler.generateWeightByItemIdByTopicId(self.model, query.itemsPerCluster);
+        # Primary model execute.  Apply to query to generate scored relationship to each "topic" and then each item
+        (weightByTopicIdList, scoreMatrix, tfidfMatrix) = self.calculateScoreMatrix([queryItemCountById], query);
+        return self.recommendedDataFromScores(query, queryItemCountById, weightByTopicIdList[0], scoreMatrix[0], tfidfMatrix[0]);
+
+    def recommendBatch(self, queries, conn=None):
+        """Run all of the queries through the model at once (calculateScoreMatrix),
+        grouped by the options that affect the model pass (excludeCategoryIds, itemsPerCluster, minClusterWeight),
+        then build the recommended item list for each query.
+        """
+        iQueriesByOptions = dict();
+        for iQuery, query in enumerate(queries):
+            optionsKey = (tuple(sorted(query.excludeCategoryIds)), query.itemsPerCluster, query.minClusterWeight);
+            if optionsKey not in iQueriesByOptions:
+                iQueriesByOptions[optionsKey] = list();
+            iQueriesByOptions[optionsKey].append(iQuery);
 
-        # Adapt query into bag-of-words format
+        resultsList = [None] * len(queries);
+        for iQueries in iQueriesByOptions.itervalues():
+            queryItemCountByIdList = [self.queryItemCountById(queries[iQuery]) for iQuery in iQueries];
+            (weightByTopicIdList, scoreMatrix, tfidfMatrix) = self.calculateScoreMatrix(queryItemCountByIdList, queries[iQueries[0]]);
+            for iRow, iQuery in enumerate(iQueries):
+                resultsList[iQuery] = self.recommendedDataFromScores(queries[iQuery], queryItemCountByIdList[iRow], weightByTopicIdList[iRow], scoreMatrix[iRow], tfidfMatrix[iRow]);
+        return resultsList;
+
+    def queryItemCountById(self, query):
+        """Adapt the query items into dictionary format"""
         queryItemCountById = query.queryItemIds;
         if not isinstance(queryItemCountById, dict):    # Not a dictionary, probably a one dimensional list/set, then just add counts of 1
             itemIds = queryItemCountById;
             queryItemCountById = dict();
             for itemId in itemIds:
                 queryItemCountById[itemId] = 1;
-        observedIds = set();
-        queryBag = list(self.modeler.itemCountByIdToBagOfWords(queryItemCountById, observedIds, self.itemsById, query.excludeCategoryIds));
-
-        # Primary model execute.  Apply to query to generate scored relationship to each "topic"
-        topicWeights = self.model[queryBag];
-        weightByTopicId = dict();
-        for (topicId, topicWeight) in topicWeights:
-            weightByTopicId[topicId] = topicWeight;
-
-        # Composite scores for (recommendable) items by taking weighted average across the top items for each topic
-        recScoreByItemId = dict();
-        for itemId in self.candidateItemIds:
-            if self.isItemRecommendable(itemId, queryItemCountById, query, self.categoryIdByItemId):
-                recScoreByItemId[itemId] = 0.0;
-        for topicId, topicWeight in weightByTopicId.iteritems():
-            if topicWeight > query.minClusterWeight:    # Ignore topics with tiny contribution
-                weightByItemId = self.weightByItemIdByTopicId[topicId];
-                for itemId in recScoreByItemId.keys():
-                    itemWeight = 0.0;
-                    if itemId in weightByItemId:
-                        itemWeight = weightByItemId[itemId];
-                    recScoreByItemId[itemId] += topicWeight*itemWeight;
-
-        # Build 2-pls with lists to sort by score
+        return queryItemCountById;
+
+    def calculateScoreMatrix(self, queryItemCountByIdList, query):
+        """Score a batch of query item count dictionaries at once, with query providing the other options (e.g., excludeCategoryIds, itemsPerCluster).
+        Returns (weightByTopicIdList, scoreMatrix, tfidfMatrix), with one element / row per query.
+        weightByTopicIdList has the model's topic weight dictionary for each query bag of words.
+        scoreMatrix columns correspond to itemIds, with the topic weighted average of each item's weight across topics.
+        tfidfMatrix scales the scores based on baseline document counts to prioritize disproportionately common items.
+        """
+        # Load item category lookup information
+        if self.itemsById is None:
+            self.initItemLookups(query);
+
+        # Load model weight parameters once to save time on serial queries
+        if self.topicItemMatrix is None or self.itemsPerCluster != query.itemsPerCluster:
+            self.initTopicItemMatrix(query.itemsPerCluster);
+
+        # Adapt queries into bag-of-words format, and run through the model as one corpus
+        queryBags = list();
+        for queryItemCountById in queryItemCountByIdList:
+            observedIds = set();
+            queryBags.append( list(self.modeler.itemCountByIdToBagOfWords(queryItemCountById, observedIds, self.itemsById, query.excludeCategoryIds)) );
+
+        weightByTopicIdList = list();
+        topicWeightMatrix = np.zeros((len(queryBags), len(self.topicIds)));
+        for iQuery, topicWeights in enumerate(self.model[queryBags]):
+            weightByTopicId = dict();
+            for (topicId, topicWeight) in topicWeights:
+                weightByTopicId[topicId] = topicWeight;
+                if topicWeight > query.minClusterWeight:    # Ignore topics with tiny contribution
+                    topicWeightMatrix[iQuery, self.topicIndexById[topicId]] = topicWeight;
+            weightByTopicIdList.append(weightByTopicId);
+
+        # Composite scores for items by taking weighted average across the top items for each topic
+        scoreMatrix = topicWeightMatrix.dot(self.topicItemMatrix);
+        tfidfMatrix = scoreMatrix * self.tfidfScales;
+        return (weightByTopicIdList, scoreMatrix, tfidfMatrix);
+
+    def recommendedDataFromScores(self, query, queryItemCountById, weightByTopicId, scores, tfidfs):
+        """Build the sorted list of recommended item models for one query,
+        given its respective elements from calculateScoreMatrix.
+        Includes all recommendable items, regardless of query.limit.
+        """
+        if self.candidateMask is None:
+            self.initCandidateMask();
+        itemIndexes = np.flatnonzero(self.recommendableMask(queryItemCountById, query));
+
+        sortScores = scores;
+        if query.sortField in TFIDF_SCORE_FIELDS:
+            sortScores = tfidfs;
+        # Descending order of score, but stable sort to keep any ties in item order
+        itemIndexes = itemIndexes[np.argsort(-sortScores[itemIndexes], kind="mergesort")];
+
+        # Build item models in sorted order
         recommendedData = list();
-        for itemId, totalItemWeight in recScoreByItemId.iteritems():
-            tfidf = 0.0;
-            if itemId in self.docCountByWordId and self.docCountByWordId[itemId] > 0.0:
-                tfidf = totalItemWeight * self.docCountByWordId[None] / self.docCountByWordId[itemId];    # Scale TF*IDF score based on baseline document counts to prioritize disproportionately common items
+        itemIds = self.itemIds[itemIndexes].tolist();
+        for itemId, totalItemWeight, tfidf in zip(itemIds, scores[itemIndexes].tolist(), tfidfs[itemIndexes].tolist()):
             itemModel = \
                 {   "totalItemWeight": totalItemWeight, "tf": totalItemWeight, "PPV": totalItemWeight, "P(item|query)": totalItemWeight, "P(B|A)": totalItemWeight,
                     "tfidf": tfidf, "lift": tfidf, "interest": tfidf, "P(item|query)/P(item)": tfidf, "P(B|A)/P(B)": tfidf,
@@ -112,7 +225,6 @@ class TopicModelRecommender(BaseItemRecommender):
                 };
             itemModel["score"] = itemModel[query.sortField];
             recommendedData.append(itemModel);
-        recommendedData.sort( RowItemFieldComparator("score"), reverse=True);
         return recommendedData;
 
     def main(self, argv):
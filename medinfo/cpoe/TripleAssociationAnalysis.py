@@ -2,12 +2,14 @@
 import sys, os
 import time;
 import math;
+from bisect import bisect_left, bisect_right;
 from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, generatePlaceholders;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.ResultsFormatter import TextResultsFormatter, TabDictReader;
 
 from AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
 from DataManager import DataManager;
@@ -46,24 +48,34 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         caller's responsibility to be careful not to repeat this analysis redundantly
         and generating duplicated statistics.
         """
+        self.analyzePatientItemSequences(patientIds, {tuple(itemIdSequence): virtualItemId});
+
+    def analyzePatientItemSequences(self, patientIds, virtualItemIdBySequence):
+        """Equivalent of analyzePatientItems for many sequences at once, in a single pass through the patient items.
+        virtualItemIdBySequence is a dictionary keyed by (mid-sequence item ID, end-sequence item ID) tuples,
+        with the virtual item ID to record each sequence's associations against.
+        """
         progress = ProgressDots();
         conn = self.connFactory.connection();
         try:
             # Preload lookup data to facilitate rapid checks and filters later
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
-            self.verifyVirtualItemLinked(itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=conn);
+            for itemIdSequence, virtualItemId in virtualItemIdBySequence.iteritems():
+                self.verifyVirtualItemLinked(itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=conn);
+            sequenceIndex = SequenceIndex(virtualItemIdBySequence);
 
             # Keep an in memory buffer of the updates to be done so can stall and submit them
             #   to the database in batch to minimize inefficient DB hits
             updateBuffer = dict();
+            lastActiveTime = time.time();
             log.info("Main patient item query...")
             analysisOptions = AnalysisOptions();
             analysisOptions.patientIds = patientIds;
             for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
                 log.debug("Calculate associations for Patient %d's %d patient items" % (iPatient, len(patientItemList)) );
-                self.updateItemAssociationsBuffer(itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
-                # Periodically send a quick arbitrary query to DB, otherwise connection may get recycled because DB thinks timeout with no interaction
-                DBUtil.execute("select 1+1", conn=conn);
+                self.updateSequenceAssociationsBuffer(sequenceIndex, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
+                # Periodically send a quick health check query to DB, otherwise connection may get recycled because DB thinks timeout with no interaction
+                lastActiveTime = DBUtil.keepAlive(conn, lastActiveTime);
             log.info("Final commit");
             self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn);  # Final update buffer commit
         finally:
@@ -80,68 +92,136 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         in the itemIdSequence.  If a triple sequence is found, then mark the end point as
         a virtualItem instance for counting associations.
         """
-        # Keep track of which items to mark as newly analyzed
-        newlyAnalyzedPatientItemIdSet = set();
+        sequenceIndex = SequenceIndex({tuple(itemIdSequence): virtualItemId});
+        self.updateSequenceAssociationsBuffer(sequenceIndex, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
 
-        # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
-        subsequentItemIds = set();
-        # Keep track of all item pairs encountered to avoid counting patient level duplicates
-        encounterIdPairsByItemIdPair = dict();
+    def updateSequenceAssociationsBuffer(self, sequenceIndex, patientItemList, updateBuffer, linkedItemIdsByBaseId=None, progress=None):
+        """Equivalent of updateItemAssociationsBuffer for all of the sequences in the SequenceIndex.
 
-        # Track where the mid-sequence items occur for easy comparison later
-        midSequenceItemDates = set();
-        for patientItem in patientItemList:
-            if patientItem["clinical_item_id"] == itemIdSequence[0]:
-                midSequenceItemDates.add(patientItem["item_date"]);
-        endSequenceItemsByPatientItemId = dict();
-
-        # Main nested loop to look for associations
-        for iItem1, patientItem1 in enumerate(patientItemList):
-            subsequentItemIds.clear();
+        Rather than scanning every item pair for each sequence, only visits the sequences whose end item
+        occurs for the patient, and finds the items that precede a sequence with bisect lookups
+        into the patient's sorted item dates:  An end item occurrence completes a triple for any item
+        up to the (last) mid-sequence item occurrence at or before it.
+        So the work per patient is proportional to the number of triples found, not the number of sequences.
+        """
+        if linkedItemIdsByBaseId is None:
+            linkedItemIdsByBaseId = dict();
 
-            for iItem2, patientItem2 in enumerate(patientItemList):
+        # Patient timeline, with dates of the mid and end sequence items for lookups
+        itemDates = [patientItem["item_date"] for patientItem in patientItemList];
+        patientItemsByItemId = dict();
+        for patientItem in patientItemList:
+            itemId = patientItem["clinical_item_id"];
+            if itemId in sequenceIndex.itemIds:
+                if itemId not in patientItemsByItemId:
+                    patientItemsByItemId[itemId] = list();
+                patientItemsByItemId[itemId].append(patientItem);
+
+        for (midItemId, endItemId, virtualItemId) in sequenceIndex.patientSequences(patientItemsByItemId):
+            endItems = patientItemsByItemId[endItemId];
+            endDates = [patientItem["item_date"] for patientItem in endItems];
+            midDates = [patientItem["item_date"] for patientItem in patientItemsByItemId[midItemId]];
+
+            # Keep track of all item pairs encountered to avoid counting patient level duplicates
+            encounterIdPairsByItemIdPair = dict();
+            endSequenceItemsByPatientItemId = dict();
+
+            # Only items up to the last mid-sequence item can start a triple sequence
+            for patientItem1 in patientItemList[:bisect_right(itemDates, midDates[-1])]:
                 itemIdPair = (patientItem1["clinical_item_id"], virtualItemId);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+                if not self.acceptableClinicalItemIdPair(patientItem1["clinical_item_id"], endItemId, linkedItemIdsByBaseId):
+                    continue;
+                isNewSubsequentItem = True; # Track repeats
+
+                # End items at or after the first mid-sequence item (at or) after this item complete a triple
+                nextMidDate = midDates[bisect_left(midDates, patientItem1["item_date"])];
+                for patientItem2 in endItems[bisect_left(endDates, nextMidDate):]:
+                    encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
 
-                # Verify is not a previously linked item pair, in which case no meaningful asssociation stats to calculate
-                #   and that the item dates are in non-negative direction
-                isPairToAnalyze = self.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId);
-                if isPairToAnalyze and self.isTripleSequence(patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
                     # Record the stat update
-                    isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
                     isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
                     isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
 
                     self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
 
-                    subsequentItemIds.add(virtualItemId);
+                    isNewSubsequentItem = False;
                     endSequenceItemsByPatientItemId[patientItem2["patient_item_id"]] = patientItem2;
 
                     if itemIdPair not in encounterIdPairsByItemIdPair:
                         encounterIdPairsByItemIdPair[itemIdPair] = set();
                     encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
 
-            # Update progress meter if available
-            if progress is not None:
-                progress.Update();
+            # Separate pass to get virtual item baseline counts.  Cannot be done directly, since the virtual items do not actually exist in the raw data
+            endSequenceItems = [patientItem for patientItem in endItems if patientItem["patient_item_id"] in endSequenceItemsByPatientItemId];
+            endSequenceDates = [patientItem["item_date"] for patientItem in endSequenceItems];
+            itemIdPair = (virtualItemId, virtualItemId);
+            isNewSubsequentItem = True;
+            for patientItem1 in endSequenceItems:
+                for patientItem2 in endSequenceItems[bisect_left(endSequenceDates, patientItem1["item_date"]):]: # Sorted by date, so only forward pairs from here on
+                    encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+
+                    isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
+                    isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);
+
+                    self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
 
-        # Separate pass to get virtual item baseline counts.  Cannot be done directly, since the virtual items do not actually exist in the raw data
-        subsequentItemIds.clear();
-        for iItem1, patientItem1 in enumerate(endSequenceItemsByPatientItemId.itervalues()):
-            for iItem2, patientItem2 in enumerate(endSequenceItemsByPatientItemId.itervalues()):
-                itemIdPair = (virtualItemId, virtualItemId);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+                    isNewSubsequentItem = False;
+                    if itemIdPair not in encounterIdPairsByItemIdPair:
+                        encounterIdPairsByItemIdPair[itemIdPair] = set();
+                    encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+
+        self.flushAssociationBuffer(updateBuffer);
+
+        # Update progress meter if available
+        if progress is not None:
+            for patientItem in patientItemList:
+                progress.Update();
 
-                isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
-                isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
-                isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);
+    def discoverFrequentSequences(self, patientIds, minSupport, itemIds=None):
+        """Find (mid-sequence item ID, end-sequence item ID) pairs, such that at least minSupport patients
+        have an occurrence of the mid item followed (at or after) by an occurrence of the end item,
+        in a single pass through the patient items.
+        These are the candidates to define virtual items for analyzePatientItemSequences,
+        which then counts the associations of every item that precedes them (i.e., all of the triples ending in them).
+        If itemIds provided, only consider sequences of those items.
+        Return a list of (itemIdSequence, patientSupport) tuples, sorted by descending support.
+        """
+        if itemIds is not None:
+            itemIds = set(itemIds);
 
-                self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
+        supportBySequence = dict();
+        progress = ProgressDots();
+        conn = self.connFactory.connection();
+        try:
+            linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+            analysisOptions = AnalysisOptions();
+            analysisOptions.patientIds = patientIds;
+            for patientItemList in self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn):
+                # First and last occurrence of each item.  Sequence occurs if the first of one is no later than the last of the other.
+                firstDateByItemId = dict();
+                lastDateByItemId = dict();
+                for patientItem in patientItemList:
+                    itemId = patientItem["clinical_item_id"];
+                    if itemIds is None or itemId in itemIds:
+                        if itemId not in firstDateByItemId:
+                            firstDateByItemId[itemId] = patientItem["item_date"];
+                        lastDateByItemId[itemId] = patientItem["item_date"];
+
+                firstDateItemIds = sorted( (firstDate, itemId) for itemId, firstDate in firstDateByItemId.iteritems() );
+                firstDates = [firstDate for (firstDate, itemId) in firstDateItemIds];
+                for endItemId, lastDate in lastDateByItemId.iteritems():
+                    for (firstDate, midItemId) in firstDateItemIds[:bisect_right(firstDates, lastDate)]:
+                        if midItemId != endItemId and self.acceptableClinicalItemIdPair(midItemId, endItemId, linkedItemIdsByBaseId):
+                            itemIdSequence = (midItemId, endItemId);
+                            supportBySequence[itemIdSequence] = supportBySequence.get(itemIdSequence, 0) + 1;
+                for patientItem in patientItemList:
+                    progress.Update();
+        finally:
+            conn.close();
 
-                subsequentItemIds.add(virtualItemId);
-                if itemIdPair not in encounterIdPairsByItemIdPair:
-                    encounterIdPairsByItemIdPair[itemIdPair] = set();
-                encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+        frequentSequences = [(itemIdSequence, support) for itemIdSequence, support in supportBySequence.iteritems() if support >= minSupport];
+        frequentSequences.sort(key=lambda sequenceSupport: (-sequenceSupport[1], sequenceSupport[0]));
+        return frequentSequences;
 
     def verifyVirtualItemLinked(self, itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=None):
         """Verify links exist from the virtualItemId to those in the itemIdSequence.
@@ -169,28 +249,6 @@ class TripleAssociationAnalysis(AssociationAnalysis):
             if not extConn:
                 conn.close();
 
-    def isTripleSequence(self, patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
-        """Assess whether the pair of items represents an acceptable triple sequence.
-        Is so if end point matches the end of the itemIdSequence, and there exists a mid-sequence
-        item in the intervening time, as previously tracked by the midSequenceItemDates.
-
-        Assume previous check has already confirmed that the item pairs are not previously linked,
-        and that there is a non-negative / forward direction in the relationship
-        """
-        itemId1 = patientItem1["clinical_item_id"]
-        itemId2 = patientItem2["clinical_item_id"]
-
-        isAcceptable = True;
-        isAcceptable = isAcceptable and itemId2 == itemIdSequence[-1];
-
-        foundMidSequenceDate = False;
-        for midDate in midSequenceItemDates:
-            if patientItem1["item_date"] <= midDate and midDate <= patientItem2["item_date"]:
-                foundMidSequenceDate = True;
-                break;  # Don't need to keep looking
-        isAcceptable = isAcceptable and foundMidSequenceDate;
-        return isAcceptable;
-
     def main(self, argv):
         """Main method, callable from command line"""
         usageStr =  "usage: %prog [options] <patientIds>\n"+\
@@ -198,6 +256,10 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--itemIdSequence", dest="itemIdSequence", help="Comma-separated sequence of item IDs to look for as representing the end of a triple of interest.")
         parser.add_option("-v", "--virtualItemId", dest="virtualItemId", help="ID of virtual clinical item to record against if find a specified triple.")
+        parser.add_option("-f", "--sequenceFile", dest="sequenceFile", help="Tab-delimited file with itemIdSequence and virtualItemId columns, to analyze many sequences in a single pass, instead of the itemIdSequence and virtualItemId options.")
+        parser.add_option("-d", "--discoverMinSupport", dest="discoverMinSupport", type="int", help="If provided, instead of analyzing associations, find the item sequences that occur for at least this many patients, and write them with their patient support to the outputFile, as candidates for a sequenceFile.");
+        parser.add_option("-i", "--discoverItemIds", dest="discoverItemIds", help="Comma-separated list of item IDs to limit sequence discovery to.");
+        parser.add_option("-o", "--outputFile", dest="outputFile", default="-", help="File to write discovered sequences to.  Default to stdout.");
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -213,14 +275,56 @@ class TripleAssociationAnalysis(AssociationAnalysis):
             # Unable to open as a filename, then interpret as simple comma-separated list
             patientIds.update(patientIdsParam.split(","));
 
-        itemIdSequence = [int(idStr) for idStr in options.itemIdSequence.split(",")];
-        virtualItemId = int(options.virtualItemId);
-
-        self.analyzePatientItems(patientIds, itemIdSequence, virtualItemId);
+        if options.discoverMinSupport is not None:
+            itemIds = None;
+            if options.discoverItemIds is not None:
+                itemIds = [int(idStr) for idStr in options.discoverItemIds.split(",")];
+            frequentSequences = self.discoverFrequentSequences(patientIds, options.discoverMinSupport, itemIds);
+
+            colNames = ["itemIdSequence","patientSupport"];
+            resultDicts = [RowItemModel(colNames,colNames)];    # Mock record to get a header / label row
+            for itemIdSequence, support in frequentSequences:
+                resultDicts.append( RowItemModel([str.join(",", [str(itemId) for itemId in itemIdSequence]), support], colNames) );
+            formatter = TextResultsFormatter(stdOpen(options.outputFile,"w"));
+            formatter.formatResultDicts( resultDicts, colNames );
+        else:
+            virtualItemIdBySequence = dict();
+            if options.sequenceFile is not None:
+                for sequenceRow in TabDictReader(stdOpen(options.sequenceFile)):
+                    itemIdSequence = tuple([int(idStr) for idStr in sequenceRow["itemIdSequence"].split(",")]);
+                    virtualItemIdBySequence[itemIdSequence] = int(sequenceRow["virtualItemId"]);
+            else:
+                itemIdSequence = tuple([int(idStr) for idStr in options.itemIdSequence.split(",")]);
+                virtualItemIdBySequence[itemIdSequence] = int(options.virtualItemId);
+
+            self.analyzePatientItemSequences(patientIds, virtualItemIdBySequence);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
 
+class SequenceIndex:
+    """Lookup of the (mid-sequence item ID, end-sequence item ID) sequences to analyze, and their virtual item IDs,
+    indexed by end item, so only need to consider the sequences a patient's items could complete.
+    """
+    def __init__(self, virtualItemIdBySequence):
+        self.itemIds = set();   # All items involved in any sequence
+        self.sequencesByEndItemId = dict();
+        for (midItemId, endItemId), virtualItemId in sorted(virtualItemIdBySequence.iteritems()):
+            if endItemId not in self.sequencesByEndItemId:
+                self.sequencesByEndItemId[endItemId] = list();
+            self.sequencesByEndItemId[endItemId].append( (midItemId, virtualItemId) );
+            self.itemIds.add(midItemId);
+            self.itemIds.add(endItemId);
+
+    def patientSequences(self, patientItemsByItemId):
+        """Generate (midItemId, endItemId, virtualItemId) for each sequence whose items both occur
+        in the given patient's items (keyed by item ID)
+        """
+        for endItemId in patientItemsByItemId.iterkeys():
+            for (midItemId, virtualItemId) in self.sequencesByEndItemId.get(endItemId, ()):
+                if midItemId in patientItemsByItemId:
+                    yield (midItemId, endItemId, virtualItemId);
+
 if __name__ == "__main__":
     instance = TripleAssociationAnalysis();
     instance.main(sys.argv);
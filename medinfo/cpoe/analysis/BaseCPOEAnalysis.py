@@ -41,6 +41,8 @@ class AnalysisQuery:
                             #   If left unset (None), then just use all remaining orders / items for that patient
     numRecommendations = None;  # Number of orders / items to recommend for comparison against the verification set
     numRecsByOrderSet = None;   # Alternative option. If set, then figure out number of recommendations on the fly based on which key order was used to trigger the evaluation period
+    batchSize = None;   # Number of patients to query the recommender for at a time, if it can score a batch of queries at once
+    fetchSize = None;   # Number of patient item rows to fetch from the database at a time when streaming through query results
 
     baseCategoryId = None;  # ID of clinical item category to look for initial items / orders from (probably the ADMIT Dx item).
     baseItemId = None;      # ID of the specific clincial item to look for initial items / orders from
@@ -72,6 +74,8 @@ class AnalysisQuery:
         self.numVerifyItems = None;
         self.numRecommendations = None;
         self.numRecsByOrderSet = False;
+        self.batchSize = None;
+        self.fetchSize = 10000;
 
         self.baseCategoryId = None;
         self.baseItemId = None;
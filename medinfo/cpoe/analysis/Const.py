@@ -23,3 +23,6 @@ Exception if next item >=1 day away (option here), suggesting that items themsel
 instead of time, so just start from the base item time.
 """
 MAX_BASE_ITEM_TIME_RESOLUTION = timedelta(1);    # 1 day
+
+"""File extension for prepared patient item data stored as a binary archive (see PatientItemArchive) instead of tab-delimited text"""
+PATIENT_ITEM_ARCHIVE_EXT = ".npz";
@@ -24,10 +24,12 @@ from Util import log;
 from RecommendationClassificationAnalysis import RecommendationClassificationAnalysis;
 from BaseCPOEAnalysis import AnalysisQuery;
 from PreparePatientItems import PreparePatientItems;
+from PatientItemArchive import openPreparedPatientItemFile;
 from RecommendationClassificationAnalysis import RecommendationClassificationAnalysis;
 
 DEFAULT_RECOMMENDED_ITEM_COUNT = 10;    # When doing validation calculations, number of items to recommend when calculating precision and recall
 DEFAULT_SORT_FIELD = "P(B|A)";
+DEFAULT_BATCH_SIZE = 1000;  # Number of patients to score against the order sets at a time
 
 class OrderSetRecommenderClassificationAnalysis(RecommendationClassificationAnalysis):
     def __init__(self):
@@ -42,27 +44,21 @@ class OrderSetRecommenderClassificationAnalysis(RecommendationClassificationAnal
         for itemId, orderSetIds in analysisQuery.recommender.orderSetIdsByItemId.iteritems():
             orderSetCountByItemId[itemId] = len(orderSetIds);
 
+        batchSize = analysisQuery.batchSize;
+        if batchSize is None:
+            batchSize = DEFAULT_BATCH_SIZE;
+
         preparer = PreparePatientItems();
         # progress = ProgressDots(50,1,"Patients");
+        patientItemDataBatch = list();
         for patientItemData in preparer.loadPatientItemData(analysisQuery):
-            patientId = patientItemData["patient_id"];
-            analysisResults = \
-                self.analyzePatientItems \
-                (   patientItemData,
-                    analysisQuery,
-                    analysisQuery.baseRecQuery,
-                    patientId,
-                    analysisQuery.recommender,
-                );
-
-            if analysisResults is not None:
-                (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData) = analysisResults;  # Unpack results
-                # Start aggregating and calculating result stats
-                resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, orderSetCountByItemId, analysisQuery.baseRecQuery, recommendedData );
-                if "baseItemId" in patientItemData:
-                    analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
-                yield resultsStatData;
-            # progress.Update();
+            patientItemDataBatch.append(patientItemData);
+            if len(patientItemDataBatch) >= batchSize:
+                for resultsStatData in self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, orderSetCountByItemId):
+                    yield resultsStatData;
+                patientItemDataBatch = list();
+        for resultsStatData in self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, orderSetCountByItemId):
+            yield resultsStatData;
         # progress.PrintStatus();
 
     def analyzePatientItems(self, patientItemData, analysisQuery, recQuery, patientId, recommender):
@@ -76,20 +72,20 @@ class OrderSetRecommenderClassificationAnalysis(RecommendationClassificationAnal
         queryItemCountById = patientItemData["queryItemCountById"];
         verifyItemCountById = patientItemData["verifyItemCountById"];
 
-        recQuery.queryItemIds = queryItemCountById; # Have option to use as dictionary, but will also function as key set
+        recQuery.queryItemIds = self.recQueryItemIds(queryItemCountById);
         # recQuery.limit = analysisQuery.numRecommendations;
 
         # Query for recommended orders / items
         recommendedData = recommender( recQuery );
 
         # Distill down to just the set of recommended item IDs
-        recommendedItemIds = set();
-        for i, recommendationModel in enumerate(recommendedData):
-            if i >= analysisQuery.numRecommendations:
-                break;
-            recommendedItemIds.add(recommendationModel["clinical_item_id"]);
+        recommendedItemIds = self.topRecommendedItemIds(recommendedData, analysisQuery);
         return (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData);
 
+    def recQueryItemIds(self, queryItemCountById):
+        """Keep the query item counts, as the recommender has option to use them as a dictionary (but will also function as key set)"""
+        return queryItemCountById;
+
     def calculateResultStats( self, patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData ):
         resultsStatData = RecommendationClassificationAnalysis.calculateResultStats( self, patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
         # Copy elements from any item in recommended list
@@ -112,13 +108,14 @@ class OrderSetRecommenderClassificationAnalysis(RecommendationClassificationAnal
         parser.add_option("-X", "--excludeCategoryIds",  dest="excludeCategoryIds", help="For recommendation, exclude / skip any items who fall under one of these comma-separated category Ids.");
         parser.add_option("-s", "--sortField",  dest="sortField", default=DEFAULT_SORT_FIELD, help="Score field to sort top recommendations by.  Default to posterior probabilty / positive predictive value 'P(B|A)', but can also select 'lift' = 'tfidf' = 'interest' for TF*IDF style score weighting.");
         parser.add_option("-r", "--numRecs",   dest="numRecs",  default=DEFAULT_RECOMMENDED_ITEM_COUNT, help="Number of orders / items to recommend for comparison against the verification set.");
+        parser.add_option("-b", "--batchSize",   dest="batchSize",  default=DEFAULT_BATCH_SIZE, help="Number of patients to score against the order sets at a time.  Default %d." % DEFAULT_BATCH_SIZE);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
         timer = time.time();
         if len(args) >= 1:
             query = AnalysisQuery();
-            query.preparedPatientItemFile = stdOpen(args[0]);
+            query.preparedPatientItemFile = openPreparedPatientItemFile(args[0]);
             query.recommender = OrderSetRecommender();
             query.baseRecQuery = RecommenderQuery();
             if options.excludeCategoryIds is not None:
@@ -131,6 +128,7 @@ class OrderSetRecommenderClassificationAnalysis(RecommendationClassificationAnal
 
             query.baseRecQuery.sortField = options.sortField;
             query.numRecommendations = int(options.numRecs);
+            query.batchSize = int(options.batchSize);
 
             # Run the actual analysis
             analysisResults = self(query);
@@ -34,6 +34,7 @@ from Util import log;
 
 from BaseCPOEAnalysis import AnalysisQuery;
 from PreparePatientItems import PreparePatientItems;
+from PatientItemArchive import openPreparedPatientItemFile;
 from RecommendationClassificationAnalysis import RecommendationClassificationAnalysis;
 
 # When doing validation calculations, number of items to recommend when calculating precision and recall
@@ -279,7 +280,7 @@ class OrderSetUsageAnalysis(RecommendationClassificationAnalysis):
         timer = time.time();
         if len(args) >= 1:
             query = AnalysisQuery();
-            query.preparedPatientItemFile = stdOpen(args[0]);
+            query.preparedPatientItemFile = openPreparedPatientItemFile(args[0]);
             query.recommender = OrderSetRecommender();
             query.baseRecQuery = RecommenderQuery();
             # Default exclusions if none specified
@@ -15,6 +15,7 @@ Rough approach
 import sys, os
 import time;
 import json;
+import copy;
 from optparse import OptionParser
 from cStringIO import StringIO;
 from datetime import timedelta;
@@ -32,12 +33,15 @@ from Util import log;
 from BaseCPOEAnalysis import BaseCPOEAnalysis;
 from BaseCPOEAnalysis import RECOMMENDER_CLASS_LIST, RECOMMENDER_CLASS_BY_NAME, AnalysisQuery;
 from PreparePatientItems import PreparePatientItems;
+from PatientItemArchive import openPreparedPatientItemFile;
 
 from medinfo.analysis.Const import OUTCOME_IN_QUERY;
 
 # If have no information to work off of for a given target item, default prediction score
 DEFAULT_SCORE = None;
 
+DEFAULT_BATCH_SIZE = 1000;  # Number of patients to query the recommender for at a time (see BaseItemRecommender.recommendBatch)
+
 class OutcomePredictionAnalysis(BaseCPOEAnalysis):
     """Driver class to review given patient data and run sample
     recommendation / prediction queries against them and collect score statistics
@@ -53,42 +57,25 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             extConn = False;
 
         try:
-            # Recommender to test with
-            recommender = analysisQuery.recommender;
-
-            # Start building basic recommendation query to use for testing
-            recQuery = analysisQuery.baseRecQuery;
+            batchSize = analysisQuery.batchSize;
+            if batchSize is None:
+                batchSize = DEFAULT_BATCH_SIZE;
 
             # Start building results data
             resultsStatDataList = list();
             # progress = ProgressDots(50,1,"Patients");
 
-            # Query for all of the order / item data for the test patients.  Load one patient's data at a time
+            # Query for all of the order / item data for the test patients.  Load one patient's data at a time,
+            #   but query the recommender for a batch of patients at a time
             preparer = PreparePatientItems();
+            patientItemDataBatch = list();
             for patientItemData in preparer.loadPatientItemData(analysisQuery, conn=conn):
-                patientId = patientItemData["patient_id"];
-                (queryItemCountById, scoreByOutcomeId, existsByOutcomeId) = \
-                    self.analyzePatientItems \
-                    (   analysisQuery,
-                        recQuery,
-                        patientId,
-                        patientItemData,
-                        recommender,
-                        conn=conn
-                    );
-
-                if existsByOutcomeId is not None:
-                    # Verify that at least one of the labels is not trivial with the outcome occuring during the query period
-                    nonTrivialOutcomeExists = False;
-                    for outcomeResult in existsByOutcomeId.itervalues():
-                        if outcomeResult != OUTCOME_IN_QUERY:
-                            nonTrivialOutcomeExists = True;
-                    if not analysisQuery.skipIfOutcomeInQuery or nonTrivialOutcomeExists:
-                        # Start aggregating and calculating result stats
-                        resultsStatData = self.prepareResultStats( patientId, queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
-                        resultsStatDataList.append(resultsStatData);
-
+                patientItemDataBatch.append(patientItemData);
+                if len(patientItemDataBatch) >= batchSize:
+                    resultsStatDataList.extend( self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, conn=conn) );
+                    patientItemDataBatch = list();
                 # progress.Update();
+            resultsStatDataList.extend( self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, conn=conn) );
 
             # progress.PrintStatus();
 
@@ -98,6 +85,42 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             if not extConn:
                 conn.close();
 
+    def analyzePatientItemsBatch(self, patientItemDataList, analysisQuery, conn=None):
+        """Same as analyzePatientItems followed by prepareResultStats, but for a batch of test patients,
+        querying the recommender for all of them at once (recommendBatch).
+        Generates the result stats for each patient.
+        """
+        recommender = analysisQuery.recommender;
+
+        # Apparently not able to extract patient item data for some records, so skip those
+        patientItemDataList = [patientItemData for patientItemData in patientItemDataList if "existsByOutcomeId" in patientItemData];
+
+        # Customize a copy of the base recommendation query for each patient
+        recQueries = list();
+        for patientItemData in patientItemDataList:
+            recQuery = copy.copy(analysisQuery.baseRecQuery);
+            recQuery.queryItemIds = patientItemData["queryItemCountById"].keys();
+            #recQuery.targetItemIds = queryStartTime.targetItemIds;     # Already established in base construction
+            recQueries.append(recQuery);
+
+        # Query for recommended orders / items
+        recommendedDataList = recommender.recommendBatch(recQueries, conn=conn);
+
+        for patientItemData, recQuery, recommendedData in zip(patientItemDataList, recQueries, recommendedDataList):
+            patientId = patientItemData["patient_id"];
+            queryItemCountById = patientItemData["queryItemCountById"];
+            existsByOutcomeId = patientItemData["existsByOutcomeId"];
+
+            # Verify that at least one of the labels is not trivial with the outcome occuring during the query period
+            nonTrivialOutcomeExists = False;
+            for outcomeResult in existsByOutcomeId.itervalues():
+                if outcomeResult != OUTCOME_IN_QUERY:
+                    nonTrivialOutcomeExists = True;
+            if not analysisQuery.skipIfOutcomeInQuery or nonTrivialOutcomeExists:
+                # Start aggregating and calculating result stats
+                scoreByOutcomeId = self.scoreOutcomes(recQuery, recommendedData);
+                yield self.prepareResultStats( patientId, queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
+
     def analyzePatientItems(self, analysisQuery, recQuery, patientId, patientItemData, recommender, conn):
         """Given the primary query data and clinical item list for a given test patient,
         Parse through the item list and run a query to get the top recommended IDs
@@ -144,14 +167,18 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
 
         """
 
-        # Record scores per outcome
+        scoreByOutcomeId = self.scoreOutcomes(recQuery, recommendedData);
+
+        return (queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
+
+    def scoreOutcomes(self, recQuery, recommendedData):
+        """Record scores per outcome, from the recommendations for the target items"""
         scoreByOutcomeId = dict();
         for outcomeId in recQuery.targetItemIds:
             scoreByOutcomeId[outcomeId] = DEFAULT_SCORE;
         for recommendationModel in recommendedData:
             scoreByOutcomeId[recommendationModel["clinical_item_id"]] = recommendationModel[recQuery.sortField];
-
-        return (queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
+        return scoreByOutcomeId;
 
     def prepareResultStats( self, patientId, queryItemCountById, scoreByOutcomeId, existsByOutcomeId):
         """Organize query prediction stats for results viewing
@@ -207,6 +234,8 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
         parser.add_option("-a", "--aggregationMethod",  dest="aggregationMethod",  help="Aggregation method to use for recommendations based off multiple query items.  Options: %s." % list(AGGREGATOR_OPTIONS) );
         parser.add_option("-s", "--skipIfOutcomeInQuery",  dest="skipIfOutcomeInQuery",  action="store_true", help="If set, will skip patients where the outcome item occurs during the query period since that would defy the point of predicting the outcome.");
         parser.add_option("-m", "--maxRecommendedId",  dest="maxRecommendedId",  help="Specify a maximum ID value to accept for recommended items.  More used to limit output in test cases");
+        parser.add_option("-A", "--associationMatrix",  dest="associationMatrix", metavar="<snapshotFile>", help="Score recommendations from an in-memory snapshot of the association counts (see ItemAssociationRecommender.loadAssociationMatrix), allowing a whole batch of patients to be scored at once.  Loads the snapshot from the named .npz file, or builds it from the database and saves it there if the file does not exist yet.");
+        parser.add_option("-B", "--batchSize",  dest="batchSize",  default=DEFAULT_BATCH_SIZE, help="Number of patients to query the recommender for at a time.  Default %d." % DEFAULT_BATCH_SIZE);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -216,11 +245,14 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             query = AnalysisQuery();
             query.recommender = RECOMMENDER_CLASS_BY_NAME[options.recommender]();
             query.recommender.dataManager.dataCache = dict(); # Use local cache to speed up repeat queries
+            if options.associationMatrix is not None:
+                query.recommender.loadAssociationMatrix(options.associationMatrix);
+            query.batchSize = int(options.batchSize);
 
             query.baseRecQuery = RecommenderQuery();
             if options.preparedPatientItemFile:
                 # Don't reconstruct validation data through database, just read off validation file
-                query.preparedPatientItemFile = stdOpen(args[0]);
+                query.preparedPatientItemFile = openPreparedPatientItemFile(args[0]);
             else:
 
                 patientIdsParam = args[0];
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Binary, columnar storage of prepared patient item data (see PreparePatientItems),
+as an alternative to the tab-delimited text files with JSON encoded item count columns,
+so repeat analyses don't have to re-parse all of the text dictionaries.
+
+Stored as an uncompressed NumPy .npz archive with arrays:
+- columnNames: Original text file column names, in order
+- For each item count column (e.g., queryItemCountByIdJSON), named without the JSON suffix:
+    CSR (compressed sparse row) style arrays queryItemCountById.indptr, queryItemCountById.itemIds, queryItemCountById.counts,
+    such that the item IDs and counts for row i are itemIds[indptr[i]:indptr[i+1]], etc.
+- For each other column, one array of values per row.  Integers for ID and outcome columns, otherwise strings.
+
+Because the members are not compressed, they can be memory-mapped directly out of the archive file
+rather than read into memory, so can stream through large data sets.
+"""
+
+import sys, os
+import struct;
+import zipfile;
+import numpy as np;
+
+from medinfo.common.Util import stdOpen, ProgressDots, loadJSONDict;
+from Const import PATIENT_ITEM_ARCHIVE_EXT;
+
+ITEM_COUNT_SUFFIX = "JSON"; # Suffix of text file columns with JSON encoded item count dictionaries
+ROW_BLOCK_SIZE = 1000;  # Number of rows to convert from array values at a time when iterating through rows
+
+class PatientItemArchive:
+    """Prepared patient item data as columns of NumPy arrays.
+    Iterating through rows yields dictionaries equivalent to the rows of a prepared text file,
+    except the item count columns are already parsed into {itemId: count} dictionaries
+    under the column name without the JSON suffix (e.g., queryItemCountById).
+    """
+    def __init__(self, filename=None, mmap=True):
+        self.columnNames = list();
+        self.arrayByName = dict();
+        self.nRows = 0;
+        if filename is not None:
+            self.load(filename, mmap);
+
+    def __len__(self):
+        return self.nRows;
+
+    def __iter__(self):
+        return self.iterRows();
+
+    def itemCountColumns(self):
+        """Names of the item count columns, without the JSON suffix"""
+        return [columnName[:-len(ITEM_COUNT_SUFFIX)] for columnName in self.columnNames if isItemCountColumn(columnName)];
+
+    def itemCounts(self, column, iRow):
+        """Arrays of the item IDs and counts for the given row and item count column (without the JSON suffix)"""
+        indptr = self.arrayByName[column+".indptr"];
+        (start, end) = (indptr[iRow], indptr[iRow+1]);
+        return (self.arrayByName[column+".itemIds"][start:end], self.arrayByName[column+".counts"][start:end]);
+
+    def allItemIds(self, columns=None):
+        """Sorted array of the unique item IDs found in the given (or all) item count columns"""
+        if columns is None:
+            columns = self.itemCountColumns();
+        itemIdArrays = [self.arrayByName[column+".itemIds"] for column in columns];
+        if not itemIdArrays:
+            return np.array([], dtype=np.int32);
+        return np.unique(np.concatenate(itemIdArrays));
+
+    def iterRows(self, blockSize=ROW_BLOCK_SIZE):
+        """Generate a dictionary for each row.
+        Convert array values into regular Python values one block of rows at a time.
+        """
+        itemCountColumns = self.itemCountColumns();
+        valueColumns = [columnName for columnName in self.columnNames if not isItemCountColumn(columnName)];
+        for blockStart in xrange(0, self.nRows, blockSize):
+            blockEnd = min(blockStart+blockSize, self.nRows);
+
+            valuesByColumn = dict();
+            for columnName in valueColumns:
+                valuesByColumn[columnName] = self.arrayByName[columnName][blockStart:blockEnd].tolist();
+
+            itemCountByIdListByColumn = dict();
+            for column in itemCountColumns:
+                indptr = self.arrayByName[column+".indptr"][blockStart:blockEnd+1];
+                (start, end) = (indptr[0], indptr[-1]);
+                itemIds = self.arrayByName[column+".itemIds"][start:end].tolist();
+                counts = self.arrayByName[column+".counts"][start:end].tolist();
+                offsets = (indptr - start).tolist();
+                itemCountByIdListByColumn[column] = \
+                    [dict(zip(itemIds[offsets[i]:offsets[i+1]], counts[offsets[i]:offsets[i+1]])) for i in xrange(blockEnd-blockStart)];
+
+            for i in xrange(blockEnd-blockStart):
+                dataRow = dict();
+                for columnName in valueColumns:
+                    dataRow[columnName] = valuesByColumn[columnName][i];
+                for column in itemCountColumns:
+                    dataRow[column] = itemCountByIdListByColumn[column][i];
+                yield dataRow;
+
+    @staticmethod
+    def fromRows(dataRows, columnNames):
+        """Build an archive from rows of prepared patient item data, with the given (text file) column names.
+        Rows may be raw text values (as from TabDictReader) or already parsed values (as from PreparePatientItems).
+        For item count columns, will use the already parsed dictionary (column name without the JSON suffix) if available.
+        """
+        archive = PatientItemArchive();
+        archive.columnNames = list(columnNames);
+
+        valuesByColumn = dict();
+        itemIdsByColumn = dict();
+        countsByColumn = dict();
+        indptrByColumn = dict();
+        for columnName in columnNames:
+            if isItemCountColumn(columnName):
+                column = columnName[:-len(ITEM_COUNT_SUFFIX)];
+                itemIdsByColumn[column] = list();
+                countsByColumn[column] = list();
+                indptrByColumn[column] = [0];
+            else:
+                valuesByColumn[columnName] = list();
+
+        prog = ProgressDots();
+        for dataRow in dataRows:
+            for columnName in columnNames:
+                if isItemCountColumn(columnName):
+                    column = columnName[:-len(ITEM_COUNT_SUFFIX)];
+                    itemCountById = dataRow.get(column);
+                    if not isinstance(itemCountById, dict):
+                        itemCountById = loadJSONDict(dataRow[columnName], int, int);
+                    itemIdsByColumn[column].extend(itemCountById.iterkeys());
+                    countsByColumn[column].extend(itemCountById.itervalues());
+                    indptrByColumn[column].append(len(itemIdsByColumn[column]));
+                else:
+                    valuesByColumn[columnName].append(dataRow[columnName]);
+            archive.nRows += 1;
+            prog.update();
+
+        archive.arrayByName["columnNames"] = np.array(archive.columnNames);
+        for column in itemIdsByColumn.iterkeys():
+            archive.arrayByName[column+".indptr"] = np.array(indptrByColumn[column], dtype=np.int64);
+            archive.arrayByName[column+".itemIds"] = np.array(itemIdsByColumn[column], dtype=np.int32);
+            archive.arrayByName[column+".counts"] = np.array(countsByColumn[column], dtype=np.int32);
+        for columnName, values in valuesByColumn.iteritems():
+            archive.arrayByName[columnName] = valueArray(columnName, values);
+        return archive;
+
+    def save(self, filename):
+        """Write the archive arrays to an (uncompressed, so can be memory-mapped) .npz file"""
+        ofs = open(filename, "wb");
+        try:
+            np.savez(ofs, **self.arrayByName);
+        finally:
+            ofs.close();
+
+    def load(self, filename, mmap=True):
+        """Read an archive .npz file written by save.
+        If mmap, memory-map the arrays out of the file, rather than reading them all into memory.
+        """
+        if mmap:
+            self.arrayByName = memmapArchive(filename);
+        else:
+            archive = np.load(filename);
+            self.arrayByName = dict((name, archive[name]) for name in archive.files);
+            archive.close();
+        self.columnNames = self.arrayByName["columnNames"].tolist();
+        self.nRows = 0;
+        for columnName in self.columnNames:
+            if isItemCountColumn(columnName):
+                self.nRows = len(self.arrayByName[columnName[:-len(ITEM_COUNT_SUFFIX)]+".indptr"])-1;
+            else:
+                self.nRows = len(self.arrayByName[columnName]);
+            break;
+
+def isItemCountColumn(columnName):
+    return columnName.endswith(ITEM_COUNT_SUFFIX);
+
+def valueArray(columnName, values):
+    """Array of the values for a (non item count) column.
+    Integers for ID and outcome columns if possible (as parsed by PreparePatientItems.parsePreparedResultFile),
+    otherwise store the text representation as would appear in the tab-delimited file.
+    """
+    if columnName.endswith("id") or columnName.endswith("Id") or columnName.startswith("outcome."):
+        try:
+            return np.array([int(value) for value in values], dtype=np.int64);
+        except (TypeError, ValueError):
+            pass;   # Not all values available as integers, just keep as text then
+    return np.array([str(value) for value in values], dtype=np.string_);
+
+def memmapArchive(filename):
+    """Load the arrays of an uncompressed .npz archive as read-only memory maps into the archive file.
+    Find the .npy member data offsets from the zip local file headers.
+    Any compressed or object members are just loaded into memory instead.
+    """
+    arrayByName = dict();
+    archive = zipfile.ZipFile(filename);
+    ifs = open(filename, "rb");
+    try:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")];
+            ifs.seek(info.header_offset);
+            localHeader = ifs.read(30);
+            (nameLength, extraLength) = struct.unpack("<HH", localHeader[26:30]);
+            ifs.seek(info.header_offset + 30 + nameLength + extraLength);
+            if info.compress_type == zipfile.ZIP_STORED:
+                version = np.lib.format.read_magic(ifs);
+                if version == (1,0):
+                    (shape, fortranOrder, dtype) = np.lib.format.read_array_header_1_0(ifs);
+                else:
+                    (shape, fortranOrder, dtype) = np.lib.format.read_array_header_2_0(ifs);
+                order = "C";
+                if fortranOrder:
+                    order = "F";
+                if dtype.hasobject:
+                    arrayByName[name] = np.lib.format.read_array(archive.open(info), allow_pickle=True);
+                elif int(np.prod(shape)) == 0:
+                    arrayByName[name] = np.empty(shape, dtype=dtype, order=order);  # Can't memory-map empty arrays
+                else:
+                    arrayByName[name] = np.memmap(filename, dtype=dtype, mode="r", shape=shape, order=order, offset=ifs.tell());
+            else:
+                arrayByName[name] = np.lib.format.read_array(archive.open(info), allow_pickle=True);
+    finally:
+        ifs.close();
+        archive.close();
+    return arrayByName;
+
+def openPreparedPatientItemFile(filename):
+    """Open a prepared patient item file, as a PatientItemArchive if it is one (by file extension),
+    otherwise as a regular (tab-delimited text) file.
+    """
+    if filename.endswith(PATIENT_ITEM_ARCHIVE_EXT):
+        return PatientItemArchive(filename);
+    return stdOpen(filename);
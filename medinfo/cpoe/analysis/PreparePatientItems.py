@@ -11,6 +11,7 @@ Given set of patient IDs of interest and some query / extraction parameters,
 import sys, os
 import time;
 import json;
+from collections import namedtuple;
 from optparse import OptionParser
 from cStringIO import StringIO;
 from datetime import timedelta;
@@ -25,13 +26,36 @@ from medinfo.cpoe.ItemRecommender import RecommenderQuery, ItemAssociationRecomm
 from medinfo.cpoe.TopicModel import TopicModel;
 from medinfo.cpoe.Const import AD_HOC_SECTION;
 from Util import log;
-from Const import MAX_BASE_ITEM_TIME_RESOLUTION;
+from Const import MAX_BASE_ITEM_TIME_RESOLUTION, PATIENT_ITEM_ARCHIVE_EXT;
 
 from medinfo.analysis.Const import OUTCOME_ABSENT, OUTCOME_PRESENT, OUTCOME_IN_QUERY;
 from medinfo.analysis.Const import NEGATIVE_OUTCOME_STRS;
 
 from BaseCPOEAnalysis import AnalysisQuery;
 from BaseCPOEAnalysis import BaseCPOEAnalysis;
+from PatientItemArchive import PatientItemArchive, openPreparedPatientItemFile;
+
+"""Name of the temporary table to load the IDs of patients to query for into"""
+PATIENT_FILTER_TABLE = "temp_prepare_patient_id";
+
+"""Columns of patient clinical item data, including any (outer joined) order set links"""
+PATIENT_CLINICAL_ITEM_HEADERS = ("patient_item_id","patient_id","clinical_item_id","clinical_item_category_id","analysis_status","item_date","item_collection_item_id","item_collection_id","order_set_id");
+
+"""Order set link values (item_collection_item_id, item_collection_id, order_set_id) for items not linked to any order set"""
+UNLINKED_ORDER_SET = (None, None, None);
+
+class PatientClinicalItemRow(namedtuple("PatientClinicalItemRow", PATIENT_CLINICAL_ITEM_HEADERS)):
+    """Lightweight (tuple) record of patient clinical item data,
+    instead of a (dictionary) RowItemModel per row.
+    Still supports the same dictionary style lookups (e.g., patientItem["clinical_item_id"], "order_set_id" in patientItem).
+    """
+    __slots__ = ();
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key);
+        return tuple.__getitem__(self, key);
+    def __contains__(self, key):
+        return key in self._fields;
 
 class PreparePatientItems(BaseCPOEAnalysis):
     def __init__(self):
@@ -67,10 +91,7 @@ class PreparePatientItems(BaseCPOEAnalysis):
         instead of doing a big DB query and manipulation
         """
         # Preload some lookup data to facilitate subsequent checks
-        self.categoryIdByItemId = dict();
-        lookupTable = DBUtil.execute("select clinical_item_id, clinical_item_category_id from clinical_item", conn=conn);
-        for (clinicalItemId, categoryId) in lookupTable:
-            self.categoryIdByItemId[clinicalItemId] = categoryId;
+        self.loadCategoryIdByItemId(conn=conn);
 
         if analysisQuery.preparedPatientItemFile is None:
             for (patientId, patientItemList) in self.queryPatientClinicalItemData(analysisQuery, conn=conn):
@@ -82,6 +103,13 @@ class PreparePatientItems(BaseCPOEAnalysis):
             for patientItemData in self.parsePreparedResultFile(analysisQuery.preparedPatientItemFile, analysisQuery):
                 yield patientItemData;
 
+    def loadCategoryIdByItemId(self, conn=None):
+        """Load the categoryIdByItemId lookup used to check which items are recommendable"""
+        self.categoryIdByItemId = dict();
+        lookupTable = DBUtil.execute("select clinical_item_id, clinical_item_category_id from clinical_item", conn=conn);
+        for (clinicalItemId, categoryId) in lookupTable:
+            self.categoryIdByItemId[clinicalItemId] = categoryId;
+
     def queryPatientClinicalItemData(self, analysisQuery, conn):
         """Query for all of the order / item data for each patient
         noted in the analysisQuery and yield them one list of clinicalItemIds
@@ -89,7 +117,14 @@ class PreparePatientItems(BaseCPOEAnalysis):
         Generated iterator over 2-ples (patientId, clinicalItemList)
             - Patient ID: ID of the patient for which the currently yielded item intended for
             - Clinical Item List:
-                List of all of the relevant clinical items for this patient
+                List of all of the relevant clinical items for this patient (as PatientClinicalItemRows)
+
+        The patient ID filter is bulk loaded into a temporary table to join against,
+        rather than passed as a (potentially huge) IN (...) parameter list,
+        and both the item and order set link queries are streamed analysisQuery.fetchSize rows at a time
+        and merge joined in a single pass, so memory use stays flat for large patient cohorts.
+        The streams are (PostgreSQL) cursors declared WITH HOLD (see DBUtil.iterate with an external connection),
+        so callers can still commit other work on the same connection while consuming the results.
         """
         analysisQuery.filteredPatientIds = set(analysisQuery.patientIds);
         if analysisQuery.baseItemId is not None:
@@ -109,148 +144,155 @@ class PreparePatientItems(BaseCPOEAnalysis):
             for (patientId,) in patientIdTable:
                 analysisQuery.filteredPatientIds.add(patientId);
 
-        orderSetCursor = None;
-        orderSetLinkRow = None;
-        orderSetHeaders = ("patient_id","patient_item_id","item_collection_item_id","item_collection_id","order_set_id");
-        if analysisQuery.byOrderSets:
-            # Effectively want to outer join patient item query to order set linkage data, but avoid doing in SQL for inconsistent syntax
-            # Depend on using the same sort order (patient ID, item date) for efficient parallel scans to join data
-            orderSetQuery = SQLQuery();
-            orderSetQuery.addSelect("pi.patient_id");
-            orderSetQuery.addSelect("pi.patient_item_id");
-            orderSetQuery.addSelect("picl.item_collection_item_id");
-            orderSetQuery.addSelect("ici.item_collection_id");
-            orderSetQuery.addSelect("ic.external_id as order_set_id");
-            orderSetQuery.addFrom("patient_item as pi");
-            orderSetQuery.addFrom("patient_item_collection_link as picl");
-            orderSetQuery.addFrom("item_collection_item as ici");
-            orderSetQuery.addFrom("item_collection as ic");
-            orderSetQuery.addWhere("pi.patient_item_id = picl.patient_item_id");
-            orderSetQuery.addWhere("picl.item_collection_item_id = ici.item_collection_item_id");
-            orderSetQuery.addWhere("ici.item_collection_id = ic.item_collection_id");
-            orderSetQuery.addWhereIn("pi.patient_id", analysisQuery.filteredPatientIds );
-            orderSetQuery.addWhereNotEqual("ic.section", AD_HOC_SECTION );
+        fetchSize = analysisQuery.fetchSize;
+        if fetchSize is None:
+            fetchSize = AnalysisQuery().fetchSize;
+
+        self.loadPatientIdFilter(analysisQuery.filteredPatientIds, conn);
+
+        orderSetLinkRows = iter(());    # Empty placeholder if not linking order sets
+        patientItemRows = None;
+        failed = False;
+        try:
+            if analysisQuery.byOrderSets:
+                # Effectively want to outer join patient item query to order set linkage data, but avoid doing in SQL for inconsistent syntax
+                # Depend on using the same sort order (patient ID, item date) for efficient parallel scans to join data
+                orderSetQuery = SQLQuery();
+                orderSetQuery.addSelect("pi.patient_id");
+                orderSetQuery.addSelect("pi.patient_item_id");
+                orderSetQuery.addSelect("picl.item_collection_item_id");
+                orderSetQuery.addSelect("ici.item_collection_id");
+                orderSetQuery.addSelect("ic.external_id as order_set_id");
+                orderSetQuery.addFrom("%s as fp" % PATIENT_FILTER_TABLE);
+                orderSetQuery.addFrom("patient_item as pi");
+                orderSetQuery.addFrom("patient_item_collection_link as picl");
+                orderSetQuery.addFrom("item_collection_item as ici");
+                orderSetQuery.addFrom("item_collection as ic");
+                orderSetQuery.addWhere("fp.patient_id = pi.patient_id");
+                orderSetQuery.addWhere("pi.patient_item_id = picl.patient_item_id");
+                orderSetQuery.addWhere("picl.item_collection_item_id = ici.item_collection_item_id");
+                orderSetQuery.addWhere("ici.item_collection_id = ic.item_collection_id");
+                orderSetQuery.addWhereNotEqual("ic.section", AD_HOC_SECTION );
+                if analysisQuery.startDate is not None:
+                    orderSetQuery.addWhereOp("pi.item_date",">=", analysisQuery.startDate );
+                if analysisQuery.endDate is not None:
+                    orderSetQuery.addWhereOp("pi.item_date","<", analysisQuery.endDate );
+                orderSetQuery.addOrderBy("pi.patient_id");
+                orderSetQuery.addOrderBy("pi.item_date");
+
+                # Execute a parallel query for order set item links
+                orderSetLinkRows = DBUtil.iterate(orderSetQuery, fetchSize=fetchSize, conn=conn);
+
+            sqlQuery = SQLQuery();
+            sqlQuery.addSelect("pi.patient_item_id");
+            sqlQuery.addSelect("pi.patient_id");
+            sqlQuery.addSelect("pi.clinical_item_id");
+            sqlQuery.addSelect("ci.clinical_item_category_id");
+            sqlQuery.addSelect("ci.analysis_status");
+            sqlQuery.addSelect("pi.item_date");
+            sqlQuery.addFrom("%s as fp" % PATIENT_FILTER_TABLE);
+            sqlQuery.addFrom("clinical_item_category as cic");
+            sqlQuery.addFrom("clinical_item as ci");
+            sqlQuery.addFrom("patient_item as pi");
+            sqlQuery.addWhere("fp.patient_id = pi.patient_id");
+            sqlQuery.addWhere("cic.clinical_item_category_id = ci.clinical_item_category_id");
+            sqlQuery.addWhere("ci.clinical_item_id = pi.clinical_item_id");
+            # Don't use items whose default is to be excluded from analysis
+            #   Unless part of specifically sought after base category id
+            if analysisQuery.baseCategoryId is None and analysisQuery.baseItemId is None:
+                sqlQuery.addWhere("ci.analysis_status <> 0");
+            elif analysisQuery.baseCategoryId is not None:
+                sqlQuery.addWhere("(ci.analysis_status <> 0 or ci.clinical_item_category_id = %s)" % analysisQuery.baseCategoryId);
+            elif analysisQuery.baseItemId is not None:
+                sqlQuery.addWhere("(ci.analysis_status <> 0 or ci.clinical_item_id = %s)" % analysisQuery.baseItemId);
+
             if analysisQuery.startDate is not None:
-                orderSetQuery.addWhereOp("pi.item_date",">=", analysisQuery.startDate );
+                # Look for items within specified date range, but accept old items from designated past categories
+                sqlQuery.openWhereOrClause();
+                sqlQuery.addWhereOp("pi.item_date",">=", analysisQuery.startDate );
+                if analysisQuery.pastCategoryIds:
+                    sqlQuery.addWhereIn("ci.clinical_item_category_id", analysisQuery.pastCategoryIds);
+                sqlQuery.closeWhereOrClause();
             if analysisQuery.endDate is not None:
-                orderSetQuery.addWhereOp("pi.item_date","<", analysisQuery.endDate );
-            orderSetQuery.addOrderBy("pi.patient_id");
-            orderSetQuery.addOrderBy("pi.item_date");
-
-            # Execute a parallel query for order set item links
-            orderSetCursor = conn.cursor();
-            orderSetCursor.execute( str(orderSetQuery), tuple(orderSetQuery.params) );
-            orderSetLinkRow = orderSetCursor.fetchone();
-
-        rowHeaders = ("patient_item_id","patient_id","clinical_item_id","clinical_item_category_id","analysis_status","item_date");
-        sqlQuery = SQLQuery();
-        sqlQuery.addSelect("pi.patient_item_id");
-        sqlQuery.addSelect("pi.patient_id");
-        sqlQuery.addSelect("pi.clinical_item_id");
-        sqlQuery.addSelect("ci.clinical_item_category_id");
-        sqlQuery.addSelect("ci.analysis_status");
-        sqlQuery.addSelect("pi.item_date");
-        sqlQuery.addFrom("clinical_item_category as cic");
-        sqlQuery.addFrom("clinical_item as ci");
-        sqlQuery.addFrom("patient_item as pi");
-        sqlQuery.addWhere("cic.clinical_item_category_id = ci.clinical_item_category_id");
-        sqlQuery.addWhere("ci.clinical_item_id = pi.clinical_item_id");
-        # Don't use items whose default is to be excluded from analysis
-        #   Unless part of specifically sought after base category id
-        if analysisQuery.baseCategoryId is None and analysisQuery.baseItemId is None:
-            sqlQuery.addWhere("ci.analysis_status <> 0");
-        elif analysisQuery.baseCategoryId is not None:
-            sqlQuery.addWhere("(ci.analysis_status <> 0 or ci.clinical_item_category_id = %s)" % analysisQuery.baseCategoryId);
-        elif analysisQuery.baseItemId is not None:
-            sqlQuery.addWhere("(ci.analysis_status <> 0 or ci.clinical_item_id = %s)" % analysisQuery.baseItemId);
-
-        if analysisQuery.startDate is not None:
-            # Look for items within specified date range, but accept old items from designated past categories
-            sqlQuery.openWhereOrClause();
-            sqlQuery.addWhereOp("pi.item_date",">=", analysisQuery.startDate );
-            if analysisQuery.pastCategoryIds:
-                sqlQuery.addWhereIn("ci.clinical_item_category_id", analysisQuery.pastCategoryIds);
-            sqlQuery.closeWhereOrClause();
-        if analysisQuery.endDate is not None:
-            sqlQuery.addWhereOp("pi.item_date","<", analysisQuery.endDate );
-
-        #sqlQuery.addWhere("cic.default_recommend <> 0");
-        #sqlQuery.addWhere("ci.default_recommend <> 0");
-
-        sqlQuery.addWhereIn("pi.patient_id", analysisQuery.filteredPatientIds );
-
-        sqlQuery.addOrderBy("pi.patient_id");
-        sqlQuery.addOrderBy("pi.item_date");
-
-        # Execute the actual query for patient order / item data
-        cursor = conn.cursor();
-        cursor.execute( str(sqlQuery), tuple(sqlQuery.params) );
-
-        currentPatientId = None;
-        patientItemList = list();
+                sqlQuery.addWhereOp("pi.item_date","<", analysisQuery.endDate );
 
-        row = cursor.fetchone();
-        while row is not None:
-            patientItem = RowItemModel( row, rowHeaders );
-            patientId = patientItem["patient_id"];
+            #sqlQuery.addWhere("cic.default_recommend <> 0");
+            #sqlQuery.addWhere("ci.default_recommend <> 0");
 
-            if currentPatientId is None:
-                currentPatientId = patientId;
+            sqlQuery.addOrderBy("pi.patient_id");
+            sqlQuery.addOrderBy("pi.item_date");
 
-            if patientId != currentPatientId:
-                # Changed patient, yield the existing data for the previous patient after linking any order set data
-                orderSetLinkRow = self.linkOrderSetData(orderSetCursor, orderSetHeaders, orderSetLinkRow, currentPatientId, patientItemList);
-                yield (currentPatientId, patientItemList);
-                # Update our data tracking for the current patient
-                currentPatientId = patientId;
-                patientItemList = list();
+            # Execute the actual query for patient order / item data
+            patientItemRows = DBUtil.iterate(sqlQuery, fetchSize=fetchSize, conn=conn);
 
-            patientItemList.append(patientItem);
+            currentPatientId = None;
+            patientRows = list();
+            orderSetLinkRow = next(orderSetLinkRows, None);
 
-            row = cursor.fetchone();
+            for row in patientItemRows:
+                patientId = row[1];
 
-        # Yield / return the last patient data
-        orderSetLinkRow = self.linkOrderSetData(orderSetCursor, orderSetHeaders, orderSetLinkRow, currentPatientId, patientItemList);
-        yield (currentPatientId, patientItemList);
+                if currentPatientId is None:
+                    currentPatientId = patientId;
 
-        cursor.close();
+                if patientId != currentPatientId:
+                    # Changed patient, yield the existing data for the previous patient after linking any order set data
+                    (patientItemList, orderSetLinkRow) = self.linkOrderSetData(orderSetLinkRows, orderSetLinkRow, currentPatientId, patientRows);
+                    yield (currentPatientId, patientItemList);
+                    # Update our data tracking for the current patient
+                    currentPatientId = patientId;
+                    patientRows = list();
 
-        if orderSetCursor is not None:
-            orderSetCursor.close();
+                patientRows.append(row);
 
-    def linkOrderSetData(self, orderSetCursor, orderSetHeaders, orderSetLinkRow, patientId, patientItemList):
-        """Scan through order set link cursor (and keep track of last row encountered)
-        to find linked items for the given patient ID (assumes the cursor is sorted in order by patient ID).
-        Update the patientItems with order set link information, null/None if does not exist (i.e., outer join).
+            # Yield / return the last patient data
+            (patientItemList, orderSetLinkRow) = self.linkOrderSetData(orderSetLinkRows, orderSetLinkRow, currentPatientId, patientRows);
+            yield (currentPatientId, patientItemList);
+        except Exception:
+            # Roll back the failed (aborted) transaction first, so the clean up below can still run
+            failed = True;
+            conn.rollback();
+            raise;
+        finally:
+            try:
+                # Release the (server-side) cursors before dropping the table they read from (if not already rolled back)
+                if patientItemRows is not None:
+                    patientItemRows.close();
+                if analysisQuery.byOrderSets:
+                    orderSetLinkRows.close();
+                DBUtil.execute("DROP TABLE IF EXISTS %s" % PATIENT_FILTER_TABLE, conn=conn, autoCommit=False);
+            except Exception, err:
+                if not failed:
+                    raise;
+                log.warning(err);   # Don't hide the original error
+
+    def loadPatientIdFilter(self, patientIds, conn):
+        """Bulk load the patient IDs to query for into a temporary table that subsequent queries can join against"""
+        DBUtil.execute("DROP TABLE IF EXISTS %s" % PATIENT_FILTER_TABLE, conn=conn, autoCommit=False);
+        DBUtil.execute("CREATE TEMPORARY TABLE %s (patient_id BIGINT)" % PATIENT_FILTER_TABLE, conn=conn, autoCommit=False);
+        DBUtil.insertRows(PATIENT_FILTER_TABLE, ["patient_id"], ((patientId,) for patientId in patientIds), conn=conn);
+
+    def linkOrderSetData(self, orderSetLinkRows, orderSetLinkRow, patientId, patientRows):
+        """Scan through order set link rows (and keep track of last row encountered)
+        to find linked items for the given patient ID (assumes the rows are sorted in order by patient ID).
+        Return the patient's rows as PatientClinicalItemRows with order set link information,
+        null/None if does not exist (i.e., outer join), along with the next unmatched order set link row.
         """
-        if orderSetCursor is not None:
-            orderSetLinkByPatientItemId = dict();
-
-            orderSetLinkItem = None;
-            if orderSetLinkRow is not None:
-                orderSetLinkItem = RowItemModel( orderSetLinkRow, orderSetHeaders );
-            # Scan through cursor until encounter a later patient or end of cursor data stream
-            while orderSetLinkItem is not None and orderSetLinkItem["patient_id"] <= patientId:
-
-                if orderSetLinkItem["patient_id"] == patientId:
-                    # Matched patient, store links in memory for subsequent lookup
-                    orderSetLinkByPatientItemId[orderSetLinkItem["patient_item_id"]] = orderSetLinkItem;
-
-                orderSetLinkItem = None;
-                orderSetLinkRow = orderSetCursor.fetchone();
-                if orderSetLinkRow is not None:
-                    orderSetLinkItem = RowItemModel( orderSetLinkRow, orderSetHeaders );
-
-            # Now pass through patient data to look for matching links
-            for patientItem in patientItemList:
-                patientItem["item_collection_item_id"] = None;  # Default to None to complete outer join
-                patientItem["item_collection_id"] = None;
-                patientItem["order_set_id"] = None;
-                if patientItem["patient_item_id"] in orderSetLinkByPatientItemId:
-                    orderSetLink = orderSetLinkByPatientItemId[patientItem["patient_item_id"]];
-                    patientItem.update(orderSetLink);
-
-        return orderSetLinkRow;
+        orderSetLinkByPatientItemId = dict();
+        # Scan through rows until encounter a later patient or end of data stream
+        while orderSetLinkRow is not None and orderSetLinkRow[0] <= patientId:
+            if orderSetLinkRow[0] == patientId:
+                # Matched patient, store links (item_collection_item_id, item_collection_id, order_set_id) for subsequent lookup
+                orderSetLinkByPatientItemId[orderSetLinkRow[1]] = tuple(orderSetLinkRow[2:]);
+            orderSetLinkRow = next(orderSetLinkRows, None);
+
+        # Now pass through patient data to look for matching links
+        patientItemList = list();
+        for row in patientRows:
+            orderSetLink = orderSetLinkByPatientItemId.get(row[0], UNLINKED_ORDER_SET);
+            patientItemList.append( PatientClinicalItemRow(*(tuple(row)+orderSetLink)) );
+
+        return (patientItemList, orderSetLinkRow);
 
     def extractPatientItemData(self, analysisQuery, recQuery, patientId, patientItemList, categoryIdByItemId):
         """Given the primary query data and patient clinical item list for a given test patient,
@@ -308,14 +350,17 @@ class PreparePatientItems(BaseCPOEAnalysis):
     def parsePreparedResultFile(self, inputFile, analysisQuery=None):
         """Invert main call that generates a text output file.  Parse that text output file
         and generate data row objects, equivalent to what would have come from querying the database directly.
+        inputFile may also be a PatientItemArchive, whose item count columns are already parsed.
         """
         prog = ProgressDots();
-        for i, dataRow in enumerate(TabDictReader(inputFile)):
+        for i, dataRow in enumerate(self.iterPreparedResultRows(inputFile)):
             existsByOutcomeId = None;
             dataKeys = dataRow.keys();  # Retrieve separate from iteration, as will be modifying contents as iterate
             for key in dataKeys:
                 value = dataRow[key];
-                if key.endswith("id") or key.endswith("Id"):
+                if isinstance(value, dict):
+                    pass;   # Item count dictionary already parsed from an archive
+                elif key.endswith("id") or key.endswith("Id"):
                     dataRow[key] = int(value);
                 elif key.endswith("Date") or key.endswith("Time"):
                     dataRow[key] = DBUtil.parseDateValue(dataRow[key]);
@@ -336,14 +381,35 @@ class PreparePatientItems(BaseCPOEAnalysis):
 
             yield dataRow;
             prog.update();
-        inputFile.close();
+        if not isinstance(inputFile, PatientItemArchive):
+            inputFile.close();
         # prog.printStatus();
 
+    def iterPreparedResultRows(self, inputFile):
+        """Generate the raw data rows from a prepared result text file or PatientItemArchive"""
+        if isinstance(inputFile, PatientItemArchive):
+            return inputFile.iterRows();
+        return TabDictReader(inputFile);
+
+    def itemCountByIdFromRow(self, dataRow, column):
+        """Item count dictionary for the column (e.g., queryItemCountById) from a raw data row,
+        parsing it from the JSON text column unless already parsed (see iterPreparedResultRows)
+        """
+        if column in dataRow:
+            return dataRow[column];
+        return loadJSONDict(dataRow[column+"JSON"], int, int);
+
     def convertResultsFileToFeatureMatrix(self, inputFilename, incHeaders=True):
         """Convert results file from primary prepare patient items script into a (sparse) feature matrix
         to facilitate subsequent analysis.  Implemented as a generator over matrix rows to stream through data
         incHeaders:    Whether to include a header label row with result
+        inputFilename may also be a PatientItemArchive.
         """
+        if isinstance(inputFilename, PatientItemArchive):
+            for resultRow in self.convertArchiveToFeatureMatrix(inputFilename, incHeaders):
+                yield resultRow;
+            return;
+
         inputFileFactory = FileFactory(inputFilename);
 
         itemColumnHeaders = ["queryItemCountByIdJSON", "verifyItemCountByIdJSON"];
@@ -415,6 +481,33 @@ class PreparePatientItems(BaseCPOEAnalysis):
         inputFile.close();
         # prog.printStatus();
 
+    def convertArchiveToFeatureMatrix(self, archive, incHeaders=True):
+        """Same as convertResultsFileToFeatureMatrix, but from a PatientItemArchive,
+        which can directly look up the full item ID list rather than needing a separate pass through the data.
+        """
+        itemColumns = ["queryItemCountById", "verifyItemCountById"];
+        baseHeaders = [header for header in archive.columnNames if header[:-len("JSON")] not in itemColumns];
+        allItemIdList = archive.allItemIds(itemColumns).tolist();
+        itemIndexById = dict((itemId, i) for (i, itemId) in enumerate(allItemIdList));
+
+        if incHeaders:
+            yield baseHeaders + [str(itemId) for itemId in allItemIdList];
+
+        prog = ProgressDots(total=archive.nRows);
+        for dataRow in archive.iterRows():
+            # Start with base headers not related to items
+            resultRow = [dataRow[header] for header in baseHeaders];
+
+            # Populate row values with counts
+            itemValues = [0] * len(allItemIdList);
+            for itemCol in itemColumns:
+                for itemId, itemCount in dataRow[itemCol].iteritems():
+                    itemValues[itemIndexById[itemId]] += itemCount;
+            resultRow.extend(itemValues);
+
+            yield resultRow;
+            prog.update();
+        # prog.printStatus();
 
     def convertResultsFileToBagOfWordsCorpus(self, inputFile, queryItems=True, verifyItems=True, outcomeItems=True, excludeCategoryIds=None):
         """Convert results file from primary prepare patient items script into a (sparse) "bag of words"
@@ -425,11 +518,12 @@ class PreparePatientItems(BaseCPOEAnalysis):
         verifyItems: Whether to include verify items in the results
         incHeaders: Whether to include a header label row with result
         excludeCategoryIds: IDs of item categories that should be excluded / skipped during conversion
+        inputFile may also be a PatientItemArchive, to avoid parsing the item counts from text.
         """
         itemsById = DBUtil.loadTableAsDict("clinical_item");
 
         prog = ProgressDots();
-        for inputDict in TabDictReader(inputFile):
+        for inputDict in self.iterPreparedResultRows(inputFile):
             resultRow = list();
             observedIds = set();
             if outcomeItems:
@@ -444,13 +538,13 @@ class PreparePatientItems(BaseCPOEAnalysis):
             totalCountById = dict();
             if queryItems:
                 # Iterate through query items
-                itemCountById = loadJSONDict(inputDict["queryItemCountByIdJSON"], int, int);
+                itemCountById = self.itemCountByIdFromRow(inputDict, "queryItemCountById");
                 for itemId, itemCount in itemCountById.iteritems():
                     if itemId not in totalCountById:
                         totalCountById[itemId] = 0;
                     totalCountById[itemId] += itemCount;
             if verifyItems:
-                itemCountById = loadJSONDict(inputDict["verifyItemCountByIdJSON"], int, int);
+                itemCountById = self.itemCountByIdFromRow(inputDict, "verifyItemCountById");
                 for itemId, itemCount in itemCountById.iteritems():
                     if itemId not in totalCountById:
                         totalCountById[itemId] = 0;
@@ -459,7 +553,8 @@ class PreparePatientItems(BaseCPOEAnalysis):
 
             yield resultRow;
             prog.update();
-        inputFile.close();
+        if not isinstance(inputFile, PatientItemArchive):
+            inputFile.close();
         # prog.printStatus();
 
     def itemCountByIdToBagOfWords(self, itemCountById, observedIds=None, itemsById=None, excludeCategoryIds=None ):
@@ -486,7 +581,8 @@ class PreparePatientItems(BaseCPOEAnalysis):
         usageStr =  "usage: %prog [options] <inputFile> [<outputFile>]\n"+\
                     "   <inputFile>    Name of file with patient ids.  If not found, then interpret as comma-separated list of test Patient IDs to prepare analysis data for\n"+\
                     "   <outputFile>   Tab-delimited file summarizing key data for patient analysis\n"+\
-                    "                       Leave blank or specify \"-\" to send to stdout.\n"
+                    "                       Leave blank or specify \"-\" to send to stdout.\n"+\
+                    "                       If named with a %s extension, instead save as a binary PatientItemArchive.\n" % PATIENT_ITEM_ARCHIVE_EXT
         parser = OptionParser(usage=usageStr)
         parser.add_option("-p", "--pastCategoryIds", dest="pastCategoryIds", help="Comma separated list of clinical item category IDs where past items should always be included in query items regardless of how long ago they occurred (e.g., patient demographics)'");
         parser.add_option("-c", "--baseCategoryId",  dest="baseCategoryId",  help="Instead of specifying first nQ query items, specify ID of clinical item category to look for initial items from (probably the ADMIT Dx item).");
@@ -502,16 +598,23 @@ class PreparePatientItems(BaseCPOEAnalysis):
         parser.add_option("-t", "--timeDeltaMax",  dest="timeDeltaMax",  help="Time delta in seconds to look for the occurrence of outcomes starting from the begining of the query time, which may be 0 seconds, 1 hour (3600), 1 day (86400), or 1 week (604800), etc.  Defaults to counting items occurring at ANY recorded time after query items.");
         parser.add_option("-M", "--featureMatrixConvert",  dest="featureMatrixConvert", action="store_true", help="If set, will ignore earlier parameters, and interpret inputFile as a prepared patient item result file and then output it back in a sparse 'feature matrix' format with a column for each clinical item and 0/1 for the binary presence of each item for each patient in the query OR verify item sets.");
         parser.add_option("-B", "--bagOfWordsConvert",  dest="bagOfWordsConvert", help="If set, instead interpret inputFile as a prepared patient item result file and then output it back in a sparse 'bag of words' format compatible with GenSim.  List of 2-ples (itemId, itemCount).  Given binary labels, counts will just be 0 or 1 for the presence of each item for each patient.  Include parameter characters 'q' and 'v' to specify which (or both) query and verify item sets to include. Include 'o' character to also include any outcome items.");
+        parser.add_option("-Z", "--archiveConvert",  dest="archiveConvert", action="store_true", help="If set, will ignore earlier parameters, and interpret inputFile as a prepared patient item result file and then save it as a binary PatientItemArchive (%s) outputFile, which subsequent analyses and conversions can read (and memory-map) without parsing the text item count columns." % PATIENT_ITEM_ARCHIVE_EXT);
         parser.add_option("-X", "--excludeCategoryIds",  dest="excludeCategoryIds", help="For conversion, exclude / skip any items who fall under one of the comma-separated category Ids.  For extraction, will use default item and category exclusions regardless of this parameter.");
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
         timer = time.time();
         if len(args) > 1:
-            if options.bagOfWordsConvert is not None:
+            if options.archiveConvert:
+                # Convert text results file into binary archive format
+                reader = TabDictReader(stdOpen(args[0]));
+                archive = PatientItemArchive.fromRows(reader, reader.fieldnames);
+                archive.save(args[1]);
+
+            elif options.bagOfWordsConvert is not None:
                 # Convert results file into bag of words (sparse matrix) corpus format
                 inputFilename = args[0];
-                inputFile = stdOpen(inputFilename);
+                inputFile = openPreparedPatientItemFile(inputFilename);
 
                 # Format the results for output
                 outputFilename = None;
@@ -547,6 +650,8 @@ class PreparePatientItems(BaseCPOEAnalysis):
                 print >> outputFile, COMMENT_TAG, json.dumps({"argv":argv});    # Print comment line with analysis arguments to allow for deconstruction later
 
                 # Run the actual analysis / data extraction
+                if inputFilename.endswith(PATIENT_ITEM_ARCHIVE_EXT):
+                    inputFilename = PatientItemArchive(inputFilename);
                 rowGenerator = self.convertResultsFileToFeatureMatrix(inputFilename);
 
                 formatter = TextResultsFormatter( outputFile );
@@ -613,15 +718,21 @@ class PreparePatientItems(BaseCPOEAnalysis):
                 outputFilename = None;
                 if len(args) > 1:
                     outputFilename = args[1];
-                outputFile = stdOpen(outputFilename,"w");
 
-                print >> outputFile, COMMENT_TAG, json.dumps({"argv":argv});    # Print comment line with analysis arguments to allow for deconstruction later
+                if outputFilename is not None and outputFilename.endswith(PATIENT_ITEM_ARCHIVE_EXT):
+                    # Save in binary archive format instead of text
+                    archive = PatientItemArchive.fromRows(resultsGenerator, self.resultHeaders(query));
+                    archive.save(outputFilename);
+                else:
+                    outputFile = stdOpen(outputFilename,"w");
 
-                formatter = TextResultsFormatter( outputFile );
+                    print >> outputFile, COMMENT_TAG, json.dumps({"argv":argv});    # Print comment line with analysis arguments to allow for deconstruction later
+
+                    formatter = TextResultsFormatter( outputFile );
 
-                colNames = self.resultHeaders(query);
-                formatter.formatTuple( colNames );    # Insert a mock record to get a header / label row
-                formatter.formatResultDicts( resultsGenerator, colNames );
+                    colNames = self.resultHeaders(query);
+                    formatter.formatTuple( colNames );    # Insert a mock record to get a header / label row
+                    formatter.formatResultDicts( resultsGenerator, colNames );
 
         else:
             parser.print_help()
@@ -929,7 +1040,7 @@ class ItemsByOrderSetExtractor(ItemsByBaseItemExtractor):
                 patientItemData["queryItemCountById"] = queryItemCountById;
                 patientItemData["verifyItemCountById"] = verifyItemCountById;
 
-                yield patientItemData;
+                yield dict(patientItemData);    # Separate copy for each order set, as callers may collect (and modify) all of the results
 
 if __name__ == "__main__":
     instance = PreparePatientItems();
@@ -11,6 +11,10 @@ Rough approach
 
 import sys, os
 import time;
+import copy;
+import itertools;
+import multiprocessing;
+from collections import deque;
 from optparse import OptionParser;
 import json;
 from cStringIO import StringIO;
@@ -26,6 +30,7 @@ from medinfo.analysis.ROCPlot import ROCPlot;
 from medinfo.cpoe.ItemRecommender import RecommenderQuery;
 from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, BaselineFrequencyRecommender, RandomItemRecommender;
 from medinfo.cpoe.OrderSetRecommender import OrderSetRecommender;
+from medinfo.cpoe.RecommendationCache import RecommendationCache;
 from Util import log;
 
 from BaseCPOEAnalysis import BaseCPOEAnalysis;
@@ -33,6 +38,13 @@ from BaseCPOEAnalysis import RECOMMENDER_CLASS_LIST, RECOMMENDER_CLASS_BY_NAME,
 from BaseCPOEAnalysis import AGGREGATOR_OPTIONS;
 
 from PreparePatientItems import PreparePatientItems;
+from PatientItemArchive import openPreparedPatientItemFile;
+
+DEFAULT_BATCH_SIZE = 1000;  # Number of patients to query the recommender for at a time (see BaseItemRecommender.recommendBatch)
+
+# Analyzer state for parallel worker processes (see analyzeParallel).  Set before the worker pool is forked,
+#   so workers inherit the loaded recommender (and any association matrix snapshot) copy-on-write, rather than reloading it.
+parallelWorkerState = None;
 
 class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
     """Driver class to review given patient data and run sample recommendation queries against
@@ -53,41 +65,25 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
             # Preload some lookup data to facilitate subsequent checks
             baseCountByItemId = self.dataManager.loadClinicalItemBaseCountByItemId(conn=conn);
 
-            # Recommender to test with
-            recommender = analysisQuery.recommender;
-
-            # Start building basic recommendation query to use for testing
-            recQuery = analysisQuery.baseRecQuery;
+            batchSize = analysisQuery.batchSize;
+            if batchSize is None:
+                batchSize = DEFAULT_BATCH_SIZE;
 
             # Start building results data
             resultsStatDataList = list();
             progress = ProgressDots(50,1,"Patients");
 
-            # Query for all of the order / item data for the test patients.  Load one patient's data at a time
+            # Query for all of the order / item data for the test patients.  Load one patient's data at a time,
+            #   but query the recommender for a batch of patients at a time
             preparer = PreparePatientItems();
+            patientItemDataBatch = list();
             for patientItemData in preparer.loadPatientItemData(analysisQuery, conn=conn):
-                patientId = patientItemData["patient_id"];
-
-                analysisResults = \
-                    self.analyzePatientItems \
-                    (   patientItemData,
-                        analysisQuery,
-                        recQuery,
-                        patientId,
-                        recommender,
-                        preparer,
-                        conn=conn
-                    );
-
-                if analysisResults is not None:
-                    (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData) = analysisResults;  # Unpack results
-                    # Start aggregating and calculating result stats
-                    resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
-                    if "baseItemId" in patientItemData:
-                        analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
-                    resultsStatDataList.append(resultsStatData);
-
+                patientItemDataBatch.append(patientItemData);
+                if len(patientItemDataBatch) >= batchSize:
+                    resultsStatDataList.extend( self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, baseCountByItemId, conn=conn) );
+                    patientItemDataBatch = list();
                 progress.Update();
+            resultsStatDataList.extend( self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, baseCountByItemId, conn=conn) );
             # progress.PrintStatus();
 
             return resultsStatDataList;
@@ -97,6 +93,102 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
                 conn.close();
 
 
+    def analyzeParallel(self, analysisQuery, numWorkers):
+        """Same results as __call__, but split the test patients into chunks of analysisQuery.batchSize
+        and analyze the chunks in numWorkers parallel worker processes.
+        Generates the result stats in the same order as the input patients, as they become available.
+        """
+        global parallelWorkerState;
+
+        batchSize = analysisQuery.batchSize;
+        if batchSize is None:
+            batchSize = DEFAULT_BATCH_SIZE;
+
+        # Preload some lookup data to share with the workers, but don't hold the connection
+        #   (or a stream on it) open while forking them, as they would otherwise share its socket
+        conn = self.connFactory.connection();
+        try:
+            baseCountByItemId = self.dataManager.loadClinicalItemBaseCountByItemId(conn=conn);
+            preparer = PreparePatientItems();
+            preparer.loadCategoryIdByItemId(conn=conn);
+        finally:
+            conn.close();
+
+        parallelWorkerState = (self, analysisQuery, preparer, baseCountByItemId);
+        pool = multiprocessing.Pool(numWorkers);
+        conn = None;
+        patientItemDataChunks = None;
+        try:
+            # Read the patient data only after forking the workers
+            conn = self.connFactory.connection();
+            patientItemDataChunks = self.iterPatientItemDataChunks(preparer.loadPatientItemData(analysisQuery, conn=conn), batchSize);
+            # Submit chunks from this thread (rather than pool.imap's task thread) so the patient data stream stays on the thread that opened it.
+            #   Yield results in the input order, while letting workers get ahead on a limited number of subsequent chunks
+            pendingResults = deque();
+            for patientItemDataChunk in itertools.chain(patientItemDataChunks, [None]):
+                if patientItemDataChunk is not None:
+                    pendingResults.append( pool.apply_async(analyzePatientChunk, (patientItemDataChunk,)) );
+                while pendingResults and (patientItemDataChunk is None or len(pendingResults) > 2*numWorkers):
+                    for resultsStatData in pendingResults.popleft().get():
+                        if "baseItemId" in resultsStatData:
+                            analysisQuery.baseItemId = resultsStatData["baseItemId"]; # Record something here, so know to report back in result headers
+                        yield resultsStatData;
+            pool.close();
+        finally:
+            pool.terminate();
+            pool.join();
+            parallelWorkerState = None;
+            if patientItemDataChunks is not None:
+                patientItemDataChunks.close();  # Release the stream before the connection
+            if conn is not None:
+                conn.close();
+
+    def iterPatientItemDataChunks(self, patientItemDataIter, chunkSize):
+        """Group the patient item data into lists of up to chunkSize patients at a time"""
+        patientItemDataChunk = list();
+        for patientItemData in patientItemDataIter:
+            patientItemDataChunk.append(patientItemData);
+            if len(patientItemDataChunk) >= chunkSize:
+                yield patientItemDataChunk;
+                patientItemDataChunk = list();
+        if patientItemDataChunk:
+            yield patientItemDataChunk;
+
+    def analyzePatientItemsBatch(self, patientItemDataList, analysisQuery, preparer, baseCountByItemId, conn=None):
+        """Same as analyzePatientItems followed by calculateResultStats, but for a batch of test patients,
+        querying the recommender for all of them at once (recommendBatch).
+        Generates the result stats for each patient.
+        """
+        recommender = analysisQuery.recommender;
+
+        # Apparently not able to find / extract relevant data for some records, so skip those
+        patientItemDataList = [patientItemData for patientItemData in patientItemDataList if "queryItemCountById" in patientItemData];
+
+        # Customize a copy of the base recommendation query for each patient
+        recQueries = list();
+        for patientItemData in patientItemDataList:
+            recQuery = copy.copy(analysisQuery.baseRecQuery);
+            recQuery.queryItemIds = self.recQueryItemIds(patientItemData["queryItemCountById"]);
+            recQuery.targetItemIds = set(); # Ensure not restricted to some specified outcome target
+            recQueries.append(recQuery);
+
+        # Query for recommended orders / items
+        recommendedDataList = recommender.recommendBatch(recQueries, conn=conn);
+
+        for patientItemData, recQuery, recommendedData in zip(patientItemDataList, recQueries, recommendedDataList):
+            queryItemCountById = patientItemData["queryItemCountById"];
+            verifyItemCountById = patientItemData["verifyItemCountById"];
+
+            # Customize number of recommendations if comparing against specific order set usage
+            self.customizeNumRecommendations(patientItemData, analysisQuery, recQuery, preparer);
+            recommendedItemIds = self.topRecommendedItemIds(recommendedData, analysisQuery);
+
+            # Start aggregating and calculating result stats
+            resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
+            if "baseItemId" in patientItemData:
+                analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
+            yield resultsStatData;
+
     def analyzePatientItems(self, patientItemData, analysisQuery, recQuery, patientId, recommender, preparer, conn):
         """Given the primary query data and clinical item list for a given test patient,
         Parse through the item list and run a query to get the top recommended IDs
@@ -109,7 +201,7 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
         queryItemCountById = patientItemData["queryItemCountById"];
         verifyItemCountById = patientItemData["verifyItemCountById"];
 
-        recQuery.queryItemIds = queryItemCountById.keys();
+        recQuery.queryItemIds = self.recQueryItemIds(queryItemCountById);
         recQuery.targetItemIds = set(); # Ensure not restricted to some specified outcome target
 
         # Query for recommended orders / items
@@ -119,13 +211,24 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
         self.customizeNumRecommendations(patientItemData, analysisQuery, recQuery, preparer);
 
         # Distill down to just the set of recommended item IDs
+        recommendedItemIds = self.topRecommendedItemIds(recommendedData, analysisQuery);
+
+        return (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData);
+
+    def recQueryItemIds(self, queryItemCountById):
+        """Query items to set on a patient's recommender query, given their item counts.
+        Just the item IDs by default, but sub-classes may keep the counts for recommenders that use them.
+        """
+        return queryItemCountById.keys();
+
+    def topRecommendedItemIds(self, recommendedData, analysisQuery):
+        """Set of the top numRecommendations item IDs from the recommended data"""
         recommendedItemIds = set();
         for i, recommendationModel in enumerate(recommendedData):
             if i >= analysisQuery.numRecommendations:
                 break;
             recommendedItemIds.add(recommendationModel["clinical_item_id"]);
-
-        return (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData);
+        return recommendedItemIds;
 
     def customizeNumRecommendations(self, patientItemData, analysisQuery, recQuery, preparer):
         """If option set, customize number of recommendations to consider
@@ -344,6 +447,9 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
         parser.add_option("-a", "--aggregationMethod",  dest="aggregationMethod",  help="Aggregation method to use for recommendations based off multiple query items.  Options: %s." % list(AGGREGATOR_OPTIONS) );
         parser.add_option("-p", "--countPrefix",  dest="countPrefix",  help="Prefix for how to do counts.  Blank for default item counting allowing repeats, otherwise ignore repeats for patient_ or encounter_");
         parser.add_option("-m", "--maxRecommendedId",  dest="maxRecommendedId",  help="Specify a maximum ID value to accept for recommended items.  More used to limit output in test cases");
+        parser.add_option("-A", "--associationMatrix",  dest="associationMatrix", metavar="<snapshotFile>", help="Score recommendations from an in-memory snapshot of the association counts (see ItemAssociationRecommender.loadAssociationMatrix), allowing a whole batch of patients to be scored at once.  Loads the snapshot from the named .npz file, or builds it from the database and saves it there if the file does not exist yet.");
+        parser.add_option("-B", "--batchSize",  dest="batchSize",  default=DEFAULT_BATCH_SIZE, help="Number of patients to query the recommender for at a time.  Default %d." % DEFAULT_BATCH_SIZE);
+        parser.add_option("-w", "--workers",  dest="workers",  type="int", help="If provided (and > 1), analyze batches of patients in this many parallel worker processes.  Workers share the recommender loaded by the main process, so use with the associationMatrix option to load it only once.  Output is the same as the serial analysis.");
 
         (options, args) = parser.parse_args(argv[1:])
 
@@ -354,10 +460,14 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
             query = AnalysisQuery();
             query.recommender = RECOMMENDER_CLASS_BY_NAME[options.recommender]();
             query.recommender.dataManager.dataCache = dict();   # Use a dataCache to facilitate repeat queries
+            query.recommender.resultCache = RecommendationCache();  # Reuse results for patients with the same query items
+            if options.associationMatrix is not None:
+                query.recommender.loadAssociationMatrix(options.associationMatrix);
+            query.batchSize = int(options.batchSize);
 
             if options.preparedPatientItemFile:
                 # Don't reconstruct validation data through database, just read off validation file
-                query.preparedPatientItemFile = stdOpen(args[0]);
+                query.preparedPatientItemFile = openPreparedPatientItemFile(args[0]);
             else:
                 patientIdsParam = args[0];
                 try:
@@ -414,7 +524,14 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
 
 
             # Run the actual analysis
-            analysisResults = self(query);
+            if options.workers is not None and options.workers > 1:
+                analysisResults = self.analyzeParallel(query, options.workers);
+                # Wait for the first result, which establishes the result headers (e.g., baseItemId), then stream the rest
+                firstResults = list(itertools.islice(analysisResults, 1));
+                analysisResults = itertools.chain(firstResults, analysisResults);
+            else:
+                analysisResults = self(query);
+                log.info("Recommendation result cache usage: %s" % query.recommender.resultCache.stats() );
 
             # Format the results for output
             outputFilename = None;
@@ -438,6 +555,19 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
 
+def analyzePatientChunk(patientItemDataList):
+    """Worker process function for RecommendationClassificationAnalysis.analyzeParallel.
+    Analyze one chunk of patients with the analyzer state inherited from the main process,
+    using a separate database connection for this process.
+    Returns the list of result stats in the same order as the patients.
+    """
+    (analyzer, analysisQuery, preparer, baseCountByItemId) = parallelWorkerState;
+    conn = analyzer.connFactory.connection();
+    try:
+        return list(analyzer.analyzePatientItemsBatch(patientItemDataList, analysisQuery, preparer, baseCountByItemId, conn=conn));
+    finally:
+        conn.close();
+
 if __name__ == "__main__":
     instance = RecommendationClassificationAnalysis();
     instance.main(sys.argv);
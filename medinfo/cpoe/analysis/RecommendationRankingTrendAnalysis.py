@@ -17,6 +17,7 @@ to find the orders that will actually be used.
 
 import sys, os
 import time;
+import copy;
 from optparse import OptionParser
 from cStringIO import StringIO;
 from datetime import timedelta;
@@ -185,6 +186,7 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
         clinical items and perform recommendation queries using the accumulated keyset
         to determine the relative rank and score for each successive item.
         Account for / skip redundant and otherwise excluded items.
+        All of the patient's serial queries are submitted to the recommender as one batch (recommendBatch).
         """
         clinicalItemIdSet = set(clinicalItemIdList);
         numPatientItems = len(clinicalItemIdSet);
@@ -192,30 +194,22 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
         numQueryItems = 0;
         queryItemIds = set();
 
+        serialItemData = list();    # (clinicalItemId, iItem, iRecItem) for each item to test against its respective query
+        serialRecQueries = list();
+
         iRecItem = 0;   # Separately track number of items that can actually be recommended (skip repeats and other exclusions)
         for (iItem, clinicalItemId) in enumerate(clinicalItemIdList):
             if self.isItemRecommendable(clinicalItemId, queryItemIds, recQuery, categoryIdByItemId):
                 # Query based on accumulated key data thus far,
                 #   to see how well able to predict / rank / score this next clinical item
-                recQuery.queryItemIds = queryItemIds;
-                recQuery.limit = None;  # No limitation because trying to find the next item whereever it may be in the list
-
-                recommendedData = recommender( recQuery, conn=conn );
+                serialRecQuery = copy.copy(recQuery);
+                serialRecQuery.queryItemIds = set(queryItemIds);    # Snapshot, since will keep accumulating below
+                serialRecQuery.limit = None;  # No limitation because trying to find the next item whereever it may be in the list
 
-                # Find the next clinical item in the recommended list
-                recRank = 0;
-                recScore = None;
-                for iRec, recommendationModel in enumerate(recommendedData):
-                    recRank = iRec+1;   # Start rankings at 1, not 0
-                    if recommendationModel["clinical_item_id"] == clinicalItemId:
-                        # Found the match, note the respective recommendation statistics
-                        recScore = recommendationModel["score"];
-                        break;  # Don't need to look anymore
-
-                yield (clinicalItemId, iItem, iRecItem, recRank, recScore);
+                serialItemData.append( (clinicalItemId, iItem, iRecItem) );
+                serialRecQueries.append(serialRecQuery);
 
                 iRecItem += 1;  # Track that we recorded information on one more recommended item
-                progress.Update();
 
             queryItemIds.add(clinicalItemId);   # Accumulate initial query set as progress
 
@@ -224,6 +218,23 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
                 #   or even potentially damaging to execution memory
                 break;
 
+        recommendedDataList = recommender.recommendBatch( serialRecQueries, conn=conn );
+
+        for ((clinicalItemId, iItem, iRecItem), recommendedData) in zip(serialItemData, recommendedDataList):
+            # Find the next clinical item in the recommended list
+            recRank = 0;
+            recScore = None;
+            for iRec, recommendationModel in enumerate(recommendedData):
+                recRank = iRec+1;   # Start rankings at 1, not 0
+                if recommendationModel["clinical_item_id"] == clinicalItemId:
+                    # Found the match, note the respective recommendation statistics
+                    recScore = recommendationModel["score"];
+                    break;  # Don't need to look anymore
+
+            yield (clinicalItemId, iItem, iRecItem, recRank, recScore);
+
+            progress.Update();
+
     def isItemRecommendable(self, clinicalItemId, queryItemIds, recQuery, categoryIdByItemId):
         """Decide if the next clinical item could even possibly appear
         in the recommendation list.  (Because if not, no point in trying to
@@ -254,6 +265,7 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
         parser.add_option("-a", "--aggregationMethod",  dest="aggregationMethod",  help="Aggregation method to use for recommendations based off multiple query items.  Options: %s." % list(AGGREGATOR_OPTIONS) );
         parser.add_option("-p", "--countPrefix",  dest="countPrefix",  help="Prefix for how to do counts.  Blank for default item counting allowing repeats, otherwise ignore repeats for patient_ or encounter_");
         parser.add_option("-q", "--queryItemMax",  dest="queryItemMax",  help="If set, specifies a maximum number of query items to use when analyzing serial recommendations.  Will stop analyzing further for a patient once reach this limit.");
+        parser.add_option("-A", "--associationMatrix",  dest="associationMatrix", metavar="<snapshotFile>", help="Score recommendations from an in-memory snapshot of the association counts (see ItemAssociationRecommender.loadAssociationMatrix), allowing each patient's serial queries to be scored as one batch.  Loads the snapshot from the named .npz file, or builds it from the database and saves it there if the file does not exist yet.");
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -263,6 +275,8 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
             query = AnalysisQuery();
             query.recommender = RECOMMENDER_CLASS_BY_NAME[options.recommender]();
             query.recommender.dataManager.dataCache = dict();   # Use a local cahce to speed up repeat queries
+            if options.associationMatrix is not None:
+                query.recommender.loadAssociationMatrix(options.associationMatrix);
 
             patientIdsParam = args[0];
             try:
@@ -27,12 +27,14 @@ from Util import log;
 from RecommendationClassificationAnalysis import RecommendationClassificationAnalysis;
 from BaseCPOEAnalysis import AnalysisQuery;
 from PreparePatientItems import PreparePatientItems;
+from PatientItemArchive import openPreparedPatientItemFile;
 from RecommendationClassificationAnalysis import RecommendationClassificationAnalysis;
 
 DEFAULT_TOPIC_ITEM_COUNT = 1000; # When using or printing out topic information, number of top scored items to consider
 DEFAULT_RECOMMENDED_ITEM_COUNT = 10;    # When doing validation calculations, number of items to recommend when calculating precision and recall
 DEFAULT_MIN_TOPIC_WEIGHT = 0.001; # When using topic models, ignore topics that contribute less than this score to avoid wasting time on low value items
 DEFAULT_SORT_FIELD = "totalItemWeight";
+DEFAULT_BATCH_SIZE = 1000;  # Number of patients to run through the topic model at a time
 
 class TopicModelAnalysis(RecommendationClassificationAnalysis):
     def __init__(self):
@@ -50,28 +52,21 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
             id2id[id] = id;
         analysisQuery.recommender.model.id2word = id2id;
 
+        batchSize = analysisQuery.batchSize;
+        if batchSize is None:
+            batchSize = DEFAULT_BATCH_SIZE;
+
         # progress = ProgressDots(50,1,"Patients");
+        patientItemDataBatch = list();
         for patientItemData in preparer.loadPatientItemData(analysisQuery):
-            patientId = patientItemData["patient_id"];
-            analysisResults = \
-                self.analyzePatientItems \
-                (   patientItemData,
-                    analysisQuery,
-                    analysisQuery.baseRecQuery,
-                    patientId,
-                    analysisQuery.recommender,
-                    preparer
-                );
-
-            if analysisResults is not None:
-                (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData) = analysisResults;  # Unpack results
-                # Start aggregating and calculating result stats
-                resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, analysisQuery.recommender.docCountByWordId, analysisQuery.baseRecQuery, recommendedData );
-                if "baseItemId" in patientItemData:
-                    analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
-                yield resultsStatData;
-
+            patientItemDataBatch.append(patientItemData);
+            if len(patientItemDataBatch) >= batchSize:
+                for resultsStatData in self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, analysisQuery.recommender.docCountByWordId):
+                    yield resultsStatData;
+                patientItemDataBatch = list();
             # progress.Update();
+        for resultsStatData in self.analyzePatientItemsBatch(patientItemDataBatch, analysisQuery, preparer, analysisQuery.recommender.docCountByWordId):
+            yield resultsStatData;
 
         # progress.PrintStatus();
 
@@ -86,7 +81,7 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
         queryItemCountById = patientItemData["queryItemCountById"];
         verifyItemCountById = patientItemData["verifyItemCountById"];
 
-        recQuery.queryItemIds = queryItemCountById; # Have option to use as dictionary, but will also function as key set
+        recQuery.queryItemIds = self.recQueryItemIds(queryItemCountById);
         # recQuery.limit = analysisQuery.numRecommendations;
 
         # Query for recommended orders / items
@@ -96,13 +91,13 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
         self.customizeNumRecommendations(patientItemData, analysisQuery, recQuery, preparer);
 
         # Distill down to just the set of recommended item IDs
-        recommendedItemIds = set();
-        for i, recommendationModel in enumerate(recommendedData):
-            if i >= analysisQuery.numRecommendations:
-                break;
-            recommendedItemIds.add(recommendationModel["clinical_item_id"]);
+        recommendedItemIds = self.topRecommendedItemIds(recommendedData, analysisQuery);
         return (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData);
 
+    def recQueryItemIds(self, queryItemCountById):
+        """Keep the query item counts, as the recommender has option to use them as a dictionary (but will also function as key set)"""
+        return queryItemCountById;
+
     def calculateResultStats( self, patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData ):
         resultsStatData = RecommendationClassificationAnalysis.calculateResultStats( self, patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
         # Copy elements from any item in recommended list
@@ -128,6 +123,7 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
         parser.add_option("-m", "--minClusterWeight",  dest="minClusterWeight", default=DEFAULT_MIN_TOPIC_WEIGHT, help="When scoring recommendations, skip any topics with less than this relation weight (effectively scores as zero, but can avoid a lot of low yield calculations).");
         parser.add_option("-s", "--sortField",  dest="sortField", default=DEFAULT_SORT_FIELD, help="Score field to sort top recommendations by.  Default to posterior probabilty 'totelItemWeight', but can also select 'lift' = 'tfidf' = 'interest' for TF*IDF style score weighting.");
         parser.add_option("-r", "--numRecs",   dest="numRecs",  default=DEFAULT_RECOMMENDED_ITEM_COUNT, help="Number of orders / items to recommend for comparison against the verification set. Alternative set option numRecsByOrderSet to look for key order set usage and size.");
+        parser.add_option("-b", "--batchSize",   dest="batchSize",  default=DEFAULT_BATCH_SIZE, help="Number of patients to run through the topic model at a time.  Default %d." % DEFAULT_BATCH_SIZE);
         parser.add_option("-O", "--numRecsByOrderSet",   dest="numRecsByOrderSet", action="store_true", help="If set, then look for an order_set_id column to find the key order set that triggered the evaluation time point to determine number of recommendations to consider.");
         (options, args) = parser.parse_args(argv[1:])
 
@@ -135,7 +131,7 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
         timer = time.time();
         if len(args) >= 1:
             query = AnalysisQuery();
-            query.preparedPatientItemFile = stdOpen(args[0]);
+            query.preparedPatientItemFile = openPreparedPatientItemFile(args[0]);
             query.recommender = TopicModelRecommender(options.modelFile);
             query.baseRecQuery = RecommenderQuery();
             if options.excludeCategoryIds is not None:
@@ -151,6 +147,7 @@ class TopicModelAnalysis(RecommendationClassificationAnalysis):
             query.baseRecQuery.sortField = options.sortField;
             query.numRecommendations = int(options.numRecs);
             query.numRecsByOrderSet = options.numRecsByOrderSet;
+            query.batchSize = int(options.batchSize);
 
             # Run the actual analysis
             analysisResults = self(query);
@@ -17,8 +17,9 @@ from medinfo.db.test.Util import DBTestCase;
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
-from medinfo.cpoe.ItemRecommender import RecommenderQuery;
+from medinfo.cpoe.ItemRecommender import RecommenderQuery, ItemAssociationRecommender;
 from medinfo.cpoe.analysis.PreparePatientItems import PreparePatientItems, AnalysisQuery;
+from medinfo.cpoe.analysis.PatientItemArchive import PatientItemArchive;
 
 class TestPreparePatientItems(DBTestCase):
     def setUp(self):
@@ -339,6 +340,20 @@ class TestPreparePatientItems(DBTestCase):
             ];
         self.assertEqualTextOutput(expectedResults, textOutput, colNames);
 
+        # Redo through the API, fetching one row at a time so the order set links are merged in across many fetch batches
+        analysisQuery = AnalysisQuery();
+        analysisQuery.patientIds = set([0,-55555,-11111]);
+        analysisQuery.baseCategoryId = -7;
+        analysisQuery.queryTimeSpan = timedelta(0,86400);
+        analysisQuery.verifyTimeSpan = timedelta(0,3600);
+        analysisQuery.byOrderSets = True;
+        analysisQuery.fetchSize = 1;
+        analysisQuery.baseRecQuery = RecommenderQuery();
+        analysisQuery.baseRecQuery.excludeCategoryIds = ItemAssociationRecommender().defaultExcludedClinicalItemCategoryIds();
+        analysisQuery.baseRecQuery.excludeItemIds = ItemAssociationRecommender().defaultExcludedClinicalItemIds();
+        analysisResults = list(self.analyzer(analysisQuery));
+        self.assertEqualResultDicts( expectedResults, analysisResults, colNames );
+
     def assertEqualResultDicts(self, expectedResults, analysisResults, colNames ):
         self.assertEquals( len(expectedResults), len(analysisResults) );
         for expectedResult, analysisResult in zip(expectedResults,analysisResults):
@@ -471,6 +486,55 @@ patient_id\tbaseItemId\tbaseItemDate\tqueryStartTime\tqueryEndTime\tverifyEndTim
         results = list(self.analyzer.convertResultsFileToBagOfWordsCorpus(StringIO(inputFileStr),queryItems=False,verifyItems=True,outcomeItems=False) );
         self.assertEqualBagOfWordsList(expectedResults,results);
 
+    def test_patientItemArchive(self):
+        # Convert prepared text file into binary archive format and verify equivalent results when reading from either
+        inputFileStr = \
+"""# {"argv": ["medinfo\\cpoe\\analysis\\PreparePatientItems.py", "-c", "2", "-Q", "14400", "-V", "86401", "-o", "27427", "-t", "2592000", "temp\\patientIds.test.tab", "test.out"]}
+patient_id\tbaseItemId\tbaseItemDate\tqueryStartTime\tqueryEndTime\tverifyEndTime\tqueryItemCountByIdJSON\tverifyItemCountByIdJSON\toutcome.-1
+50559\t-21\t2010-02-04 00:00:00\t2010-02-04 00:00:00\t2010-02-04 04:00:00\t2010-02-05 00:00:01\t{"20449":1, "132":2, "133":3}\t{"19596":1, "19694":1}\t0
+52137\t-21\t2013-03-18 00:00:00\t2013-03-18 00:00:00\t2013-03-18 04:00:00\t2013-03-19 00:00:01\t{"20388":1, "19766":10}\t{"19622":4, "19766":7}\t1
+35141\t-21\t2012-07-17 00:00:00\t2012-07-17 00:00:00\t2012-07-17 04:00:00\t2012-07-18 00:00:01\t{"13326":1, "5778":1, "13589":1}\t{"19810":1, "19724":1, "13474":1}\t0
+19347\t-21\t2010-11-26 00:00:00\t2010-11-26 00:00:00\t2010-11-26 04:00:00\t2010-11-27 00:00:01\t{"13312":1, "19840":1, "13318":1}\t{}\t0
+""";
+        textFilename = "preparedPatientItemsTemp.tab";
+        archiveFilename = "preparedPatientItemsTemp.npz";
+        try:
+            textFile = open(textFilename,"w");
+            textFile.write(inputFileStr);
+            textFile.close();
+
+            # Convert through command-line interface
+            argv = ["PreparePatientItems.py","-Z",textFilename,archiveFilename];
+            self.analyzer.main(argv);
+            archive = PatientItemArchive(archiveFilename);
+            self.assertEqual( 4, len(archive) );
+
+            colNames = ["patient_id","baseItemId","baseItemDate","queryStartTime","queryEndTime","verifyEndTime","queryItemCountById","verifyItemCountById","outcome.-1","existsByOutcomeId"];
+            textBasedResults = list(self.analyzer.parsePreparedResultFile(StringIO(inputFileStr)));
+            archiveBasedResults = list(self.analyzer.parsePreparedResultFile(archive));
+            self.assertEqualResultDicts( textBasedResults, archiveBasedResults, colNames );
+
+            # Feature matrix values should be the same, though converted to numbers rather than left as text
+            textBasedResults = list(self.analyzer.convertResultsFileToFeatureMatrix(StringIO(inputFileStr)));
+            archiveBasedResults = list(self.analyzer.convertResultsFileToFeatureMatrix(archive));
+            self.assertEqual( textBasedResults[0], archiveBasedResults[0] );
+            for textRow, archiveRow in zip(textBasedResults[1:], archiveBasedResults[1:]):
+                self.assertEqual( [str(value) for value in textRow], [str(value) for value in archiveRow] );
+
+            textBasedResults = list(self.analyzer.convertResultsFileToBagOfWordsCorpus(StringIO(inputFileStr),queryItems=True,verifyItems=True,outcomeItems=True) );
+            archiveBasedResults = list(self.analyzer.convertResultsFileToBagOfWordsCorpus(archive,queryItems=True,verifyItems=True,outcomeItems=True) );
+            self.assertEqualBagOfWordsList(textBasedResults,archiveBasedResults);
+
+            # Read into memory instead of memory-mapping
+            archive = PatientItemArchive(archiveFilename, mmap=False);
+            archiveBasedResults = list(self.analyzer.parsePreparedResultFile(archive));
+            textBasedResults = list(self.analyzer.parsePreparedResultFile(StringIO(inputFileStr)));
+            self.assertEqualResultDicts( textBasedResults, archiveBasedResults, colNames );
+        finally:
+            for filename in (textFilename, archiveFilename):
+                if os.path.exists(filename):
+                    os.remove(filename);
+
     def assertEqualBagOfWordsList(self, expectedResults, results ):
         """Convert random order Bag of Words items into consistent dictionaries for comparison"""
         for i, result in enumerate(expectedResults):
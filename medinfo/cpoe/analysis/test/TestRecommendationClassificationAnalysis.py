@@ -559,6 +559,32 @@ class TestRecommendationClassificationAnalysis(DBTestCase):
         textOutput = StringIO(sys.stdout.getvalue());
         self.assertEqualStatResultsTextOutput(expectedResults, textOutput, colNames);
 
+    def test_parallelAnalysis(self):
+        # Analysis by parallel worker processes should yield the same output as the serial analysis
+        colNames = ["patient_id", "TP", "FN", "FP",  "recall", "precision", "F1-score", "weightRecall","weightPrecision", "normalRecall","normalPrecision", "ROC-AUC"];
+        expectedResults = [ RowItemModel([-11111, 1, 2, 3,  0.333, 0.25, 0.286,  0.254, 0.194, 0.333, 0.25/0.75, 0.4167], colNames ) ];
+
+        sys.stdout = StringIO();
+        argv = ["PreparePatientItems.py","-q","2","-v","3",'0,-11111',"-"];
+        self.preparer.main(argv);
+        preparedData = sys.stdout.getvalue();
+
+        sys.stdin = StringIO(preparedData);
+        sys.stdout = StringIO();
+        argv = ["RecommendationClassificationAnalysis.py","-P","-r","4","-m","0","-R","ItemAssociationRecommender",'-',"-"];
+        self.analyzer.main(argv);
+        serialOutput = sys.stdout.getvalue();
+
+        sys.stdin = StringIO(preparedData);
+        sys.stdout = StringIO();
+        argv = ["RecommendationClassificationAnalysis.py","-P","-r","4","-m","0","-R","ItemAssociationRecommender","-w","2","-B","1",'-',"-"];
+        self.analyzer.main(argv);
+        parallelOutput = sys.stdout.getvalue();
+        self.assertEqualStatResultsTextOutput(expectedResults, StringIO(parallelOutput), colNames);
+
+        # Other than the leading comment line with the command arguments, should be identical
+        self.assertEqual( serialOutput.splitlines()[1:], parallelOutput.splitlines()[1:] );
+
 
 
 
@@ -236,6 +236,82 @@ class TestAssociationAnalysis(DBTestCase):
         associationStats = DBUtil.execute(associationQuery);
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
+    def test_commitLegacyJSONBuffer(self):
+        # Buffer files saved in the older JSON format (str(itemIdPair) keyed dictionaries) should still load and commit
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                count_0, count_3600, count_any, patient_count_any,
+                time_diff_sum, time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0 and clinical_item_id <> subsequent_item_id
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+        legacyBuffer = \
+            {   "nAssociations": 2,
+                "analyzedPatientItemIds": [-1, -2],
+                "incrementDataByItemIdPair":
+                {   "(-11, -6)": {"count_0": 1, "count_3600": 1, "count_any": 1, "patient_count_any": 1, "time_diff_sum": 0, "time_diff_sum_squares": 0},
+                    "(-6, -11)": {"count_3600": 2, "count_any": 2, "time_diff_sum": 3600, "time_diff_sum_squares": 12960000},
+                },
+            };
+        import json;
+        from medinfo.common.Util import stdOpen;
+        ofs = stdOpen(self.bufferFilename+".json.gz","w");
+        json.dump(legacyBuffer, ofs);
+        ofs.close();
+
+        updateBuffer = self.analyzer.loadUpdateBufferFromFile(self.bufferFilename+".json.gz");
+        self.assertEqual( 2, updateBuffer["nAssociations"] );
+        self.assertEqual( set([-1,-2]), updateBuffer["analyzedPatientItemIds"] );
+        self.assertEqual( [(-11,-6),(-6,-11)], sorted(updateBuffer["incrementDataByItemIdPair"].itemIdPairs()) );
+
+        # Round trip through the current file format as well
+        self.analyzer.saveBufferToFile(self.bufferFilename+".npz", updateBuffer);
+        self.analyzer.commitUpdateBufferFromFile(self.bufferFilename+".npz");
+
+        expectedAssociationStats = \
+            [
+                [-11, -6,   1, 1, 1, 1,     0.0, 0.0],
+                [ -6,-11,   0, 2, 2, 0,  3600.0, 12960000.0],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        analyzedItems = DBUtil.execute("select patient_item_id from patient_item where patient_item_id in (-1,-2,-3) and analyze_date is not null order by patient_item_id");
+        self.assertEqualTable( [[-2],[-1]], analyzedItems );
+
+    def test_updateBufferMergeDecay(self):
+        # Merge and decay of the array backed update buffers, including a legacy dictionary buffer merged in
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222];
+        bufferOne = self.analyzer.makeUpdateBuffer();
+        for patientItemList in self.analyzer.queryPatientItemsPerPatient(analysisOptions):
+            self.analyzer.updateItemAssociationsBuffer(patientItemList, bufferOne, analysisOptions, dict());
+        nAssociations = bufferOne["nAssociations"];
+        self.assertTrue( nAssociations > 0 );
+        expectedIncrementData = bufferOne["incrementDataByItemIdPair"].toIncrementDataByItemIdPair();
+
+        legacyBuffer = \
+            {   "nAssociations": 1,
+                "analyzedPatientItemIds": set([-1000]),
+                "incrementDataByItemIdPair": {"(-1000, -1001)": {"count_any": 4, "time_diff_sum": 8}},
+            };
+        bufferOne = self.analyzer.mergeBuffers(bufferOne, legacyBuffer);
+        self.assertEqual( nAssociations+1, bufferOne["nAssociations"] );
+        self.assertTrue( -1000 in bufferOne["analyzedPatientItemIds"] );
+
+        bufferOne = self.analyzer.bufferDecay(bufferOne, 0.5);
+        incrementDataByItemIdPair = bufferOne["incrementDataByItemIdPair"].toIncrementDataByItemIdPair();
+        self.assertEqual( {"count_any": 2.0, "time_diff_sum": 4.0}, incrementDataByItemIdPair.pop(str((-1000,-1001))) );
+        for itemIdPair, incrementData in expectedIncrementData.iteritems():
+            for col, increment in incrementData.iteritems():
+                self.assertAlmostEqual( increment*0.5, incrementDataByItemIdPair[itemIdPair][col] );
+
     def test_analyzePatientItems(self):
         # Run the association analysis against the mock test data above and verify
         #   expected stats afterwards.
@@ -591,6 +667,215 @@ class TestAssociationAnalysis(DBTestCase):
         associationStats = DBUtil.execute(encounterAssociationQuery);
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
+    def test_updateItemAssociationsBufferVectorized(self):
+        # Vectorized counting engine should produce buffers identical to the nested loop engine
+        linkedItemIdsByBaseId = self.analyzer.dataManager.loadLinkedItemIdsByBaseId();
+
+        # Mark some items as previously analyzed, so partial pair counting is covered as well
+        DBUtil.execute("update patient_item set analyze_date = %s where patient_item_id in (-1,-10,-14)" % DBUtil.SQL_PLACEHOLDER, (datetime(2000,3,1),) );
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+
+        loopBuffer = self.analyzer.makeUpdateBuffer();
+        vectorBuffer = self.analyzer.makeUpdateBuffer();
+        for patientItemList in self.analyzer.queryPatientItemsPerPatient(analysisOptions):
+            self.analyzer.updateItemAssociationsBuffer(patientItemList, loopBuffer, analysisOptions, linkedItemIdsByBaseId);
+            self.analyzer.updateItemAssociationsBufferVectorized(patientItemList, vectorBuffer, analysisOptions, linkedItemIdsByBaseId);
+        self.assertEqual( loopBuffer, vectorBuffer );
+
+        # Same with restricted time windows
+        analysisOptions.deltaSecondsOptions = [0, 3600, 86400];
+        loopBuffer = self.analyzer.makeUpdateBuffer();
+        vectorBuffer = self.analyzer.makeUpdateBuffer();
+        for patientItemList in self.analyzer.queryPatientItemsPerPatient(analysisOptions):
+            self.analyzer.updateItemAssociationsBuffer(patientItemList, loopBuffer, analysisOptions, linkedItemIdsByBaseId);
+            self.analyzer.updateItemAssociationsBufferVectorized(patientItemList, vectorBuffer, analysisOptions, linkedItemIdsByBaseId);
+        self.assertEqual( loopBuffer, vectorBuffer );
+
+    def test_analyzePatientItems_countEngine(self):
+        # Full analysis with the vectorized counting engine selected from the command-line
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any,
+                patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.main(["AssociationAnalysis.py","-c","numpy","-s","2000-01-09","-e","2000-02-11","0,-22222,-33333"]);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_analyzePatientItems_bulkCommit(self):
+        # Same results as the commandLine_bufferFile test, but committing with staging tables and set-based upserts
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any,
+                patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        log.debug("Use incremental update, including date filters to start.");
+        self.analyzer.main(["AssociationAnalysis.py","-s","2000-01-09","-e","2000-02-11","-b",self.bufferFilename,"-p","1",  "0,-22222,-33333"]);
+        self.analyzer.main(["AssociationAnalysis.py","-m","-b",self.bufferFilename]);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+        associationStats = DBUtil.execute(associationQuery)
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 )
+
+        log.debug("Increment existing records and add new baseline ones");
+        self.analyzer.main(["AssociationAnalysis.py","-m","0,-22222,-33333"]);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+                [-11, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7,-11,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+                [ -7, -7,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7, -6,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+
+                [ -6,-11,   1, 1, 1, 2, 2, 2, 2, 2, 172800.0, 29859840000.0],
+                [ -6, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        # All items for the patients analyzed, except those ignored by analysis_status
+        unanalyzedItems = DBUtil.execute("select patient_item_id from patient_item where patient_id in (-22222,-33333) and analyze_date is null");
+        self.assertEqualTable( [[-15]], unanalyzedItems );
+
+    def test_analyzePatientItemsParallel(self):
+        # Parallel workers on patient shards, merged and committed once, should yield the same results as a single process
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any,
+                patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.main(["AssociationAnalysis.py","-w","2","-x","itemCount","-s","2000-01-09","-e","2000-02-11","0,-22222,-33333"]);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        # No shard files left behind
+        for filename in os.listdir("."):
+            self.assertFalse( filename.startswith("shard.associationAnalysis.") );
+
+    def test_analyzePatientItemsParallel_associationsPerCommit(self):
+        # Workers spilling shard parts and committing in intervals to stay within associationsPerCommit should yield the same results
+        self.analyzer.main(["AssociationAnalysis.py","-w","2","-a","1","-s","2000-01-09","-e","2000-02-11","0,-22222,-33333"]);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1],
+                [-11, -6,   1, 1],
+                [ -6,-11,   1, 1],
+                [ -6, -6,   2, 2],
+            ];
+        associationStats = DBUtil.execute("select clinical_item_id, subsequent_item_id, patient_count_0, patient_count_any from clinical_item_association where clinical_item_id < 0 order by clinical_item_id, subsequent_item_id");
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        for filename in os.listdir("."):
+            self.assertFalse( filename.startswith("shard.associationAnalysis.") );
+
+    def test_analyzePatientItemsParallel_resume(self):
+        # Existing shard buffer files (e.g., from a run that crashed before committing) should be used instead of recounting
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222, -33333];
+        analysisOptions.bufferFile = self.bufferFilename;
+
+        patientIdsByShard = self.analyzer.partitionPatientIds(analysisOptions.patientIds, 2);
+        self.assertEqual( [[-22222],[-33333]], patientIdsByShard );
+
+        # Leave an empty result for the first shard, so it should effectively be skipped
+        shardOptions = AnalysisOptions();
+        shardOptions.__dict__.update(analysisOptions.__dict__);
+        shardOptions.patientIds = patientIdsByShard[0];
+        shardFilename = self.analyzer.shardFilename(shardOptions);
+        self.analyzer.saveBufferToFile(shardFilename, self.analyzer.makeUpdateBuffer());
+
+        shardOptions.startDate = datetime(2000,1,9);    # Different options, so could not reuse the shard file
+        self.assertNotEqual( shardFilename, self.analyzer.shardFilename(shardOptions) );
+
+        self.analyzer.analyzePatientItemsParallel(analysisOptions, 2);
+        self.assertFalse( os.path.exists(shardFilename) );
+        self.analyzer.commitUpdateBufferFromFile(self.bufferFilename);
+
+        # Only patient -33333's associations (-6 to -11)
+        associationStats = DBUtil.execute("select clinical_item_id, subsequent_item_id, patient_count_any from clinical_item_association where clinical_item_id < 0 and patient_count_any > 0 order by clinical_item_id, subsequent_item_id");
+        self.assertEqualTable( [[-11,-11,1],[-6,-11,1],[-6,-6,1]], associationStats, precision=3 );
+
+    def test_queryPatientItemsPerPatient_stream(self):
+        # Small fetch batches (that split patients across batches) and skipping the count query should yield the same per patient item lists
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        expectedItemIdLists = [[-6,-11],[-7,-11,-6],[-10,-4,-8,-10,-12]];   # Ordered by patient, then date and item. Item -2 excluded by analysis_status
+
+        for fetchSize in (1, 2, 10000):
+            analysisOptions.fetchSize = fetchSize;
+            analysisOptions.skipCountQuery = (fetchSize == 2);
+            itemIdLists = list();
+            for patientItemList in self.analyzer.queryPatientItemsPerPatient(analysisOptions):
+                itemIdLists.append( [patientItem["clinical_item_id"] for patientItem in patientItemList] );
+                self.assertEqual( patientItemList[0].patient_id, patientItemList[-1]["patient_id"] );
+            self.assertEqual( expectedItemIdLists, itemIdLists );
+
+        # Abandoning the generator early should still release the cursor and connection
+        patientItemLists = self.analyzer.queryPatientItemsPerPatient(analysisOptions);
+        self.assertEqual( 2, len(patientItemLists.next()) );
+        patientItemLists.close();
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
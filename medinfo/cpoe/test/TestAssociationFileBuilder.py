@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+from cStringIO import StringIO
+from datetime import datetime;
+import unittest
+
+from Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
+from Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+
+import numpy as np;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import SQLQuery, RowItemModel;
+
+from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.AssociationMatrix import AssociationMatrix;
+from medinfo.cpoe.AssociationFileBuilder import AssociationFileBuilder;
+
+class TestAssociationFileBuilder(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+        ClinicalItemDataLoader.build_clinical_item_psql_schemata();
+
+        self.clinicalItemCategoryIdStrList = list();
+        headers = ["clinical_item_category_id","source_table"];
+        dataModels = \
+            [
+                RowItemModel( [-1, "Labs"], headers ),
+                RowItemModel( [-2, "Imaging"], headers ),
+                RowItemModel( [-3, "Meds"], headers ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", dataModel );
+            self.clinicalItemCategoryIdStrList.append( str(dataItemId) );
+
+        self.clinicalItemHeaders = ["clinical_item_id","clinical_item_category_id","name","analysis_status"];
+        self.clinicalItems = \
+            [
+                RowItemModel( [-1, -1, "CBC",1], self.clinicalItemHeaders ),
+                RowItemModel( [-2, -1, "BMP",0], self.clinicalItemHeaders ), # Clear analysis status, so this will be ignored
+                RowItemModel( [-4, -1, "Cardiac Enzymes",1], self.clinicalItemHeaders ),
+                RowItemModel( [-6, -2, "RUQ Ultrasound",1], self.clinicalItemHeaders ),
+                RowItemModel( [-7, -2, "CT Abdomen/Pelvis",1], self.clinicalItemHeaders ),
+                RowItemModel( [-8, -2, "CT PE Thorax",1], self.clinicalItemHeaders ),
+                RowItemModel( [-10, -3, "Carvedilol",1], self.clinicalItemHeaders ),
+                RowItemModel( [-11, -3, "Enoxaparin",1], self.clinicalItemHeaders ),
+                RowItemModel( [-12, -3, "Warfarin",1], self.clinicalItemHeaders ),
+            ];
+        for dataModel in self.clinicalItems:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", dataModel );
+
+        self.patientItemHeaders = ["patient_item_id","encounter_id","patient_id","clinical_item_id","item_date"];
+        self.patientItems = \
+            [
+                RowItemModel( [-1,  -111,   -11111, -4,  datetime(2000, 1, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-2,  -111,   -11111, -10, datetime(2000, 1, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-3,  -111,   -11111, -8,  datetime(2000, 1, 1, 2)], self.patientItemHeaders ),
+                RowItemModel( [-4,  -112,   -11111, -10, datetime(2000, 1, 2, 0)], self.patientItemHeaders ),
+                RowItemModel( [-5,  -112,   -11111, -12, datetime(2000, 2, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-10, -222,   -22222, -7,  datetime(2000, 1, 5, 0)], self.patientItemHeaders ),
+                RowItemModel( [-12, -222,   -22222, -6,  datetime(2000, 1, 9, 0)], self.patientItemHeaders ),
+                RowItemModel( [-13, -222,   -22222, -11, datetime(2000, 1, 9, 0)], self.patientItemHeaders ),
+                RowItemModel( [-16, -333,   -33333, -11, datetime(2000, 2,11, 0)], self.patientItemHeaders ),    # Out of date order, as extracts need only be grouped by patient
+                RowItemModel( [-14, -333,   -33333, -6,  datetime(2000, 2, 9, 0)], self.patientItemHeaders ),
+                RowItemModel( [-15, -333,   -33333, -2,  datetime(2000, 2,11, 0)], self.patientItemHeaders ),
+            ];
+        for dataModel in self.patientItems:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("patient_item", dataModel );
+
+        self.linkHeaders = ["clinical_item_id","linked_item_id"];
+        self.links = \
+            [
+                RowItemModel( [-6, -4], self.linkHeaders ),
+            ];
+        for dataModel in self.links:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item_link", dataModel );
+
+        self.patientItemFilename = "patientItemTemp.tab";
+        self.associationFilename = "associationFileTemp.npz";
+
+        self.analyzer = AssociationAnalysis();
+        self.builder = AssociationFileBuilder();  # Instance to test on
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+
+        for filename in (self.patientItemFilename, self.associationFilename):
+            if os.path.exists(filename):
+                os.remove(filename);
+
+        DBUtil.execute("delete from clinical_item_link where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("delete from patient_item where patient_item_id < 0");
+        DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
+
+        DBTestCase.tearDown(self);
+
+    def tabText(self, headers, dataModels):
+        """Tab-delimited text extract of the data models"""
+        lines = [str.join("\t", headers)];
+        for dataModel in dataModels:
+            lines.append( str.join("\t", [str(dataModel[header]) for header in headers]) );
+        return str.join("\n", lines) + "\n";
+
+    def test_buildAssociationFile(self):
+        # Association file built from flat file extracts, without the database,
+        #   should match the database analysis when loaded into a snapshot or committed to the database
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                count_0, count_3600, count_86400, count_any, time_diff_sum, time_diff_sum_squares,
+                patient_count_0, patient_count_86400, patient_count_any, patient_time_diff_sum,
+                encounter_count_0, encounter_count_86400, encounter_count_any
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        ofs = open(self.patientItemFilename, "w");
+        ofs.write( self.tabText(self.patientItemHeaders, self.patientItems) );
+        ofs.close();
+        self.builder.loadClinicalItems( StringIO(self.tabText(self.clinicalItemHeaders, self.clinicalItems)) );
+        self.builder.loadLinkedItems( StringIO(self.tabText(self.linkHeaders, self.links)) );
+        ofs = open(self.associationFilename, "wb");
+        self.assertEqual( 3, self.builder.buildAssociationFile(self.patientItemFilename, ofs) );
+        ofs.close();
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems(analysisOptions);
+        expectedAssociationStats = DBUtil.execute(associationQuery);
+
+        expectedMatrix = AssociationMatrix();
+        expectedMatrix.loadFromDatabase(acceptCache=False);
+        ifs = open(self.associationFilename, "rb");
+        associationMatrix = AssociationMatrix();
+        associationMatrix.loadFromAssociationFile(ifs);
+        ifs.close();
+
+        # Database holds other (non-test) items, so just compare the test items
+        testItemIds = [dataModel["clinical_item_id"] for dataModel in self.clinicalItems];
+        self.assertEqual( expectedMatrix.totalPatients, associationMatrix.totalPatients );
+        self.assertEqual( expectedMatrix.itemCategoryIds(testItemIds).tolist(), associationMatrix.itemCategoryIds(testItemIds).tolist() );
+        for countPrefix in ("","patient_","encounter_"):
+            self.assertEqual( expectedMatrix.baseCounts(testItemIds, countPrefix).tolist(), associationMatrix.baseCounts(testItemIds, countPrefix).tolist() );
+        for countColumn in expectedMatrix.countMatrixByColumn.iterkeys():
+            expectedRows = expectedMatrix.associationRows(testItemIds, [countColumn]);
+            associationRows = associationMatrix.associationRows(testItemIds, [countColumn]);
+            self.assertEqual( expectedRows[0].tolist(), associationRows[0].tolist() );
+            self.assertEqual( expectedRows[1].tolist(), associationRows[1].tolist() );
+            self.assertEqual( expectedRows[2][countColumn].tolist(), associationRows[2][countColumn].tolist() );
+
+        # Bulk commit of the file from scratch should yield the same associations
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        self.analyzer.bulkCommit = True;
+        self.analyzer.commitUpdateBufferFromFile(self.associationFilename);
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqual( expectedAssociationStats, associationStats );
+
+        # Items recorded as analyzed too
+        analyzedItemIds = DBUtil.execute("select patient_item_id from patient_item where patient_item_id < 0 and analyze_date is not null order by patient_item_id");
+        self.assertEqual( [-16,-14,-13,-12,-10,-5,-4,-3,-2,-1], [row[0] for row in analyzedItemIds] );
+
+    def test_ungroupedPatientItems(self):
+        # Extracts must be grouped by patient, so the counts for each patient are complete
+        ofs = open(self.patientItemFilename, "w");
+        ofs.write( self.tabText(self.patientItemHeaders, self.patientItems[:6]+self.patientItems[:1]) );
+        ofs.close();
+        ofs = StringIO();
+        self.assertRaises( ValueError, self.builder.buildAssociationFile, self.patientItemFilename, ofs );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestAssociationFileBuilder));
+    return suite;
+
+if __name__=="__main__":
+    log.setLevel(LOGGER_LEVEL)
+
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+from cStringIO import StringIO
+from datetime import datetime;
+import unittest
+
+from Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
+from Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+
+import numpy as np;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import SQLQuery, RowItemModel;
+
+from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.AssociationMatrix import AssociationMatrix;
+from medinfo.cpoe.AssociationUpdater import AssociationUpdater;
+from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender;
+from medinfo.cpoe.Const import DECAY_SCALE_KEY, ASSOCIATION_UPDATE_KEY;
+
+TEST_SNAPSHOT_FILENAME = "TestAssociationUpdater.npz";
+
+class TestAssociationUpdater(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+        ClinicalItemDataLoader.build_clinical_item_psql_schemata();
+
+        self.clinicalItemCategoryIdStrList = list();
+        headers = ["clinical_item_category_id","source_table"];
+        dataModels = \
+            [
+                RowItemModel( [-1, "Labs"], headers ),
+                RowItemModel( [-2, "Imaging"], headers ),
+                RowItemModel( [-3, "Meds"], headers ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", dataModel );
+            self.clinicalItemCategoryIdStrList.append( str(dataItemId) );
+
+        headers = ["clinical_item_id","clinical_item_category_id","name","analysis_status"];
+        dataModels = \
+            [
+                RowItemModel( [-1, -1, "CBC",1], headers ),
+                RowItemModel( [-2, -1, "BMP",0], headers ), # Clear analysis status, so this will be ignored
+                RowItemModel( [-4, -1, "Cardiac Enzymes",1], headers ),
+                RowItemModel( [-6, -2, "RUQ Ultrasound",1], headers ),
+                RowItemModel( [-7, -2, "CT Abdomen/Pelvis",1], headers ),
+                RowItemModel( [-8, -2, "CT PE Thorax",1], headers ),
+                RowItemModel( [-10, -3, "Carvedilol",1], headers ),
+                RowItemModel( [-11, -3, "Enoxaparin",1], headers ),
+                RowItemModel( [-12, -3, "Warfarin",1], headers ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", dataModel );
+
+        self.patientItemHeaders = ["patient_item_id","encounter_id","patient_id","clinical_item_id","item_date"];
+        dataModels = \
+            [
+                RowItemModel( [-1,  -111,   -11111, -4,  datetime(2000, 1, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-2,  -111,   -11111, -10, datetime(2000, 1, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-3,  -111,   -11111, -8,  datetime(2000, 1, 1, 2)], self.patientItemHeaders ),
+                RowItemModel( [-10, -222,   -22222, -7,  datetime(2000, 1, 5, 0)], self.patientItemHeaders ),
+                RowItemModel( [-12, -222,   -22222, -6,  datetime(2000, 1, 9, 0)], self.patientItemHeaders ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("patient_item", dataModel );
+
+        headers = ["clinical_item_id","linked_item_id"];
+        dataModels = \
+            [
+                RowItemModel( [-6, -4], headers ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item_link", dataModel );
+
+        # Newly loaded data, after the initial association analysis
+        self.newPatientItems = \
+            [
+                RowItemModel( [-4,  -112,   -11111, -10, datetime(2000, 1, 2, 0)], self.patientItemHeaders ),  # New items for an existing patient
+                RowItemModel( [-5,  -112,   -11111, -12, datetime(2000, 2, 1, 0)], self.patientItemHeaders ),
+                RowItemModel( [-13, -222,   -22222, -11, datetime(2000, 1, 9, 0)], self.patientItemHeaders ),
+                RowItemModel( [-14, -333,   -33333, -6,  datetime(2000, 2, 9, 0)], self.patientItemHeaders ),  # New patient
+                RowItemModel( [-15, -333,   -33333, -2,  datetime(2000, 2,11, 0)], self.patientItemHeaders ),
+                RowItemModel( [-16, -333,   -33333, -11, datetime(2000, 2,11, 0)], self.patientItemHeaders ),
+            ];
+
+        self.analyzer = AssociationAnalysis();
+        self.updater = AssociationUpdater();  # Instance to test on
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+
+        DBUtil.execute("delete from clinical_item_link where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("delete from patient_item where patient_item_id < 0");
+        DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
+        self.updater.dataManager.clearCacheData(DECAY_SCALE_KEY);
+        self.updater.dataManager.clearCacheData(ASSOCIATION_UPDATE_KEY);
+
+        if os.path.exists(TEST_SNAPSHOT_FILENAME):
+            os.remove(TEST_SNAPSHOT_FILENAME);
+
+        DBTestCase.tearDown(self);
+
+    def test_updateAssociations(self):
+        # Incremental updates for newly loaded items should match a full analysis of all of the data
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                count_0, count_3600, count_86400, count_any, time_diff_sum, time_diff_sum_squares,
+                patient_count_0, patient_count_86400, patient_count_any, patient_time_diff_sum,
+                encounter_count_0, encounter_count_86400, encounter_count_any
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems(analysisOptions);
+
+        # In-memory snapshot to keep up to date along with the database
+        associationMatrix = AssociationMatrix();
+        associationMatrix.loadFromDatabase(acceptCache=False);
+        self.updater.associationMatrices.append(associationMatrix);
+
+        # Recommender (as if in another process) with its own copy of the snapshot, saved to a file
+        recommender = ItemAssociationRecommender();
+        recommender.associationMatrixCheckSeconds = 0;  # Check for updates every time
+        recommender.loadAssociationMatrix(TEST_SNAPSHOT_FILENAME);
+
+        # Nothing new to update yet
+        self.assertEqual( 0, self.updater.updateAssociations() );
+
+        for dataModel in self.newPatientItems:
+            DBUtil.findOrInsertItem("patient_item", dataModel);
+        DBUtil.findOrInsertItem("clinical_item", RowItemModel([-13, -3, "Ceftriaxone", 1], ["clinical_item_id","clinical_item_category_id","name","analysis_status"]) );   # Item not in the snapshot yet
+        DBUtil.findOrInsertItem("patient_item", RowItemModel([-17, -333, -33333, -13, datetime(2000, 2,12, 0)], self.patientItemHeaders) );
+
+        # One patient at a time, until caught up
+        self.updater.maxPatientsPerUpdate = 1;
+        self.assertEqual( 1, self.updater.updateAssociations(snapshotFilename=TEST_SNAPSHOT_FILENAME) );
+        self.assertEqual( 1, self.updater.updateAssociations(snapshotFilename=TEST_SNAPSHOT_FILENAME) );
+        self.assertEqual( 1, self.updater.updateAssociations(snapshotFilename=TEST_SNAPSHOT_FILENAME) );
+        self.assertEqual( 0, self.updater.updateAssociations(snapshotFilename=TEST_SNAPSHOT_FILENAME) );
+        updatedAssociationStats = DBUtil.execute(associationQuery);
+
+        # Snapshot should match a fresh load of the updated database
+        expectedMatrix = AssociationMatrix();
+        expectedMatrix.loadFromDatabase(acceptCache=False);
+        self.assertEqual( expectedMatrix.totalPatients, associationMatrix.totalPatients );
+        self.assertEqual( expectedMatrix.itemIds.tolist(), associationMatrix.itemIds.tolist() );
+        self.assertEqual( expectedMatrix.categoryIds.tolist(), associationMatrix.categoryIds.tolist() );
+        for baseCountColumn, baseCounts in expectedMatrix.baseCountsByColumn.iteritems():
+            self.assertEqual( baseCounts.tolist(), associationMatrix.baseCountsByColumn[baseCountColumn].tolist() );
+        for countColumn in expectedMatrix.countMatrixByColumn.iterkeys():
+            self.assertEqual( expectedMatrix.countMatrix(countColumn).toarray().tolist(), associationMatrix.countMatrix(countColumn).toarray().tolist() );
+            self.assertEqual( expectedMatrix.countMatrix(countColumn).nnz, associationMatrix.countMatrix(countColumn).nnz );
+
+        # Recommender should notice the updates and reload its snapshot from the saved file
+        staleMatrix = recommender.associationMatrix;
+        recommender.refreshAssociationMatrix();
+        self.assertFalse( staleMatrix is recommender.associationMatrix );
+        self.assertEqual( expectedMatrix.totalPatients, recommender.associationMatrix.totalPatients );
+        self.assertEqual( expectedMatrix.itemIds.tolist(), recommender.associationMatrix.itemIds.tolist() );
+        for countColumn in expectedMatrix.countMatrixByColumn.iterkeys():
+            self.assertEqual( expectedMatrix.countMatrix(countColumn).toarray().tolist(), recommender.associationMatrix.countMatrix(countColumn).toarray().tolist() );
+
+        # No further reload until there are more updates
+        reloadedMatrix = recommender.associationMatrix;
+        recommender.refreshAssociationMatrix();
+        self.assertTrue( reloadedMatrix is recommender.associationMatrix );
+
+        # Full analysis from scratch should yield the same associations
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        self.analyzer.analyzePatientItems(analysisOptions);
+        expectedAssociationStats = DBUtil.execute(associationQuery);
+        self.assertEqual( expectedAssociationStats, updatedAssociationStats );
+
+    def test_updateAssociations_lazyDecay(self):
+        # With a lazy decay pending, commitUpdateBuffer stores the increments divided by the decay scale,
+        #   which the snapshot should scale back up, so it still matches a fresh load of the database
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems(analysisOptions);
+        self.updater.dataManager.decayAssociationModel(0.5, lazy=True);
+
+        associationMatrix = AssociationMatrix();
+        associationMatrix.loadFromDatabase(acceptCache=False);
+        self.assertEqual( 0.5, associationMatrix.decayScale );
+        self.updater.associationMatrices.append(associationMatrix);
+
+        for dataModel in self.newPatientItems:
+            DBUtil.findOrInsertItem("patient_item", dataModel);
+        self.assertEqual( 3, self.updater.updateAssociations() );
+
+        expectedMatrix = AssociationMatrix();
+        expectedMatrix.loadFromDatabase(acceptCache=False);
+        self.assertEqual( expectedMatrix.totalPatients, associationMatrix.totalPatients );
+        for baseCountColumn, baseCounts in expectedMatrix.baseCountsByColumn.iteritems():
+            self.assertEqual( baseCounts.tolist(), associationMatrix.baseCountsByColumn[baseCountColumn].tolist() );
+        for countColumn in expectedMatrix.countMatrixByColumn.iterkeys():
+            self.assertEqual( expectedMatrix.countMatrix(countColumn).toarray().tolist(), associationMatrix.countMatrix(countColumn).toarray().tolist() );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestAssociationUpdater));
+    return suite;
+
+if __name__=="__main__":
+    log.setLevel(LOGGER_LEVEL)
+
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+import unittest
+import time
+
+from Const import RUNNER_VERBOSITY;
+from Util import log;
+
+from medinfo.common.test.Util import MedInfoTestCase;
+
+from medinfo.cpoe.DataCache import DataCache, estimateSize;
+
+class TestDataCache(MedInfoTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        MedInfoTestCase.setUp(self);
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        MedInfoTestCase.tearDown(self);
+
+    def test_dictInterface(self):
+        # Should work as a drop-in replacement for a plain dict
+        dataCache = DataCache(maxBytes=1024*1024);   # Sizes only estimated when there is a memory cap
+        self.assertFalse( "a" in dataCache );
+        self.assertEqual( None, dataCache.get("a") );
+        self.assertRaises( KeyError, dataCache.__getitem__, "a" );
+
+        dataCache["a"] = [1,2,3];
+        dataCache["b"] = {"x": 1};
+        self.assertTrue( "a" in dataCache );
+        self.assertEqual( [1,2,3], dataCache["a"] );
+        self.assertEqual( {"x": 1}, dataCache.get("b") );
+        self.assertEqual( 2, len(dataCache) );
+
+        dataCache["a"] = [4];  # Replace prior value
+        self.assertEqual( [4], dataCache["a"] );
+        self.assertEqual( 2, len(dataCache) );
+        self.assertEqual( estimateSize([4]) + estimateSize({"x": 1}), dataCache.residentBytes );
+
+        del dataCache["a"];
+        self.assertFalse( "a" in dataCache );
+        self.assertEqual( 1, len(dataCache) );
+        self.assertEqual( estimateSize({"x": 1}), dataCache.residentBytes );
+
+        stats = dataCache.stats();
+        self.assertEqual( 3, stats["hits"] );
+        self.assertEqual( 2, stats["misses"] );
+
+        dataCache.clear();
+        self.assertEqual( 0, len(dataCache) );
+        self.assertEqual( 0, dataCache.residentBytes );
+
+    def test_namespaces(self):
+        # Same keys in different namespaces should not collide, with separate stats
+        dataCache = DataCache(maxBytes=1024*1024);
+        rows = dataCache.namespace("associationRows");
+        counts = dataCache.namespace("baseCounts");
+
+        rows["query"] = [1,2,3];
+        counts["query"] = [4,5];
+        self.assertEqual( [1,2,3], rows["query"] );
+        self.assertEqual( [4,5], counts.get("query") );
+        self.assertEqual( None, counts.get("other") );
+        self.assertFalse( "query" in dataCache );  # Not in the default namespace
+
+        stats = dataCache.stats()["namespaces"];
+        self.assertEqual( 1, stats["associationRows"]["hits"] );
+        self.assertEqual( 1, stats["baseCounts"]["hits"] );
+        self.assertEqual( 1, stats["baseCounts"]["misses"] );
+        self.assertEqual( estimateSize([1,2,3]), stats["associationRows"]["residentBytes"] );
+
+        counts.clear();
+        self.assertEqual( 0, len(counts) );
+        self.assertEqual( 1, len(rows) );
+        self.assertEqual( estimateSize([1,2,3]), dataCache.residentBytes );
+
+    def test_evictLeastRecentlyUsed(self):
+        value = list(range(10));
+        valueSize = estimateSize(value);
+
+        # Room for 3 values
+        dataCache = DataCache(maxBytes=valueSize*3);
+        dataCache["a"] = list(value);
+        dataCache["b"] = list(value);
+        dataCache["c"] = list(value);
+        dataCache["a"];    # Now most recently used
+        dataCache["d"] = list(value);  # Should evict b
+        self.assertTrue( "a" in dataCache );
+        self.assertFalse( "b" in dataCache );
+        self.assertTrue( "c" in dataCache );
+        self.assertTrue( "d" in dataCache );
+        self.assertEqual( 1, dataCache.evictions );
+        self.assertEqual( valueSize*3, dataCache.residentBytes );
+
+        # Too large for the whole cache, so don't store at all, rather than evicting everything else
+        self.assertFalse( dataCache.set("e", range(100)) );
+        self.assertFalse( "e" in dataCache );
+        self.assertEqual( 3, len(dataCache) );
+        self.assertEqual( 1, dataCache.rejections );
+        self.assertEqual( 1, dataCache.stats()["namespaces"]["default"]["rejections"] );
+
+        # Limit by entry count instead
+        dataCache = DataCache(maxEntries=2);
+        for key in ("a","b","c"):
+            dataCache[key] = key;
+        self.assertEqual( ["b","c"], sorted(key for (namespace, key) in dataCache.entryByKey.keys()) );
+        self.assertEqual( 1, dataCache.evictions );
+        self.assertEqual( 0, dataCache.residentBytes );    # No memory cap, so sizes not estimated
+
+    def test_expiration(self):
+        dataCache = DataCache(maxBytes=1024*1024, maxAgeByNamespace={"totalPatientCount": 0.05});
+        counts = dataCache.namespace("totalPatientCount");
+        counts["analyzedPatientCount"] = 100.0;
+        dataCache.set("a", 1, maxAge=0.05);
+        dataCache.set("b", 2);  # No expiration by default
+        self.assertEqual( 100.0, counts.get("analyzedPatientCount") );
+        self.assertEqual( 1, dataCache["a"] );
+
+        time.sleep(0.1);
+        self.assertEqual( None, counts.get("analyzedPatientCount") );
+        self.assertFalse( "a" in dataCache );
+        self.assertEqual( 2, dataCache["b"] );
+        self.assertEqual( 2, dataCache.expirations );
+        self.assertEqual( estimateSize(2), dataCache.residentBytes );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestDataCache));
+    return suite;
+
+if __name__=="__main__":
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
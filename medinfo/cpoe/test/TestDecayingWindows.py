@@ -20,6 +20,7 @@ from medinfo.cpoe.DecayingWindows import DecayingWindows, DecayAnalysisOptions;
 from medinfo.cpoe.DataManager import DataManager;
 
 from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.Const import DECAY_SCALE_KEY;
 
 TEMP_FILENAME = "DWTemp.txt";
 
@@ -112,6 +113,7 @@ class TestDecayingWindows(DBTestCase):
         DBUtil.execute("delete from patient_item where patient_item_id < 0");
         DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
+        self.dataManager.clearCacheData(DECAY_SCALE_KEY);
 
         # Purge temporary buffer files. May not match exact name if modified for other purpose
         for filename in os.listdir("."):
@@ -371,6 +373,53 @@ class TestDecayingWindows(DBTestCase):
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
 
+    def test_lazyDecayingWindows(self):
+        # Lazy decay should yield the same effective stats as updating all of the association rows each delta
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                count_0, count_3600, count_86400, count_any, time_diff_sum, time_diff_sum_squares,
+                patient_count_0, patient_count_86400, patient_count_any, patient_time_diff_sum,
+                encounter_count_0, encounter_count_any
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        decayAnalysisOptions = DecayAnalysisOptions()
+        decayAnalysisOptions.startD = datetime(2000,1,9)
+        decayAnalysisOptions.endD = datetime(2000,2,11)
+        decayAnalysisOptions.decay = 0.9
+        decayAnalysisOptions.delta = timedelta(weeks=4)
+        decayAnalysisOptions.patientIds = [-22222, -33333]
+        self.decayAnalyzer.decayAnalyzePatientItems(decayAnalysisOptions)
+        expectedAssociationStats = DBUtil.execute(associationQuery);
+        expectedBaseCountByItemId = self.dataManager.loadClinicalItemBaseCountByItemId(acceptCache=False);
+
+        self.dataManager.resetAssociationModel();
+        decayAnalysisOptions.lazyDecay = True;
+        self.decayAnalyzer.decayAnalyzePatientItems(decayAnalysisOptions)
+
+        # Stored stats are not decayed, just the pending decay scale
+        decayScale = self.dataManager.loadDecayScale(acceptCache=False);
+        self.assertAlmostEqual( 0.9*0.9, decayScale );
+        associationStats = [row[:2] + [value*decayScale for value in row[2:]] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+        baseCountByItemId = self.dataManager.loadClinicalItemBaseCountByItemId(acceptCache=False);
+        for itemId, baseCount in expectedBaseCountByItemId.iteritems():
+            if itemId < 0:
+                self.assertAlmostEqual( baseCount, baseCountByItemId[itemId], 3 );
+
+        # Applying the pending decay to the stored stats should get the same stats directly, and reset the scale
+        self.dataManager.decayAssociationModel(1.0);
+        self.assertEqual( 1.0, self.dataManager.loadDecayScale(acceptCache=False) );
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
     def test_resetModel(self):
         associationQuery = \
             """
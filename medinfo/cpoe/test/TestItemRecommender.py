@@ -20,6 +20,8 @@ from medinfo.db.ResultsFormatter import TabDictReader;
 from medinfo.cpoe.DataManager import DataManager;
 from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, RecommenderQuery;
 from medinfo.cpoe.ItemRecommender import SIMULATED_PATIENT_COUNT;
+from medinfo.cpoe.RecommendationCache import RecommendationCache, estimateSize;
+from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis;
 
 DELTA_HOUR = timedelta(0,60*60);
 
@@ -490,6 +492,223 @@ class TestItemRecommender(DBTestCase):
         self.assertEqualRecommendedData( baselineData, newData, query );
         self.assertEqual( baselineQueryCount, newQueryCount );  # Expect no queries for subsets
 
+    def test_resultCache(self):
+        # Repeat queries with a result cache should reuse prior results without recalculating them
+        query = RecommenderQuery();
+        query.countPrefix = "patient_";
+        query.queryItemIds = set([-2,-5]);
+        query.limit = 3;
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+        self.recommender.dataManager.dataCache = None;  # Ensure any recalculation needs new queries
+        baselineData = self.recommender( query );
+
+        self.recommender.resultCache = RecommendationCache();
+        newData = self.recommender( query );
+        self.assertEqualRecommendedData( baselineData, newData, query );
+        self.assertEqual( 0, self.recommender.resultCache.hits );
+        self.assertEqual( 1, self.recommender.resultCache.misses );
+        baselineQueryCount = self.recommender.dataManager.queryCount;
+
+        # Equivalent query, with item sets built in a different order
+        repeatQuery = RecommenderQuery();
+        repeatQuery.countPrefix = "patient_";
+        repeatQuery.queryItemIds = set([-5,-2]);
+        repeatQuery.limit = 3;
+        repeatQuery.maxRecommendedId = 0;
+        newData = self.recommender( repeatQuery );
+        self.assertEqualRecommendedData( baselineData, newData, query );
+        self.assertEqual( baselineQueryCount, self.recommender.dataManager.queryCount );   # No recalculation
+        self.assertEqual( 1, self.recommender.resultCache.hits );
+
+        # Callers modifying results should not affect the cached copies
+        for result in newData:
+            result["name"] = "Modified";
+        newData = self.recommender( query );
+        for result in newData:
+            self.assertFalse( "name" in result );
+        self.assertEqual( 2, self.recommender.resultCache.hits );
+
+        # Different query parameters should not reuse the results
+        query.limit = 2;
+        newData = self.recommender( query );
+        self.assertEqual( 2, len(newData) );
+        self.assertEqual( 2, self.recommender.resultCache.misses );
+        query.limit = 3;
+        baselineQueryCount = self.recommender.dataManager.queryCount;
+
+        # Association statistics updates are not checked for on every lookup, so cached results are still used
+        self.recommender.dataManager.setCacheData("analyzedPatientCount", "100");
+        newData = self.recommender( query );
+        self.assertEqual( 3, self.recommender.resultCache.hits );
+        self.assertEqual( baselineQueryCount, self.recommender.dataManager.queryCount );
+
+        # Until explicitly invalidated
+        self.recommender.resultCache.invalidate();
+        newData = self.recommender( query );
+        self.assertEqualRecommendedData( baselineData, newData, query );
+        self.assertEqual( 1, self.recommender.resultCache.invalidations );
+        self.assertEqual( 3, self.recommender.resultCache.misses );
+        self.assertNotEqual( baselineQueryCount, self.recommender.dataManager.queryCount );   # Had to recalculate
+        self.recommender.dataManager.clearCacheData("analyzedPatientCount");
+
+        # Or association updates are committed in the same process
+        AssociationAnalysis().commitUpdateBuffer(dict(), dict());
+        self.assertEqual( 2, self.recommender.resultCache.invalidations );
+        self.assertEqual( 0, len(self.recommender.resultCache) );
+        newData = self.recommender( query );
+        self.assertEqualRecommendedData( baselineData, newData, query );
+        self.assertEqual( 4, self.recommender.resultCache.misses );
+
+        # Or they expire
+        self.recommender.resultCache.maxAge = -1;   # Expired as soon as stored
+        self.recommender.resultCache.invalidate();
+        self.recommender( query );
+        newData = self.recommender( query );
+        self.assertEqual( 1, self.recommender.resultCache.expirations );
+        self.assertEqual( 6, self.recommender.resultCache.misses );
+
+        # Memory cap too small to keep more than one set of results at a time
+        self.recommender.resultCache = RecommendationCache();
+        self.recommender.resultCache.maxBytes = estimateSize(self.recommender.resultCache.copyResults(newData))*3/2;
+        self.recommender( query );
+        self.recommender( repeatQuery );
+        self.assertEqual( 1, self.recommender.resultCache.hits );
+        query.queryItemIds = set([-2]);
+        self.recommender( query );
+        self.assertEqual( 1, self.recommender.resultCache.evictions );
+        self.assertEqual( 1, len(self.recommender.resultCache) );
+        self.assertTrue( self.recommender.resultCache.residentBytes <= self.recommender.resultCache.maxBytes );
+
+    def test_associationMatrix(self):
+        # In-memory association matrix snapshot should yield the same recommendations as the database queries
+        snapshotFilename = "associationMatrixTemp.npz";
+
+        queries = list();
+        for paramDict in \
+            [   {"queryItemIds": "", "maxRecommendedId": "0", "excludeCategoryIds": "-1,-4"},   # Default / most common items
+                {"queryItemIds": "-2,-5,-100", "maxRecommendedId": "0"},
+                {"queryItemIds": "-2,-5,-100", "maxRecommendedId": "0", "timeDeltaMax": "3600", "excludeCategoryIds": "-2,-4,-5,-6"},
+                {"queryItemIds": "-2,-5", "maxRecommendedId": "0", "countPrefix": "patient_", "aggregationMethod": "NaiveBayes", "sortField": "freqRatio"},
+                {"queryItemIds": "-2,-5", "maxRecommendedId": "0", "countPrefix": "patient_", "aggregationMethod": "SerialBayes", "excludeItemIds": "-6"},
+                {"queryItemIds": "-6", "maxRecommendedId": "0", "countPrefix": "patient_", "sortField": "P-Fisher", "targetItemIds": "-2,-4,-5"},
+                {"queryItemIds": "-4,-6", "maxRecommendedId": "0", "invertQuery": "true", "sortField": "oddsRatio"},
+                {"queryItemIds": "-3,-4", "countPrefix": "patient_"},   # Not restricted to test data IDs, so uses actual patient count
+            ]:
+            query = RecommenderQuery();
+            query.parseParams(paramDict);
+            queries.append(query);
+
+        expectedResults = list();
+        for query in queries:
+            expectedResults.append( [(result["clinical_item_id"], result["score"]) for result in self.recommender(query)] );
+
+        try:
+            # Build the snapshot from the database and save a copy of it
+            matrixRecommender = ItemAssociationRecommender();
+            matrixRecommender.loadAssociationMatrix(snapshotFilename);
+            self.assertTrue( os.path.exists(snapshotFilename) );
+
+            # Separate instance that should just load from the saved file
+            fileRecommender = ItemAssociationRecommender();
+            fileRecommender.loadAssociationMatrix(snapshotFilename);
+            self.assertEqual( 0, fileRecommender.dataManager.queryCount );
+
+            for recommender in (matrixRecommender, fileRecommender):
+                baselineQueryCount = recommender.dataManager.queryCount;
+                for query, expectedResult in zip(queries, expectedResults):
+                    recommendedData = recommender(query);
+                    self.assertEqual( [itemId for (itemId, score) in expectedResult], [result["clinical_item_id"] for result in recommendedData] );
+                    for (itemId, score), result in zip(expectedResult, recommendedData):
+                        self.assertAlmostEquals( score, result["score"], 5 );
+                self.assertEqual( baselineQueryCount, recommender.dataManager.queryCount ); # No more association queries once have the snapshot
+        finally:
+            if os.path.exists(snapshotFilename):
+                os.remove(snapshotFilename);
+
+    def test_recommendBatch(self):
+        # Batch of queries should yield the same recommendations as running each query individually
+        queries = list();
+        for paramDict in \
+            [   {"queryItemIds": "", "maxRecommendedId": "0", "excludeCategoryIds": "-1,-4"},   # Default / most common items
+                {"queryItemIds": "-2,-5,-100", "maxRecommendedId": "0"},
+                {"queryItemIds": "-2,-5", "maxRecommendedId": "0", "timeDeltaMax": "3600", "excludeCategoryIds": "-2,-4,-5,-6"},
+                {"queryItemIds": "-2,-5", "maxRecommendedId": "0", "countPrefix": "patient_", "aggregationMethod": "NaiveBayes", "sortField": "freqRatio"},
+                {"queryItemIds": "-2,-5", "maxRecommendedId": "0", "countPrefix": "patient_", "aggregationMethod": "SerialBayes", "excludeItemIds": "-6"},
+                {"queryItemIds": "-6", "maxRecommendedId": "0", "countPrefix": "patient_", "sortField": "P-Fisher", "targetItemIds": "-2,-4,-5"},
+                {"queryItemIds": "-4,-6", "maxRecommendedId": "0", "invertQuery": "true", "sortField": "oddsRatio"},
+                {"queryItemIds": "-4,-6", "maxRecommendedId": "0", "invertQuery": "true", "sortField": "oddsRatio"}, # Repeat query
+            ]:
+            query = RecommenderQuery();
+            query.parseParams(paramDict);
+            queries.append(query);
+
+        expectedResults = list();
+        for query in queries:
+            expectedResults.append( [(result["clinical_item_id"], result["score"]) for result in self.recommender(query)] );
+
+        # Database queries, run in turn
+        self.assertBatchResults( expectedResults, self.recommender.recommendBatch(queries) );
+
+        # In-memory association matrix snapshot, preparing the batch's association rows all at once
+        snapshotFilename = "associationMatrixTemp.npz";
+        try:
+            matrixRecommender = ItemAssociationRecommender();
+            matrixRecommender.loadAssociationMatrix(snapshotFilename);
+            baselineQueryCount = matrixRecommender.dataManager.queryCount;
+            self.assertBatchResults( expectedResults, matrixRecommender.recommendBatch(queries) );
+            self.assertEqual( baselineQueryCount, matrixRecommender.dataManager.queryCount );
+
+            # Identical result models to the individual queries on the snapshot, including component results and tie order
+            for query, recommendedData in zip(queries, matrixRecommender.recommendBatch(queries)):
+                self.assertEqual( matrixRecommender(query), recommendedData );
+
+            # Should also work through result cache, reusing the results for repeat queries
+            matrixRecommender.resultCache = RecommendationCache();
+            self.assertBatchResults( expectedResults, matrixRecommender.recommendBatch(queries) );
+            self.assertBatchResults( expectedResults, matrixRecommender.recommendBatch(queries) );
+            self.assertTrue( matrixRecommender.resultCache.stats()["hits"] >= len(queries) );
+        finally:
+            if os.path.exists(snapshotFilename):
+                os.remove(snapshotFilename);
+
+    def assertBatchResults(self, expectedResults, batchResults):
+        """Compare batch results against individual query results.
+        Items with tied scores may come back in a different order, so compare the score sequence and item sets.
+        """
+        self.assertEqual( len(expectedResults), len(batchResults) );
+        for expectedResult, recommendedData in zip(expectedResults, batchResults):
+            self.assertEqual( len(expectedResult), len(recommendedData) );
+            self.assertEqual( set([itemId for (itemId, score) in expectedResult]), set([result["clinical_item_id"] for result in recommendedData]) );
+            for (itemId, score), result in zip(expectedResult, recommendedData):
+                self.assertAlmostEquals( score, result["score"], 5 );
+
+    def test_selectTopResults(self):
+        # Partial selection of the top results should yield the same order, including tie-breaks, as fully sorting them
+        aggregateResults = list();
+        for itemId in xrange(-1,-101,-1):
+            nAB = float(-itemId % 7);  # Many ties in scores
+            aggregateResults.append( {"clinical_item_id": itemId, "nAB": nAB, "nA": 10.0, "nB": 20.0, "N": 100.0} );
+        ItemAssociationRecommender.populateDerivedStatsList(aggregateResults, ["PPV"]);
+
+        for sortReverse in (True, False):
+            for limit in (None, 0, 1, 5, 10, 15, 100, 200):
+                query = RecommenderQuery();
+                query.sortField = "PPV";
+                query.sortReverse = sortReverse;
+
+                fullySorted = [(result["PPV"], result) for result in aggregateResults];
+                fullySorted.sort();
+                if sortReverse:
+                    fullySorted.reverse();
+                expectedItemIds = [result["clinical_item_id"] for (score, result) in fullySorted];
+                if limit is not None:
+                    expectedItemIds = expectedItemIds[:limit];
+
+                query.limit = limit;
+                topResults = ItemAssociationRecommender.selectTopResults(aggregateResults, query);
+                self.assertEqual( expectedItemIds, [result["clinical_item_id"] for result in topResults] );
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
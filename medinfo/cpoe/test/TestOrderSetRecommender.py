@@ -335,6 +335,38 @@ class TestOrderSetRecommender(DBTestCase):
         recommendedData = self.recommender( query );
         self.assertEqualRecommendedData( expectedData, recommendedData, query );
 
+    def test_calculateScoreMatrix(self):
+        # Score a batch of queries at once and verify consistent with individual queries
+        query = RecommenderQuery();
+        query.sortField = "tf";
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+        self.recommender.initItemLookups(query);
+
+        queryItemIdsList = [set(), set([-100]), set([-2,-5,-100]), set([-5])];
+        (weightMatrix, scoreMatrix, tfidfMatrix) = self.recommender.calculateScoreMatrix(queryItemIdsList);
+        self.assertEqual( (4, len(self.recommender.orderSetIds)), weightMatrix.shape );
+        self.assertEqual( (4, len(self.recommender.orderSetItemIds)), scoreMatrix.shape );
+        self.assertEqual( scoreMatrix.shape, tfidfMatrix.shape );
+
+        # Blank query or query with no order set data should be weighted by order set sizes
+        iItem = self.recommender.itemIndexById[-6];
+        self.assertAlmostEquals( 2.0/13, scoreMatrix[0,iItem], 5 );
+        self.assertAlmostEquals( 2.0/13, scoreMatrix[1,iItem], 5 );
+        self.assertAlmostEquals( (1.0/6)*(2.0/2)+(1.0/4)*(1.0/2), scoreMatrix[2,iItem], 5 );
+        self.assertAlmostEquals( (13.0/2)*((1.0/6)*(2.0/2)+(1.0/4)*(1.0/2)), tfidfMatrix[2,iItem], 5 );
+
+        # Query with just -5, found in order sets -2 and -3
+        weightByOrderSetId = dict( zip(self.recommender.orderSetIds, weightMatrix[3]) );
+        self.assertAlmostEquals( 0.0, weightByOrderSetId[-1], 5 );
+        self.assertAlmostEquals( 1.0, weightByOrderSetId[-2], 5 );
+        self.assertAlmostEquals( 1.0, weightByOrderSetId[-3], 5 );
+
+        for iQuery, queryItemIds in enumerate(queryItemIdsList):
+            query.queryItemIds = queryItemIds;
+            expectedData = self.recommender( query );
+            recommendedData = self.recommender.recommendedDataFromScores(query, self.recommender.queryItemCountById(query), weightMatrix[iQuery], scoreMatrix[iQuery], tfidfMatrix[iQuery]);
+            self.assertEqualRecommendedData( expectedData, recommendedData, query );
+
     def assertEqualRecommendedData(self, expectedData, recommendedData, query):
         """Run assertEqualGeneral on the key components of the contents of the recommendation data.
         Don't necessarily care about the specific numbers that come out of the recommendations,
@@ -105,6 +105,7 @@ class TestTopicModel(DBTestCase):
         expectedDocCountByWordId = \
                 {1:3, 2:3, 3:3, 4:4, 5:3, None:5, 9:3, 10:3, 11:2, 12:4, 13:4, 14:1, 15:2, 16:4, 8:3}
         self.assertExpectedTopItems( expectedDocCountByWordId, model, topTopicFile );
+        self.assertExpectedTopicItemMatrix( expectedDocCountByWordId, model, TEST_FILE_PREFIX );
         
         
         # Do again but with HDP non-parametric model
@@ -119,6 +120,29 @@ class TestTopicModel(DBTestCase):
         expectedDocCountByWordId = \
                 {1:3, 2:3, 3:3, 4:4, 5:3, None:5, 9:3, 10:3, 11:2, 12:4, 13:4, 14:1, 15:2, 16:4, 8:3}
         self.assertExpectedTopItems( expectedDocCountByWordId, model, topTopicFile );
+        self.assertExpectedTopicItemMatrix( expectedDocCountByWordId, model, "HDP"+TEST_FILE_PREFIX );
+
+    def assertExpectedTopicItemMatrix(self, expectedDocCountByWordId, model, modelFilename):
+        # Dense topic item matrix saved with the model should be consistent with the model topic parameters
+        topicItemMatrixFilename = self.instance.topicItemMatrixFilename(modelFilename, ITEMS_PER_TOPIC);
+        (topicIds, itemIds, weightMatrix, tfidfScales) = self.instance.loadTopicItemMatrix( topicItemMatrixFilename, modelFilename );
+        self.assertEqual( sorted(itemId for itemId in expectedDocCountByWordId if itemId is not None), itemIds.tolist() );
+
+        weightByItemIdByTopicId = self.instance.generateWeightByItemIdByTopicId(model, ITEMS_PER_TOPIC);
+        self.assertEqual( sorted(weightByItemIdByTopicId.keys()), sorted(topicIds.tolist()) );
+        for iTopic, topicId in enumerate(topicIds):
+            for iItem, itemId in enumerate(itemIds):
+                expectedWeight = weightByItemIdByTopicId[topicId].get(itemId, 0.0);
+                self.assertAlmostEqual( expectedWeight, weightMatrix[iTopic,iItem], places=5 );
+
+        for iItem, itemId in enumerate(itemIds):
+            expectedTFIDFScale = float(expectedDocCountByWordId[None]) / expectedDocCountByWordId[itemId];
+            self.assertAlmostEqual( expectedTFIDFScale, tfidfScales[iItem], places=5 );
+
+        # Not accepted anymore if the model file is replaced afterwards
+        modelMTime = os.path.getmtime(modelFilename);
+        os.utime(modelFilename, (modelMTime+60, modelMTime+60));
+        self.assertEqual( None, self.instance.loadTopicItemMatrix( topicItemMatrixFilename, modelFilename ) );
 
     def assertExpectedTopItems(self, expectedDocCountByWordId, model, topTopicFile):
         # With randomized optimization algorithm, cannot depend on stable
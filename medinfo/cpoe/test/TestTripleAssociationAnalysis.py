@@ -59,6 +59,7 @@ class TestTripleAssociationAnalysis(DBTestCase):
                 RowItemModel( [-14, -4, "Admit",1], headers ),  # Look for sequences of these
                 RowItemModel( [-15, -4, "Discharge",1], headers ),
                 RowItemModel( [-16, -4, "Readmit",1], headers ),
+                RowItemModel( [-17, -4, "Admit to Discharge",1], headers ),
             ];
         for dataModel in dataModels:
             (dataItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", dataModel );
@@ -153,6 +154,54 @@ class TestTripleAssociationAnalysis(DBTestCase):
         itemLinks = DBUtil.execute(itemLinkQuery);
         self.assertEqualTable( expectedItemLinks, itemLinks );
 
+    def test_analyzePatientItemSequences(self):
+        # Analyze multiple sequences in a single pass
+        associationQuery = \
+            """
+            select 
+                clinical_item_id, subsequent_item_id, 
+                count_0, count_3600, count_86400, count_604800, 
+                count_2592000, count_7776000, count_31536000,
+                count_any, 
+                time_diff_sum, time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0 and
+                count_any > 0
+            order by
+                subsequent_item_id, clinical_item_id
+            """;
+
+        self.analyzer.analyzePatientItemSequences( [-11111], {(-15,-14): -16, (-14,-15): -17} );
+
+        expectedAssociationStats = \
+            [
+                [-17,-17,   2, 2, 2, 2, 3, 3, 3, 3,  2505600.0, 2505600.0**2],   # Both discharges complete an admit to discharge sequence
+                [-12,-17,   0, 0, 0, 0, 1, 1, 1, 1,  2592000.0, 2592000.0**2],
+                [-11,-17,   0, 0, 0, 0, 1, 1, 1, 1,  2505600.0, 2505600.0**2],
+                [-10,-17,   0, 0, 0, 0, 1, 4, 4, 4,  2764800.0+5270400.0+5184000.0+2469600.0, 2764800.0**2+5270400.0**2+5184000.0**2+2469600.0**2],
+                [ -9,-17,   0, 0, 1, 1, 1, 1, 1, 1,  86400.0, 86400.0**2],
+                [ -8,-17,   0, 0, 1, 1, 1, 3, 3, 3,  2757600.0+5263200.0+82800.0, 2757600.0**2+5263200.0**2+82800.0**2],
+
+                # Same as analyzing the first sequence alone
+                [-16,-16,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-12,-16,   0, 0, 0, 0, 1, 1, 1, 1,  2509200.0, 2509200.0**2],
+                [-11,-16,   0, 0, 0, 0, 1, 1, 1, 1,  2422800.0, 2422800.0**2],
+                [-10,-16,   0, 0, 0, 0, 0, 2, 2, 2,  5101200.0+5187600.0, 5101200.0**2+5187600.0**2],
+                [ -8,-16,   0, 0, 0, 0, 0, 1, 1, 1,  5180400.0, 5180400.0**2],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_discoverFrequentSequences(self):
+        # Find sequences of items that occur for enough patients
+        frequentSequences = self.analyzer.discoverFrequentSequences( [-11111], 1, itemIds=[-14,-15] );
+        self.assertEqual( [((-15,-14), 1), ((-14,-15), 1)], frequentSequences );
+
+        frequentSequences = self.analyzer.discoverFrequentSequences( [-11111], 2, itemIds=[-14,-15] );
+        self.assertEqual( [], frequentSequences );
+
 
 def suite():
     """Returns the suite of tests to run for this test class / module.
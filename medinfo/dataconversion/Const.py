@@ -32,4 +32,10 @@ FLAG_ABNORMAL = "Abnormal";
 Z_SCORE_LIMIT = 2;
 
 """Collection Type ID to designate system order sets"""
-COLLECTION_TYPE_ORDERSET = 4;
\ No newline at end of file
+COLLECTION_TYPE_ORDERSET = 4;
+
+"""Columns of the patient_item unique constraint (patient_item_composite), to skip duplicate patient items when bulk inserting"""
+PATIENT_ITEM_KEY_COLS = ("patient_id","clinical_item_id","item_date");
+
+"""Columns of the patient_item_collection_link unique constraint (patient_item_collection_link_composite), to skip duplicate links when bulk inserting"""
+PATIENT_ITEM_COLLECTION_LINK_KEY_COLS = ("patient_item_id","item_collection_item_id");
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""Run a STRIDE data conversion (e.g., STRIDEOrderProcConversion) in parallel,
+by splitting its source table into chunks by date range and/or patient hash,
+and converting the chunks in a pool of worker processes.
+
+Converter objects covered by the runner provide a common interface:
+- connFactory: Source of database connections
+- queryChunkSourceItems(chunk, progress=None, dimensionsOnly=False, conn=None): Yield the source items for a ConversionChunk,
+    or if dimensionsOnly, just the distinct combinations of the values that determine their dimension records (see selectDimensionsOnly)
+- convertSourceItemDimensions(sourceItem, conn): Find or insert just the dimension records
+    (clinical_item_category, clinical_item, item_collection, etc.) for a source item
+- convertSourceItem(sourceItem, conn): Convert a source item into (buffered) patient_item and link records
+- flushBuffers(conn): Bulk insert any patient_item and link records still buffered
+
+Dimension tables have no unique constraints, so parallel workers could race to insert duplicate clinical items.
+Instead, a pre-pass resolves all of the dimension records first, in the parent process,
+from the distinct dimension values of each chunk, queried in parallel by the workers.
+Workers then start with the converter's warmed caches, only looking up dimension records in memory
+while they bulk insert the patient_item (and link) records for their chunks.
+
+Each chunk is converted in a single transaction, along with its record in the conversion_checkpoint table,
+so if a run is killed, running it again (with the same chunk options) will skip the chunks already done,
+and redo any chunk left incomplete from scratch.
+"""
+import sys, os
+import time;
+import itertools;
+import multiprocessing;
+from datetime import datetime, timedelta;
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery, RowItemModel;
+
+from Util import log;
+
+"""Table recording the chunks completed by each conversion, so interrupted runs can resume"""
+CHECKPOINT_TABLE = "conversion_checkpoint";
+
+class ConversionChunk:
+    """Portion of a conversion's source data to run in one worker.
+    Source items dated on or after startDate and before endDate (None for unbounded).
+    If patientShard is specified as an (iShard, nShards) tuple, only items for patients
+    whose (numeric) pat_id modulo nShards is iShard (see addPatientShardWhere).
+    """
+    def __init__(self, startDate=None, endDate=None, patientShard=None):
+        self.startDate = startDate;
+        self.endDate = endDate;
+        self.patientShard = patientShard;
+
+    def key(self):
+        """String to identify the chunk in the checkpoint table"""
+        dateStrs = list();
+        for chunkDate in (self.startDate, self.endDate):
+            if chunkDate is not None:
+                dateStrs.append(chunkDate.isoformat());
+            else:
+                dateStrs.append("");
+        keyStr = str.join("/", dateStrs);
+        if self.patientShard is not None:
+            keyStr += "#%d/%d" % self.patientShard;
+        return keyStr;
+
+    def __str__(self):
+        return self.key();
+
+class ConversionRunner:
+    """Split a converter's source data into chunks and run them in parallel worker processes,
+    with a shared pre-pass to resolve dimension records, and checkpoints to resume interrupted runs.
+    """
+    def __init__(self, converter, numWorkers=1, chunkDays=None, nPatientShards=None):
+        """Constructor, with the (configured) converter object to run.
+
+        numWorkers - Number of worker processes. If only 1, just convert the chunks in this process.
+            Worker processes are forked without any open database connection, so each opens its own.
+        chunkDays - If provided, split the date range into chunks of this many days each.
+        nPatientShards - If provided, further split each date range into this many chunks by patient ID hash.
+        """
+        self.converter = converter;
+        self.numWorkers = numWorkers;
+        self.chunkDays = chunkDays;
+        self.nPatientShards = nPatientShards;
+
+    def conversionName(self):
+        """Name of the conversion, to record its checkpoints by"""
+        return self.converter.__class__.__name__;
+
+    def run(self, startDate=None, endDate=None, restart=False):
+        """Primary run function to convert the source items dated on or after startDate and before endDate.
+        Chunks already recorded as completed by a previous run are skipped, unless restart is set.
+        Returns the number of chunks converted.
+        """
+        timer = time.time();
+        chunks = self.makeChunks(startDate, endDate);
+        conn = self.converter.connFactory.connection();
+        try:
+            if restart:
+                self.clearCheckpoints(conn=conn);
+            completedKeys = self.queryCompletedChunkKeys(conn=conn);
+            pendingChunks = [chunk for chunk in chunks if chunk.key() not in completedKeys];
+            if len(pendingChunks) < len(chunks):
+                log.info("Resume with %d of %d chunks already completed" % (len(chunks)-len(pendingChunks), len(chunks)) );
+        finally:
+            conn.close();
+
+        # Find or insert all dimension records up front, so workers do not race to insert them
+        self.resolveDimensions(pendingChunks);
+
+        chunkTasks = [(self.conversionName(), chunk) for chunk in pendingChunks];
+        if self.numWorkers > 1 and len(chunkTasks) > 1:
+            pool = multiprocessing.Pool(min(self.numWorkers, len(chunkTasks)), initConversionWorker, (self.converter,));
+            try:
+                for chunkResult in pool.imap_unordered(convertChunk, chunkTasks):
+                    self.logChunkResult(chunkResult);
+                pool.close();
+            finally:
+                pool.terminate();
+                pool.join();
+        else:
+            initConversionWorker(self.converter);
+            for chunkTask in chunkTasks:
+                self.logChunkResult(convertChunk(chunkTask));
+
+        timer = time.time() - timer;
+        log.info("%d chunks converted by %d workers in %.1f seconds" % (len(chunkTasks), self.numWorkers, timer) );
+        return len(chunkTasks);
+
+    def makeChunks(self, startDate=None, endDate=None):
+        """List of ConversionChunks covering the date range, split by chunkDays and nPatientShards.
+        Without an endDate, chunks continue up to the present, with the last one left open-ended
+        (so later items are not missed, and the other chunk keys stay the same if the run is resumed on a later day).
+        Date range chunks require a startDate.
+        """
+        dateRanges = [(startDate, endDate)];
+        if self.chunkDays is not None:
+            if startDate is None:
+                log.warning("Date range chunks require a start date. Converting the whole date range as one chunk.");
+            else:
+                dateRanges = list();
+                now = datetime.now();
+                chunkStart = startDate;
+                while endDate is None or chunkStart < endDate:
+                    chunkEnd = chunkStart + timedelta(self.chunkDays);
+                    if endDate is not None:
+                        chunkEnd = min(chunkEnd, endDate);
+                    elif chunkEnd > now:
+                        chunkEnd = None;    # Last chunk, for any items dated later
+                    dateRanges.append( (chunkStart, chunkEnd) );
+                    if chunkEnd is None:
+                        break;
+                    chunkStart = chunkEnd;
+
+        patientShards = [None];
+        if self.nPatientShards is not None and self.nPatientShards > 1:
+            patientShards = [(iShard, self.nPatientShards) for iShard in xrange(self.nPatientShards)];
+
+        chunks = list();
+        for (chunkStart, chunkEnd) in dateRanges:
+            for patientShard in patientShards:
+                chunks.append( ConversionChunk(chunkStart, chunkEnd, patientShard) );
+        return chunks;
+
+    def resolveDimensions(self, chunks):
+        """Pre-pass to find or insert the dimension records for the source items of the chunks,
+        leaving them in the converter's local caches for the workers.
+        Worker processes query just the distinct dimension values of each chunk (see queryChunkDimensionItems),
+        which are then resolved here one at a time, so only this process inserts any new dimension records.
+        Returns the number of distinct dimension items checked.
+        """
+        timer = time.time();
+        nItems = 0;
+        pool = None;
+        if self.numWorkers > 1 and len(chunks) > 1:
+            # Fork the pool before opening a connection here, so the workers do not inherit it
+            pool = multiprocessing.Pool(min(self.numWorkers, len(chunks)), initConversionWorker, (self.converter,));
+            chunkItemLists = pool.imap(queryChunkDimensionItems, chunks);
+        else:
+            initConversionWorker(self.converter);
+            chunkItemLists = itertools.imap(queryChunkDimensionItems, chunks);
+
+        conn = self.converter.connFactory.connection();
+        try:
+            for chunkItems in chunkItemLists:
+                for sourceItem in chunkItems:
+                    self.converter.convertSourceItemDimensions(sourceItem, conn=conn);
+                    nItems += 1;
+            conn.commit();
+            if pool is not None:
+                pool.close();
+        finally:
+            conn.close();
+            if pool is not None:
+                pool.terminate();
+                pool.join();
+        log.info("Resolved dimensions for %d distinct items in %.1f seconds" % (nItems, time.time()-timer) );
+        return nItems;
+
+    def queryCompletedChunkKeys(self, conn=None):
+        """Set of the keys of the chunks of this conversion recorded in the checkpoint table"""
+        query = SQLQuery();
+        query.addSelect("chunk_key");
+        query.addFrom(CHECKPOINT_TABLE);
+        query.addWhereEqual("conversion_name", self.conversionName() );
+        return set([row[0] for row in DBUtil.execute(query, conn=conn)]);
+
+    def clearCheckpoints(self, conn=None):
+        """Discard the checkpoints of this conversion, so all chunks will be converted again"""
+        query = "delete from %s where conversion_name = %s" % (CHECKPOINT_TABLE, DBUtil.SQL_PLACEHOLDER);
+        DBUtil.execute(query, (self.conversionName(),), conn=conn);
+
+    def logChunkResult(self, chunkResult):
+        (pid, chunkKey, nItems, chunkSeconds) = chunkResult;
+        log.info("Worker %d: Chunk %s, %d source items in %.1f seconds (%.1f items/sec)" % \
+            (pid, chunkKey, nItems, chunkSeconds, nItems/max(chunkSeconds,1e-6)) );
+
+def addPatientShardWhere(query, patientIdCol, patientShard=None):
+    """Restrict a source item SQLQuery to an (iShard, nShards) patient shard, if specified,
+    by the numeric value of the patientIdCol modulo nShards.
+    Source patient IDs (e.g., STRIDE pat_id) are cast to numbers, as they are for the patient_item table.
+    """
+    if patientShard is not None:
+        (iShard, nShards) = patientShard;
+        query.addWhere("mod(abs(cast(%s as bigint)), %d) = %d" % (patientIdCol, nShards, iShard) );
+
+def selectDimensionsOnly(query, dimensionHeaders):
+    """Reduce a source item SQLQuery for a queryChunkSourceItems dimensionsOnly pre-pass,
+    to select just the distinct combinations of the dimensionHeaders columns, with nulls in place of the other columns.
+    Rows then still have all of the usual columns for the converter to process, but there are far fewer of them.
+    """
+    query.select = [selectItem if selectItem in dimensionHeaders else "null" for selectItem in query.select];
+    query.setDistinct();
+
+def addRunnerOptions(parser):
+    """Add the command-line options for running a conversion in parallel chunks to the OptionParser"""
+    parser.add_option("-w", "--numWorkers", dest="numWorkers", help="If provided, run the conversion in parallel chunks with this many worker processes. Previously completed chunks are skipped, to resume an interrupted run.");
+    parser.add_option("-c", "--chunkDays", dest="chunkDays", help="With numWorkers, split the date range into chunks of this many days each (requires a start date).");
+    parser.add_option("-p", "--patientShards", dest="patientShards", help="With numWorkers, further split each date range into this many chunks by patient ID hash.");
+    parser.add_option("-r", "--restart", dest="restart", action="store_true", help="With numWorkers, discard the checkpoints of any previous run and convert all chunks again.");
+
+def runnerFromParserOptions(converter, options):
+    """ConversionRunner for the converter configured from the addRunnerOptions options,
+    or None if not requested (numWorkers not specified).
+    """
+    if options.numWorkers is None:
+        return None;
+    chunkDays = None;
+    if options.chunkDays is not None:
+        chunkDays = int(options.chunkDays);
+    nPatientShards = None;
+    if options.patientShards is not None:
+        nPatientShards = int(options.patientShards);
+    return ConversionRunner(converter, int(options.numWorkers), chunkDays, nPatientShards);
+
+# Converter object for the chunks run in each worker process, with the dimension caches warmed by the pre-pass
+workerConverter = None;
+
+class ChunkTransaction:
+    """Wrapper around a database connection to convert a chunk in a single transaction, along with its checkpoint,
+    so the chunk is either completed and checkpointed, or left entirely undone to convert again.
+    Commits along the way (e.g., by DimensionCache or InsertBuffer flushes) are deferred until the real commit at the end.
+    A rollback discards everything since the start of the chunk, so the chunk can no longer be completed.
+    """
+    def __init__(self, conn):
+        self.conn = conn;
+        self.rolledBack = False;
+
+    def commit(self):
+        pass;   # Deferred to the end of the chunk
+
+    def rollback(self):
+        self.conn.rollback();
+        self.rolledBack = True;
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name);
+
+def initConversionWorker(converter):
+    """Worker process initializer for ConversionRunner.run, to receive the (large) converter object only once"""
+    global workerConverter;
+    workerConverter = converter;
+
+def queryChunkDimensionItems(chunk):
+    """Worker process function for ConversionRunner.resolveDimensions.
+    Returns the list of the distinct dimension value items of one chunk (see queryChunkSourceItems dimensionsOnly).
+    """
+    conn = workerConverter.connFactory.connection();
+    try:
+        # Copies, in case the converter reuses row objects between items
+        return [RowItemModel(sourceItem) for sourceItem in workerConverter.queryChunkSourceItems(chunk, dimensionsOnly=True, conn=conn)];
+    finally:
+        conn.close();
+
+def convertChunk(chunkTask):
+    """Worker process function for ConversionRunner.run.
+    Convert the source items of one chunk, bulk inserting the patient_item (and link) records,
+    then record the chunk as completed in the checkpoint table, all in one transaction (see ChunkTransaction).
+    Returns (process ID, chunk key, source items, seconds) to report throughput.
+    """
+    (conversionName, chunk) = chunkTask;
+    timer = time.time();
+    converter = workerConverter;
+    realConn = converter.connFactory.connection();
+    conn = ChunkTransaction(realConn);
+    try:
+        nItems = 0;
+        for sourceItem in converter.queryChunkSourceItems(chunk, conn=conn):
+            converter.convertSourceItem(sourceItem, conn=conn);
+            nItems += 1;
+        converter.flushBuffers(conn=conn);
+
+        checkpoint = \
+            RowItemModel \
+            (   {   "conversion_name": conversionName,
+                    "chunk_key": chunk.key(),
+                    "source_item_count": nItems,
+                    "completed_date": datetime.now(),
+                }
+            );
+        DBUtil.insertRow(CHECKPOINT_TABLE, checkpoint, conn=conn);
+        if conn.rolledBack:
+            raise Exception("Chunk %s partially rolled back (skipped errors?), so not completed" % chunk.key());
+        realConn.commit();
+    finally:
+        realConn.close();
+    return (os.getpid(), chunk.key(), nItems, time.time()-timer);
@@ -946,6 +946,8 @@ class FeatureMatrixFactory:
     def _queryFlowsheetResultsByName(self, flowsheetBaseNames):
         """
         Query stride_flowsheet for each patient.
+        Returns an iterator over the result rows (as RowItemModels),
+        streamed from the database in batches.
         """
         # Verify patient list and/or patient episode has been processed.
         if not self.patientsProcessed:
@@ -1002,23 +1004,9 @@ class FeatureMatrixFactory:
         # print query_str
         log.debug(query_str)
 
-        # results = DBUtil.connection().cursor().execute(query_str).fetchall()
-        # print results
-        cur = DBUtil.connection().cursor()
-        cur.execute(query_str)
-
-        results = []
-        colNames = DBUtil.columnNamesFromCursor(cur)
-        results.append(colNames)
-
-        dataTable = list(cur.fetchall())
-        for i, row in enumerate(dataTable):
-            dataTable[i] = list(row);
-        results.extend(dataTable);
-
-        # Execute query.
-        # return modelListFromTable(DBUtil.execute(query, includeColumnNames=True))
-        return modelListFromTable(results)
+        # Execute query, streaming the results in batches rather than
+        # holding the whole result set in memory.
+        return DBUtil.iterate(query_str, rowFormat="model")
 
     def colsFromBaseNames(self, baseNames, preTimeDays, postTimeDays):
         """Enumerate derived column/feature names given a set of (lab) result base names"""
@@ -1169,6 +1157,8 @@ class FeatureMatrixFactory:
     def _queryLabResultsByName(self, labNames, isLabPanel = True):
         """
         Query for all lab results that match with the given result base names.
+        Returns an iterator over the result rows (as RowItemModels),
+        streamed from the database in batches.
         """
         # Verify patient list and/or patient episode has been processed.
         if not self.patientsProcessed:
@@ -1210,7 +1200,7 @@ class FeatureMatrixFactory:
             query.addOrderBy("sor.result_time")
 
             log.debug(query)
-            return modelListFromTable(DBUtil.execute(query, includeColumnNames=True))
+            return DBUtil.iterate(query, rowFormat="model")
 
 
         else:
@@ -1243,19 +1233,7 @@ class FeatureMatrixFactory:
             elif LocalEnv.DATASET_SOURCE_NAME == 'UMich' or LocalEnv.DATASET_SOURCE_NAME == 'UCSF':
                 query_str += ", result_time"
 
-            cur = DBUtil.connection().cursor()
-            cur.execute(query_str)
-
-            results = []
-            colNames = DBUtil.columnNamesFromCursor(cur)
-            results.append(colNames)
-
-            dataTable = list(cur.fetchall())
-            for i, row in enumerate(dataTable):
-                dataTable[i] = list(row);
-            results.extend(dataTable);
-
-            return modelListFromTable(results)
+            return DBUtil.iterate(query_str, rowFormat="model")
 
 
     def _parseResultsData(self, resultRowIter, patientIdCol, nameCol, valueCol, datetimeCol):
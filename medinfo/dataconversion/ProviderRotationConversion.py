@@ -84,19 +84,10 @@ class ProviderRotationConversion:
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
         # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             yield rowModel;
-            row = cursor.fetchone();
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
 
         if not extConn:
             conn.close();
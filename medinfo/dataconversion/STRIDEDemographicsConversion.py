@@ -5,12 +5,12 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS;
 from Env import DATE_FORMAT;
 
 SOURCE_TABLE = "stride_patient";
@@ -79,6 +79,8 @@ class STRIDEDemographicsConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS, findIds=False);   # Patient items to bulk insert (IDs not needed)
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
 
@@ -95,6 +97,7 @@ class STRIDEDemographicsConversion:
         try:
             for sourceItem in self.querySourceItems(patientIds, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
+            self.patientItemBuffer.flush(conn=conn);
         finally:
             conn.close();
         # progress.PrintStatus();
@@ -204,7 +207,8 @@ class STRIDEDemographicsConversion:
             categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItemModel = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
             patientItemModel = self.patientItemModelFromSourceItem(sourceItem, clinicalItemModel, conn=conn);
-
+            if not extConn:
+                self.patientItemBuffer.flush(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
@@ -220,7 +224,7 @@ class STRIDEDemographicsConversion:
                         "description":  "Demographics",
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -238,7 +242,7 @@ class STRIDEDemographicsConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
@@ -254,14 +258,8 @@ class STRIDEDemographicsConversion:
                     "item_date":  sourceItem["itemDate"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items
+        self.patientItemBuffer.add(patientItem, conn=conn);
 
 
 
@@ -7,12 +7,13 @@ from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS;
 from Env import DATE_FORMAT;
+from ConversionRunner import addPatientShardWhere, selectDimensionsOnly, addRunnerOptions, runnerFromParserOptions;
 
 SOURCE_TABLE = "stride_dx_list";
 SUBCODE_DELIM = ".";    # Delimiter for ICD9 codes to distinguish main categorization vs. detail descriptions
@@ -39,6 +40,8 @@ class STRIDEDxListConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS, findIds=False);   # Patient items to bulk insert (IDs not needed)
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
         self.icd9_str_by_code = None
@@ -58,15 +61,22 @@ class STRIDEDxListConversion:
         try:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
+            self.flushBuffers(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
 
 
-    def querySourceItems(self, startDate=None, endDate=None, progress=None, conn=None):
+    def queryChunkSourceItems(self, chunk, progress=None, dimensionsOnly=False, conn=None):
+        """Query for the source items of one chunk (date range and patient shard) of a parallel conversion (see ConversionRunner)"""
+        return self.querySourceItems(chunk.startDate, chunk.endDate, progress=progress, patientShard=chunk.patientShard, dimensionsOnly=dimensionsOnly, conn=conn);
+
+    def querySourceItems(self, startDate=None, endDate=None, progress=None, patientShard=None, dimensionsOnly=False, conn=None):
         """Query the database for list of all source clinical items (diagnosed probelms in this case)
         and yield the results one at a time.  If startDate provided, only return items
         whose noted_date is on or after that date.
+        If patientShard provided as an (iShard, nShards) tuple, only return items for that hash partition of patients.
+        If dimensionsOnly, only return the distinct combinations of the values needed for convertSourceItemDimensions.
         """
         extConn = conn is not None;
         if not extConn:
@@ -90,6 +100,9 @@ class STRIDEDxListConversion:
             query.addWhereOp("noted_date",">=", startDate);
         if endDate is not None:
             query.addWhereOp("noted_date","<", endDate);
+        addPatientShardWhere(query, "pat_id", patientShard);
+        if dimensionsOnly:
+            selectDimensionsOnly(query, ["dx_icd9_code","dx_icd9_code_list","dx_icd10_code_list","data_source"]);
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
@@ -179,7 +192,8 @@ class STRIDEDxListConversion:
                             yield row_model
 
             row = cursor.fetchone();
-            progress.Update();
+            if progress is not None:
+                progress.Update();
 
         # Slight risk here.  Normally DB connection closing should be in finally of a try block,
         #   but using the "yield" generator construct forbids us from using a try, finally construct.
@@ -197,17 +211,25 @@ class STRIDEDxListConversion:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
-            #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
-            #   in a first past, with subsequent calls just yielding back in memory cached copies
-            categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
-            clinicalItem = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
+            clinicalItem = self.convertSourceItemDimensions(sourceItem, conn=conn);
             patientItem = self.patientItemModelFromSourceItem(sourceItem, clinicalItem, conn=conn);
-
+            if not extConn:
+                self.flushBuffers(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
 
+    def convertSourceItemDimensions(self, sourceItem, conn):
+        """Find or produce the dimension records for the sourceItem, without its patient_item.
+        Return the clinicalItem.
+        A ConversionRunner calls this alone in a pre-pass, so its parallel workers find these in the local caches.
+        """
+        # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
+        #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
+        #   in a first past, with subsequent calls just yielding back in memory cached copies
+        categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
+        return self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
+
 
     def categoryFromSourceItem(self, sourceItem, conn):
         # Load or produce a clinical_item_category record model for the given sourceItem
@@ -220,7 +242,7 @@ class STRIDEDxListConversion:
                         "description":  "Diagnosis (%s)" % sourceItem["data_source"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -239,7 +261,7 @@ class STRIDEDxListConversion:
                         "description": "%(icd_str)s" % sourceItem,
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey]
@@ -255,15 +277,12 @@ class STRIDEDxListConversion:
                     "item_date":  sourceItem["noted_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
-            pass;
+        # Buffered to bulk insert, skipping any duplicates of existing patient items
+        self.patientItemBuffer.add(patientItem, conn=conn);
+
+    def flushBuffers(self, conn):
+        # Bulk insert any remaining buffered patient items
+        self.patientItemBuffer.flush(conn=conn);
 
     def prepare_icd9_lookup(self, conn):
         """
@@ -295,6 +314,7 @@ class STRIDEDxListConversion:
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--startDate", dest="startDate", metavar="<startDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time on or after this date.");
         parser.add_option("-e", "--endDate", dest="endDate", metavar="<endDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time before this date.");
+        addRunnerOptions(parser);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -309,7 +329,12 @@ class STRIDEDxListConversion:
             # Parse out the start date parameter
             timeTuple = time.strptime(options.endDate, DATE_FORMAT);
             endDate = datetime(*timeTuple[0:3]);
-        self.convertSourceItems(startDate,endDate);
+
+        runner = runnerFromParserOptions(self, options);
+        if runner is not None:
+            runner.run(startDate, endDate, options.restart);
+        else:
+            self.convertSourceItems(startDate,endDate);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
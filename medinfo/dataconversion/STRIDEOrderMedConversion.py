@@ -6,15 +6,16 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS, PATIENT_ITEM_COLLECTION_LINK_KEY_COLS;
 from Const import TEMPLATE_MEDICATION_ID, TEMPLATE_MEDICATION_PREFIX;
 from Const import COLLECTION_TYPE_ORDERSET;
 from Env import DATE_FORMAT;
+from ConversionRunner import addPatientShardWhere, selectDimensionsOnly, addRunnerOptions, runnerFromParserOptions;
 
 SOURCE_TABLE = "stride_order_med";
 CATEGORY_TEMPLATE = "Med (%s)";    # For this data source, item category will be a Medication subscripted by medication route
@@ -37,10 +38,15 @@ class STRIDEOrderMedConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source, but Allow specification of alternative DB connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS);   # Patient items to bulk insert
+        self.collectionLinkBuffer = InsertBuffer("patient_item_collection_link", PATIENT_ITEM_COLLECTION_LINK_KEY_COLS, findIds=False);   # Item collection links to bulk insert, after their patient items
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdCode = dict(); # Local cache to track clinical item table contents
         self.itemCollectionByKeyStr = dict();   # Local cache to track item collections
         self.itemCollectionItemByCollectionIdItemId = dict();   # Local cache to track item collection items
+        self.rxcuiDataByMedId = None;   # Medication mapping table, loaded when first needed for chunks run by a ConversionRunner
+        self.convOptions = ConversionOptions(); # Options for chunks run by a ConversionRunner
 
     def convertSourceItems(self, convOptions):
         """Primary run function to process the contents of the stride_order_med
@@ -57,26 +63,46 @@ class STRIDEOrderMedConversion:
             # Load up the medication mapping table to facilitate subsequent conversions
             rxcuiDataByMedId = self.loadRXCUIData(conn=conn);
 
-            # Keep track of which order meds have already been converted based on mixture components (don't repeat for the aggregate order then)
-            # Can be a lot to store in local memory for large conversions, so may need to batch smaller sub-processes
-            convertedOrderMedIds = set();
-
-            # First round for medication combinations that must be extracted from order_medmixinfo table
-            for sourceItem in self.queryMixSourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
+            for sourceItem in self.queryAllSourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
-                convertedOrderMedIds.add(sourceItem["order_med_id"]);
-                progress.Update();
-
-            # Next round for medications directly from order_med table not addressed in medmix
-            for sourceItem in self.querySourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
-                if sourceItem["order_med_id"] not in convertedOrderMedIds:  # Don't repeat conversion if mixture components already addressed
-                    self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
-
+            self.flushBuffers(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
 
+    def queryChunkSourceItems(self, chunk, progress=None, dimensionsOnly=False, conn=None):
+        """Query for the source items of one chunk (date range and patient shard) of a parallel conversion (see ConversionRunner),
+        with the rest of the convOptions of this instance.
+        """
+        if self.rxcuiDataByMedId is None:
+            self.rxcuiDataByMedId = self.loadRXCUIData(conn=conn);
+        chunkOptions = ConversionOptions();
+        chunkOptions.__dict__.update(self.convOptions.__dict__);
+        chunkOptions.startDate = chunk.startDate;
+        chunkOptions.endDate = chunk.endDate;
+        chunkOptions.patientShard = chunk.patientShard;
+        chunkOptions.dimensionsOnly = dimensionsOnly;
+        return self.queryAllSourceItems(self.rxcuiDataByMedId, chunkOptions, progress=progress, conn=conn);
+
+    def queryAllSourceItems(self, rxcuiDataByMedId, convOptions, progress=None, conn=None):
+        """Yield the source items from medication mixtures (see queryMixSourceItems),
+        then from any other medication orders (see querySourceItems).
+        """
+        # Keep track of which order meds have already been converted based on mixture components (don't repeat for the aggregate order then)
+        # Can be a lot to store in local memory for large conversions, so may need to batch smaller sub-processes
+        convertedOrderMedIds = set();
+
+        # First round for medication combinations that must be extracted from order_medmixinfo table
+        for sourceItem in self.queryMixSourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
+            convertedOrderMedIds.add(sourceItem["order_med_id"]);
+            yield sourceItem;
+
+        # Next round for medications directly from order_med table not addressed in medmix
+        for sourceItem in self.querySourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
+            if sourceItem["order_med_id"] not in convertedOrderMedIds:  # Don't repeat conversion if mixture components already addressed
+                yield sourceItem;
+
 
     def loadRXCUIData(self, conn=None):
         """Load up the full contents of the stride_mapped_meds table into
@@ -94,18 +120,11 @@ class STRIDEOrderMedConversion:
                 from stride_mapped_meds
                 """;
 
-            cursor = conn.cursor();
-            cursor.execute( query );
-
-            row = cursor.fetchone();
-            while row is not None:
-                (medId, rxcui, ingredient) = row;   # Unpack the data tuple
+            for (medId, rxcui, ingredient) in DBUtil.iterate(query, conn=conn):   # Unpack the data tuple
                 if medId not in rxcuiDataByMedId:
                     rxcuiDataByMedId[medId] = dict();
                 rxcuiDataByMedId[medId][rxcui] = ingredient;
 
-                row = cursor.fetchone();
-
             return rxcuiDataByMedId;
 
         finally:
@@ -135,25 +154,21 @@ class STRIDEOrderMedConversion:
             query.addWhereOp("ordering_date",">=", convOptions.startDate);
         if convOptions.endDate is not None:
             query.addWhereOp("ordering_date","<", convOptions.endDate);
+        addPatientShardWhere(query, "pat_id", convOptions.patientShard);
+        if convOptions.dimensionsOnly:
+            selectDimensionsOnly(query, ["med.medication_id", "med.description", "med_route","number_of_doses","protocol_id","protocol_name","section_name","smart_group"]);
+            # Still identify orders with mixture components, for queryAllSourceItems to skip any already converted as mixtures
+            query.select[0] = "case when exists (select order_med_id from stride_order_medmixinfo as mix where mix.order_med_id = med.order_med_id) then med.order_med_id end";
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
         # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             for normalizedModel in self.normalizeMedData(rxcuiDataByMedId, rowModel, convOptions):
                 yield normalizedModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
-            row = cursor.fetchone();
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
 
         if not extConn:
             conn.close();
@@ -183,22 +198,19 @@ class STRIDEOrderMedConversion:
             query.addWhereOp("ordering_date",">=", convOptions.startDate);
         if convOptions.endDate is not None:
             query.addWhereOp("ordering_date","<", convOptions.endDate);
+        addPatientShardWhere(query, "med.pat_id", convOptions.patientShard);
         query.addOrderBy("med.ordering_date, med.order_med_id, mix.line");
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
-        # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
         # Accumulate mixture components one item at a time
         mixByOrderMedId = dict();
 
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        # Do one massive query, but yield data for one item at a time.
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             orderMedId = rowModel["order_med_id"];
             if orderMedId not in mixByOrderMedId:  # New medication mix encountered.  Process any prior ones before moving on
                 for normalizedModel in self.normalizeMixData(rxcuiDataByMedId, mixByOrderMedId, convOptions):
@@ -207,15 +219,10 @@ class STRIDEOrderMedConversion:
                 mixByOrderMedId.clear(); # Discard previously processed mixes so don't have a ton left in memory
                 mixByOrderMedId[orderMedId] = list(); # Prep for next mix
             mixByOrderMedId[orderMedId].append(rowModel);
-            row = cursor.fetchone();
         # One more pass for remaining items
         for normalizedModel in self.normalizeMixData(rxcuiDataByMedId, mixByOrderMedId, convOptions):
             yield normalizedModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
 
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
-
         if not extConn:
             conn.close();
 
@@ -364,23 +371,37 @@ class STRIDEOrderMedConversion:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
-            #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
-            #   in a first pass, with subsequent calls just yielding back in memory cached copies
-            category = self.categoryFromSourceItem(sourceItem, conn=conn);
-            clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
-            patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
-
-            if sourceItem["protocol_id"] is not None:
-                # Similarly build up item collection (order set) hierarchy and link
-                itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn);
-                itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn);
-                patientItemCollectionLink = self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn);
+            (clinicalItem, itemCollectionItem) = self.convertSourceItemDimensions(sourceItem, conn=conn);
+
+            linkCallback = None;
+            if itemCollectionItem is not None:
+                # Link to the item collection (order set), once the (buffered) patient item is inserted
+                linkCallback = lambda patientItem: self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn);
 
+            patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn, callback=linkCallback);
+            if not extConn:
+                self.flushBuffers(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
 
+    def convertSourceItemDimensions(self, sourceItem, conn):
+        """Find or produce the dimension records for the sourceItem, without its patient_item.
+        Return a (clinicalItem, itemCollectionItem) tuple, the latter None if the sourceItem is not from an order set.
+        A ConversionRunner calls this alone in a pre-pass, so its parallel workers find these in the local caches.
+        """
+        # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
+        #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
+        #   in a first pass, with subsequent calls just yielding back in memory cached copies
+        category = self.categoryFromSourceItem(sourceItem, conn=conn);
+        clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
+
+        itemCollectionItem = None;
+        if sourceItem["protocol_id"] is not None:
+            # Similarly build up item collection (order set) hierarchy
+            itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn);
+            itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn);
+        return (clinicalItem, itemCollectionItem);
 
 
     def categoryFromSourceItem(self, sourceItem, conn):
@@ -396,7 +417,7 @@ class STRIDEOrderMedConversion:
                         "description":  categoryDescription,
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -414,7 +435,7 @@ class STRIDEOrderMedConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdCode[clinicalItemKey] = clinicalItem;
         else:
@@ -429,7 +450,7 @@ class STRIDEOrderMedConversion:
                 DBUtil.updateRow("clinical_item", priorClinicalItem, priorClinicalItem["clinical_item_id"], conn=conn);
         return self.clinicalItemByCategoryIdCode[clinicalItemKey];
 
-    def patientItemFromSourceItem(self, sourceItem, clinicalItem, conn):
+    def patientItemFromSourceItem(self, sourceItem, clinicalItem, conn, callback=None):
         # Produce a patient_item record model for the given sourceItem
         patientItem = \
             RowItemModel \
@@ -440,21 +461,9 @@ class STRIDEOrderMedConversion:
                     "item_date":  sourceItem["ordering_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, pull out existint ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items.
+        #   The patient_item_id is filled in once inserted, and any callback then called with the patientItem.
+        self.patientItemBuffer.add(patientItem, callback, conn=conn);
         return patientItem;
 
 
@@ -466,7 +475,6 @@ class STRIDEOrderMedConversion:
             return None;
 
         collectionKey = "%(protocol_id)s-%(protocol_name)s-%(section_name)s-%(smart_group)s" % sourceItem;
-        self.itemCollectionByKeyStr = dict();   # Local cache to track item collections
         if collectionKey not in self.itemCollectionByKeyStr:
             # Collection does not yet exist in the local cache.  Check if in database table (if not, persist a new record)
             collection = \
@@ -477,7 +485,7 @@ class STRIDEOrderMedConversion:
                         "subgroup":  sourceItem["smart_group"],
                     }
                 );
-            (collectionId, isNew) = DBUtil.findOrInsertItem("item_collection", collection, conn=conn);
+            (collectionId, isNew) = self.dimensionCache.findOrInsertItem("item_collection", collection, conn=conn);
             collection["item_collection_id"] = collectionId;
             self.itemCollectionByKeyStr[collectionKey] = collection;
         return self.itemCollectionByKeyStr[collectionKey];
@@ -494,7 +502,7 @@ class STRIDEOrderMedConversion:
                         "collection_type_id": COLLECTION_TYPE_ORDERSET,
                     }
                 );
-            (collectionItemId, isNew) = DBUtil.findOrInsertItem("item_collection_item", collectionItem, conn=conn);
+            (collectionItemId, isNew) = self.dimensionCache.findOrInsertItem("item_collection_item", collectionItem, conn=conn);
             collectionItem["item_collection_item_id"] = collectionItemId;
             self.itemCollectionItemByCollectionIdItemId[itemKey] = collectionItem;
         return self.itemCollectionItemByCollectionIdItemId[itemKey];
@@ -507,15 +515,13 @@ class STRIDEOrderMedConversion:
                     "item_collection_item_id":  collectionItem["item_collection_item_id"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item_collection_link", patientItemCollectionLink.keys() );
-        insertParams= patientItemCollectionLink.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        self.collectionLinkBuffer.add(patientItemCollectionLink, conn=conn);
+
 
+    def flushBuffers(self, conn):
+        # Bulk insert any remaining buffered patient items, then the item collection links that depend on them
+        self.patientItemBuffer.flush(conn=conn);
+        self.collectionLinkBuffer.flush(conn=conn);
 
     def main(self, argv):
         """Main method, callable from command line"""
@@ -526,6 +532,7 @@ class STRIDEOrderMedConversion:
         parser.add_option("-n", "--normalizeMixtures", dest="normalizeMixtures", action="store_true",  help="If set, when find medication mixtures, will unravel / normalize into separate entries, one for each ingredient");
         parser.add_option("-m", "--maxMixtureCount", dest="maxMixtureCount", help="If not normalizing mixtures, then this is the maximum number of mixture components will itemize for a mixture.  If more than this, just use the summary label.");
         parser.add_option("-d", "--doseCountLimit", dest="doseCountLimit", help="Medication orders with a finite number of doses specified less than this limit will be labeled as different items than those without a number specified, or whose number is >= to this limit. Intended to distinguish things like IV single bolus / use vs. continuous infusions and standing medication orders");
+        addRunnerOptions(parser);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -534,7 +541,12 @@ class STRIDEOrderMedConversion:
         convOptions = ConversionOptions();
         convOptions.extractParserOptions(options);
 
-        self.convertSourceItems(convOptions);
+        runner = runnerFromParserOptions(self, options);
+        if runner is not None:
+            self.convOptions = convOptions;
+            runner.run(convOptions.startDate, convOptions.endDate, options.restart);
+        else:
+            self.convertSourceItems(convOptions);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
@@ -548,6 +560,8 @@ class ConversionOptions:
         self.maxMixtureCount = None;
         self.doseCountLimit = None;
         self.includeRouteInDescription = True;
+        self.patientShard = None;   # (iShard, nShards) tuple to only convert one hash partition of patients
+        self.dimensionsOnly = False;    # Only query the distinct combinations of the values needed for convertSourceItemDimensions
 
     def extractParserOptions(self, options):
         if options.startDate is not None:
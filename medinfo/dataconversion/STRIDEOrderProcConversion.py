@@ -5,14 +5,15 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS, PATIENT_ITEM_COLLECTION_LINK_KEY_COLS;
 from Env import DATE_FORMAT;
 from Const import COLLECTION_TYPE_ORDERSET;
+from ConversionRunner import addPatientShardWhere, selectDimensionsOnly, addRunnerOptions, runnerFromParserOptions;
 
 SOURCE_TABLE = "stride_order_proc";
 
@@ -33,10 +34,9 @@ class STRIDEOrderProcConversion:
     #   Some debate about whether to distinguish by proc_id or proc_code, but there are many labs and other procs 
     #   that use different proc_ids even though they are obviously the same. Go link in STRIDE_ORDER_PROC for examples like LABA1C.
     # The self.clinicalItemByCategoryIdExtId is supposed to keep track of which clinical_items we're already aware of, 
-    #   but not that it starts blank when this module runs. 
-    #   So you in theory should only run this conversion process on a database once 
-    #   (otherwise it will not be aware that a bunch of duplicate clinical_items already exist in the database). 
-    #   Alternatively, this module should be updated, so that it initializes this key tracker with whatever is already in the database.
+    #   but note that it starts blank when this module runs.
+    #   The self.dimensionCache is preloaded with whatever clinical_items already exist in the database though,
+    #   so repeat conversions will find those rather than inserting duplicates.
 
 
     """
@@ -44,6 +44,9 @@ class STRIDEOrderProcConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source, but Allow specification of alternative DB connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS);   # Patient items to bulk insert
+        self.collectionLinkBuffer = InsertBuffer("patient_item_collection_link", PATIENT_ITEM_COLLECTION_LINK_KEY_COLS, findIds=False);   # Item collection links to bulk insert, after their patient items
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdExtId = dict(); # Local cache to track clinical item table contents
         self.itemCollectionByKeyStr = dict();   # Local cache to track item collections
@@ -64,16 +67,23 @@ class STRIDEOrderProcConversion:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.flushBuffers(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
 
 
-    def querySourceItems(self, startDate=None, endDate=None, progress=None, conn=None):
+    def queryChunkSourceItems(self, chunk, progress=None, dimensionsOnly=False, conn=None):
+        """Query for the source items of one chunk (date range and patient shard) of a parallel conversion (see ConversionRunner)"""
+        return self.querySourceItems(chunk.startDate, chunk.endDate, progress=progress, patientShard=chunk.patientShard, dimensionsOnly=dimensionsOnly, conn=conn);
+
+    def querySourceItems(self, startDate=None, endDate=None, progress=None, patientShard=None, dimensionsOnly=False, conn=None):
         """Query the database for list of all source clinical items (orders, etc.)
         and yield the results one at a time.  If startDate provided, only return items whose order_time is on or after that date.
         Ignore entries with instantiated_time not null, as those represent child orders spawned from an original order,
         whereas we are more interested in the decision making to enter the original order.
+        If patientShard provided as an (iShard, nShards) tuple, only return items for that hash partition of patients.
+        If dimensionsOnly, only return the distinct combinations of the values needed for convertSourceItemDimensions.
         """
         extConn = conn is not None;
         if not extConn:
@@ -94,24 +104,18 @@ class STRIDEOrderProcConversion:
             query.addWhereOp("order_time",">=", startDate);
         if endDate is not None:
             query.addWhereOp("order_time","<", endDate);
+        addPatientShardWhere(query, "pat_id", patientShard);
+        if dimensionsOnly:
+            selectDimensionsOnly(query, ["op.order_type", "op.proc_id", "op.proc_code", "description","protocol_id","protocol_name","section_name","smart_group"]);
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
         # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             yield rowModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
-            row = cursor.fetchone();
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
 
         if not extConn:
             conn.close();
@@ -125,22 +129,37 @@ class STRIDEOrderProcConversion:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
-            #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
-            #   in a first past, with subsequent calls just yielding back in memory cached copies
-            category = self.categoryFromSourceItem(sourceItem, conn=conn);
-            clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
-            patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
-
-            if sourceItem["protocol_id"] is not None:
-                # Similarly build up item collection (order set) hierarchy and link
-                itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn);
-                itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn);
-                patientItemCollectionLink = self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn);
+            (clinicalItem, itemCollectionItem) = self.convertSourceItemDimensions(sourceItem, conn=conn);
+
+            linkCallback = None;
+            if itemCollectionItem is not None:
+                # Link to the item collection (order set), once the (buffered) patient item is inserted
+                linkCallback = lambda patientItem: self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn);
+
+            patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn, callback=linkCallback);
+            if not extConn:
+                self.flushBuffers(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
 
+    def convertSourceItemDimensions(self, sourceItem, conn):
+        """Find or produce the dimension records for the sourceItem, without its patient_item.
+        Return a (clinicalItem, itemCollectionItem) tuple, the latter None if the sourceItem is not from an order set.
+        A ConversionRunner calls this alone in a pre-pass, so its parallel workers find these in the local caches.
+        """
+        # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
+        #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
+        #   in a first past, with subsequent calls just yielding back in memory cached copies
+        category = self.categoryFromSourceItem(sourceItem, conn=conn);
+        clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
+
+        itemCollectionItem = None;
+        if sourceItem["protocol_id"] is not None:
+            # Similarly build up item collection (order set) hierarchy
+            itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn);
+            itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn);
+        return (clinicalItem, itemCollectionItem);
 
     def categoryFromSourceItem(self, sourceItem, conn):
         # Load or produce a clinical_item_category record model for the given sourceItem
@@ -153,7 +172,7 @@ class STRIDEOrderProcConversion:
                         "description":  sourceItem["order_type"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -165,10 +184,9 @@ class STRIDEOrderProcConversion:
         #   Some debate about whether to distinguish by proc_id or proc_code, but there are many labs and other procs 
         #   that use different proc_ids even though they are obviously the same. Go link in STRIDE_ORDER_PROC for examples like LABA1C.
         # The self.clinicalItemByCategoryIdExtId is supposed to keep track of which clinical_items we're already aware of, 
-        #   but not that it starts blank when this module runs. 
-        #   So you in theory should only run this conversion process on a database once 
-        #   (otherwise it will not be aware that a bunch of duplicate clinical_items already exist in the database). 
-        #   Alternatively, this module should be updated, so that it initializes this key tracker with whatever is already in the database.
+        #   but note that it starts blank when this module runs.
+        #   The self.dimensionCache is preloaded with whatever clinical_items already exist in the database though,
+        #   so repeat conversions will find those rather than inserting duplicates.
         if clinicalItemKey not in self.clinicalItemByCategoryIdExtId:
             # Clinical Item does not yet exist in the local cache.  Check if in database table (if not, persist a new record)
             clinicalItem = \
@@ -179,12 +197,12 @@ class STRIDEOrderProcConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
 
-    def patientItemFromSourceItem(self, sourceItem, clinicalItem, conn):
+    def patientItemFromSourceItem(self, sourceItem, clinicalItem, conn, callback=None):
         # Produce a patient_item record model for the given sourceItem
         patientItem = \
             RowItemModel \
@@ -195,21 +213,9 @@ class STRIDEOrderProcConversion:
                     "item_date":  sourceItem["order_time"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, pull out existint ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items.
+        #   The patient_item_id is filled in once inserted, and any callback then called with the patientItem.
+        self.patientItemBuffer.add(patientItem, callback, conn=conn);
         return patientItem;
 
 
@@ -221,7 +227,6 @@ class STRIDEOrderProcConversion:
             return None;
 
         collectionKey = "%(protocol_id)s-%(protocol_name)s-%(section_name)s-%(smart_group)s" % sourceItem;
-        self.itemCollectionByKeyStr = dict();   # Local cache to track item collections
         if collectionKey not in self.itemCollectionByKeyStr:
             # Collection does not yet exist in the local cache.  Check if in database table (if not, persist a new record)
             collection = \
@@ -232,7 +237,7 @@ class STRIDEOrderProcConversion:
                         "subgroup":  sourceItem["smart_group"],
                     }
                 );
-            (collectionId, isNew) = DBUtil.findOrInsertItem("item_collection", collection, conn=conn);
+            (collectionId, isNew) = self.dimensionCache.findOrInsertItem("item_collection", collection, conn=conn);
             collection["item_collection_id"] = collectionId;
             self.itemCollectionByKeyStr[collectionKey] = collection;
         return self.itemCollectionByKeyStr[collectionKey];
@@ -249,7 +254,7 @@ class STRIDEOrderProcConversion:
                         "collection_type_id": COLLECTION_TYPE_ORDERSET,
                     }
                 );
-            (collectionItemId, isNew) = DBUtil.findOrInsertItem("item_collection_item", collectionItem, conn=conn);
+            (collectionItemId, isNew) = self.dimensionCache.findOrInsertItem("item_collection_item", collectionItem, conn=conn);
             collectionItem["item_collection_item_id"] = collectionItemId;
             self.itemCollectionItemByCollectionIdItemId[itemKey] = collectionItem;
         return self.itemCollectionItemByCollectionIdItemId[itemKey];
@@ -262,23 +267,23 @@ class STRIDEOrderProcConversion:
                     "item_collection_item_id":  collectionItem["item_collection_item_id"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item_collection_link", patientItemCollectionLink.keys() );
-        insertParams= patientItemCollectionLink.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        self.collectionLinkBuffer.add(patientItemCollectionLink, conn=conn);
+
 
+    def flushBuffers(self, conn):
+        # Bulk insert any remaining buffered patient items, then the item collection links that depend on them
+        self.patientItemBuffer.flush(conn=conn);
+        self.collectionLinkBuffer.flush(conn=conn);
 
     def main(self, argv):
         """Main method, callable from command line"""
         usageStr =  "usage: %prog [options]\n"+\
-            "Beware that this module is intended to be run only ONCE ever on a database. Currently will end up with duplicate clinical item keys if you try to run it in parallel or even serially."
+            "Beware that this module is not intended to be run in parallel on the same database, as concurrent runs may end up with duplicate clinical item keys.\n"+\
+            "Use the numWorkers option instead to convert in parallel chunks, after resolving clinical items in a single pre-pass."
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--startDate", dest="startDate", metavar="<startDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time on or after this date.");
         parser.add_option("-e", "--endDate", dest="endDate", metavar="<endDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time before this date.");
+        addRunnerOptions(parser);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -293,7 +298,12 @@ class STRIDEOrderProcConversion:
             # Parse out the end date parameter
             timeTuple = time.strptime(options.endDate, DATE_FORMAT);
             endDate = datetime(*timeTuple[0:3]);
-        self.convertSourceItems(startDate,endDate);
+
+        runner = runnerFromParserOptions(self, options);
+        if runner is not None:
+            runner.run(startDate, endDate, options.restart);
+        else:
+            self.convertSourceItems(startDate,endDate);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
@@ -6,13 +6,14 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS;
 from Env import DATE_FORMAT;
+from ConversionRunner import addPatientShardWhere, selectDimensionsOnly, addRunnerOptions, runnerFromParserOptions;
 
 from Const import SENTINEL_RESULT_VALUE, Z_SCORE_LIMIT;
 from Const import FLAG_IN_RANGE, FLAG_HIGH, FLAG_LOW, FLAG_RESULT, FLAG_ABNORMAL;
@@ -38,6 +39,8 @@ class STRIDEOrderResultsConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS, findIds=False);   # Patient items to bulk insert (IDs not needed)
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
         self.resultStatsByBaseName = None;
@@ -57,15 +60,22 @@ class STRIDEOrderResultsConversion:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.flushBuffers(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
 
 
-    def querySourceItems(self, startDate=None, endDate=None, progress=None, conn=None):
+    def queryChunkSourceItems(self, chunk, progress=None, dimensionsOnly=False, conn=None):
+        """Query for the source items of one chunk (date range and patient shard) of a parallel conversion (see ConversionRunner)"""
+        return self.querySourceItems(chunk.startDate, chunk.endDate, progress=progress, patientShard=chunk.patientShard, dimensionsOnly=dimensionsOnly, conn=conn);
+
+    def querySourceItems(self, startDate=None, endDate=None, progress=None, patientShard=None, dimensionsOnly=False, conn=None):
         """Query the database for list of all source clinical items (lab results in this case)
         and yield the results one at a time.  If startDate provided, only return items
         whose result_time is on or after that date.
+        If patientShard provided as an (iShard, nShards) tuple, only return items for that hash partition of patients.
+        If dimensionsOnly, only return the distinct combinations of the values needed for convertSourceItemDimensions.
         Only include results records where the result_flag is set to an informative value,
         to focus only on abnormal lab results (including would be a ton more relatively uninformative
         data that would greatly expend data space and subsequent computation time)
@@ -88,6 +98,9 @@ class STRIDEOrderResultsConversion:
             query.addWhereOp("sor.result_time",">=", startDate);
         if endDate is not None:
             query.addWhereOp("sor.result_time","<", endDate);
+        addPatientShardWhere(query, "pat_id", patientShard);
+        if dimensionsOnly:
+            selectDimensionsOnly(query, ["order_type", "base_name", "common_name", "ord_num_value", "result_flag", "result_in_range_yn"]);
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
@@ -108,7 +121,8 @@ class STRIDEOrderResultsConversion:
                 row = cursor.fetchone()
                 continue
 
-            self.populateResultFlag(rowModel,conn=conn);
+            if not dimensionsOnly:  # Otherwise left for convertSourceItemDimensions, which may need to record new result stats
+                self.populateResultFlag(rowModel,conn=conn);
 
             yield rowModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
             row = cursor.fetchone();
@@ -223,17 +237,27 @@ class STRIDEOrderResultsConversion:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
-            #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
-            #   in a first past, with subsequent calls just yielding back in memory cached copies
-            categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
-            clinicalItemModel = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
+            clinicalItemModel = self.convertSourceItemDimensions(sourceItem, conn=conn);
             patientItemModel = self.patientItemModelFromSourceItem(sourceItem, clinicalItemModel, conn=conn);
-
+            if not extConn:
+                self.flushBuffers(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
 
+    def convertSourceItemDimensions(self, sourceItem, conn):
+        """Find or produce the dimension records for the sourceItem, without its patient_item.
+        Return the clinicalItem.
+        A ConversionRunner calls this alone in a pre-pass, so its parallel workers find these in the local caches.
+        """
+        self.populateResultFlag(sourceItem, conn=conn);  # If not already done when queried
+
+        # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
+        #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
+        #   in a first past, with subsequent calls just yielding back in memory cached copies
+        categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
+        return self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
+
 
     def categoryFromSourceItem(self, sourceItem, conn):
         # Load or produce a clinical_item_category record model for the given sourceItem
@@ -246,7 +270,7 @@ class STRIDEOrderResultsConversion:
                         "description":  "%s Result" % sourceItem["order_type"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -266,7 +290,7 @@ class STRIDEOrderResultsConversion:
                         "description": "%(common_name)s (%(result_flag)s)" % sourceItem,
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
@@ -283,14 +307,12 @@ class STRIDEOrderResultsConversion:
                     "num_value": sourceItem["ord_num_value"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items
+        self.patientItemBuffer.add(patientItem, conn=conn);
+
+    def flushBuffers(self, conn):
+        # Bulk insert any remaining buffered patient items
+        self.patientItemBuffer.flush(conn=conn);
 
 
     def main(self, argv):
@@ -299,6 +321,7 @@ class STRIDEOrderResultsConversion:
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--startDate", dest="startDate", metavar="<startDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time on or after this date.");
         parser.add_option("-e", "--endDate", dest="endDate", metavar="<endDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with ordering time before this date.");
+        addRunnerOptions(parser);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -313,7 +336,12 @@ class STRIDEOrderResultsConversion:
             # Parse out the start date parameter
             timeTuple = time.strptime(options.endDate, DATE_FORMAT);
             endDate = datetime(*timeTuple[0:3]);
-        self.convertSourceItems(startDate,endDate);
+
+        runner = runnerFromParserOptions(self, options);
+        if runner is not None:
+            runner.run(startDate, endDate, options.restart);
+        else:
+            self.convertSourceItems(startDate,endDate);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
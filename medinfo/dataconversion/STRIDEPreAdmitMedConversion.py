@@ -5,12 +5,12 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS;
 from Const import TEMPLATE_MEDICATION_ID, TEMPLATE_MEDICATION_PREFIX;
 from Const import COLLECTION_TYPE_ORDERSET;
 from Env import DATE_FORMAT;
@@ -29,6 +29,8 @@ class STRIDEPreAdmitMedConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source, but Allow specification of alternative DB connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS, findIds=False);   # Patient items to bulk insert (IDs not needed)
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdCode = dict(); # Local cache to track clinical item table contents
 
@@ -51,7 +53,7 @@ class STRIDEPreAdmitMedConversion:
             for sourceItem in self.querySourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
-
+            self.patientItemBuffer.flush(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
@@ -101,18 +103,11 @@ class STRIDEPreAdmitMedConversion:
                 from stride_mapped_meds
                 """;
 
-            cursor = conn.cursor();
-            cursor.execute( query );
-
-            row = cursor.fetchone();
-            while row is not None:
-                (medId, rxcui, ingredient, theraClass) = row;   # Unpack the data tuple
+            for (medId, rxcui, ingredient, theraClass) in DBUtil.iterate(query, conn=conn):   # Unpack the data tuple
                 if medId not in rxcuiDataByMedId:
                     rxcuiDataByMedId[medId] = dict();
                 rxcuiDataByMedId[medId][rxcui] = (ingredient, theraClass);
 
-                row = cursor.fetchone();
-
             return rxcuiDataByMedId;
 
         finally:
@@ -144,20 +139,11 @@ class STRIDEPreAdmitMedConversion:
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
         # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             for normalizedModel in self.normalizeMedIngredients(rxcuiDataByMedId, rowModel, convOptions, conn=conn):
                 yield normalizedModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
-            row = cursor.fetchone();
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
 
         if not extConn:
             conn.close();
@@ -257,7 +243,8 @@ class STRIDEPreAdmitMedConversion:
             category = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
             patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
-
+            if not extConn:
+                self.patientItemBuffer.flush(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
@@ -277,7 +264,7 @@ class STRIDEPreAdmitMedConversion:
                         "description":  categoryDescription,
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -295,7 +282,7 @@ class STRIDEPreAdmitMedConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdCode[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdCode[clinicalItemKey];
@@ -311,21 +298,8 @@ class STRIDEPreAdmitMedConversion:
                     "item_date":  sourceItem["contact_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, pull out existing ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items
+        self.patientItemBuffer.add(patientItem, conn=conn);
         return patientItem;
 
     def main(self, argv):
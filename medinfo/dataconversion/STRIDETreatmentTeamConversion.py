@@ -5,15 +5,16 @@ from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
-from medinfo.db.DBUtil import DB_CONNECTOR_MODULE;
-IntegrityError = DB_CONNECTOR_MODULE.IntegrityError;
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
 
 from Util import log;
+from Const import PATIENT_ITEM_KEY_COLS;
 from Const import TEMPLATE_MEDICATION_ID, TEMPLATE_MEDICATION_PREFIX;
 from Const import COLLECTION_TYPE_ORDERSET;
 from Env import DATE_FORMAT;
+from ConversionRunner import addPatientShardWhere, selectDimensionsOnly, addRunnerOptions, runnerFromParserOptions;
 
 SOURCE_TABLE = "stride_treatment_team";
 CATEGORY_TEMPLATE = "Treatment Team";
@@ -37,8 +38,11 @@ class STRIDETreatmentTeamConversion:
         """Default constructor"""
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source, but Allow specification of alternative DB connection source
 
+        self.dimensionCache = DimensionCache();    # Preloaded dimension table contents, to find or insert items without a query each
+        self.patientItemBuffer = InsertBuffer("patient_item", PATIENT_ITEM_KEY_COLS, findIds=False);   # Patient items to bulk insert (IDs not needed)
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCompositeKey = dict(); # Local cache to track clinical item table contents
+        self.convOptions = ConversionOptions(); # Options for chunks run by a ConversionRunner
 
     def convertSourceItems(self, convOptions):
         """Primary run function to process the contents of the raw source
@@ -56,11 +60,22 @@ class STRIDETreatmentTeamConversion:
             for sourceItem in self.querySourceItems(convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
-
+            self.flushBuffers(conn=conn);
         finally:
             conn.close();
         progress.PrintStatus();
 
+    def queryChunkSourceItems(self, chunk, progress=None, dimensionsOnly=False, conn=None):
+        """Query for the source items of one chunk (date range and patient shard) of a parallel conversion (see ConversionRunner),
+        with the rest of the convOptions of this instance.
+        """
+        chunkOptions = ConversionOptions();
+        chunkOptions.__dict__.update(self.convOptions.__dict__);
+        chunkOptions.startDate = chunk.startDate;
+        chunkOptions.endDate = chunk.endDate;
+        chunkOptions.patientShard = chunk.patientShard;
+        chunkOptions.dimensionsOnly = dimensionsOnly;
+        return self.querySourceItems(chunkOptions, progress=progress, conn=conn);
 
     def querySourceItems(self, convOptions, progress=None, conn=None):
         """Query the database for list of all source clinical items (medications, etc.)
@@ -82,25 +97,19 @@ class STRIDETreatmentTeamConversion:
             query.addWhereOp("trtmnt_tm_begin_date",">=", convOptions.startDate);
         if convOptions.endDate is not None:
             query.addWhereOp("trtmnt_tm_begin_date","<", convOptions.endDate);  # Still use begin date as common filter value
+        addPatientShardWhere(query, "pat_id", convOptions.patientShard);
+        if convOptions.dimensionsOnly:
+            selectDimensionsOnly(query, ["treatment_team","prov_name"]);
 
         # Query to get an estimate of how long the process will be
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
         # Do one massive query, but yield data for one item at a time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        row = cursor.fetchone();
-        while row is not None:
-            rowModel = RowItemModel( row, headers );
+        #   Results are streamed from the database in batches, to avoid having to keep the whole result set in memory.
+        for rowModel in DBUtil.iterate(query, rowFormat="model", columnNames=headers, conn=conn):
             for normalizedModel in self.normalizeRowModel(rowModel, convOptions, conn=conn):
                 yield normalizedModel; # Yield one row worth of data at a time to avoid having to keep the whole result set in memory
-            row = cursor.fetchone();
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
 
         if not extConn:
             conn.close();
@@ -210,17 +219,24 @@ class STRIDETreatmentTeamConversion:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
-            #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
-            #   in a first pass, with subsequent calls just yielding back in memory cached copies
-            category = self.categoryFromSourceItem(sourceItem, conn=conn);
-            clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
+            clinicalItem = self.convertSourceItemDimensions(sourceItem, conn=conn);
             patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
-
+            if not extConn:
+                self.flushBuffers(conn=conn);   # Not converting any more items with this connection
         finally:
             if not extConn:
                 conn.close();
 
+    def convertSourceItemDimensions(self, sourceItem, conn):
+        """Find or produce the dimension records for the sourceItem, without its patient_item.
+        Return the clinicalItem.
+        A ConversionRunner calls this alone in a pre-pass, so its parallel workers find these in the local caches.
+        """
+        # Normalize sourceItem data into hierachical components (category -> clinical_item -> patient_item).
+        #   Relatively small / finite number of categories and clinical_items, so these should only have to be instantiated
+        #   in a first pass, with subsequent calls just yielding back in memory cached copies
+        category = self.categoryFromSourceItem(sourceItem, conn=conn);
+        return self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
 
 
     def categoryFromSourceItem(self, sourceItem, conn):
@@ -236,7 +252,7 @@ class STRIDETreatmentTeamConversion:
                         "description":  categoryDescription,
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item_category", category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -254,7 +270,7 @@ class STRIDETreatmentTeamConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.dimensionCache.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCompositeKey[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCompositeKey[clinicalItemKey];
@@ -270,23 +286,14 @@ class STRIDETreatmentTeamConversion:
                     "item_date":  sourceItem["trtmnt_tm_begin_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", patientItem.keys() );
-        insertParams= patientItem.values();
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except IntegrityError, err:
-            # If turns out to be a duplicate, okay, pull out existing ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        # Buffered to bulk insert, skipping any duplicates of existing patient items
+        self.patientItemBuffer.add(patientItem, conn=conn);
         return patientItem;
 
+    def flushBuffers(self, conn):
+        # Bulk insert any remaining buffered patient items
+        self.patientItemBuffer.flush(conn=conn);
+
     def main(self, argv):
         """Main method, callable from command line"""
         usageStr =  "usage: %prog [options]\n"
@@ -294,6 +301,7 @@ class STRIDETreatmentTeamConversion:
         parser.add_option("-s", "--startDate", dest="startDate", metavar="<startDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with start time on or after this date.");
         parser.add_option("-e", "--endDate", dest="endDate", metavar="<endDate>",  help="Date string (e.g., 2011-12-15), if provided, will only run conversion on items with start time before this date.");
         parser.add_option("-a", "--aggregate", dest="aggregate", action="store_true",  help="If set, will try to aggregate data so Med Univ A1, A2, A3 will all be counted as Med Univ and Primary Team, Intern, Resident will all just be counted as Primary.");
+        addRunnerOptions(parser);
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -302,7 +310,12 @@ class STRIDETreatmentTeamConversion:
         convOptions = ConversionOptions();
         convOptions.extractParserOptions(options);
 
-        self.convertSourceItems(convOptions);
+        runner = runnerFromParserOptions(self, options);
+        if runner is not None:
+            self.convOptions = convOptions;
+            runner.run(convOptions.startDate, convOptions.endDate, options.restart);
+        else:
+            self.convertSourceItems(convOptions);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
@@ -313,6 +326,8 @@ class ConversionOptions:
         self.startDate = None;
         self.endDate = None;
         self.aggregate = False;
+        self.patientShard = None;   # (iShard, nShards) tuple to only convert one hash partition of patients
+        self.dimensionsOnly = False;    # Only query the distinct combinations of the values needed for convertSourceItemDimensions
 
     def extractParserOptions(self, options):
         if options.startDate is not None:
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+from cStringIO import StringIO
+from datetime import datetime;
+import unittest
+
+from Const import RUNNER_VERBOSITY;
+from Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+from stride.core.StrideLoader import StrideLoader;
+from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import SQLQuery, RowItemModel;
+
+from medinfo.dataconversion.ConversionRunner import ConversionRunner;
+from medinfo.dataconversion.STRIDEOrderProcConversion import STRIDEOrderProcConversion;
+
+TEST_START_DATE = datetime(2111,12,1);   # Dates in far future to avoid including existing data in database
+TEST_END_DATE = datetime(2112,2,1);
+
+class TestConversionRunner(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        StrideLoader.build_stride_psql_schemata()
+        ClinicalItemDataLoader.build_clinical_item_psql_schemata();
+
+        self.orderProcIdStrList = list();
+        headers = ["order_proc_id", "pat_id", "pat_enc_csn_id", "order_type", "proc_id", "proc_code", "description", "order_time", "instantiated_time","stand_interval"];
+        dataModels = \
+            [   # Deliberately design dates in far future to facilitate isolated testing
+                RowItemModel( [ -417974686, "380873", 111, "Nursing", 1453, "NUR1043", "NURSING PULSE OXIMETRY", "2111-12-10", None, "CONTINUOUS"], headers ),
+                RowItemModel( [ -419697343, "3042640", 222, "Point of Care Testing", 1001, "LABPOCGLU", "GLUCOSE BY METER", "2112-01-13", None, "Q6H"], headers ),
+                RowItemModel( [ -418928388, "-1612899", 333, "Point of Care Testing", 1001, "LABPOCGLU", "GLUCOSE BY METER", "2111-12-28", None, "ONCE"], headers ),
+                RowItemModel( [ -418928378, "-1612899", 333, "Point of Care Testing", 1001, "LABPOCGLU", "GLUCOSE BY METER", "2111-12-18", None, "PRN"], headers ),    # PRN orders should be ignored
+                RowItemModel( [ -418045499, "2087083", 444, "Nursing", 1428, "NUR1018", "MONITOR INTAKE AND OUTPUT", "2111-12-11", None, None], headers ),
+                RowItemModel( [ -417843774, "2648748", 555, "Nursing", 1508, "NUR1068", "WEIGHT", "2111-12-08", None, "ONCE"], headers ),
+                RowItemModel( [ -419268931, "3039254", 666, "Lab", 1721, "LABPTT", "PTT PARTIAL THROMBOPLASTIN TIME", "2112-01-04", None, "DAILY"], headers ),
+                RowItemModel( [ -419268937, "3039254", 666, "Lab", 9991721, "LABPTT", "PTT (PARTIAL THROMBOPLASTIN TIME)", "2112-01-05", None, "DAILY"], headers ), # Different proc_id, but same proc_Code. Treat like the same
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("stride_order_proc", dataModel, retrieveCol="order_proc_id" );
+            self.orderProcIdStrList.append( str(dataItemId) );
+
+        # Certain items drawn from order sets
+        headers = ["order_proc_id", "protocol_id","protocol_name","section_name","smart_group"];
+        dataModels = \
+            [
+                RowItemModel( [ -418928388, -222, "ER General", "Testing", "PoC",], headers ),
+                RowItemModel( [ -418045499, -111, "General Admit", "Nursing", "Monitoring",], headers ),
+                RowItemModel( [ -419268931, -111, "General Admit", "Lab", "Coag",], headers ),
+            ];
+        for dataModel in dataModels:
+            (dataItemId, isNew) = DBUtil.findOrInsertItem("stride_orderset_order_proc", dataModel, retrieveCol="order_proc_id" );
+
+        self.converter = STRIDEOrderProcConversion();
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+
+        DBUtil.execute("delete from conversion_checkpoint where conversion_name = 'STRIDEOrderProcConversion';");
+        DBUtil.execute \
+        (   """delete from patient_item_collection_link
+            where item_collection_item_id in
+            (   select item_collection_item_id
+                from item_collection_item as ici, item_collection as ic
+                where ici.item_collection_id = ic.item_collection_id
+                and ic.external_id < 0
+            );
+            """
+        );
+        DBUtil.execute \
+        (   """delete from item_collection_item
+            where item_collection_id in
+            (   select item_collection_id
+                from item_collection as ic
+                where ic.external_id < 0
+            );
+            """
+        );
+        DBUtil.execute("delete from item_collection where external_id < 0;");
+
+        DBUtil.execute \
+        (   """delete from patient_item
+            where clinical_item_id in
+            (   select clinical_item_id
+                from clinical_item as ci, clinical_item_category as cic
+                where ci.clinical_item_category_id = cic.clinical_item_category_id
+                and cic.source_table = 'stride_order_proc'
+            );
+            """
+        );
+        DBUtil.execute \
+        (   """delete from clinical_item
+            where clinical_item_category_id in
+            (   select clinical_item_category_id
+                from clinical_item_category
+                where source_table = 'stride_order_proc'
+            );
+            """
+        );
+        DBUtil.execute("delete from clinical_item_category where source_table = 'stride_order_proc';");
+
+        DBUtil.execute("delete from stride_orderset_order_proc where order_proc_id in (%s)" % str.join(",", self.orderProcIdStrList) );
+        DBUtil.execute("delete from stride_order_proc where order_proc_id in (%s)" % str.join(",", self.orderProcIdStrList) );
+
+        DBTestCase.tearDown(self);
+
+    def test_makeChunks(self):
+        runner = ConversionRunner(self.converter, chunkDays=10, nPatientShards=2);
+        chunkKeys = [chunk.key() for chunk in runner.makeChunks(datetime(2111,12,1), datetime(2111,12,25))];
+        expectedKeys = \
+            [   "2111-12-01T00:00:00/2111-12-11T00:00:00#0/2",
+                "2111-12-01T00:00:00/2111-12-11T00:00:00#1/2",
+                "2111-12-11T00:00:00/2111-12-21T00:00:00#0/2",
+                "2111-12-11T00:00:00/2111-12-21T00:00:00#1/2",
+                "2111-12-21T00:00:00/2111-12-25T00:00:00#0/2",  # Last chunk cut short at the end date
+                "2111-12-21T00:00:00/2111-12-25T00:00:00#1/2",
+            ];
+        self.assertEqual( expectedKeys, chunkKeys );
+
+        # Without an end date, the last chunk is left open-ended for any later items
+        runner = ConversionRunner(self.converter, chunkDays=36500);
+        chunkKeys = [chunk.key() for chunk in runner.makeChunks(datetime(2000,1,1))];
+        self.assertEqual( ["2000-01-01T00:00:00/"], chunkKeys );
+
+    def test_runChunks(self):
+        # Convert in chunks by date range and patient, in parallel worker processes
+        runner = ConversionRunner(self.converter, numWorkers=2, chunkDays=10, nPatientShards=2);
+        self.assertEqual( 14, runner.run(TEST_START_DATE, TEST_END_DATE) );
+
+        # Same results as converting all at once
+        testQuery = \
+            """
+            select
+                pi.external_id,
+                pi.patient_id,
+                pi.encounter_id,
+                cic.description,
+                ci.external_id,
+                ci.name,
+                ci.description,
+                pi.item_date
+            from
+                patient_item as pi,
+                clinical_item as ci,
+                clinical_item_category as cic
+            where
+                pi.clinical_item_id = ci.clinical_item_id and
+                ci.clinical_item_category_id = cic.clinical_item_category_id and
+                cic.source_table = 'stride_order_proc'
+            order by
+                pi.external_id
+            """;
+        expectedData = \
+            [
+                [ -419697343, 3042640, 222, "Point of Care Testing", 1001, "LABPOCGLU", "GLUCOSE BY METER", datetime(2112,01,13) ],
+                [ -419268937, 3039254, 666, "Lab", 1721, "LABPTT", "PTT PARTIAL THROMBOPLASTIN TIME", datetime(2112,01,05) ],
+                [ -419268931, 3039254, 666, "Lab", 1721, "LABPTT", "PTT PARTIAL THROMBOPLASTIN TIME", datetime(2112,01,04) ],
+                [ -418928388, -1612899, 333, "Point of Care Testing", 1001, "LABPOCGLU", "GLUCOSE BY METER", datetime(2111,12,28) ],
+                [ -418045499, 2087083, 444, "Nursing", 1428, "NUR1018", "MONITOR INTAKE AND OUTPUT", datetime(2111,12,11) ],
+                [ -417974686, 380873, 111, "Nursing", 1453, "NUR1043", "NURSING PULSE OXIMETRY", datetime(2111,12,10) ],
+                [ -417843774, 2648748, 555, "Nursing", 1508, "NUR1068", "WEIGHT", datetime(2111,12,8) ],
+            ];
+        actualData = DBUtil.execute(testQuery);
+        self.assertEqualTable( expectedData, actualData );
+
+        # Dimension records resolved once up front, not duplicated by parallel workers
+        clinicalItemCountQuery = "select count(*) from clinical_item as ci, clinical_item_category as cic where ci.clinical_item_category_id = cic.clinical_item_category_id and cic.source_table = 'stride_order_proc'";
+        self.assertEqual( 5, DBUtil.execute(clinicalItemCountQuery)[0][0] );
+        linkCountQuery = "select count(*) from patient_item_collection_link as picl, patient_item as pi where picl.patient_item_id = pi.patient_item_id and pi.external_id < 0";
+        self.assertEqual( 3, DBUtil.execute(linkCountQuery)[0][0] );
+
+        # All chunks checkpointed, so nothing more to do on another run
+        self.assertEqual( 14, DBUtil.execute("select count(*) from conversion_checkpoint where conversion_name = 'STRIDEOrderProcConversion'")[0][0] );
+        self.assertEqual( 0, runner.run(TEST_START_DATE, TEST_END_DATE) );
+
+        # Simulate a run killed before finishing one chunk. Resuming should convert just that chunk again.
+        DBUtil.execute("delete from patient_item where external_id = -419697343");
+        DBUtil.execute("delete from conversion_checkpoint where chunk_key = '2112-01-10T00:00:00/2112-01-20T00:00:00#0/2'");
+        self.assertEqual( 1, runner.run(TEST_START_DATE, TEST_END_DATE) );
+        actualData = DBUtil.execute(testQuery);
+        self.assertEqualTable( expectedData, actualData );
+        self.assertEqual( 3, DBUtil.execute(linkCountQuery)[0][0] );   # Links of the other patient items in the chunk not repeated
+
+        # Or start over regardless of checkpoints
+        self.assertEqual( 14, runner.run(TEST_START_DATE, TEST_END_DATE, restart=True) );
+        actualData = DBUtil.execute(testQuery);
+        self.assertEqualTable( expectedData, actualData );
+        self.assertEqual( 3, DBUtil.execute(linkCountQuery)[0][0] );
+        self.assertEqual( 5, DBUtil.execute(clinicalItemCountQuery)[0][0] );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestConversionRunner));
+    return suite;
+
+if __name__=="__main__":
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
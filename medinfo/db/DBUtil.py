@@ -19,7 +19,10 @@ be edited in the following places...
 
 import sys, os
 import time;
-from datetime import datetime;
+import threading;
+import itertools;
+from collections import namedtuple;
+from datetime import date, datetime;
 import json;
 import csv;
 from getpass import getpass;
@@ -31,6 +34,7 @@ from Model import SQLQuery, RowItemModel;
 from Model import modelListFromTable, modelDictFromList;
 from Const import DEFAULT_ID_COL_SUFFIX, SQL_DELIM;
 from Env import DB_PARAM;   # Default connection parameters
+from Env import DB_POOL_ENABLED, DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, DB_POOL_CHECKOUT_TIMEOUT_SECONDS, DB_POOL_HEALTH_CHECK_SECONDS, DB_POOL_MAX_IDLE_SECONDS;
 from ResultsFormatter import TextResultsFormatter, TabDictReader;
 from Util import log;
 from medinfo.db import Util;
@@ -84,8 +88,22 @@ if DATABASE_CONNECTOR_NAME != "sqlite3":
     STRING = DB_CONNECTOR_MODULE.STRING;
     DATETIME = DB_CONNECTOR_MODULE.DATETIME;
 
-def connection( connParams=None ):
+def connection( connParams=None, pooled=None ):
     """Return a connection to the application database.
+    If pooled (defaults to whether pooling is enabled, see enableConnectionPooling),
+    check one out of the ConnectionPool for the connection parameters instead of opening a new one.
+    Either way, the caller should close the connection when done with it.
+    """
+    if connParams is None:
+        connParams = DB_PARAM;
+    if pooled is None:
+        pooled = poolOptions["enabled"];
+    if pooled:
+        return connectionPool(connParams).checkout();
+    return openConnection(connParams);
+
+def openConnection( connParams=None ):
+    """Open a new (unpooled) connection to the application database.
     Implementation of this method should change depending upon what
     database is being interfaced to.
     """
@@ -185,7 +203,7 @@ def createDatabase( dbParams ):
         # For PostgreSQL, have to connect to some database first before can create a new one. Connect to default "postgres" database to start.
         defaultParams = dict(dbParams);
         defaultParams["DSN"] = "postgres";
-        defaultConn = connection(defaultParams);
+        defaultConn = openConnection(defaultParams);   # Unpooled, as changing connection settings
         defaultConn.autocommit = True;  # Create/Drop Database not allowed in transaction blocks
         try:
             execute("CREATE DATABASE %s" % dbParams["DSN"], conn=defaultConn);
@@ -194,7 +212,7 @@ def createDatabase( dbParams ):
     elif DATABASE_CONNECTOR_NAME == "sqlite3":
         defaultParams = dict(dbParams);
         # Sqlite3 automatically creates a database upon connection
-        defaultConn = connection(defaultParams);
+        defaultConn = openConnection(defaultParams);   # Unpooled, as changing connection settings
         # None for autocommit mode
         defaultConn.isolation_level = None
         defaultConn.close()
@@ -203,11 +221,12 @@ def dropDatabase( dbParams ):
     """Drop the database specified by the DSN name specified in the dbParams.
     Will likely require logging in first as the user-password specified.
     """
+    closeConnectionPools(dbParams); # Pooled connections would block dropping (PostgreSQL) or be left on a deleted file (SQLite)
     if DATABASE_CONNECTOR_NAME == "psycopg2":
     # For PostgreSQL, cannot drop database while connected to it, so connect to default "postgres" database to start.
         defaultParams = dict(dbParams);
         defaultParams["DSN"] = "postgres";
-        defaultConn = connection(defaultParams);
+        defaultConn = openConnection(defaultParams);   # Unpooled, as changing connection settings
         defaultConn.autocommit = True;  # Create/Drop Database not allowed in transaction blocks
         try:
             execute("DROP DATABASE %s" % dbParams["DSN"], conn=defaultConn);
@@ -225,6 +244,342 @@ def dropDatabase( dbParams ):
 #########  END  Database Specific Stuff ###########
 ###################################################
 
+"""Current connection pooling options, initially from Env (see enableConnectionPooling)"""
+poolOptions = \
+    {   "enabled": DB_POOL_ENABLED,
+        "minConnections": DB_POOL_MIN_CONNECTIONS,
+        "maxConnections": DB_POOL_MAX_CONNECTIONS,
+        "checkoutTimeout": DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+        "healthCheckSeconds": DB_POOL_HEALTH_CHECK_SECONDS,
+        "maxIdleSeconds": DB_POOL_MAX_IDLE_SECONDS,
+    };
+
+# ConnectionPools by poolKey, and a lock for changes to them
+connectionPools = dict();
+connectionPoolsLock = threading.Lock();
+
+def enableConnectionPooling(enabled=True, **options):
+    """Turn on (or off) connection pooling for connection() calls that don't specify,
+    so existing call sites transparently reuse pooled connections.
+    Any options (e.g., maxConnections, see poolOptions) apply to pools created afterwards.
+    """
+    for name in options.iterkeys():
+        if name not in poolOptions:
+            raise KeyError("Unknown connection pool option: %s" % name);
+    poolOptions.update(options);
+    poolOptions["enabled"] = enabled;
+
+def poolKey( connParams ):
+    """Key to keep a separate pool for each set of connection parameters.
+    Also separate by process, so forked worker processes don't share connections (sockets) with their parent,
+    and for SQLite by thread, as sqlite3 connections can only be used by the thread that created them.
+    """
+    paramKey = tuple( sorted( (key, str(value)) for key, value in connParams.iteritems() if key != "PWD" ) );
+    threadId = None;
+    if DATABASE_CONNECTOR_NAME == "sqlite3":
+        threadId = threading.current_thread().ident;
+    return (paramKey, os.getpid(), threadId);
+
+def connectionPool( connParams=None ):
+    """Return the ConnectionPool for the connection parameters, creating it with the current poolOptions if needed"""
+    if connParams is None:
+        connParams = DB_PARAM;
+    key = poolKey(connParams);
+    with connectionPoolsLock:
+        if key not in connectionPools:
+            connectionPools[key] = ConnectionPool( dict(connParams), **dict( (name, value) for name, value in poolOptions.iteritems() if name != "enabled" ) );
+        return connectionPools[key];
+
+def closeConnectionPools( connParams=None ):
+    """Close the idle connections of the pools for the connection parameters (or all pools) and discard the pools,
+    e.g., before dropping a database.  Connections still checked out are closed when they are returned.
+    """
+    paramKey = None;
+    if connParams is not None:
+        paramKey = poolKey(connParams)[0];
+    with connectionPoolsLock:
+        for key in connectionPools.keys():
+            if paramKey is None or key[0] == paramKey:
+                connectionPools.pop(key).close();
+
+def connectionPoolStats():
+    """Usage and wait time metrics (see ConnectionPool.stats) of this process's pools,
+    keyed by the database name, host, and user (combining any per thread SQLite pools).
+    """
+    statsByName = dict();
+    with connectionPoolsLock:
+        pools = connectionPools.values();
+    for pool in pools:
+        name = "%s@%s as %s" % (pool.connParams.get("DSN"), pool.connParams.get("HOST"), pool.connParams.get("UID"));
+        stats = pool.stats();
+        if name in statsByName:
+            combinedStats = statsByName[name];
+            for statName, value in stats.iteritems():
+                if statName == "maxWaitSeconds":
+                    combinedStats[statName] = max(combinedStats[statName], value);
+                else:
+                    combinedStats[statName] += value;
+            combinedStats["meanWaitSeconds"] = combinedStats["totalWaitSeconds"] / max(combinedStats["checkouts"], 1);
+        else:
+            statsByName[name] = stats;
+    return statsByName;
+
+def healthCheckQuery():
+    """Trivial query to verify a connection still works"""
+    if DATABASE_CONNECTOR_NAME == "cx_Oracle":
+        return "select 1 from dual";
+    return "select 1";
+
+def isConnectionHealthy( conn ):
+    """Run the health check query on the connection, ending with a rollback, so no transaction is left open.
+    Return False if that fails (e.g., the server closed the connection).
+    """
+    try:
+        cursor = conn.cursor();
+        try:
+            cursor.execute(healthCheckQuery());
+            cursor.fetchall();
+        finally:
+            cursor.close();
+        conn.rollback();
+        return True;
+    except Exception, err:
+        log.warning("Failed connection health check: %s" % err);
+        return False;
+
+def keepAlive( conn, lastActiveTime, intervalSeconds=DB_POOL_HEALTH_CHECK_SECONDS ):
+    """For long computations while holding an otherwise idle connection,
+    run a health check query if more than intervalSeconds have passed since lastActiveTime,
+    so the database server doesn't time out the connection.
+    Unlike the health check for pooled connections, leaves any transaction in progress open.
+    Return the updated last active time, for the next call.
+    """
+    now = time.time();
+    if lastActiveTime is None or now - lastActiveTime > intervalSeconds:
+        execute(healthCheckQuery(), conn=conn, autoCommit=False);
+        lastActiveTime = now;
+    return lastActiveTime;
+
+"""Connection attributes restored to their initial values when connections are returned to a pool"""
+RESETTABLE_CONNECTION_SETTINGS = ("autocommit","isolation_level");
+
+class ConnectionPoolTimeout(Exception):
+    """No pooled connection became available within the checkout timeout"""
+    pass;
+
+class ConnectionPool:
+    """Thread-safe pool of open connections for one set of connection parameters.
+    checkout returns a PooledConnection, which goes back to the pool when closed (or when used as a context manager),
+    with any uncommitted transaction rolled back, the same as closing a regular connection would.
+
+    Keeps stats on checkouts and how long callers had to wait for a connection,
+    to help size maxConnections (see stats).
+    """
+    def __init__(self, connParams, minConnections=DB_POOL_MIN_CONNECTIONS, maxConnections=DB_POOL_MAX_CONNECTIONS,
+                checkoutTimeout=DB_POOL_CHECKOUT_TIMEOUT_SECONDS, healthCheckSeconds=DB_POOL_HEALTH_CHECK_SECONDS, maxIdleSeconds=DB_POOL_MAX_IDLE_SECONDS):
+        self.connParams = connParams;
+        self.minConnections = minConnections;
+        self.maxConnections = maxConnections;
+        self.checkoutTimeout = checkoutTimeout; # Seconds to wait for a connection before raising ConnectionPoolTimeout. None to wait indefinitely
+        self.healthCheckSeconds = healthCheckSeconds;   # Health check connections idle for longer than this before reuse. 0 to always check
+        self.maxIdleSeconds = maxIdleSeconds;   # Close connections idle for longer than this, but keep at least minConnections once opened
+        self.defaultSettings = None;    # Initial values of RESETTABLE_CONNECTION_SETTINGS, found on the first connection opened
+
+        self.condition = threading.Condition();
+        self.idleConnections = list();  # (connection, lastUsedTime) tuples, most recently used last
+        self.nOpen = 0; # Open connections, idle or checked out
+        self.isClosed = False;
+
+        self.nCheckouts = 0;
+        self.nWaits = 0;    # Checkouts that had to wait for a connection to be returned
+        self.nTimeouts = 0; # Checkouts that gave up waiting
+        self.totalWaitSeconds = 0.0;
+        self.maxWaitSeconds = 0.0;
+        self.nOpened = 0;
+        self.nReplaced = 0; # Connections that failed health checks and were replaced
+
+    def checkout(self):
+        """Return a PooledConnection, reusing an idle connection if available,
+        otherwise opening a new one if there are less than maxConnections open,
+        otherwise waiting up to checkoutTimeout seconds for one to be returned.
+        """
+        startTime = time.time();
+        conn = None;
+        lastUsedTime = None;
+        with self.condition:
+            isWaiting = False;
+            while True:
+                if self.idleConnections:
+                    (conn, lastUsedTime) = self.idleConnections.pop();
+                    break;
+                if self.nOpen < self.maxConnections:
+                    self.nOpen += 1;    # Reserve a spot for a new connection
+                    break;
+                remainingSeconds = None;
+                if self.checkoutTimeout is not None:
+                    remainingSeconds = self.checkoutTimeout - (time.time() - startTime);
+                    if remainingSeconds <= 0:
+                        self.nTimeouts += 1;
+                        raise ConnectionPoolTimeout("No connection available from the pool of %d after %.3f seconds" % (self.maxConnections, time.time() - startTime) );
+                isWaiting = True;
+                self.condition.wait(remainingSeconds);
+
+            waitSeconds = time.time() - startTime;
+            self.nCheckouts += 1;
+            if isWaiting:
+                self.nWaits += 1;
+                self.totalWaitSeconds += waitSeconds;
+                self.maxWaitSeconds = max(self.maxWaitSeconds, waitSeconds);
+                log.debug("Waited %.3f sec for pooled connection" % waitSeconds );
+
+        try:
+            if conn is None:
+                conn = self.openConnection();
+            elif time.time() - lastUsedTime > self.healthCheckSeconds and not isConnectionHealthy(conn):
+                closeQuietly(conn);
+                conn = self.openConnection();
+                with self.condition:
+                    self.nReplaced += 1;
+        except:
+            self.discard();
+            raise;
+        return PooledConnection(self, conn);
+
+    def openConnection(self):
+        conn = openConnection(self.connParams);
+        with self.condition:
+            self.nOpened += 1;
+            if self.defaultSettings is None:
+                self.defaultSettings = dict( (name, getattr(conn, name)) for name in RESETTABLE_CONNECTION_SETTINGS if hasattr(conn, name) );
+        return conn;
+
+    def resetSettings(self, conn):
+        """Undo any changes to connection settings (e.g., autocommit) made while checked out"""
+        for name, value in self.defaultSettings.iteritems():
+            if getattr(conn, name) != value:
+                setattr(conn, name, value);
+
+    def checkin(self, conn):
+        """Return a (raw) connection to the pool, rolling back any uncommitted transaction.
+        Connections that fail to roll back are closed instead.
+        Close any connections idle for more than maxIdleSeconds, down to minConnections.
+        """
+        try:
+            conn.rollback();
+            self.resetSettings(conn);
+        except Exception, err:
+            log.warning("Discarding pooled connection that failed to roll back: %s" % err);
+            closeQuietly(conn);
+            self.discard();
+            return;
+
+        now = time.time();
+        expiredConnections = list();
+        with self.condition:
+            if self.isClosed:
+                expiredConnections.append(conn);
+                self.nOpen -= 1;
+            else:
+                self.idleConnections.append( (conn, now) );
+                while self.nOpen > self.minConnections and self.idleConnections and now - self.idleConnections[0][1] > self.maxIdleSeconds:
+                    expiredConnections.append( self.idleConnections.pop(0)[0] );
+                    self.nOpen -= 1;
+            self.condition.notify();
+        for expiredConnection in expiredConnections:
+            closeQuietly(expiredConnection);
+
+    def discard(self):
+        """Release the spot of a checked out connection that was closed instead of returned"""
+        with self.condition:
+            self.nOpen -= 1;
+            self.condition.notify();
+
+    def close(self):
+        """Close all idle connections. Connections still checked out are closed when returned."""
+        with self.condition:
+            self.isClosed = True;
+            idleConnections = self.idleConnections;
+            self.idleConnections = list();
+            self.nOpen -= len(idleConnections);
+            self.condition.notifyAll();
+        for (conn, lastUsedTime) in idleConnections:
+            closeQuietly(conn);
+
+    def stats(self):
+        """Dictionary of pool usage and wait time metrics"""
+        with self.condition:
+            stats = \
+                {   "open": self.nOpen,
+                    "idle": len(self.idleConnections),
+                    "checkouts": self.nCheckouts,
+                    "waits": self.nWaits,
+                    "timeouts": self.nTimeouts,
+                    "totalWaitSeconds": self.totalWaitSeconds,
+                    "maxWaitSeconds": self.maxWaitSeconds,
+                    "meanWaitSeconds": self.totalWaitSeconds / max(self.nCheckouts, 1),
+                    "opened": self.nOpened,
+                    "replaced": self.nReplaced,
+                };
+        return stats;
+
+def closeQuietly( conn ):
+    try:
+        conn.close();
+    except Exception, err:
+        log.warning("Error closing connection: %s" % err);
+
+class PooledConnection(object):
+    """Wrapper around a connection checked out from a ConnectionPool.
+    Delegates everything to the underlying connection, except close, which returns it to the pool.
+    As a context manager, commits on success (or rolls back on error), then returns the connection to the pool.
+    Connections that are never closed are returned when garbage collected.
+    """
+    def __init__(self, pool, conn):
+        object.__setattr__(self, "_pool", pool);
+        object.__setattr__(self, "_conn", conn);
+
+    def rawConnection(self):
+        """The underlying connection"""
+        conn = object.__getattribute__(self, "_conn");
+        if conn is None:
+            raise DB_CONNECTOR_MODULE.InterfaceError("Connection already returned to the pool");
+        return conn;
+
+    def __getattr__(self, name):
+        return getattr(self.rawConnection(), name);
+
+    def __setattr__(self, name, value):
+        setattr(self.rawConnection(), name, value);
+
+    def close(self):
+        conn = object.__getattribute__(self, "_conn");
+        if conn is not None:
+            object.__setattr__(self, "_conn", None);
+            self._pool.checkin(conn);
+
+    @property
+    def closed(self):
+        return object.__getattribute__(self, "_conn") is None;
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                self.commit();
+            else:
+                self.rollback();
+        finally:
+            self.close();
+        return False;
+
+    def __del__(self):
+        try:
+            self.close();
+        except Exception:
+            pass;   # E.g., interpreter shutting down, nothing left to return to
+
 class ConnectionFactory:
     """Simple factory object to encapsulate the primary DBUtil.connection function.
     This way, we can pass around the *means* to produce a connection object,
@@ -233,11 +588,12 @@ class ConnectionFactory:
     committing and closing, etc.
     """
     
-    def __init__(self, connParam=None):
+    def __init__(self, connParam=None, pooled=None):
         self.connParam = connParam;
+        self.pooled = pooled;   # Whether to check connections out of a ConnectionPool. None to follow enableConnectionPooling
     
     def connection(self):
-        return connection( self.connParam );
+        return connection( self.connParam, self.pooled );
 
 
 def execute( query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, 
@@ -355,6 +711,130 @@ def execute( query, parameters=None, includeColumnNames=False, incTypeCodes=Fals
     return returnValue
 
 
+"""Formats executeStream / iterate can yield result rows in:
+- tuple: Plain tuples, as returned by the DB-API cursor, with no copying
+- namedtuple: Lightweight tuples that also allow attribute lookups by column name (e.g., row.patient_id)
+- model: RowItemModel dictionaries, as modelListFromTable would produce
+- columns: (executeStream only) Dictionary of column name -> numpy array of the batch values for that column
+"""
+STREAM_ROW_FORMATS = ("tuple","namedtuple","model","columns");
+
+"""Default number of rows to fetch from the database at a time when streaming query results"""
+DEFAULT_FETCH_SIZE = 10000;
+
+# Unique names for server-side cursors
+streamCursorIds = itertools.count();
+
+def executeStream( query, parameters=None, rowFormat="tuple", fetchSize=DEFAULT_FETCH_SIZE, columnNames=None, conn=None, connFactory=None ):
+    """Execute a single SQL select query, but rather than pulling the whole result set into memory
+    (and copying it into lists, as execute does), return an iterator over batches of up to fetchSize rows at a time,
+    so large scans run in bounded memory.  Batches are lists of rows in the specified rowFormat (see STREAM_ROW_FORMATS),
+    except for the "columns" format, where each batch is a dictionary of column arrays.
+
+    With PostgreSQL, uses a named (server-side) cursor, so the database only sends fetchSize rows at a time.
+    With MySQLdb, uses an unbuffered (server-side) cursor.  Otherwise, the default cursor's fetchmany.
+
+    If columnNames are provided, use those to label the result columns instead of the names from the cursor
+    (e.g., to drop table prefixes).
+
+    The query is not actually executed until iteration starts.
+    If an external connection is supplied, the caller may still commit (or run other queries)
+    on it while iterating, as PostgreSQL cursors are held across transaction commits.
+    The cursor (and connection, if not external) is closed once iteration is finished (or the iterator is closed).
+    """
+    if rowFormat not in STREAM_ROW_FORMATS:
+        raise ValueError("Unrecognized row format %s, expected one of %s" % (rowFormat, str.join(", ", STREAM_ROW_FORMATS)) );
+    return _executeStreamBatches(query, parameters, rowFormat, fetchSize, columnNames, conn, connFactory);
+
+def _executeStreamBatches( query, parameters, rowFormat, fetchSize, columnNames, conn, connFactory ):
+    """Generator for executeStream, so argument errors are raised up front rather than on first iteration"""
+    extConn = ( conn is not None );
+    if conn is None:
+        if connFactory is not None:
+            conn = connFactory.connection();
+        else:
+            conn = connection();
+
+    if parameters is None:
+        parameters = ();
+    if isinstance(query,SQLQuery):
+        parameters = tuple(query.getParams());
+        query = str(query);
+
+    cur = None;
+    try:
+        if DATABASE_CONNECTOR_NAME == "psycopg2":
+            # Hold the cursor across transaction commits, as the caller may commit on an external connection while still iterating
+            cur = conn.cursor(name="stream_%d_%d" % (os.getpid(), streamCursorIds.next()), withhold=extConn);
+            cur.itersize = fetchSize;
+        elif DATABASE_CONNECTOR_NAME == "MySQLdb":
+            import MySQLdb.cursors;
+            cur = conn.cursor(MySQLdb.cursors.SSCursor);
+        else:
+            cur = conn.cursor();
+
+        timer = time.time();
+        try:
+            cur.execute( query, parameters );
+        except Exception, err:
+            log.error(err);
+            if not extConn:
+                conn.rollback();
+            raise;
+        timer = time.time() - timer;
+        log.debug("Query Time: (%1.3f sec)" % timer );
+
+        rows = cur.fetchmany(fetchSize);
+        if columnNames is None:
+            columnNames = columnNamesFromCursor(cur);
+
+        rowClass = None;
+        if rowFormat == "namedtuple":
+            rowClass = namedtuple("Row", columnNames, rename=True);   # Rename any columns that are not valid identifiers (e.g., "count(*)")
+
+        while rows:
+            if rowFormat == "namedtuple":
+                yield [rowClass._make(row) for row in rows];
+            elif rowFormat == "model":
+                yield [RowItemModel(row, columnNames) for row in rows];
+            elif rowFormat == "columns":
+                yield columnArraysFromRows(rows, columnNames);
+            else:
+                yield rows;
+            rows = cur.fetchmany(fetchSize);
+    finally:
+        if cur is not None:
+            cur.close();
+        if not extConn:
+            conn.close();
+
+def iterate( query, parameters=None, rowFormat="tuple", fetchSize=DEFAULT_FETCH_SIZE, columnNames=None, conn=None, connFactory=None ):
+    """Execute a single SQL select query and iterate through the result rows one at a time,
+    in the specified rowFormat, streaming them from the database in batches (see executeStream)
+    so the whole result set never has to be held in memory.
+    Close the returned iterator to release the cursor early, without reading the remaining rows.
+    """
+    if rowFormat == "columns":
+        raise ValueError("Column arrays are only available by batch from executeStream");
+    return _iterateBatchRows(executeStream(query, parameters, rowFormat, fetchSize, columnNames, conn, connFactory));
+
+def _iterateBatchRows(batches):
+    try:
+        for batch in batches:
+            for row in batch:
+                yield row;
+    finally:
+        batches.close();
+
+def columnArraysFromRows(rows, columnNames):
+    """Transpose a batch of result rows into a dictionary of column name -> numpy array of values"""
+    import numpy as np;    # Only needed for this output format
+    columnValuesList = zip(*rows);
+    columnArrays = dict();
+    for columnName, columnValues in zip(columnNames, columnValuesList):
+        columnArrays[columnName] = np.array(columnValues);
+    return columnArrays;
+
 def columnNamesFromCursor(cursor):
     """Given a cursor that was just used to execute a query, return the list
     of column names of the result set.
@@ -419,6 +899,12 @@ def runDBScript( scriptFile, skipErrors = False ):
     finally:
         conn.close()
 
+"""Default number of rows to load per batch in bulk inserts / updates"""
+BULK_ROWS_PER_BATCH = 10000;
+
+"""Maximum number of distinct date strings to cache parsed values for, per column, when inserting files"""
+DATE_VALUE_CACHE_SIZE = 100000;
+
 def normalizeColName( col ):
     """Normalize column name string for consistent use as dictionary key"""
     normCol = col.strip().lower();
@@ -426,12 +912,9 @@ def normalizeColName( col ):
         normCol = normCol[1:-1];
     return normCol;
 
-def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None, skipErrors=False, dateColFormats=None, escapeStrings=False, estInput=None, connFactory=None ):
+def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None, skipErrors=False, dateColFormats=None, escapeStrings=False, estInput=None, connFactory=None, rowsPerBatch=None ):
     """Insert the contents of a whitespace-delimited text file into the database.
     
-    For PostgreSQL specifically, consider alternative direct COPY command that can run 10x:
-    E.g., gzip -d -c TTeam_2014.tsv.gz | psql -U jonc101 -c "COPY tteamx (  pat_deid,  enc_deid,  relation,  prov_id,  prov_name,  start_date,  end_date ) FROM STDIN WITH (FORMAT csv, DELIMITER E'\t', HEADER, NULL 'None');" resident-access-log-2017
-
     Inserts the contents of the <sourceFile> into the database
     under the <tableName>.  One line is expected in the <sourceFile>
     per row in the database, with each item delimited by the <delim>
@@ -440,21 +923,30 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
 
     Use the built-in csv module for parsing out lines and managing quotes, etc.
     If delimiter is not specified (None), then default to tab-delimited
+
+    Rows are bulk loaded rowsPerBatch at a time (default BULK_ROWS_PER_BATCH),
+    streamed in with COPY for PostgreSQL, otherwise with executemany (see insertRows).
+    If skipErrors is set, each batch is committed separately, and a batch that fails
+    is rolled back and bisected to find and skip just the bad rows.
     
-    If idFile is provided, then will try to run SQL from identityQuery method
-    after each insert, and write out the contents, one per line to the idFile.
-    Will bypass above step if can find an insert column with the expected default ID column ("tableName_id")
+    If idFile is provided, then will write out the ID values of the inserted rows to it, one per line.
+    Uses the insert column with the expected default ID column ("tableName_id") if there is one,
+    otherwise the generated ID values (with an insert ... returning query for PostgreSQL,
+    or the identityQuery / cursor lastrowid after each insert for other databases).
     
     If dateColFormats provided, expect a dictionary keyed by the names of columns
     that should be as interpreted date strings, with values equal to the 
     Python date format string to parse them by.  
     If a format string is not provided, a series of standard date format strings will be attempted 
-    (but this is inefficient for repeated date text parsing and error handling).
+    (but this is inefficient for repeated date text parsing and error handling,
+    though each distinct date string is only parsed once).
     
     Returns the total number of rows successfully inserted.
     """
     if columnNames is not None and len(columnNames) < 1:
         columnNames = None; # If empty columnNames list, then reset to null and look for it in first line of data
+    if rowsPerBatch is None:
+        rowsPerBatch = BULK_ROWS_PER_BATCH;
 
     reader = TabDictReader(sourceFile, fieldnames=columnNames, delimiter=delim);
     columnNames = reader.fieldnames;
@@ -480,71 +972,32 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
     cur  = conn.cursor()
     
     try:
-        # Prepare the SQL Statement
-        sqlParts = []
-        sqlParts.append("insert into")
-        sqlParts.append( tableName )
-
-        sqlParts.append("(")
-        sqlParts.append( str.join(",", columnNames) );
-        sqlParts.append(")")
-
-        sqlParts.append("values")
-        sqlParts.append("(")
-        for i in range(len(columnNames)):
-            sqlParts.append( SQL_PLACEHOLDER )    # Parameter placeholder, depends on DB-API
-            sqlParts.append(",")
-        sqlParts.pop(); # Remove extra end comma
-        sqlParts.append(")")
-
-        sql = str.join(" ",sqlParts)
-
+        sql = buildInsertQuery( tableName, columnNames );
         log.debug(sql)
-        
 
-        # Loop through file and execute insert statement everytime find enough delimited parameters.  
+        def insertBatch(batch):
+            """Insert the batch of rows, returning their ID values if needed for the idFile"""
+            if idFile is None:
+                _insertRowBatch(cur, tableName, columnNames, sql, batch);
+            elif iIdCol is not None:    # Manually assigned ID values
+                _insertRowBatch(cur, tableName, columnNames, sql, batch);
+                return [row[iIdCol] for row in batch];
+            else:
+                return insertRowsReturning(tableName, columnNames, batch, idCol, conn=conn);
+
+        # Loop through file and insert every batch of rows after parsing out data values from strings
+        parseRow = rowValueParser(columnNames, dateColFormats, escapeStrings);
         nInserts = 0
-        nCols = len(columnNames)
-        params = list();
+        batch = list();
         progress = ProgressDots(total=estInput);
-        for iLine, rowModel in enumerate(reader):
-            # Parse out data values from strings
-            for iCol, colName in enumerate(columnNames):
-                value = parseValue(rowModel[colName], colName, dateColFormats, escapeStrings);
-                params.append(value);
-
-            log.debug(params)
-            try:
-                cur.execute(sql,tuple(params))
-                nInserts += cur.rowcount
-
-                if idFile != None:
-                    rowId = None;
-                    if iIdCol is not None:  # Look for manually assigned ID value first
-                        rowId = params[iIdCol];
-                    else:
-                        cur.execute(identityQuery(tableName));
-                        rowId = cur.fetchone()[0];
-                    print >> idFile, rowId;
-
-                # Need to "auto-commit" after each command, 
-                #   otherwise a skipped error will rollback 
-                #   any previous commands as well
-                if skipErrors: 
-                    conn.commit()    
-
-                progress.Update()
-
-            except Exception, err:
-                log.info(sql);
-                log.info(tuple(params))
-                conn.rollback();    # Reset any changes since the last commit
-                if skipErrors:
-                    log.warning("Error Executing in Script: "+ sql )
-                    log.warning(err)
-                else:
-                    raise;
-            params = list();
+        for rowModel in reader:
+            batch.append( parseRow(rowModel) );
+            if len(batch) >= rowsPerBatch:
+                nInserts += bulkApplyBatch(conn, insertBatch, batch, skipErrors, idFile);
+                batch = list();
+            progress.Update()
+        if batch:
+            nInserts += bulkApplyBatch(conn, insertBatch, batch, skipErrors, idFile);
 
         conn.commit()
 
@@ -555,8 +1008,63 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
 
     return 0    
 
-
-def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=None, skipErrors=False, connFactory=None  ):
+def rowValueParser(columnNames, dateColFormats=None, escapeStrings=False):
+    """Function to parse a row dictionary of string values (e.g., from a TabDictReader)
+    into a tuple of columnNames values, as parseValue would.
+    Date column values are cached, as the same date strings often repeat many times in a file.
+    """
+    dateValueCacheByCol = dict();
+    if dateColFormats is not None:
+        for colName in columnNames:
+            if colName.lower() in dateColFormats:
+                dateValueCacheByCol[colName] = dict();
+
+    def parseRow(rowModel):
+        values = list();
+        for colName in columnNames:
+            chunk = rowModel[colName];
+            if colName in dateValueCacheByCol:
+                dateValueCache = dateValueCacheByCol[colName];
+                if chunk not in dateValueCache:
+                    if len(dateValueCache) >= DATE_VALUE_CACHE_SIZE:
+                        dateValueCache.clear();
+                    dateValueCache[chunk] = parseValue(chunk, colName, dateColFormats, escapeStrings);
+                values.append(dateValueCache[chunk]);
+            else:
+                values.append(parseValue(chunk, colName, dateColFormats, escapeStrings));
+        return tuple(values);
+    return parseRow;
+
+def bulkApplyBatch(conn, applyBatch, batch, skipErrors, idFile=None):
+    """Apply (insert / update) a batch of rows with the applyBatch function,
+    which may return a list of ID values to write out to the idFile.
+    Also used for other bulk loads (e.g., DimensionCache.InsertBuffer) that want the same error handling.
+    If skipErrors is set, commit each successful batch, and if the batch fails,
+    roll it back and bisect it to isolate and skip just the bad rows.
+    Returns the number of rows successfully applied.
+    """
+    try:
+        rowIds = applyBatch(batch);
+        if skipErrors:
+            conn.commit();
+    except Exception, err:
+        conn.rollback();    # Reset any changes since the last commit
+        if not skipErrors:
+            log.info(err);
+            raise;
+        if len(batch) == 1:
+            log.warning("Error applying row, skipping: %s" % str(batch[0]) );
+            log.warning(err);
+            return 0;
+        iMid = len(batch) / 2;
+        return bulkApplyBatch(conn, applyBatch, batch[:iMid], skipErrors, idFile) + bulkApplyBatch(conn, applyBatch, batch[iMid:], skipErrors, idFile);
+
+    if idFile is not None:
+        for rowId in rowIds:
+            print >> idFile, rowId;
+    return len(batch);
+
+def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=None, skipErrors=False, connFactory=None, rowsPerBatch=None ):
     """Update the database with the contents of a whitespace-delimited text file.
     
     Updates the contents of the <tableName> with the data from the <sourceFile>.  
@@ -575,92 +1083,87 @@ def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=No
     values must not be None / null.  The query looks for rows where columnname = value,
     and the = operator always returns false when the value is null.
 
+    Rows are applied rowsPerBatch at a time (default BULK_ROWS_PER_BATCH), by bulk loading
+    each batch into a temporary staging table (see insertRows) and updating the table from it with a single query.
+    If skipErrors is set, each batch is committed separately, and a batch that fails
+    is rolled back and bisected to find and skip just the bad rows.
+
     Returns the total number of rows successfully updated.
     """
     if columnNames is None or len(columnNames) < 1:
         headerLine = sourceFile.readline();
         columnNames = headerLine.split(delim);
+    columnNames = [colName.strip() for colName in columnNames];
+    if rowsPerBatch is None:
+        rowsPerBatch = BULK_ROWS_PER_BATCH;
     
     conn = None;
     if connFactory is not None:
         conn = connFactory.connection();
     else:
         conn = connection()
-    cur  = conn.cursor()
 
     nCols = len(columnNames);
+    stagingTable = "temp_update_%s" % tableName.replace(".","_");
     
     try:
-        # Prepare the SQL Statement
-        sql = [];
-        sql.append("update");
-        sql.append( tableName );
-        sql.append("set");
-
-        # Data Columns
-        for i in xrange(nIdCols,nCols):
-            sql.append(columnNames[i]);
-            sql.append("=");
-            sql.append(SQL_PLACEHOLDER);
-            sql.append(",");
-        sql.pop();  # Remove extra comma at end
-
-        # ID Columns
-        sql.append("where")
-        for i in xrange(nIdCols):
-            sql.append(columnNames[i]);
-            sql.append("=");
-            sql.append(SQL_PLACEHOLDER);
-            sql.append("and");
-        sql.pop();  # Remove extra comma at end
-
-        sql = str.join(" ",sql);
+        # Staging table with the same column types as the table to update.
+        #   Staging columns are aliased by position, as the same column may be listed as both a key and a value to update
+        stagingColumns = ["c%d" % iCol for iCol in xrange(nCols)];
+        execute("DROP TABLE IF EXISTS %s" % stagingTable, conn=conn);
+        execute("CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WHERE 1=0" % (stagingTable, str.join(",", ["%s AS %s" % pair for pair in zip(columnNames, stagingColumns)]), tableName), conn=conn);
 
+        # Prepare the SQL Statement
+        dataColumns = zip(columnNames[nIdCols:], stagingColumns[nIdCols:]);
+        idColumns = zip(columnNames[:nIdCols], stagingColumns[:nIdCols]);
+        setClause = str.join(", ", ["%s = s.%s" % pair for pair in dataColumns]);
+        joinClause = str.join(" and ", ["t.%s = s.%s" % pair for pair in idColumns]);
+        if DATABASE_CONNECTOR_NAME in ("mysql.connector", "MySQLdb"):
+            setClause = str.join(", ", ["t.%s = s.%s" % pair for pair in dataColumns]);
+            sql = "update %s as t join %s as s on %s set %s" % (tableName, stagingTable, joinClause, setClause);
+        else:
+            sql = "update %s as t set %s from %s as s where %s" % (tableName, setClause, stagingTable, joinClause);
         log.debug(sql)
 
-        # Loop through file and execute update statement for every line
+        def updateBatch(batch):
+            # Only the last update for any row, as if they were applied in order
+            rowsById = dict();
+            for params in batch:
+                rowsById[tuple(params[:nIdCols])] = params;
+            cur = conn.cursor();
+            try:
+                insertRows(stagingTable, stagingColumns, rowsById.itervalues(), rowsPerBatch=len(batch), conn=conn);
+                cur.execute(sql);
+                cur.execute("delete from %s" % stagingTable);
+            finally:
+                cur.close();
+
+        # Loop through file and apply every batch of lines
+        nUpdates = 0;
+        batch = list();
         progress = ProgressDots()
         for iLine, line in enumerate(sourceFile):
             if not line.startswith(COMMENT_TAG):
-                try:
-                    line = line[:-1];    # Strip the newline character
-                    params = line.split(delim);
-                    
-                    # Special handling for null / None string
-                    for iParam in xrange(len(params)):
-                        if params[iParam] == "" or params[iParam] == NULL_STRING:   # Treat blank strings as NULL
-                            params[iParam] = None;
-
-                    # Reposition ID columns to end of parameter list
-                    idParams = params[:nIdCols];
-                    dataParams = params[nIdCols:];
-                    paramTuple = dataParams;
-                    paramTuple.extend( idParams );
-                    paramTuple = tuple(paramTuple);
-                    
-                    cur.execute(sql, paramTuple);
-
-                    # Need to "auto-commit" after each command, 
-                    #   otherwise a skipped error will rollback 
-                    #   any previous commands as well
-                    if skipErrors:
-                        conn.commit()    
-
-                    progress.Update()
-
-                except Exception, err:
-                    conn.rollback();    # Reset changes and connection state
-                    log.critical(sql);
-                    log.critical(paramTuple);
-                    log.warning("Error Executing in Script: %s", parameterizeQueryString(sql,paramTuple) );
-                    if skipErrors:
-                        log.warning(err)
-                    else:
-                        raise err
+                line = line[:-1];    # Strip the newline character
+                params = line.split(delim);
+                
+                # Special handling for null / None string
+                for iParam in xrange(len(params)):
+                    if params[iParam] == "" or params[iParam] == NULL_STRING:   # Treat blank strings as NULL
+                        params[iParam] = None;
+
+                batch.append(params);
+                if len(batch) >= rowsPerBatch:
+                    nUpdates += bulkApplyBatch(conn, updateBatch, batch, skipErrors);
+                    batch = list();
+                progress.Update()
+        if batch:
+            nUpdates += bulkApplyBatch(conn, updateBatch, batch, skipErrors);
 
+        execute("DROP TABLE %s" % stagingTable, conn=conn);
         conn.commit()
 
-        return progress.GetCounts();
+        return nUpdates;
 
     finally:
         conn.close()
@@ -783,6 +1286,199 @@ def insertRow(tableName, insertDict, conn=None, cursor=None):
         if not extConn:
             conn.close();
 
+def insertRows(tableName, colNames, rows, rowsPerBatch=BULK_ROWS_PER_BATCH, conn=None):
+    """Bulk insert of many records into the named table.
+    rows can be any iterable (e.g., a generator) of value lists/tuples in colNames order,
+    and will be consumed in batches of rowsPerBatch, so the full data set need not be in memory at once.
+
+    With PostgreSQL (psycopg2), stream each batch in with COPY, otherwise fall back to cursor.executemany.
+    Return the number of rows inserted.
+    """
+    extConn = ( conn is not None );
+    if not extConn: conn = connection();
+    cursor = conn.cursor();
+    try:
+        insertQuery = buildInsertQuery( tableName, colNames );
+        nRows = 0;
+        batch = list();
+        for row in rows:
+            batch.append(row);
+            if len(batch) >= rowsPerBatch:
+                nRows += _insertRowBatch(cursor, tableName, colNames, insertQuery, batch);
+                batch = list();
+        if batch:
+            nRows += _insertRowBatch(cursor, tableName, colNames, insertQuery, batch);
+        return nRows;
+    finally:
+        cursor.close();
+        if not extConn:
+            conn.commit();
+            conn.close();
+
+def _insertRowBatch(cursor, tableName, colNames, insertQuery, batch):
+    if DATABASE_CONNECTOR_NAME == "psycopg2":
+        from cStringIO import StringIO;
+        copyData = StringIO();
+        for row in batch:
+            copyData.write( str.join("\t", [_copyValueStr(value) for value in row]) );
+            copyData.write("\n");
+        copyData.seek(0);
+        # Explicit COPY statement, as copy_from quotes (case-sensitive) column names in newer psycopg2 versions
+        cursor.copy_expert( "COPY %s (%s) FROM STDIN" % (tableName, str.join(",", colNames)), copyData );
+    else:
+        cursor.executemany( insertQuery, batch );
+    return len(batch);
+
+def _copyValueStr(value):
+    """String representation of a value in PostgreSQL COPY text format"""
+    if value is None:
+        return "\\N";
+    if isinstance(value, float):
+        return repr(value); # Default str would round to 12 significant digits
+    if isinstance(value, unicode):
+        value = value.encode("utf-8");
+    value = str(value);
+    return value.replace("\\","\\\\").replace("\t","\\t").replace("\n","\\n").replace("\r","\\r");
+
+def insertRowsReturning(tableName, colNames, rows, returnCol=None, conn=None):
+    """Insert the rows (value lists/tuples in colNames order) into the named table
+    and return the list of their returnCol values (default ID column), in the same order as the rows.
+
+    With PostgreSQL (psycopg2), use a single multi-row insert ... returning query,
+    otherwise insert one row at a time and get each generated ID value with the identityQuery
+    (or cursor lastrowid), so only the default ID column can be returned.
+    Does not commit if an external connection is provided, so the caller decides the transaction boundaries.
+    """
+    if returnCol is None:
+        returnCol = defaultIDColumn(tableName);
+    extConn = ( conn is not None );
+    if not extConn: conn = connection();
+    cursor = conn.cursor();
+    try:
+        returnValues = list();
+        if not rows:
+            return returnValues;
+        if DATABASE_CONNECTOR_NAME == "psycopg2":
+            valuesStr = _mogrifyValuesStr(cursor, colNames, rows);
+            cursor.execute("insert into %s (%s) values %s returning %s" % (tableName, str.join(",", colNames), valuesStr, returnCol) );
+            returnValues.extend([row[0] for row in cursor.fetchall()]);
+        else:
+            insertQuery = buildInsertQuery( tableName, colNames );
+            for row in rows:
+                cursor.execute(insertQuery, row);
+                returnValues.append(_lastInsertId(cursor, tableName));
+        return returnValues;
+    finally:
+        cursor.close();
+        if not extConn:
+            conn.commit();
+            conn.close();
+
+def insertOrFindRows(tableName, colNames, rows, keyCols, returnCol=None, findExisting=True, conn=None):
+    """Insert the rows (value lists/tuples in colNames order) into the named table,
+    except for any that duplicate the keyCols values of an existing row (i.e., a unique constraint, like patient_item_composite).
+    An alternative to an optimistic insert per row with an IntegrityError fallback lookup.
+
+    Returns the list of returnCol values (default ID column) for every row, in the same order,
+    whether newly inserted or already existing.  keyCols values must not be null.
+
+    With PostgreSQL (psycopg2), use a single multi-row insert ... on conflict do nothing returning query,
+    otherwise insert one row at a time, skipping duplicates (on conflict do nothing, or insert ignore for MySQL),
+    so only the default ID column can be returned for newly inserted rows.
+    Any duplicate rows are then looked up together by their keyCols values (joined against a values list with PostgreSQL).
+    If the caller does not need the values of existing rows, set findExisting to False to skip that lookup,
+    and None is returned for the duplicate rows instead.
+    Does not commit if an external connection is provided, so the caller decides the transaction boundaries.
+    """
+    if returnCol is None:
+        returnCol = defaultIDColumn(tableName);
+    extConn = ( conn is not None );
+    if not extConn: conn = connection();
+    cursor = conn.cursor();
+    try:
+        iKeyCols = [colNames.index(keyCol) for keyCol in keyCols];
+        rowKeys = [tuple([normalizeKeyValue(row[iCol]) for iCol in iKeyCols]) for row in rows];
+        returnValueByKey = dict();
+        if not rows:
+            return list();
+
+        keyColsStr = str.join(",", keyCols);
+        if DATABASE_CONNECTOR_NAME == "psycopg2":
+            # Duplicates within the same batch are also skipped, so each key is returned at most once
+            valuesStr = _mogrifyValuesStr(cursor, colNames, rows);
+            cursor.execute("insert into %s (%s) values %s on conflict (%s) do nothing returning %s, %s" % (tableName, str.join(",", colNames), valuesStr, keyColsStr, returnCol, keyColsStr) );
+            for resultRow in cursor.fetchall():
+                returnValueByKey[tuple([normalizeKeyValue(value) for value in resultRow[1:]])] = resultRow[0];
+        else:
+            insertQuery = buildInsertQuery( tableName, colNames );
+            if DATABASE_CONNECTOR_NAME in ("mysql.connector", "MySQLdb"):
+                insertQuery = insertQuery.replace("insert into","insert ignore into",1);
+            else:
+                insertQuery = "%s on conflict (%s) do nothing" % (insertQuery, keyColsStr);
+            for row, rowKey in itertools.izip(rows, rowKeys):
+                if rowKey not in returnValueByKey:
+                    cursor.execute(insertQuery, row);
+                    if cursor.rowcount > 0:
+                        returnValueByKey[rowKey] = _lastInsertId(cursor, tableName);
+
+        # Look up the existing rows that new ones were duplicates of
+        missingKeys = list(set([rowKey for rowKey in rowKeys if rowKey not in returnValueByKey]));
+        if findExisting and missingKeys:
+            # Results identified by the index of their key, in case values read back differ in type from those provided
+            resultRows = list();
+            if DATABASE_CONNECTOR_NAME == "psycopg2":
+                valuesStr = _mogrifyValuesStr(cursor, ["iKey"]+list(keyCols), [(iKey,)+rowKey for iKey, rowKey in enumerate(missingKeys)]);
+                joinClause = str.join(" and ", ["t.%s = v.%s" % (keyCol, keyCol) for keyCol in keyCols]);
+                cursor.execute("select v.iKey, t.%s from %s as t join (values %s) as v (iKey,%s) on %s" % (returnCol, tableName, valuesStr, keyColsStr, joinClause) );
+                resultRows.extend(cursor.fetchall());
+            else:
+                # Union of simple queries instead, in modest batches to stay within query parameter limits (e.g., SQLite)
+                indexedKeys = list(enumerate(missingKeys));
+                whereClause = str.join(" and ", ["%s = %s" % (keyCol, SQL_PLACEHOLDER) for keyCol in keyCols]);
+                keyQuery = "select %s, %s from %s where %s" % (SQL_PLACEHOLDER, returnCol, tableName, whereClause);
+                for iBatch in xrange(0, len(indexedKeys), 100):
+                    batchKeys = indexedKeys[iBatch:iBatch+100];
+                    params = list();
+                    for iKey, rowKey in batchKeys:
+                        params.append(iKey);
+                        params.extend(rowKey);
+                    cursor.execute( str.join(" union all ", [keyQuery]*len(batchKeys)), params );
+                    resultRows.extend(cursor.fetchall());
+            for (iKey, returnValue) in resultRows:
+                if missingKeys[iKey] not in returnValueByKey:
+                    returnValueByKey[missingKeys[iKey]] = returnValue;
+
+        return [returnValueByKey.get(rowKey) for rowKey in rowKeys];
+    finally:
+        cursor.close();
+        if not extConn:
+            conn.commit();
+            conn.close();
+
+def _mogrifyValuesStr(cursor, colNames, rows):
+    """Multi-row values list string for an insert query, with the row values quoted by the (psycopg2) cursor"""
+    valuesTemplate = "(%s)" % str.join(",", [SQL_PLACEHOLDER]*len(colNames));
+    return str.join(",", [cursor.mogrify(valuesTemplate, row) for row in rows]);
+
+def _lastInsertId(cursor, tableName):
+    """Generated ID value of the row just inserted with the cursor"""
+    query = identityQuery(tableName);
+    if query is not None:
+        cursor.execute(query);
+        return cursor.fetchone()[0];
+    return cursor.lastrowid;
+
+def normalizeKeyValue(value):
+    """Normalize a column value to use in a lookup key (e.g., a dictionary key tuple),
+    so values read back from the database match the same values from other sources.
+    Dates become datetimes (as in TIMESTAMP columns) and unicode text becomes UTF-8 encoded strings.
+    """
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day);
+    if isinstance(value, unicode):
+        return value.encode("utf-8");
+    return value;
+
 def updateRow(tableName, rowDict, idValue, idCol=None, conn=None):
     """Adapted from Jocelyne's function.  Given a dictionary object (RowItemModel)
     representing a row of a database table, and identified by the key value(s),
@@ -1058,6 +1754,7 @@ def main(argv):
     parser.add_option("-o", "--output",     dest="output",      metavar="<outputFile>", help="If inserting a file with the -i option and want to get generated ID numbers from the inserted rows, specify this file to send them to.")
     parser.add_option("-e", "--skipErrors", dest="skipErrors",  action="store_true",    help="If inserting or updating a file or running a script with the -s option, keep running the remainder of the inserts or script commands even if one causes an exception.")
     parser.add_option("-f", "--dateColFormats", dest="dateColFormats",  metavar="<dateColFormats>",    help="If inserting a file, can specify columns that should be interpreted as date strings to be parsed into datetime objects.  Provide comma-separated list, and optional | separated Python date parsing format (e.g., 'MyDateTime1|%m/%d/%Y %H:%M:%S,MyDateTime2').  http://docs.python.org/library/datetime.html#strftime-strptime-behavior.")
+    parser.add_option("-b", "--rowsPerBatch", dest="rowsPerBatch", type="int", help="If inserting or updating a file, number of rows to bulk load at a time.  Default %d." % BULK_ROWS_PER_BATCH);
     parser.add_option("-x", "--escapeStrings", dest="escapeStrings",  action="store_true",    help="If inserting a file, can set whether to run all input strings through escape filter to avoid special characters compromising inserts.")
     (options, args) = parser.parse_args(argv[1:])
 
@@ -1092,12 +1789,12 @@ def main(argv):
             lineCountFile = stdOpen(options.input);
             estInput = fileLineCount(lineCountFile);
 
-        nInserts = insertFile( inputFile, options.table, args, options.delim, outputFile, options.skipErrors, dateColFormats=dateColFormats, escapeStrings=options.escapeStrings, estInput=estInput );
+        nInserts = insertFile( inputFile, options.table, args, options.delim, outputFile, options.skipErrors, dateColFormats=dateColFormats, escapeStrings=options.escapeStrings, estInput=estInput, rowsPerBatch=options.rowsPerBatch );
         log.info("%d rows successfully inserted",nInserts)
     elif options.update is not None and options.table is not None:
         sourceFile  = stdOpen(options.update,"r",sys.stdin);
         nIdCols = int(options.nIdCols);
-        nUpdates = updateFromFile( sourceFile, options.table, args, nIdCols, options.delim, options.skipErrors );
+        nUpdates = updateFromFile( sourceFile, options.table, args, nIdCols, options.delim, options.skipErrors, rowsPerBatch=options.rowsPerBatch );
         log.info("%d row updates completed",nUpdates);
     elif len(args) > 0:
         outFile = "-"   # Default to stdout if no outputFile specified
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""Bulk alternatives to resolving and inserting database rows one at a time,
+as data conversion processes otherwise do for every source record
+(e.g., DBUtil.findOrInsertItem for each clinical_item, then an insert and identityQuery for each patient_item).
+"""
+import sys;
+import itertools;
+from Model import SQLQuery;
+import DBUtil;
+from DBUtil import BULK_ROWS_PER_BATCH, normalizeKeyValue;
+from Util import log;
+
+class DimensionCache:
+    """In-memory cache of the ID values of dimension table rows (e.g., clinical_item_category, clinical_item, item_collection),
+    keyed by the search column values used to find them, so lookups do not need a database query each.
+
+    The first lookup for a table (and set of search columns) preloads the whole table into a hash map with a single query.
+    Lookups that miss are checked against the database (in case the values are stored differently than provided),
+    and any still not found are inserted in batches, rowsPerBatch at a time (see DBUtil.insertRowsReturning).
+    Intended for relatively small dimension tables, not large fact tables like patient_item (see InsertBuffer).
+    """
+    def __init__(self, rowsPerBatch=BULK_ROWS_PER_BATCH):
+        """Default constructor"""
+        self.rowsPerBatch = rowsPerBatch;
+        self.idByKeyByTableCols = dict();   # Hash maps of ID values by search value tuple, keyed by (tableName, colNames, retrieveCol)
+
+    def findOrInsertItem(self, tableName, searchDict, retrieveCol=None, conn=None):
+        """Drop-in alternative to DBUtil.findOrInsertItem, returning a tuple (col, isNew)
+        where col is the value of the retrieveCol (default ID column) of the row matching the searchDict,
+        which is inserted (and committed) if it does not exist yet.
+        """
+        return self.findOrInsertItems(tableName, [searchDict], retrieveCol, conn=conn)[0];
+
+    def findOrInsertItems(self, tableName, searchDicts, retrieveCol=None, conn=None):
+        """Batch version of findOrInsertItem, returning a list of (col, isNew) tuples for each of the searchDicts.
+        All rows not found are inserted and committed, rowsPerBatch at a time.
+        With databases other than PostgreSQL, only the default ID column can be retrieved for newly inserted rows.
+        """
+        if retrieveCol is None:
+            retrieveCol = DBUtil.defaultIDColumn(tableName);
+        extConn = conn is not None;
+        if not extConn:
+            conn = DBUtil.connection();
+        try:
+            results = [None]*len(searchDicts);
+            missIndexesByKeyByCols = dict();    # Indexes of the searchDicts not found in the cache yet
+            for iSearch, searchDict in enumerate(searchDicts):
+                colNames = tuple(sorted(searchDict.keys()));
+                idByKey = self.loadTable(tableName, colNames, retrieveCol, conn=conn);
+                key = searchKey(searchDict, colNames);
+                if key in idByKey:
+                    results[iSearch] = (idByKey[key], False);
+                else:
+                    if colNames not in missIndexesByKeyByCols:
+                        missIndexesByKeyByCols[colNames] = dict();
+                    missIndexesByKeyByCols[colNames].setdefault(key, list()).append(iSearch);
+
+            for colNames, missIndexesByKey in missIndexesByKeyByCols.iteritems():
+                idByKey = self.idByKeyByTableCols[(tableName, colNames, retrieveCol)];
+                insertKeys = list();
+                for key, missIndexes in missIndexesByKey.iteritems():
+                    itemId = self.findItemId(tableName, searchDicts[missIndexes[0]], retrieveCol, conn=conn);
+                    if itemId is not None:
+                        idByKey[key] = itemId;
+                    else:
+                        insertKeys.append(key);
+
+                for iBatch in xrange(0, len(insertKeys), self.rowsPerBatch):
+                    batchKeys = insertKeys[iBatch:iBatch+self.rowsPerBatch];
+                    batchRows = [[searchDicts[missIndexesByKey[key][0]][col] for col in colNames] for key in batchKeys];
+                    itemIds = DBUtil.insertRowsReturning(tableName, colNames, batchRows, retrieveCol, conn=conn);
+                    conn.commit();
+                    for key, itemId in itertools.izip(batchKeys, itemIds):
+                        idByKey[key] = itemId;
+                        results[missIndexesByKey[key][0]] = (itemId, True);
+                if insertKeys:
+                    log.debug("Inserted %d new %s rows" % (len(insertKeys), tableName) );
+
+                for key, missIndexes in missIndexesByKey.iteritems():
+                    for iSearch in missIndexes:
+                        if results[iSearch] is None:    # Found in the database or a duplicate of one just inserted
+                            results[iSearch] = (idByKey[key], False);
+            return results;
+        finally:
+            if not extConn:
+                conn.close();
+
+    def loadTable(self, tableName, colNames, retrieveCol, conn=None):
+        """Hash map of the retrieveCol values of the rows in the table, keyed by the tuple of their colNames values,
+        loaded from the database with a single query the first time it is needed.
+        Where several rows have the same values, keep the first (lowest retrieveCol value).
+        """
+        cacheKey = (tableName, colNames, retrieveCol);
+        if cacheKey not in self.idByKeyByTableCols:
+            query = SQLQuery();
+            query.addSelect(retrieveCol);
+            for colName in colNames:
+                query.addSelect(colName);
+            query.addFrom(tableName);
+            query.addOrderBy(retrieveCol);
+
+            idByKey = dict();
+            for row in DBUtil.iterate(query, conn=conn):
+                key = tuple([normalizeKeyValue(value) for value in row[1:]]);
+                if key not in idByKey:
+                    idByKey[key] = row[0];
+            log.debug("Loaded %d %s rows" % (len(idByKey), tableName) );
+            self.idByKeyByTableCols[cacheKey] = idByKey;
+        return self.idByKeyByTableCols[cacheKey];
+
+    def findItemId(self, tableName, searchDict, retrieveCol, conn):
+        """Look up the retrieveCol value of a row matching the searchDict in the database, or None if there is none"""
+        query = SQLQuery();
+        query.addSelect(retrieveCol);
+        query.addFrom(tableName);
+        for col, value in searchDict.iteritems():
+            if value is not None:
+                query.addWhereEqual(col, value);
+            else:
+                query.addWhereOp(col,"is",value);   # Equals operator doesn't work for null values
+        query.addOrderBy(retrieveCol);
+        query.setLimit(1);
+        results = DBUtil.execute(query, conn=conn);
+        if results:
+            return results[0][0];
+        return None;
+
+    def clear(self):
+        """Discard all cached values, so they are reloaded from the database on next use"""
+        self.idByKeyByTableCols.clear();
+
+def searchKey(searchDict, colNames):
+    """Hash key tuple of the searchDict values of the colNames"""
+    return tuple([normalizeKeyValue(searchDict[colName]) for colName in colNames]);
+
+class InsertBuffer:
+    """Buffer rows to insert into a table and bulk insert them rowsPerBatch at a time,
+    instead of one insert query (and identityQuery) per row.
+
+    If keyCols are specified (a unique constraint, like patient_item_composite on patient_item),
+    rows that duplicate an existing row are skipped (see DBUtil.insertOrFindRows)
+    rather than relying on an optimistic insert and IntegrityError fallback for each row,
+    and the row models are filled in with their idCol values (whether newly inserted or existing).
+    If nothing needs those idCol values, set findIds to False to skip looking up the existing rows.
+    Callbacks added with a row are called with the row model once it is inserted
+    (e.g., to add dependent link rows to another buffer).
+
+    Each flush is committed.  If a batch fails, the error is raised, unless skipErrors is set,
+    in which case the batch is rolled back and bisected to find and skip just the bad rows,
+    as with the skipErrors option of DBUtil.insertFile.  Callbacks are not called for skipped rows.
+    Make sure to flush when done adding rows, so the last partial batch is not left behind.
+    """
+    def __init__(self, tableName, keyCols=None, idCol=None, findIds=True, skipErrors=False, rowsPerBatch=BULK_ROWS_PER_BATCH):
+        """Default constructor"""
+        self.tableName = tableName;
+        self.keyCols = keyCols;
+        self.idCol = idCol;
+        if self.idCol is None:
+            self.idCol = DBUtil.defaultIDColumn(tableName);
+        self.findIds = findIds;
+        self.skipErrors = skipErrors;
+        self.rowsPerBatch = rowsPerBatch;
+        self.colNames = None;   # Columns to insert, taken from the first row added
+        self.rowCallbacks = list();  # (rowModel, callback) pairs not yet inserted
+
+    def add(self, rowModel, callback=None, conn=None):
+        """Add a row model (dictionary of column values) to insert, flushing the buffer if it is full.
+        All rows are expected to have the same columns.
+        """
+        if self.colNames is None:
+            self.colNames = rowModel.keys();
+        self.rowCallbacks.append( (rowModel, callback) );
+        if len(self.rowCallbacks) >= self.rowsPerBatch:
+            self.flush(conn=conn);
+
+    def flush(self, conn=None):
+        """Insert and commit all of the buffered rows, then call their callbacks.
+        Returns the number of rows successfully inserted (or found already existing).
+        """
+        if not self.rowCallbacks:
+            return 0;
+        extConn = conn is not None;
+        if not extConn:
+            conn = DBUtil.connection();
+        try:
+            rowCallbacks = self.rowCallbacks;
+            self.rowCallbacks = list(); # Reset first, in case callbacks add more rows
+            if self.skipErrors:
+                conn.commit();  # So rolling back a failed batch will not discard any prior work
+
+            insertedCallbacks = list(); # Callbacks of the rows successfully inserted
+            def insertBatch(batch):
+                rows = [[rowModel[colName] for colName in self.colNames] for (rowModel, callback) in batch];
+                if self.keyCols is None:
+                    DBUtil.insertRows(self.tableName, self.colNames, rows, conn=conn);
+                else:
+                    rowIds = DBUtil.insertOrFindRows(self.tableName, self.colNames, rows, self.keyCols, self.idCol, self.findIds, conn=conn);
+                    if self.findIds:
+                        for (rowModel, callback), rowId in itertools.izip(batch, rowIds):
+                            rowModel[self.idCol] = rowId;
+                insertedCallbacks.extend(batch);
+
+            nRows = DBUtil.bulkApplyBatch(conn, insertBatch, rowCallbacks, self.skipErrors);
+            conn.commit();
+
+            for rowModel, callback in insertedCallbacks:
+                if callback is not None:
+                    callback(rowModel);
+            return nRows;
+        finally:
+            if not extConn:
+                conn.close();
@@ -66,6 +66,21 @@ TEST_DB_PARAM = LocalEnv.LOCAL_TEST_DB_PARAM
 #TEST_DB_PARAM["DSN"] = "/Users/angelicaperez/Documents/JonChen/sqlite_db/dave_chan2.sqlite"
 
 
+"""Connection pooling options (see DBUtil.ConnectionPool).
+If enabled (e.g., DB_POOL_ENABLED = True in LocalEnv.py for long running web or recommender processes),
+DBUtil.connection() checks out connections from a pool kept for each set of connection parameters,
+and closing them returns them to the pool, so existing call sites reuse open connections.
+Pools keep up to the max number of connections open (waiting up to the checkout timeout for one to be returned),
+and trim idle ones down to the min number after the max idle time.
+Connections idle for longer than the health check interval are tested with a trivial query before reuse, and replaced if broken.
+"""
+DB_POOL_ENABLED = getattr(LocalEnv, "DB_POOL_ENABLED", False);
+DB_POOL_MIN_CONNECTIONS = 1;
+DB_POOL_MAX_CONNECTIONS = 10;
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = 60;
+DB_POOL_HEALTH_CHECK_SECONDS = 60;
+DB_POOL_MAX_IDLE_SECONDS = 600;
+
 """Parameters on whether to do additional pre-processing when parsing text / CSV files.
 Seems necessary for STRIDE 2008-2014-2017 Order Proc dumps?
 """
@@ -190,6 +190,7 @@ class SQLQuery:
         """Allow specification of specific SQL_PLACEHOLDER character. (Different modules use ? vs. %s, etc.)
         """
         self.prefix = None;
+        self.distinct = False;  # If set, select only distinct rows
         self.delete = False;    # If set, will ignore the select list and make a delete query instead
         self.select = [];
         self.into   = None;
@@ -206,6 +207,9 @@ class SQLQuery:
     def setPrefix(self,aPrefix):
         self.prefix = aPrefix;
 
+    def setDistinct(self,aDistinct=True):
+        self.distinct = aDistinct;
+
     def addSelect(self,aSelect):
         self.select.append(aSelect);
 
@@ -293,6 +297,8 @@ class SQLQuery:
             query.append("DELETE");
         else:
             query.append("SELECT");
+            if self.distinct:
+                query.append("DISTINCT");
             for item in self.select:
                 query.append(item);
                 query.append(",");
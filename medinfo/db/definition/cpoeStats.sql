@@ -303,3 +303,4 @@ ALTER TABLE patient_item_collection_link ADD CONSTRAINT patient_item_collection_
 CREATE INDEX patient_item_collection_link_patient_item_id ON patient_item_collection_link(patient_item_id);
 ALTER TABLE patient_item_collection_link ADD CONSTRAINT patient_item_collection_link_item_fkey FOREIGN KEY (item_collection_item_id) REFERENCES item_collection_item(item_collection_item_id);
 CREATE INDEX patient_item_collection_link_item_collection_item_id ON patient_item_collection_link(item_collection_item_id);
+ALTER TABLE patient_item_collection_link ADD CONSTRAINT patient_item_collection_link_composite UNIQUE (patient_item_id, item_collection_item_id);
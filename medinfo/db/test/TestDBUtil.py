@@ -14,6 +14,7 @@ from Util import DBTestCase;
 
 from medinfo.common.test.Util import MedInfoTestCase;
 
+import medinfo.db.Env;
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery;
 from medinfo.db.DBUtil import NUMBER, BOOLEAN, STRING, DATETIME;
@@ -320,6 +321,41 @@ class TestDBUtil(DBTestCase):
         results = DBUtil.execute("select count(*) from TestTypes where MyText like %s",("%Test",))
         self.assertEqual( 1, results[0][0] )
 
+    def test_insertFile_batches(self):
+        # Bulk load in small batches, with bad rows scattered through them,
+        #   verify each batch is isolated, so only the bad rows are skipped
+        DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
+
+        dataFile = StringIO()
+        dataFile.write("MyInteger\tMyText\n");
+        for i in xrange(1,11):
+            if i in (2,7,8):
+                dataFile.write("Bad%d\tBadTest\n" % i);
+            else:
+                dataFile.write("%d\tBatchTest\n" % i);
+        dataFile = StringIO(dataFile.getvalue())
+
+        idFile = StringIO()
+        nInserts = DBUtil.insertFile( dataFile, "TestTypes", None, "\t", idFile, skipErrors=True, rowsPerBatch=3 );
+        self.assertEqual( 7, nInserts );
+
+        results = DBUtil.execute("select TestTypes_id, MyInteger from TestTypes where MyText = %s order by MyInteger",("BatchTest",));
+        self.assertEqual( [1,3,4,5,6,9,10], [row[1] for row in results] );
+        self.assertEqual( sorted([row[0] for row in results]), sorted([int(rowId) for rowId in idFile.getvalue().split()]) );
+
+        # Batch updates, with a bad row, and a repeated row where the last update should win
+        dataFile = StringIO()
+        dataFile.write("1\tOne\n");
+        dataFile.write("3\tThree\n");
+        dataFile.write("Bad4\tFour\n");
+        dataFile.write("1\tUno\n");
+        dataFile = StringIO(dataFile.getvalue())
+        nUpdates = DBUtil.updateFromFile( dataFile, "TestTypes", ["MyInteger","MyText"], delim="\t", skipErrors=True, rowsPerBatch=3 );
+        self.assertEqual( 3, nUpdates );
+
+        results = DBUtil.execute("select MyInteger, MyText from TestTypes where MyInteger in (1,3,4) order by MyInteger");
+        self.assertEqual( [[1,"Uno"],[3,"Three"],[4,"BatchTest"]], results );
+
     def test_insertFile_dateParsing(self):
         # Create a test data file to insert, and verify no errors
         DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
@@ -508,6 +544,22 @@ class TestDBUtil(DBTestCase):
         results = DBUtil.execute( self.DATA_QUERY );
         self.assertEqual( self.DATA_ROWS, results );
 
+    def test_updateFromFile_repeatColumn(self):
+        # Same column used as the key to look up rows by and as a value to update (rename text values), across multiple batches
+        DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
+
+        dataFile = StringIO();
+        dataFile.write("Sample Text\t1230\tNew Sample\n");
+        dataFile.write("Joe Mama\t2340\tNew Joe\n");
+        dataFile.write("Mo Fo\t3450\tNone\n");
+        dataFile = StringIO(dataFile.getvalue());
+
+        nUpdates = DBUtil.updateFromFile( dataFile, self.DATA_TABLE, ["MyText","MyInteger","MyText"], delim="\t", rowsPerBatch=2 );
+        self.assertEqual( 3, nUpdates );
+
+        results = DBUtil.execute("select MyInteger, MyText from TestTypes order by MyInteger");
+        self.assertEqual( [[1230,"New Sample"],[2340,"New Joe"],[3450,None]], results );
+
 
     def test_updateFromFile_commandline(self):
         # Similar to test_updateFromFile, but from higher-level command-line interface
@@ -615,6 +667,129 @@ class TestDBUtil(DBTestCase):
         DBUtil.deleteRows("TestTypes", nonDefaultIds, "MyInteger");
         afterCount = DBUtil.execute( query )[0][0];
 
+    def test_insertRows(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False );
+
+        # Bulk insert from a generator, with small batches to verify rows spanning multiple batches are all loaded,
+        #   including null values and special characters that need escaping for COPY
+        columnNames = ["MyInteger","MyReal","MyText"];
+        dataRows = \
+            [   [100, 100.25, "ATest"],
+                [200, None, "Tab\tand\\backslash"],
+                [300, 3.0000000001, None],
+            ];
+        nRows = DBUtil.insertRows("TestTypes", columnNames, (row for row in dataRows), rowsPerBatch=2 );
+        self.assertEqual( 3, nRows );
+
+        results = DBUtil.execute("select MyInteger, MyReal, MyText from TestTypes where MyInteger in (100,200,300) order by MyInteger");
+        self.assertEqualTable( dataRows, results, precision=3 );
+
+    def test_iterate(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False );
+
+        query = "select MyText as my_text, MyInteger as my_integer, MyInteger+1 from TestTypes order by MyInteger";
+        expectedRows = DBUtil.execute(query);
+        self.assertEqual( 3, len(expectedRows) );
+
+        # Stream in batches smaller than the result set
+        batches = list(DBUtil.executeStream(query, fetchSize=2));
+        self.assertEqual( [2,1], [len(batch) for batch in batches] );
+
+        rows = [list(row) for row in DBUtil.iterate(query, fetchSize=2)];
+        self.assertEqual( expectedRows, rows );
+
+        # Named tuples, with invalid identifier column names renamed by position
+        rows = list(DBUtil.iterate(query, rowFormat="namedtuple", fetchSize=2));
+        self.assertEqual( [row[0] for row in expectedRows], [row.my_text for row in rows] );
+        self.assertEqual( [row[1] for row in expectedRows], [row.my_integer for row in rows] );
+        self.assertEqual( [row[2] for row in expectedRows], [row._2 for row in rows] );
+
+        # Row models, with alternative column labels
+        rows = list(DBUtil.iterate(query, rowFormat="model", columnNames=["text","integer","nextInteger"], fetchSize=2));
+        self.assertEqual( [row[2] for row in expectedRows], [row["nextInteger"] for row in rows] );
+
+        # Column arrays by batch
+        batches = list(DBUtil.executeStream(query, rowFormat="columns", fetchSize=2));
+        self.assertEqual( [123,234], batches[0]["my_integer"].tolist() );
+        self.assertEqual( [345], batches[1]["my_integer"].tolist() );
+        self.assertEqual( ["Mo Fo"], batches[1]["my_text"].tolist() );
+
+        # Stop iterating early with an external connection, which should remain usable
+        conn = DBUtil.connection();
+        try:
+            rows = DBUtil.iterate(query, fetchSize=1, conn=conn);
+            self.assertEqual( expectedRows[0], list(rows.next()) );
+            rows.close();
+            self.assertEqual( expectedRows, DBUtil.execute(query, conn=conn) );
+        finally:
+            conn.close();
+
+        self.assertRaises( ValueError, DBUtil.executeStream, query, rowFormat="dictionary" );
+        self.assertRaises( ValueError, DBUtil.iterate, query, rowFormat="columns" );
+
+    def test_connectionPool(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False );
+
+        pool = DBUtil.ConnectionPool( medinfo.db.Env.DB_PARAM, minConnections=1, maxConnections=2, checkoutTimeout=0.1, healthCheckSeconds=0 );
+        try:
+            conn1 = pool.checkout();
+            rawConn1 = conn1.rawConnection();
+            conn2 = pool.checkout();
+            self.assertRaises( DBUtil.ConnectionPoolTimeout, pool.checkout );  # Max connections all checked out
+
+            # Closing returns the connection to the pool for reuse
+            conn1.close();
+            conn3 = pool.checkout();
+            self.assertTrue( conn3.rawConnection() is rawConn1 );
+            self.assertRaises( DBUtil.DB_CONNECTOR_MODULE.InterfaceError, getattr, conn1, "cursor" );
+            conn2.close();
+            conn3.close();
+
+            # Context manager commits before returning the connection, otherwise uncommitted changes are rolled back
+            with pool.checkout() as conn:
+                DBUtil.execute("insert into TestTypes (MyText,MyInteger) values ('Pooled',456)", conn=conn, autoCommit=False);
+            conn = pool.checkout();
+            DBUtil.execute("insert into TestTypes (MyText,MyInteger) values ('Uncommitted',567)", conn=conn, autoCommit=False);
+            conn.close();
+            results = DBUtil.execute("select MyText, MyInteger from TestTypes where MyInteger in (456,567)");
+            self.assertEqualTable( [["Pooled",456]], results );
+
+            # Broken idle connections are replaced after failing health checks
+            (rawConn, lastUsedTime) = pool.idleConnections[-1];
+            rawConn.close();
+            conn = pool.checkout();
+            self.assertEqual( [[1]], DBUtil.execute(DBUtil.healthCheckQuery(), conn=conn) );
+            conn.close();
+
+            stats = pool.stats();
+            self.assertEqual( 2, stats["open"] );
+            self.assertEqual( 1, stats["timeouts"] );
+            self.assertEqual( 1, stats["replaced"] );
+            self.assertEqual( 3, stats["opened"] );
+        finally:
+            pool.close();
+
+    def test_connectionPooling(self):
+        # Default connections are transparently pooled when enabled
+        DBUtil.enableConnectionPooling();
+        try:
+            conn = DBUtil.connection();
+            rawConn = conn.rawConnection();
+            conn.close();
+            self.assertEqual( [[1]], DBUtil.execute(DBUtil.healthCheckQuery()) );
+            conn = DBUtil.ConnectionFactory().connection();
+            self.assertTrue( conn.rawConnection() is rawConn );
+            conn.close();
+            self.assertEqual( 1, DBUtil.connectionPool().stats()["open"] );
+
+            # Unless explicitly unpooled
+            conn = DBUtil.ConnectionFactory(pooled=False).connection();
+            self.assertFalse( isinstance(conn, DBUtil.PooledConnection) );
+            conn.close();
+        finally:
+            DBUtil.enableConnectionPooling(False);
+            DBUtil.closeConnectionPools();
+
 
 def suite():
     """Returns the suite of tests to run for this test class / module.
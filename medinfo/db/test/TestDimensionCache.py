@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Test case for respective module in medinfo.db package"""
+
+import sys, os
+from cStringIO import StringIO
+import unittest
+
+from datetime import datetime;
+
+from Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
+from Util import log;
+
+from Util import DBTestCase;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import RowItemModel;
+from medinfo.db.DimensionCache import DimensionCache, InsertBuffer;
+
+class TestDimensionCache(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        scriptFile = StringIO()
+        scriptFile.write("create table TestCategory\n")
+        scriptFile.write("(\n")
+        scriptFile.write("    TestCategory_id serial,\n")
+        scriptFile.write("    MyText          varchar(50)\n")
+        scriptFile.write(");\n")
+        scriptFile.write("ALTER TABLE TestCategory ADD CONSTRAINT TestCategory_id PRIMARY KEY (TestCategory_id);\n");
+        scriptFile.write("insert into TestCategory (MyText) values ('Labs');\n")
+        scriptFile.write("insert into TestCategory (MyText) values ('Meds');\n")
+        scriptFile.write("\n")
+        scriptFile.write("create table TestItem\n")
+        scriptFile.write("(\n")
+        scriptFile.write("    TestItem_id     serial,\n")
+        scriptFile.write("    TestCategory_id integer,\n")
+        scriptFile.write("    MyText          varchar(50) not null,\n")
+        scriptFile.write("    MyDateTime      TIMESTAMP\n")
+        scriptFile.write(");\n")
+        scriptFile.write("ALTER TABLE TestItem ADD CONSTRAINT TestItem_id PRIMARY KEY (TestItem_id);\n");
+        scriptFile.write("ALTER TABLE TestItem ADD CONSTRAINT TestItem_composite UNIQUE (TestCategory_id, MyDateTime);\n");
+        scriptFile.write("insert into TestItem (TestCategory_id,MyText,MyDateTime) values (1,'Existing','2000-01-01 00:00:00');\n")
+        scriptFile = StringIO(scriptFile.getvalue())
+        DBUtil.runDBScript( scriptFile, False );
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        for tableName in ("TestItem","TestCategory"):
+            try:
+                DBUtil.execute("drop table %s" % tableName);
+            except Exception, err:
+                log.warning(err)
+
+        DBTestCase.tearDown(self);
+
+    def test_findOrInsertItems(self):
+        existingIdByText = dict(DBUtil.execute("select MyText, TestCategory_id from TestCategory"));
+
+        # Mix of existing and new items, including repeats, inserted in small batches
+        cache = DimensionCache(rowsPerBatch=2);
+        searchTexts = ["Labs","New1","Meds","New2","New1","New3"];
+        results = cache.findOrInsertItems("TestCategory", [{"MyText": text} for text in searchTexts]);
+        self.assertEqual( [False, True, False, True, False, True], [isNew for (itemId, isNew) in results] );
+
+        idByText = dict(DBUtil.execute("select MyText, TestCategory_id from TestCategory"));
+        self.assertEqual( 5, len(idByText) );
+        self.assertEqual( [idByText[text] for text in searchTexts], [itemId for (itemId, isNew) in results] );
+        self.assertEqual( existingIdByText["Labs"], results[0][0] );
+
+        # Same results one at a time, now from the cache, without inserting anything more
+        for text in searchTexts:
+            self.assertEqual( (idByText[text], False), cache.findOrInsertItem("TestCategory", {"MyText": text}) );
+        self.assertEqual( 5, DBUtil.execute("select count(*) from TestCategory")[0][0] );
+
+        # Items missing from the cache, but inserted by others since it was loaded, should still be found
+        DBUtil.execute("insert into TestCategory (MyText) values ('Other')");
+        otherId = DBUtil.execute("select TestCategory_id from TestCategory where MyText = 'Other'")[0][0];
+        self.assertEqual( (otherId, False), cache.findOrInsertItem("TestCategory", {"MyText": "Other"}) );
+        self.assertEqual( 6, DBUtil.execute("select count(*) from TestCategory")[0][0] );
+
+    def test_insertBuffer(self):
+        existingId = DBUtil.execute("select TestItem_id from TestItem where MyText = 'Existing'")[0][0];
+        headers = ["TestCategory_id","MyText","MyDateTime"];
+        rowModels = \
+            [   RowItemModel( [1, "Duplicate", datetime(2000,1,1)], headers ),  # Duplicate key of the existing item
+                RowItemModel( [1, "NewA", datetime(2000,1,2)], headers ),
+                RowItemModel( [2, "NewB", datetime(2000,1,1)], headers ),
+                RowItemModel( [2, "NewC", datetime(2000,1,3)], headers ),
+                RowItemModel( [2, None, datetime(2000,1,4)], headers ),    # Bad row, missing required value
+                RowItemModel( [2, "NewCRepeat", datetime(2000,1,3)], headers ), # Duplicate key of a new item
+            ];
+
+        # Bad rows raise errors by default
+        buffer = InsertBuffer("TestItem", ["TestCategory_id","MyDateTime"]);
+        buffer.add( rowModels[4] );
+        self.assertRaises( Exception, buffer.flush );
+
+        # Or skip just the bad rows if requested
+        insertedTexts = list();
+        buffer = InsertBuffer("TestItem", ["TestCategory_id","MyDateTime"], skipErrors=True, rowsPerBatch=4);
+        for rowModel in rowModels:
+            buffer.add( rowModel, lambda rowModel: insertedTexts.append(rowModel["MyText"]) );
+        self.assertEqual( 4, len(insertedTexts) );  # First batch flushed when full
+        buffer.flush();
+        self.assertEqual( ["Duplicate","NewA","NewB","NewC","NewCRepeat"], insertedTexts );  # Callbacks not called for the skipped bad row
+
+        idByText = dict(DBUtil.execute("select MyText, TestItem_id from TestItem"));
+        self.assertEqual( ["Existing","NewA","NewB","NewC"], sorted(idByText.keys()) );
+        self.assertEqual( existingId, rowModels[0]["TestItem_id"] );
+        self.assertEqual( idByText["NewA"], rowModels[1]["TestItem_id"] );
+        self.assertEqual( idByText["NewC"], rowModels[3]["TestItem_id"] );
+        self.assertEqual( idByText["NewC"], rowModels[5]["TestItem_id"] );
+        self.assertFalse( "TestItem_id" in rowModels[4] );
+
+        # Existing rows not looked up if their IDs are not needed
+        rowModel = RowItemModel( [1, "DuplicateAgain", datetime(2000,1,1)], headers );
+        buffer = InsertBuffer("TestItem", ["TestCategory_id","MyDateTime"], findIds=False);
+        buffer.add( rowModel );
+        self.assertEqual( 1, buffer.flush() );
+        self.assertFalse( "TestItem_id" in rowModel );
+        self.assertEqual( 4, DBUtil.execute("select count(*) from TestItem")[0][0] );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestDimensionCache));
+    return suite;
+
+if __name__=="__main__":
+    log.setLevel(LOGGER_LEVEL)
+
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
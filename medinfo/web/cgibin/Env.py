@@ -45,3 +45,6 @@ CGI_TEXT_RESPONSE = False;
 # Whether to use a local memory data cache to reduce DB hits for web queries.  If left unchecked, this will result
 #   in excessive memory use / leak by the webserver
 USE_DATA_CACHE = True;
+
+# Estimated memory cap (bytes) for the local memory data cache, evicting least recently used data beyond that
+DATA_CACHE_MAX_BYTES = 2*1024*1024*1024;
@@ -6,6 +6,9 @@ import Const
 import sys, os
 import logging
 
+from medinfo.cpoe.DataCache import DataCache;
+from medinfo.cpoe.RecommendationCache import RecommendationCache;
+
 log = logging.getLogger("CDSS")
 log.setLevel(Const.LOGGER_LEVEL)
 
@@ -18,4 +21,9 @@ log.addHandler(handler)
 """Persistent cache object to store query results in local memory for reuse later"""
 webDataCache = None;
 if Env.USE_DATA_CACHE:
-    webDataCache = dict();
+    webDataCache = DataCache(maxBytes=Env.DATA_CACHE_MAX_BYTES);
+
+"""Persistent cache of recommender results to reuse for repeat queries"""
+webResultCache = None;
+if Env.USE_DATA_CACHE:
+    webResultCache = RecommendationCache();
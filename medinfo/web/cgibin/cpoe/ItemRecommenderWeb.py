@@ -16,6 +16,7 @@ from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS;
 from medinfo.web.cgibin.cpoe.BaseCPOEWeb import BaseCPOEWeb
 
 from medinfo.web.cgibin import Options;
+from medinfo.web.cgibin.Util import webResultCache;
 
 class ItemRecommenderWeb(BaseCPOEWeb):
     def __init__(self):
@@ -195,6 +196,9 @@ class ItemRecommenderWeb(BaseCPOEWeb):
             self.requestData["resultsInfo"] = "(%d rows) " % len(results)
         else:
             self.requestData["resultsText"] = "%d rows affected (or other return code)" % results
+            if webResultCache is not None:
+                # May have modified association statistics, so don't keep serving recommendations based on the old ones
+                webResultCache.invalidate();
         timer = time.time() - timer
         self.requestData["resultsInfo"] += "(%1.3f seconds)" % timer
 
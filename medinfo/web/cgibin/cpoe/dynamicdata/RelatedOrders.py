@@ -22,7 +22,7 @@ from medinfo.cpoe.SimManager import SimManager, ClinicalItemQuery;
 
 from medinfo.web.cgibin.cpoe.dynamicdata.BaseDynamicData import BaseDynamicData;
 from medinfo.web.cgibin import Options;
-from medinfo.web.cgibin.Util import webDataCache;
+from medinfo.web.cgibin.Util import webDataCache, webResultCache;
 
 CONTROLS_TEMPLATE = \
     """
@@ -106,6 +106,7 @@ class RelatedOrders(BaseDynamicData):
         """Look for related orders by association / recommender methods"""
         self.recommender = ItemAssociationRecommender();  # Instance to test on
         self.recommender.dataManager.dataCache = webDataCache;
+        self.recommender.resultCache = webResultCache;
 
         query = RecommenderQuery();
         if self.requestData["sortField"] == "":
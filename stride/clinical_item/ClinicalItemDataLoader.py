@@ -42,7 +42,8 @@ class ClinicalItemDataLoader:
         'clinical_item_link',
         'backup_link_patient_item',
         'data_cache',
-        'clinical_item_association'
+        'clinical_item_association',
+        'conversion_checkpoint'
     ]
 
     STRIDE_TABLE_TRANSFORMER_MAP = {
@@ -0,0 +1,12 @@
+-- Table: conversion_checkpoint
+-- Description: Chunks of source data (by date range and patient shard) completed by a
+--              parallel data conversion (ConversionRunner), so an interrupted run can resume.
+
+CREATE TABLE IF NOT EXISTS conversion_checkpoint
+(
+	conversion_name	VARCHAR(255)	NOT NULL,
+	chunk_key	VARCHAR(255)	NOT NULL,
+	source_item_count	BIGINT,
+	completed_date	TIMESTAMP	NOT NULL,
+  CONSTRAINT conversion_checkpoint_pkey PRIMARY KEY (conversion_name, chunk_key)
+);
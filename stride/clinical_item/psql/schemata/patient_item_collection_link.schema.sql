@@ -9,5 +9,6 @@ CREATE TABLE IF NOT EXISTS patient_item_collection_link
 	item_collection_item_id BIGINT NOT NULL,
   CONSTRAINT patient_item_collection_link_pkey PRIMARY KEY (patient_item_collection_link_id),
   CONSTRAINT patient_item_collection_link_patient_fkey FOREIGN KEY (patient_item_id) REFERENCES patient_item(patient_item_id),
-  CONSTRAINT patient_item_collection_link_item_fkey FOREIGN KEY (item_collection_item_id) REFERENCES item_collection_item(item_collection_item_id)
+  CONSTRAINT patient_item_collection_link_item_fkey FOREIGN KEY (item_collection_item_id) REFERENCES item_collection_item(item_collection_item_id),
+  CONSTRAINT patient_item_collection_link_composite UNIQUE (patient_item_id, item_collection_item_id)
 );